@@ -18,20 +18,27 @@ import platform
 import ipaddress
 import socket
 import hashlib
+import hmac
+import shlex
 import threading
 import http.server
+import concurrent.futures
+import contextlib
+import enum
+import signal
 from urllib.parse import urlparse
 import zipfile
 from collections import deque
-from typing import Optional, Any, Dict, Iterable, Mapping, Protocol, TypeAlias, TypedDict
+import heapq
+from typing import Optional, Any, AsyncIterator, Awaitable, Callable, Coroutine, Dict, Iterable, Mapping, Protocol, TypeAlias, TypedDict
 from io import BytesIO
 from dotenv import load_dotenv
 from zoneinfo import ZoneInfo
 import httpx
 import paramiko
 from telegram import Update as TelegramUpdate, CallbackQuery as TelegramCallbackQuery, Message as TelegramMessage, PreCheckoutQuery as TelegramPreCheckoutQuery, SuccessfulPayment as TelegramSuccessfulPayment, User as TelegramUser, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButtonRequestUsers
-from telegram.error import BadRequest, Forbidden, NetworkError, TimedOut
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.ext import ApplicationBuilder, BaseHandler, BaseUpdateProcessor, CommandHandler, PreCheckoutQueryHandler, MessageHandler, filters
 from telegram.request import HTTPXRequest
 
 qrcode = importlib.import_module("qrcode")
@@ -120,6 +127,34 @@ async def _systemctl(*args: str) -> None:
     except Exception as e:
         logging.error(f"systemctl {' '.join(args)} failed: {e}")
 
+_XUI_WRITE_DEPTH = 0
+# Held across the stop and the start, so an entrant only writes once x-ui is actually down.
+_XUI_WINDOW_LOCK = asyncio.Lock()
+# Chats are processed concurrently, so every writer of an inbound's settings blob holds this from its
+# SELECT through the UPDATE; otherwise two read-modify-write cycles interleave and one update is lost.
+_XUI_SETTINGS_LOCK = asyncio.Lock()
+
+
+@contextlib.asynccontextmanager
+async def _xui_write_window() -> AsyncIterator[None]:
+    """Keep x-ui stopped while its DB is written; nested windows share a single stop/start."""
+    global _XUI_WRITE_DEPTH
+    async with _XUI_WINDOW_LOCK:
+        _XUI_WRITE_DEPTH += 1
+        if _XUI_WRITE_DEPTH == 1:
+            try:
+                await _systemctl("stop", "x-ui")
+            except BaseException:
+                _XUI_WRITE_DEPTH -= 1
+                raise
+    try:
+        yield
+    finally:
+        async with _XUI_WINDOW_LOCK:
+            _XUI_WRITE_DEPTH -= 1
+            if _XUI_WRITE_DEPTH == 0:
+                await _systemctl("start", "x-ui")
+
 async def _systemctl_status(*args: str) -> tuple[int, str]:
     try:
         proc = await asyncio.create_subprocess_exec(
@@ -212,29 +247,106 @@ async def _get_local_xray_version() -> Optional[str]:
             return ver
     return None
 
-async def _github_latest_version(owner: str, repo: str) -> Optional[str]:
-    headers = {"Accept": "application/vnd.github+json"}
+class _GithubCacheEntry(TypedDict):
+    status: int
+    data: Any
+    etag: str
+    fetched_at: float
+
+
+_GITHUB_CACHE: dict[str, _GithubCacheEntry] = {}
+_GITHUB_HTTP: Optional[tuple[asyncio.AbstractEventLoop, httpx.AsyncClient, dict[str, asyncio.Lock]]] = None
+_GITHUB_TRACKED_REPOS = (("MHSanaei", "3x-ui"), ("XTLS", "Xray-core"))
+
+
+def _github_http() -> tuple[httpx.AsyncClient, dict[str, asyncio.Lock]]:
+    global _GITHUB_HTTP
+    loop = asyncio.get_running_loop()
+    if _GITHUB_HTTP is None or _GITHUB_HTTP[0] is not loop or _GITHUB_HTTP[1].is_closed:
+        client = httpx.AsyncClient(
+            timeout=10,
+            follow_redirects=True,
+            headers={"Accept": "application/vnd.github+json", "User-Agent": "x-ui-bot"},
+        )
+        _GITHUB_HTTP = (loop, client, {})
+    return _GITHUB_HTTP[1], _GITHUB_HTTP[2]
+
+
+async def _github_api_get(url: str, force: bool = False) -> tuple[int, Any]:
+    """GET a GitHub API URL through the shared cache, revalidating with If-None-Match after the TTL.
+
+    Status 0 means the request itself failed; the data is then the error text.
+    """
+    entry = _GITHUB_CACHE.get(url)
+    if entry is not None and not force and time.time() - entry["fetched_at"] < GITHUB_RELEASE_CACHE_TTL_SEC:
+        return entry["status"], entry["data"]
+    client, locks = _github_http()
+    lock = locks.setdefault(url, asyncio.Lock())
+    async with lock:
+        entry = _GITHUB_CACHE.get(url)
+        if entry is not None and not force and time.time() - entry["fetched_at"] < GITHUB_RELEASE_CACHE_TTL_SEC:
+            return entry["status"], entry["data"]
+        headers = {"If-None-Match": entry["etag"]} if entry is not None and entry["etag"] else {}
+        try:
+            resp = await client.get(url, headers=headers)
+        except Exception as e:
+            if entry is not None:
+                return entry["status"], entry["data"]
+            logging.warning(f"GitHub request failed for {url}: {e}")
+            return 0, str(e) or type(e).__name__
+        if resp.status_code == 304 and entry is not None:
+            entry["fetched_at"] = time.time()
+            return entry["status"], entry["data"]
+        if resp.status_code != 200:
+            if entry is not None:
+                return entry["status"], entry["data"]
+            return resp.status_code, None
+        try:
+            data = resp.json()
+        except Exception:
+            return resp.status_code, None
+        _GITHUB_CACHE[url] = {
+            "status": 200,
+            "data": data,
+            "etag": resp.headers.get("etag") or "",
+            "fetched_at": time.time(),
+        }
+        return 200, data
+
+
+async def _close_github_http() -> None:
+    global _GITHUB_HTTP
+    if _GITHUB_HTTP is not None:
+        client = _GITHUB_HTTP[1]
+        _GITHUB_HTTP = None
+        await client.aclose()
+
+
+async def _github_latest_version(owner: str, repo: str, force: bool = False) -> Optional[str]:
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            rel = await client.get(f"https://api.github.com/repos/{owner}/{repo}/releases/latest", headers=headers)
-            if rel.status_code == 200:
-                data = rel.json()
-                tag = str(data.get("tag_name") or data.get("name") or "")
-                ver = _extract_semver(tag)
-                if ver:
-                    return ver
-            tags = await client.get(f"https://api.github.com/repos/{owner}/{repo}/tags?per_page=1", headers=headers)
-            if tags.status_code == 200:
-                items = tags.json()
-                if isinstance(items, list) and items:
-                    tag = str(items[0].get("name") or "")
-                    ver = _extract_semver(tag)
-                    if ver:
-                        return ver
+        status, data = await _github_api_get(f"https://api.github.com/repos/{owner}/{repo}/releases/latest", force)
+        if status == 200 and isinstance(data, dict):
+            tag = str(data.get("tag_name") or data.get("name") or "")
+            ver = _extract_semver(tag)
+            if ver:
+                return ver
+        status, items = await _github_api_get(f"https://api.github.com/repos/{owner}/{repo}/tags?per_page=1", force)
+        if status == 200 and isinstance(items, list) and items:
+            tag = str(items[0].get("name") or "")
+            ver = _extract_semver(tag)
+            if ver:
+                return ver
     except Exception:
         return None
     return None
 
+
+async def refresh_github_releases_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.gather(
+        *(_github_latest_version(owner, repo, force=True) for owner, repo in _GITHUB_TRACKED_REPOS),
+        return_exceptions=True,
+    )
+
 def _get_xray_target_path() -> Optional[str]:
     candidates = (
         "/usr/local/x-ui/bin/xray-linux-amd64",
@@ -260,7 +372,130 @@ def _select_xray_asset_name(machine: str) -> Optional[str]:
         return "Xray-linux-32.zip"
     return None
 
-async def _update_xray_binary() -> tuple[bool, str]:
+class XrayRelease(TypedDict):
+    version: str
+    assets: dict[str, str]
+
+
+_XRAY_ASSET_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+async def _fetch_xray_release() -> tuple[Optional[XrayRelease], str]:
+    status, data = await _github_api_get(XRAY_RELEASE_API_URL)
+    if status == 0:
+        return None, f"Ошибка запроса к GitHub API: {data}"
+    if status != 200 or not isinstance(data, dict):
+        return None, f"GitHub API вернул {status}"
+    tag = str(data.get("tag_name") or data.get("name") or "")
+    assets: dict[str, str] = {}
+    for asset in data.get("assets") or []:
+        if not isinstance(asset, dict):
+            continue
+        name = str(asset.get("name") or "")
+        url = str(asset.get("browser_download_url") or "")
+        if name and url:
+            assets[name] = url
+    if not assets:
+        return None, "Не найдены assets в релизе Xray-core"
+    return {"version": _extract_semver(tag) or tag or "unknown", "assets": assets}, ""
+
+
+def _pick_xray_asset(release: XrayRelease, machine: str) -> Optional[str]:
+    preferred = _select_xray_asset_name(machine)
+    if preferred and preferred in release["assets"]:
+        return preferred
+    for name in release["assets"]:
+        if name.endswith(".zip") and name.startswith("Xray-linux-") and "dgst" not in name:
+            return name
+    return None
+
+
+def _parse_xray_digest(text: str) -> Optional[str]:
+    for line in text.splitlines():
+        match = re.match(r"\s*SHA2?-?256\s*=\s*([0-9a-fA-F]{64})\s*$", line)
+        if match:
+            return match.group(1).lower()
+    return None
+
+
+def _extract_xray_member(zip_bytes: bytes) -> Optional[bytes]:
+    with zipfile.ZipFile(BytesIO(zip_bytes)) as zf:
+        for info in zf.infolist():
+            name = info.filename
+            if name.endswith("/"):
+                continue
+            if name.rsplit("/", 1)[-1] == "xray":
+                return zf.read(name)
+    return None
+
+
+def _prune_xray_cache(current_version: str) -> None:
+    try:
+        entries = [
+            os.path.join(XRAY_CACHE_DIR, name)
+            for name in os.listdir(XRAY_CACHE_DIR)
+            if os.path.isdir(os.path.join(XRAY_CACHE_DIR, name)) and name != current_version
+        ]
+    except OSError:
+        return
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[max(0, XRAY_CACHE_KEEP_VERSIONS - 1):]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _store_xray_archive(content: bytes, expected: Optional[str], bin_path: str, version: str) -> str:
+    """Verify a downloaded release archive and cache its xray binary; returns an error message or ""."""
+    if not expected or hashlib.sha256(content).hexdigest() != expected:
+        return "Контрольная сумма архива Xray не совпадает"
+    try:
+        xray_bin = _extract_xray_member(content)
+    except zipfile.BadZipFile:
+        xray_bin = None
+    if not xray_bin:
+        return "В архиве релиза не найден файл xray"
+    os.makedirs(os.path.dirname(bin_path), exist_ok=True)
+    tmp_path = f"{bin_path}.tmp.{uuid.uuid4().hex}"
+    with open(tmp_path, "wb") as f:
+        f.write(xray_bin)
+    os.chmod(tmp_path, 0o755)
+    os.replace(tmp_path, bin_path)
+    _prune_xray_cache(version)
+    return ""
+
+
+async def _ensure_cached_xray_binary(release: XrayRelease, asset_name: str) -> tuple[Optional[str], str]:
+    # Downloaded and verified once per (version, asset); every node then gets the same file.
+    version = re.sub(r"[^0-9A-Za-z._-]", "_", release["version"])
+    bin_path = os.path.join(XRAY_CACHE_DIR, version, asset_name.rsplit(".zip", 1)[0], "xray")
+    lock = _XRAY_ASSET_LOCKS.setdefault(bin_path, asyncio.Lock())
+    async with lock:
+        if os.path.isfile(bin_path):
+            return bin_path, ""
+        url = release["assets"].get(asset_name)
+        digest_url = release["assets"].get(f"{asset_name}.dgst")
+        if not url:
+            return None, "Не удалось выбрать архив Xray под текущую архитектуру"
+        if not digest_url:
+            return None, "В релизе нет контрольной суммы архива Xray"
+        try:
+            async with httpx.AsyncClient(timeout=60, follow_redirects=True) as client:
+                resp = await client.get(url)
+                if resp.status_code != 200:
+                    return None, f"Скачивание Xray не удалось ({resp.status_code})"
+                digest_resp = await client.get(digest_url)
+                if digest_resp.status_code != 200:
+                    return None, f"Скачивание контрольной суммы Xray не удалось ({digest_resp.status_code})"
+        except Exception as e:
+            return None, str(e)
+        expected = _parse_xray_digest(digest_resp.text)
+        # Hashing, unzipping and writing a ~10 MB archive would stall the event loop.
+        error = await asyncio.to_thread(_store_xray_archive, resp.content, expected, bin_path, version)
+        if error:
+            return None, error
+        return bin_path, ""
+
+
+async def _update_xray_binary(release: Optional[XrayRelease] = None) -> tuple[bool, str]:
     target_path = _get_xray_target_path()
     if not target_path:
         return False, "Не найден путь к бинарнику Xray"
@@ -270,78 +505,34 @@ async def _update_xray_binary() -> tuple[bool, str]:
     if before_rc == 0 and before_out:
         before_ver = _extract_semver(before_out.splitlines()[0].strip())
 
-    headers = {"Accept": "application/vnd.github+json"}
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            rel = await client.get(
-                "https://api.github.com/repos/XTLS/Xray-core/releases/latest",
-                headers=headers,
-            )
-            if rel.status_code != 200:
-                return False, f"GitHub API вернул {rel.status_code}"
-            release = rel.json()
-
-            assets = release.get("assets") or []
-            if not isinstance(assets, list) or not assets:
-                return False, "Не найдены assets в релизе Xray-core"
-
-            preferred_name = _select_xray_asset_name(platform.machine())
-            chosen = None
-            for asset in assets:
-                if not isinstance(asset, dict):
-                    continue
-                name = str(asset.get("name") or "")
-                url = str(asset.get("browser_download_url") or "")
-                if not name.endswith(".zip"):
-                    continue
-                if preferred_name and name == preferred_name and url:
-                    chosen = (name, url)
-                    break
-            if not chosen:
-                for asset in assets:
-                    if not isinstance(asset, dict):
-                        continue
-                    name = str(asset.get("name") or "")
-                    url = str(asset.get("browser_download_url") or "")
-                    if not url or not name.endswith(".zip"):
-                        continue
-                    if name.startswith("Xray-linux-") and "dgst" not in name:
-                        chosen = (name, url)
-                        break
-
-            if not chosen:
-                return False, "Не удалось выбрать архив Xray под текущую архитектуру"
-
-            _, url = chosen
-            resp = await client.get(url, follow_redirects=True)
-            if resp.status_code != 200:
-                return False, f"Скачивание Xray не удалось ({resp.status_code})"
-
-        zip_bytes = resp.content
-        with zipfile.ZipFile(BytesIO(zip_bytes)) as zf:
-            xray_member = None
-            for info in zf.infolist():
-                name = info.filename
-                if name.endswith("/"):
-                    continue
-                base = name.rsplit("/", 1)[-1]
-                if base == "xray":
-                    xray_member = name
-                    break
-            if not xray_member:
-                return False, "В архиве релиза не найден файл xray"
-            xray_bin = zf.read(xray_member)
+        if release is None:
+            release, error = await _fetch_xray_release()
+            if release is None:
+                return False, error
+        asset_name = _pick_xray_asset(release, platform.machine())
+        if not asset_name:
+            return False, "Не удалось выбрать архив Xray под текущую архитектуру"
+        cached_path, error = await _ensure_cached_xray_binary(release, asset_name)
+        if not cached_path:
+            return False, error
 
         dir_name = os.path.dirname(target_path)
         tmp_path = os.path.join(dir_name, f".xray.tmp.{uuid.uuid4().hex}")
-        with open(tmp_path, "wb") as f:
-            f.write(xray_bin)
-        os.chmod(tmp_path, 0o755)
-        os.replace(tmp_path, target_path)
+        backup_path = f"{target_path}.bak"
+
+        def _swap_binary() -> None:
+            shutil.copyfile(cached_path, tmp_path)
+            os.chmod(tmp_path, 0o755)
+            shutil.copy2(target_path, backup_path)
+            os.replace(tmp_path, target_path)
+
+        await asyncio.to_thread(_swap_binary)
 
         after_rc, after_out = await _cmd_status(target_path, "version")
         if after_rc != 0:
-            return False, "Бинарник Xray обновлён, но команда version завершилась ошибкой"
+            os.replace(backup_path, target_path)
+            return False, "Бинарник Xray обновлён, но команда version завершилась ошибкой — откат выполнен"
         after_first = after_out.splitlines()[0].strip() if after_out else ""
         after_ver = _extract_semver(after_first) or after_first
 
@@ -437,6 +628,54 @@ BOT_SYSTEMD_SERVICE = os.getenv("BOT_SYSTEMD_SERVICE", "x-ui-bot")
 BACKUP_KEEP_FILES = int(os.getenv("BACKUP_KEEP_FILES", "20"))
 BACKUP_KEEP_SETS = int(os.getenv("BACKUP_KEEP_SETS", "20"))
 AUTO_SYNC_INTERVAL_SEC = int(os.getenv("AUTO_SYNC_INTERVAL_SEC", "300"))
+REMOTE_FANOUT_CONCURRENCY = max(1, int(os.getenv("REMOTE_FANOUT_CONCURRENCY", "8")))
+REMOTE_FANOUT_NODE_TIMEOUT_SEC = float(os.getenv("REMOTE_FANOUT_NODE_TIMEOUT_SEC", "45"))
+REMOTE_FANOUT_EDIT_INTERVAL_SEC = float(os.getenv("REMOTE_FANOUT_EDIT_INTERVAL_SEC", "1.5"))
+REMOTE_AGENT_ENABLE = str(os.getenv("REMOTE_AGENT_ENABLE", "0")).strip().lower() in ("1", "true", "yes", "on")
+REMOTE_AGENT_DIR = (os.getenv("REMOTE_AGENT_DIR") or "/usr/local/x-ui").strip()
+REMOTE_AGENT_CALL_TIMEOUT_SEC = float(os.getenv("REMOTE_AGENT_CALL_TIMEOUT_SEC", "30"))
+MOBILE_UPSERT_COALESCE_SEC = float(os.getenv("MOBILE_UPSERT_COALESCE_SEC", "1.5"))
+MOBILE_UPSERT_BATCH_MAX = max(1, int(os.getenv("MOBILE_UPSERT_BATCH_MAX", "500")))
+MOBILE_TRAFFIC_REFRESH_SEC = int(os.getenv("MOBILE_TRAFFIC_REFRESH_SEC", "120"))
+MOBILE_CACHE_FALLBACK_TTL_SEC = max(0, int(os.getenv("MOBILE_CACHE_FALLBACK_TTL_SEC", "120")))
+REMOTE_FULL_SYNC_INTERVAL_SEC = int(os.getenv("REMOTE_FULL_SYNC_INTERVAL_SEC", "86400"))
+NODE_HEALTH_PROBE_SEC = int(os.getenv("NODE_HEALTH_PROBE_SEC", "60"))
+NODE_HEALTH_RING_SIZE = int(os.getenv("NODE_HEALTH_RING_SIZE", "120"))
+NODE_HEALTH_BUCKET_SEC = int(os.getenv("NODE_HEALTH_BUCKET_SEC", "900"))
+NODE_HEALTH_RETENTION_DAYS = int(os.getenv("NODE_HEALTH_RETENTION_DAYS", "7"))
+BROADCAST_RATE_PER_SEC = float(os.getenv("BROADCAST_RATE_PER_SEC", "25"))
+BROADCAST_CONCURRENCY = max(1, int(os.getenv("BROADCAST_CONCURRENCY", "10")))
+BROADCAST_PROGRESS_EDIT_SEC = float(os.getenv("BROADCAST_PROGRESS_EDIT_SEC", "3"))
+BROADCAST_MAX_ATTEMPTS = max(1, int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5")))
+POLL_VOTE_FLUSH_SEC = float(os.getenv("POLL_VOTE_FLUSH_SEC", "2"))
+POLL_RENDER_DEBOUNCE_SEC = float(os.getenv("POLL_RENDER_DEBOUNCE_SEC", "0.7"))
+EXPIRY_SCHEDULER_TICK_SEC = max(5, int(os.getenv("EXPIRY_SCHEDULER_TICK_SEC", "60")))
+UPDATE_CONCURRENCY = max(1, int(os.getenv("UPDATE_CONCURRENCY", "16")))
+NICKNAME_SYNC_CONCURRENCY = max(1, int(os.getenv("NICKNAME_SYNC_CONCURRENCY", "8")))
+CHAT_PROFILE_TTL_SEC = int(os.getenv("CHAT_PROFILE_TTL_SEC", "21600"))
+CHAT_PROFILE_NEGATIVE_TTL_SEC = int(os.getenv("CHAT_PROFILE_NEGATIVE_TTL_SEC", "1800"))
+ADMIN_OUTBOX_MAX_ATTEMPTS = max(1, int(os.getenv("ADMIN_OUTBOX_MAX_ATTEMPTS", "12")))
+ADMIN_OUTBOX_BACKOFF_MAX_SEC = float(os.getenv("ADMIN_OUTBOX_BACKOFF_MAX_SEC", "900"))
+STAR_TX_BOOTSTRAP_LOOKBACK_SEC = int(os.getenv("STAR_TX_BOOTSTRAP_LOOKBACK_SEC", "86400"))
+PAYMENT_JOB_TICK_SEC = max(5.0, float(os.getenv("PAYMENT_JOB_TICK_SEC", "15")))
+PAYMENT_JOB_MAX_ATTEMPTS = max(1, int(os.getenv("PAYMENT_JOB_MAX_ATTEMPTS", "8")))
+PAYMENT_JOB_BACKOFF_MAX_SEC = float(os.getenv("PAYMENT_JOB_BACKOFF_MAX_SEC", "1800"))
+ADMIN_STATS_RECONCILE_SEC = max(30, int(os.getenv("ADMIN_STATS_RECONCILE_SEC", "600")))
+USER_SEARCH_REBUILD_SEC = max(300, int(os.getenv("USER_SEARCH_REBUILD_SEC", "21600")))
+AUDIENCE_SYNC_SEC = max(60, int(os.getenv("AUDIENCE_SYNC_SEC", "600")))
+_NICKNAME_SYNC_PROGRESS_EDIT_SEC = 3.0
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip()
+GITHUB_RELEASE_CACHE_TTL_SEC = int(os.getenv("GITHUB_RELEASE_CACHE_TTL_SEC", "21600"))
+GITHUB_RELEASE_REFRESH_SEC = int(os.getenv("GITHUB_RELEASE_REFRESH_SEC", "3600"))
+XRAY_RELEASE_API_URL = (os.getenv("XRAY_RELEASE_API_URL") or "https://api.github.com/repos/XTLS/Xray-core/releases/latest").strip()
+XRAY_CACHE_DIR = (os.getenv("XRAY_CACHE_DIR") or "/usr/local/x-ui/bot/xray_cache").strip()
+XRAY_CACHE_KEEP_VERSIONS = max(1, int(os.getenv("XRAY_CACHE_KEEP_VERSIONS", "2")))
+XRAY_ROLLOUT_CONCURRENCY = max(1, int(os.getenv("XRAY_ROLLOUT_CONCURRENCY", "3")))
+XRAY_ROLLOUT_CANARY = (os.getenv("XRAY_ROLLOUT_CANARY") or "").strip()
+XRAY_ROLLOUT_NODE_TIMEOUT_SEC = float(os.getenv("XRAY_ROLLOUT_NODE_TIMEOUT_SEC", "300"))
 MULTI_SUB_ENABLE_RAW = os.getenv("MULTI_SUB_ENABLE", "1")
 MULTI_SUB_ENABLE = str(MULTI_SUB_ENABLE_RAW).strip().lower() in ("1", "true", "yes", "on")
 MULTI_SUB_HOST = os.getenv("MULTI_SUB_HOST", "0.0.0.0")
@@ -649,6 +888,7 @@ TEXTS = {
         "mobile_sub_not_found": "❌ 3G/4G Subscription Not Found\n\nPlease visit the shop.",
         "mobile_sub_expired": "⚠️ 3G/4G Subscription Expired\n\nPlease buy a new plan to restore access.",
         "mobile_stats_title": "📊 3G/4G Stats\n\n⬇️ Download: {down}\n⬆️ Upload: {up}\n📦 Total: {total}",
+        "mobile_traffic_updated_ago": "🕒 Updated {seconds} s ago",
         "stats_sub_type": "💳 Plan: {plan}",
         "rank_info_traffic": "\n🏆 You downloaded {traffic} via VPN.\nYour rank: #{rank} of {total}.",
         "traffic_info": "\n🏆 You downloaded {traffic} via VPN.",
@@ -704,10 +944,12 @@ TEXTS = {
         "remote_location_deleted": "✅ Location deleted.",
         "remote_node_deleted": "✅ Node deleted.",
         "remote_node_sync_ok": "✅ Node synced.",
+        "remote_nodes_sync_progress_title": "🔄 *Syncing nodes*",
         "remote_node_sync_failed": "❌ Sync failed.",
         "remote_node_sync_missing_ssh": "❌ SSH credentials are missing for this node.",
         "remote_list_empty": "List is empty.",
         "remote_check_ok": "ok",
+        "remote_check_pending": "⏳",
         "remote_check_fail": "fail",
         "btn_user_locations": "🌍 Other Locations",
         "user_locations_title": "🌍 *Other Locations*\n\nChoose a location:",
@@ -731,6 +973,16 @@ TEXTS = {
         "admin_server_mobile_title": "📶 *3G/4G Server Status*",
         "admin_server_nodes_title": "🌐 *Remote VPS*",
         "admin_server_node_title": "🖥 *Node Details*",
+        "node_health_no_data": "⏳ No samples yet",
+        "node_health_age": "sampled {seconds} s ago",
+        "node_health_latency": "📶 *Latency:*",
+        "btn_xray_rollout": "⬆️ Update Xray on nodes",
+        "btn_xray_rollback": "↩️ Roll back Xray",
+        "xray_rollout_title": "⬆️ *Xray rollout* `{version}`",
+        "xray_rollout_skipped": "⏸ skipped",
+        "xray_rollout_halted": "⛔ Rollout stopped after a failed node.",
+        "xray_rollback_title": "↩️ *Xray rollback*",
+        "xray_rollback_empty": "Nothing to roll back.",
         "btn_server_nodes": "🌐 Nodes/VPS",
         "node_label": "Node",
         "health_title": "🩺 *Health Check*",
@@ -739,6 +991,7 @@ TEXTS = {
         "health_access_log": "Access log",
         "health_support_bot": "Support bot",
         "health_main_bot": "Main bot",
+        "health_updates": "⚙️ Updates: running {running}/{limit}, queued {queued} ({chats} chats)\n⏱ Wait: avg {wait_avg_ms} ms, p95 {wait_p95_ms} ms, max {wait_max_ms} ms · processed {processed}",
         "health_ok": "ok",
         "health_fail": "fail",
         "health_inbound_missing": "inbound not found",
@@ -802,6 +1055,8 @@ TEXTS = {
         "sync_error_inbound": "❌ X-UI Inbound not found.",
         "sync_progress": "🔄 Syncing: {current}/{total}",
         "sync_complete": "✅ Sync complete!\n\nUpdated: {updated}\nFailed: {failed}\n\n⚠️ X-UI restarted to update names.",
+        "sync_nicknames_complete": "✅ Sync complete!\n\nUpdated: {updated}\nAlready up to date: {skipped}\nFailed: {failed}",
+        "payment_job_applied": "✅ Your payment of {amount} Stars has been applied.\n\n➕ Added: {days} days",
         "sync_mobile_empty": "📭 No 3G/4G subscriptions found.",
         "users_list_title": "📋 *{title}*",
         "title_all": "All Clients",
@@ -866,8 +1121,13 @@ TEXTS = {
         "flash_delete_success": "✅ Force deleted {count} messages.",
         "search_prompt": "🔍 *Search User*\n\nSend *Telegram ID* to search in database.",
         "search_error_digit": "❌ Error: ID must be digits.",
+        "search_results": "🔍 Matches found: {count}",
+        "search_no_results": "🔍 Nothing found.",
         "sales_log_empty": "📜 *Sales Log*\n\nNo sales yet.",
-        "sales_log_title": "📜 *Sales Log (Last 20)*\n\n",
+        "sales_log_title": "📜 *Sales Log*\n\n",
+        "sales_log_error": "❌ Error loading the log.",
+        "btn_sales_log_older": "⬅️ Older",
+        "btn_sales_log_latest": "⏮ Latest",
         "db_detail_title": "👤 *User Info (DB)*",
         "db_lang": "🌍 Language:",
         "db_reg_date": "📅 Activation Date:",
@@ -882,6 +1142,12 @@ TEXTS = {
         "btn_broadcast_en": "🇮🇧 English (en)",
         "btn_broadcast_ru": "🇷🇺 Russian (ru)",
         "btn_broadcast_individual": "👥 Individual",
+        "btn_broadcast_active": "🟢 Active",
+        "btn_broadcast_expired": "🔴 Expired",
+        "btn_broadcast_trial": "🎁 Trial only",
+        "btn_broadcast_paid": "💳 Paid",
+        "btn_broadcast_nopaid": "🆓 Never paid",
+        "btn_broadcast_mobile": "📶 3G/4G",
         "broadcast_individual_title": "📢 *Individual Broadcast*\n\nSelect users from list:",
         "btn_done_count": "✅ Done ({count})",
         "broadcast_confirm_prompt": "✅ Selected {count} recipients.\n\nNow send the message (text, photo, video, sticker) you want to broadcast.",
@@ -966,6 +1232,7 @@ TEXTS = {
         "mobile_sub_not_found": "❌ *3G/4G подписка не найдена*\n\nУ вас нет активной 3G/4G подписки. Перейдите в магазин.",
         "mobile_sub_expired": "⚠️ *3G/4G подписка истекла*\n\nОформите новый тариф для восстановления доступа.",
         "mobile_stats_title": "📊 *3G/4G статистика*\n\n⬇️ Скачано: {down}\n⬆️ Загружено: {up}\n📦 Всего: {total}",
+        "mobile_traffic_updated_ago": "🕒 Обновлено {seconds} сек. назад",
         "expiry_unlimited": "Бессрочный",
         "stats_your_title": "📊 Ваша статистика",
         "stats_today": "📅 За сегодня:",
@@ -1125,10 +1392,12 @@ TEXTS = {
         "remote_location_deleted": "✅ Локация удалена.",
         "remote_node_deleted": "✅ Узел удалён.",
         "remote_node_sync_ok": "✅ Узел синхронизирован.",
+        "remote_nodes_sync_progress_title": "🔄 *Синхронизация узлов*",
         "remote_node_sync_failed": "❌ Синхронизация не удалась.",
         "remote_node_sync_missing_ssh": "❌ Для узла не заданы SSH‑логин/пароль.",
         "remote_list_empty": "Список пуст.",
         "remote_check_ok": "ok",
+        "remote_check_pending": "⏳",
         "remote_check_fail": "fail",
         "btn_user_locations": "🌍 Другие локации",
         "user_locations_title": "🌍 *Другие локации*\n\nВыберите локацию:",
@@ -1162,6 +1431,16 @@ TEXTS = {
         "admin_server_mobile_title": "📶 *Состояние сервера 3G/4G*",
         "admin_server_nodes_title": "🌐 *Удалённые VPS*",
         "admin_server_node_title": "🖥 *Параметры узла*",
+        "node_health_no_data": "⏳ Данных пока нет",
+        "node_health_age": "замер {seconds} сек. назад",
+        "node_health_latency": "📶 *Задержка:*",
+        "btn_xray_rollout": "⬆️ Обновить Xray на узлах",
+        "btn_xray_rollback": "↩️ Откатить Xray",
+        "xray_rollout_title": "⬆️ *Обновление Xray* `{version}`",
+        "xray_rollout_skipped": "⏸ пропущен",
+        "xray_rollout_halted": "⛔ Обновление остановлено после ошибки на узле.",
+        "xray_rollback_title": "↩️ *Откат Xray*",
+        "xray_rollback_empty": "Откатывать нечего.",
         "btn_server_nodes": "🌐 Узлы/VPS",
         "node_label": "Узел",
         "health_title": "🩺 *Проверка здоровья*",
@@ -1170,6 +1449,7 @@ TEXTS = {
         "health_access_log": "Журнал access.log",
         "health_support_bot": "Support bot",
         "health_main_bot": "Основной бот",
+        "health_updates": "⚙️ Обновления: в работе {running}/{limit}, в очереди {queued} (чатов: {chats})\n⏱ Ожидание: ср. {wait_avg_ms} мс, p95 {wait_p95_ms} мс, макс. {wait_max_ms} мс · обработано {processed}",
         "health_ok": "ок",
         "health_fail": "ошибка",
         "health_inbound_missing": "inbound не найден",
@@ -1233,6 +1513,8 @@ TEXTS = {
         "sync_error_inbound": "❌ X-UI Inbound not found.",
         "sync_progress": "🔄 Синхронизация: {current}/{total}",
         "sync_complete": "✅ Синхронизация завершена!\n\nОбновлено: {updated}\nОшибок: {failed}\n\n⚠️ X-UI был перезапущен для обновления имен в панели.",
+        "sync_nicknames_complete": "✅ Синхронизация завершена!\n\nОбновлено: {updated}\nУже актуальны: {skipped}\nОшибок: {failed}",
+        "payment_job_applied": "✅ Ваш платеж на {amount} Stars зачислен.\n\n➕ Добавлено: {days} дн.",
         "sync_mobile_empty": "📭 3G/4G подписок не найдено.",
         "users_list_title": "📋 *{title}*",
         "title_all": "Все клиенты",
@@ -1316,8 +1598,12 @@ TEXTS = {
         "flash_delete_success": "✅ Принудительно удалено {count} сообщений.",
         "search_prompt": "🔍 *Поиск пользователя*\n\nОтправьте *Telegram ID* пользователя для поиска в базе данных.",
         "search_error_digit": "❌ Ошибка: ID должен состоять из цифр.",
+        "search_results": "🔍 Найдено совпадений: {count}",
+        "search_no_results": "🔍 Ничего не найдено.",
         "sales_log_empty": "📜 *Журнал продаж*\n\nПродаж пока нет.",
-        "sales_log_title": "📜 *Журнал продаж (последние 20)*\n\n",
+        "sales_log_title": "📜 *Журнал продаж*\n\n",
+        "btn_sales_log_older": "⬅️ Раньше",
+        "btn_sales_log_latest": "⏮ Последние",
         "db_detail_title": "👤 *Информация о пользователе (DB)*",
         "db_lang": "🌍 Язык:",
         "db_reg_date": "📅 Дата активации:",
@@ -1332,6 +1618,12 @@ TEXTS = {
         "btn_broadcast_en": "🇮🇧 Английский (en)",
         "btn_broadcast_ru": "🇷🇺 Русский (ru)",
         "btn_broadcast_individual": "👥 Индивидуально",
+        "btn_broadcast_active": "🟢 Активные",
+        "btn_broadcast_expired": "🔴 Истёкшие",
+        "btn_broadcast_trial": "🎁 Только пробный",
+        "btn_broadcast_paid": "💳 Покупатели",
+        "btn_broadcast_nopaid": "🆓 Без покупок",
+        "btn_broadcast_mobile": "📶 3G/4G",
         "broadcast_individual_title": "📢 *Индивидуальная рассылка*\n\nВыберите пользователей из списка:",
         "btn_done_count": "✅ Готово ({count})",
         "broadcast_confirm_prompt": "✅ Выбрано {count} получателей.\n\nТеперь отправьте сообщение (текст, фото, видео, стикер), которое хотите отправить.",
@@ -1585,6 +1877,20 @@ def init_db():
         )
     ''')
 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mobile_client_traffics (
+            email TEXT PRIMARY KEY,
+            inbound_id INTEGER,
+            enable INTEGER,
+            up INTEGER,
+            down INTEGER,
+            total INTEGER,
+            expiry_time INTEGER,
+            last_online INTEGER,
+            fetched_at INTEGER
+        )
+    ''')
+
     # Initialize default prices if empty
     cursor.execute("SELECT COUNT(*) FROM prices")
     if cursor.fetchone()[0] == 0:
@@ -1744,6 +2050,193 @@ def init_db():
     if "ssh_password" not in existing_columns:
         cursor.execute("ALTER TABLE remote_nodes ADD COLUMN ssh_password TEXT")
 
+    # Audience segments: one row per known user, kept current by triggers on the bot tables, by
+    # _note_audience_clients from the x-ui writers and by the periodic _sync_audience_clients.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audience_members (
+            tg_id TEXT PRIMARY KEY,
+            in_prefs INTEGER DEFAULT 0,
+            lang TEXT,
+            first_name TEXT,
+            username TEXT,
+            trial_used INTEGER DEFAULT 0,
+            paid INTEGER DEFAULT 0,
+            mobile INTEGER DEFAULT 0,
+            has_client INTEGER DEFAULT 0,
+            expiry_ms INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audience_lang ON audience_members(lang)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audience_paid ON audience_members(paid, trial_used)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audience_client ON audience_members(has_client, expiry_ms)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audience_mobile ON audience_members(mobile)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_tg_id ON transactions(tg_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(date)")
+    for event in ("INSERT", "UPDATE"):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_audience_prefs_{event.lower()} AFTER {event} ON user_prefs
+            BEGIN
+                INSERT OR IGNORE INTO audience_members (tg_id) VALUES (NEW.tg_id);
+                UPDATE audience_members
+                SET in_prefs=1, lang=NEW.lang, first_name=NEW.first_name, username=NEW.username,
+                    trial_used=COALESCE(NEW.trial_used, 0)
+                WHERE tg_id=NEW.tg_id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_audience_mobile_{event.lower()} AFTER {event} ON mobile_subscriptions
+            BEGIN
+                INSERT OR IGNORE INTO audience_members (tg_id) VALUES (NEW.tg_id);
+                UPDATE audience_members SET mobile=1 WHERE tg_id=NEW.tg_id;
+            END
+        ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_audience_prefs_delete AFTER DELETE ON user_prefs
+        BEGIN
+            UPDATE audience_members SET in_prefs=0 WHERE tg_id=OLD.tg_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_audience_mobile_delete AFTER DELETE ON mobile_subscriptions
+        BEGIN
+            UPDATE audience_members SET mobile=0 WHERE tg_id=OLD.tg_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_audience_paid AFTER INSERT ON transactions
+        WHEN NEW.amount > 0
+        BEGIN
+            INSERT OR IGNORE INTO audience_members (tg_id) VALUES (NEW.tg_id);
+            UPDATE audience_members SET paid=1 WHERE tg_id=NEW.tg_id;
+        END
+    ''')
+    # Backfill / repair from the source tables; the triggers keep it current afterwards.
+    cursor.execute("INSERT OR IGNORE INTO audience_members (tg_id) SELECT tg_id FROM user_prefs")
+    cursor.execute("INSERT OR IGNORE INTO audience_members (tg_id) SELECT tg_id FROM mobile_subscriptions")
+    cursor.execute("INSERT OR IGNORE INTO audience_members (tg_id) SELECT DISTINCT tg_id FROM transactions WHERE amount > 0 AND tg_id IS NOT NULL")
+    cursor.execute('''
+        UPDATE audience_members SET
+            in_prefs=EXISTS(SELECT 1 FROM user_prefs p WHERE p.tg_id=audience_members.tg_id),
+            lang=(SELECT p.lang FROM user_prefs p WHERE p.tg_id=audience_members.tg_id),
+            first_name=(SELECT p.first_name FROM user_prefs p WHERE p.tg_id=audience_members.tg_id),
+            username=(SELECT p.username FROM user_prefs p WHERE p.tg_id=audience_members.tg_id),
+            trial_used=COALESCE((SELECT p.trial_used FROM user_prefs p WHERE p.tg_id=audience_members.tg_id), 0),
+            paid=EXISTS(SELECT 1 FROM transactions t WHERE t.tg_id=audience_members.tg_id AND t.amount > 0),
+            mobile=EXISTS(SELECT 1 FROM mobile_subscriptions m WHERE m.tg_id=audience_members.tg_id)
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            target TEXT,
+            status TEXT,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at INTEGER,
+            finished_at INTEGER
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER,
+            tg_id TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            updated_at INTEGER,
+            PRIMARY KEY (broadcast_id, tg_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients(broadcast_id, status)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS node_health_history (
+            node_id INTEGER,
+            bucket_ts INTEGER,
+            cpu REAL,
+            ram REAL,
+            disk REAL,
+            rx REAL,
+            tx REAL,
+            latency REAL,
+            samples INTEGER,
+            PRIMARY KEY (node_id, bucket_ts)
+        )
+    ''')
+
+    try:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+            "tg_id, username, name, email, comment, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS user_search_trigram USING fts5(doc, tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        # FTS5 (or its trigram tokenizer, SQLite >= 3.34) is missing; admin search falls back to exact IDs.
+        logging.warning(f"User search index unavailable: {e}")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payment_jobs (
+            charge_id TEXT PRIMARY KEY,
+            tx_id INTEGER,
+            tg_id TEXT NOT NULL,
+            plan_id TEXT,
+            amount INTEGER,
+            days INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at INTEGER DEFAULT 0,
+            last_error TEXT,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payment_jobs_due ON payment_jobs(status, next_attempt_at)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT UNIQUE,
+            text TEXT,
+            created_at REAL,
+            last_seen_at REAL,
+            next_attempt_at REAL,
+            attempts INTEGER DEFAULT 0,
+            repeat_count INTEGER DEFAULT 1,
+            last_error TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_outbox_due ON admin_outbox(next_attempt_at)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            cache_key TEXT PRIMARY KEY,
+            file_id TEXT,
+            created_at INTEGER
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS nickname_sync (
+            tg_id TEXT PRIMARY KEY,
+            nick TEXT,
+            synced_at INTEGER
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS remote_inbound_replicas (
+            node_key TEXT PRIMARY KEY,
+            base_hash TEXT,
+            client_hashes TEXT,
+            full_synced_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sync_state (
             key TEXT PRIMARY KEY,
@@ -1751,6 +2244,31 @@ def init_db():
             updated_at INTEGER
         )
     ''')
+    # Change counter for the expiry scheduler: bumped on any payment or trial flag change, edits included.
+    bump_expiry_version = '''
+            INSERT INTO sync_state (key, value, updated_at) VALUES ('expiry_sources_version', '1', CAST(strftime('%s', 'now') AS INTEGER))
+            ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER) + 1, updated_at=excluded.updated_at;
+    '''
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_expiry_tx_{event.lower()} AFTER {event} ON transactions
+            BEGIN {bump_expiry_version} END
+        ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expiry_trial_insert AFTER INSERT ON user_prefs
+        WHEN NEW.trial_used=1
+        BEGIN {bump_expiry_version} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expiry_trial_update AFTER UPDATE OF trial_used ON user_prefs
+        WHEN OLD.trial_used IS NOT NEW.trial_used
+        BEGIN {bump_expiry_version} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expiry_trial_delete AFTER DELETE ON user_prefs
+        WHEN OLD.trial_used=1
+        BEGIN {bump_expiry_version} END
+    ''')
 
     conn.commit()
     conn.close()
@@ -2061,6 +2579,16 @@ def _get_sync_state(key: str) -> Optional[str]:
         return None
     return str(row[0])
 
+def _get_fresh_sync_state(key: str, max_age_sec: int) -> Optional[str]:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM sync_state WHERE key=? AND updated_at >= ?", (key, int(time.time()) - max_age_sec))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return None
+    return str(row[0])
+
 def _set_sync_state(key: str, value: str) -> None:
     conn = sqlite3.connect(BOT_DB_PATH)
     cursor = conn.cursor()
@@ -2187,108 +2715,786 @@ def _get_remote_location_id(
         return None
     return int(row[0])
 
-def _ssh_fetch_remote_xui_data(
-    host: str,
-    port: int,
-    username: str,
-    password: str,
-) -> Optional[dict[str, Any]]:
-    client = None
-    try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            hostname=host,
-            port=port,
-            username=username,
-            password=password,
-            timeout=6,
-            banner_timeout=6,
-            auth_timeout=6,
-            look_for_keys=False,
-            allow_agent=False,
-        )
-        cmd = (
-            "python3 - <<'PY'\n"
-            "import json, sqlite3, os\n"
-            "db=os.getenv('XUI_DB_PATH','/etc/x-ui/x-ui.db')\n"
-            "conn=sqlite3.connect(db)\n"
-            "cur=conn.cursor()\n"
-            "cur.execute(\"SELECT key, value FROM settings WHERE key IN ('webPort','webBasePath','subEnable','subPort','subPath','subCertFile','webCertFile')\")\n"
-            "settings={k:v for k,v in cur.fetchall()}\n"
-            "cur.execute(\"SELECT port, stream_settings, protocol FROM inbounds\")\n"
-            "rows=cur.fetchall()\n"
-            "conn.close()\n"
-            "result={\n"
-            "    'web_port': settings.get('webPort'),\n"
-            "    'web_base_path': settings.get('webBasePath'),\n"
-            "    'sub_enable': settings.get('subEnable'),\n"
-            "    'sub_port': settings.get('subPort'),\n"
-            "    'sub_path': settings.get('subPath'),\n"
-            "    'sub_cert': settings.get('subCertFile'),\n"
-            "    'web_cert': settings.get('webCertFile'),\n"
-            "}\n"
-            "for port, stream_settings, protocol in rows:\n"
-            "    if protocol != 'vless':\n"
-            "        continue\n"
-            "    try:\n"
-            "        ss=json.loads(stream_settings or '{}')\n"
-            "    except Exception:\n"
-            "        continue\n"
-            "    reality=ss.get('realitySettings') or {}\n"
-            "    settings_inner=reality.get('settings') or {}\n"
-            "    public_key=settings_inner.get('publicKey')\n"
-            "    sni_list=reality.get('serverNames') or []\n"
-            "    sid_list=reality.get('shortIds') or []\n"
-            "    if public_key and sni_list and sid_list:\n"
-            "        result.update({\n"
-            "            'inbound_port': port,\n"
-            "            'public_key': public_key,\n"
-            "            'sni': sni_list[0],\n"
-            "            'sid': sid_list[0],\n"
-            "            'flow': settings_inner.get('flow')\n"
-            "        })\n"
-            "        break\n"
-            "print(json.dumps(result))\n"
-            "PY"
-        )
-        _, stdout, stderr = client.exec_command(cmd, timeout=12)
-        output = stdout.read().decode("utf-8", errors="ignore").strip()
-        error = stderr.read().decode("utf-8", errors="ignore").strip()
-        if not output:
-            if error:
-                logging.warning(f"SSH sync error for {host}:{port}: {error}")
-            return None
+_REMOTE_AGENT_LIB = r'''
+import json, os, re, shutil, sqlite3, subprocess, sys, time
+
+DB = os.getenv('XUI_DB_PATH', '/etc/x-ui/x-ui.db')
+_conn = None
+_last_sample = None
+_versions = {'ts': 0.0, 'xui': None, 'xray': None, 'probe': []}
+
+
+def _db():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB, timeout=10)
+    return _conn
+
+
+def _reset_db():
+    global _conn
+    if _conn is not None:
         try:
-            data = json.loads(output)
+            _conn.close()
         except Exception:
-            logging.warning(f"SSH sync invalid json for {host}:{port}: {output}")
-            return None
-        if not isinstance(data, dict):
-            return None
-        if error:
-            logging.warning(f"SSH sync stderr for {host}:{port}: {error}")
-        return data
-    except Exception as exc:
-        logging.warning(f"SSH sync exception for {host}:{port}: {exc}")
+            pass
+    _conn = None
+
+
+def _restart_xui():
+    os.system('systemctl restart x-ui >/dev/null 2>&1 || x-ui restart >/dev/null 2>&1 || true')
+
+
+def _extract_semver(text):
+    m = re.search(r'(?P<v>v?\d+\.\d+(?:\.\d+)?)', text or '')
+    if not m:
         return None
-    finally:
-        if client is not None:
-            try:
-                client.close()
-            except Exception:
-                pass
+    v = m.group('v').lstrip('v')
+    if v.count('.') == 1:
+        v = v + '.0'
+    return v or None
 
 
-def _ssh_fetch_remote_server_status(
-    host: str,
-    port: int,
-    username: str,
-    password: str,
-) -> Optional[dict[str, Any]]:
-    client = None
-    try:
-        client = paramiko.SSHClient()
+def _run_first_semver(cmds):
+    probe = []
+    for cmd in cmds:
+        try:
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=6)
+            out = (p.stdout or '').strip()
+            first = out.splitlines()[0].strip() if out else ''
+            probe.append({'cmd': ' '.join(cmd), 'rc': int(p.returncode), 'out': first[:160]})
+            for line in out.splitlines()[:8]:
+                ver = _extract_semver(line.strip())
+                if ver:
+                    return ver, probe
+        except Exception as e:
+            probe.append({'cmd': ' '.join(cmd), 'rc': 999, 'out': str(e)[:160]})
+    return None, probe
+
+
+def _sample():
+    total = idle = rx = tx = 0
+    try:
+        with open('/proc/stat', 'r') as f:
+            parts = f.readline().split()
+            total = sum(int(x) for x in parts[1:])
+            idle = int(parts[4])
+    except Exception:
+        pass
+    try:
+        with open('/proc/net/dev', 'r') as f:
+            for line in f.readlines()[2:]:
+                if ':' not in line:
+                    continue
+                data = line.split(':', 1)[1].split()
+                if len(data) < 9:
+                    continue
+                rx += int(data[0])
+                tx += int(data[8])
+    except Exception:
+        pass
+    return time.monotonic(), total, idle, rx, tx
+
+
+def _versions_cached():
+    if time.monotonic() - _versions['ts'] < 300 and _versions['ts'] > 0:
+        return _versions
+    xui, probe = _run_first_semver([
+        ['x-ui', '-v'], ['x-ui', 'version'], ['/usr/local/x-ui/x-ui', '-v'],
+        ['/usr/local/x-ui/x-ui', 'version'], ['/usr/bin/x-ui', '-v'], ['/usr/local/bin/x-ui', '-v'],
+    ])
+    xray, _ = _run_first_semver([
+        ['/usr/local/x-ui/bin/xray-linux-amd64', 'version'], ['/usr/local/x-ui/bin/xray', 'version'], ['xray', 'version'],
+    ])
+    _versions.update({'ts': time.monotonic(), 'xui': xui, 'xray': xray, 'probe': probe})
+    return _versions
+
+
+def get_status(params):
+    global _last_sample
+    now = _sample()
+    prev = _last_sample
+    if prev is None or not (0.2 <= now[0] - prev[0] <= 60):
+        prev = now
+        time.sleep(0.5)
+        now = _sample()
+    _last_sample = now
+    elapsed = max(now[0] - prev[0], 0.001)
+    diff_total = now[1] - prev[1]
+    diff_idle = now[2] - prev[2]
+    cpu = (1.0 - (diff_idle / diff_total)) * 100.0 if diff_total > 0 else 0.0
+    mem = {}
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                parts = line.split(':', 1)
+                if len(parts) == 2:
+                    mem[parts[0].strip()] = int(parts[1].split()[0])
+    except Exception:
+        pass
+    total_ram = mem.get('MemTotal', 0)
+    used_ram = max(0, total_ram - mem.get('MemAvailable', 0))
+    total_swap = mem.get('SwapTotal', 0)
+    used_swap = max(0, total_swap - mem.get('SwapFree', 0))
+    uptime_sec = 0
+    try:
+        with open('/proc/uptime', 'r') as f:
+            uptime_sec = int(float(f.readline().split()[0]))
+    except Exception:
+        pass
+    disk_total = disk_used = disk_free = 0
+    try:
+        disk = shutil.disk_usage('/')
+        disk_total, disk_used, disk_free = disk.total, disk.used, disk.free
+    except Exception:
+        pass
+    versions = _versions_cached()
+    return {
+        'cpu': float(cpu),
+        'ram_usage': (used_ram / total_ram) * 100.0 if total_ram else 0.0,
+        'ram_total': total_ram / (1024 * 1024),
+        'ram_used': used_ram / (1024 * 1024),
+        'swap_usage': (used_swap / total_swap) * 100.0 if total_swap else 0.0,
+        'swap_total': total_swap / (1024 * 1024),
+        'swap_used': used_swap / (1024 * 1024),
+        'disk_usage': (disk_used / disk_total) * 100.0 if disk_total else 0.0,
+        'disk_total': disk_total / (1024 ** 3),
+        'disk_used': disk_used / (1024 ** 3),
+        'disk_free': disk_free / (1024 ** 3),
+        'rx_speed': int(max(0, now[3] - prev[3]) / elapsed),
+        'tx_speed': int(max(0, now[4] - prev[4]) / elapsed),
+        'uptime_sec': uptime_sec,
+        'xui_version': versions['xui'],
+        'xray_version': versions['xray'],
+        'xui_probe': versions['probe'],
+    }
+
+
+def get_xui_data(params):
+    cur = _db().cursor()
+    cur.execute("SELECT key, value FROM settings WHERE key IN ('webPort','webBasePath','subEnable','subPort','subPath','subCertFile','webCertFile')")
+    settings = {k: v for k, v in cur.fetchall()}
+    result = {
+        'web_port': settings.get('webPort'),
+        'web_base_path': settings.get('webBasePath'),
+        'sub_enable': settings.get('subEnable'),
+        'sub_port': settings.get('subPort'),
+        'sub_path': settings.get('subPath'),
+        'sub_cert': settings.get('subCertFile'),
+        'web_cert': settings.get('webCertFile'),
+    }
+    cur.execute('SELECT port, stream_settings, protocol FROM inbounds')
+    for port, stream_settings, protocol in cur.fetchall():
+        if protocol != 'vless':
+            continue
+        try:
+            ss = json.loads(stream_settings or '{}')
+        except Exception:
+            continue
+        reality = ss.get('realitySettings') or {}
+        inner = reality.get('settings') or {}
+        sni_list = reality.get('serverNames') or []
+        sid_list = reality.get('shortIds') or []
+        if inner.get('publicKey') and sni_list and sid_list:
+            result.update({
+                'inbound_port': port,
+                'public_key': inner.get('publicKey'),
+                'sni': sni_list[0],
+                'sid': sid_list[0],
+                'flow': inner.get('flow'),
+            })
+            break
+    return result
+
+
+def get_client_traffic(params):
+    cur = _db().cursor()
+    cur.execute('SELECT up, down, expiry_time, last_online FROM client_traffics WHERE email=? LIMIT 1', (str(params.get('email') or ''),))
+    row = cur.fetchone()
+    if not row:
+        return {'ok': False}
+    return {'ok': True, 'up': row[0] or 0, 'down': row[1] or 0, 'expiry_time': row[2] or 0, 'last_online': row[3] or 0}
+
+
+def get_all_client_traffics(params):
+    cur = _db().cursor()
+    inbound_id = int(params.get('inbound_id') or 0)
+    try:
+        sql = 'SELECT inbound_id, email, enable, up, down, total, expiry_time, last_online FROM client_traffics'
+        if inbound_id > 0:
+            cur.execute(sql + ' WHERE inbound_id=?', (inbound_id,))
+        else:
+            cur.execute(sql)
+        rows = cur.fetchall()
+    except sqlite3.OperationalError:
+        cur.execute('SELECT 0, email, enable, up, down, 0, expiry_time, 0 FROM client_traffics')
+        rows = cur.fetchall()
+    return [
+        {'inbound_id': r[0] or 0, 'email': r[1] or '', 'enable': 1 if r[2] else 0, 'up': r[3] or 0, 'down': r[4] or 0,
+         'total': r[5] or 0, 'expiry_time': r[6] or 0, 'last_online': r[7] or 0}
+        for r in rows
+    ]
+
+
+def _resolve_inbound(cur, inbound_id):
+    if inbound_id > 0:
+        cur.execute('SELECT id FROM inbounds WHERE id=?', (inbound_id,))
+        row = cur.fetchone()
+        if row:
+            return int(row[0])
+    cur.execute('SELECT id, protocol, stream_settings FROM inbounds')
+    rows = cur.fetchall()
+    for iid, proto, stream_settings in rows:
+        if proto != 'vless':
+            continue
+        try:
+            ss = json.loads(stream_settings or '{}')
+        except Exception:
+            continue
+        reality = ss.get('realitySettings') or {}
+        inner = reality.get('settings') or {}
+        if inner.get('publicKey') and reality.get('serverNames') and reality.get('shortIds'):
+            return int(iid)
+    for iid, proto, _ in rows:
+        if proto == 'vless':
+            return int(iid)
+    return None
+
+
+def _apply_client(clients, by_email, by_tg, rec, flow, now):
+    email = str(rec.get('email') or '')
+    tg_id = str(rec.get('tg_id') or '')
+    comment = str(rec.get('comment') or '')
+    force_comment = bool(rec.get('force_comment'))
+    try:
+        tg_value = int(tg_id)
+    except Exception:
+        tg_value = tg_id
+    c = by_email.get(email)
+    if c is None and tg_id:
+        c = by_tg.get(tg_id)
+    if c is not None:
+        c['id'] = str(rec.get('uuid') or '')
+        c['email'] = email
+        c['expiryTime'] = int(rec.get('expiry_ms') or 0)
+        c['enable'] = True
+        c['subId'] = str(rec.get('sub_id') or '')
+        c['tgId'] = tg_value
+        if flow and not c.get('flow'):
+            c['flow'] = flow
+        if comment:
+            if force_comment or str(c.get('comment') or '') != comment:
+                c['comment'] = comment
+            if force_comment or str(c.get('_comment') or '') != comment:
+                c['_comment'] = comment
+        if not c.get('created_at'):
+            c['created_at'] = now
+        c['updated_at'] = now
+        if 'reset' not in c:
+            c['reset'] = 0
+        return False
+    c = {
+        'id': str(rec.get('uuid') or ''),
+        'email': email,
+        'limitIp': 0,
+        'totalGB': 0,
+        'expiryTime': int(rec.get('expiry_ms') or 0),
+        'enable': True,
+        'subId': str(rec.get('sub_id') or ''),
+        'created_at': now,
+        'updated_at': now,
+        'comment': comment,
+        '_comment': comment,
+        'reset': 0,
+        'tgId': tg_value,
+    }
+    if flow:
+        c['flow'] = flow
+    clients.append(c)
+    by_email[email] = c
+    if tg_id:
+        by_tg[tg_id] = c
+    return True
+
+
+def upsert_clients(params):
+    records = [r for r in (params.get('clients') or []) if r.get('email') and r.get('uuid') and r.get('sub_id')]
+    if not records:
+        return {'ok': True, 'added': 0, 'updated': 0}
+    conn = _db()
+    cur = conn.cursor()
+    inbound_id = _resolve_inbound(cur, int(params.get('inbound_id') or 0))
+    if inbound_id is None:
+        return {'ok': False, 'error': 'inbound_not_found'}
+    flow = str(params.get('flow') or '')
+    cur.execute('SELECT settings FROM inbounds WHERE id=?', (inbound_id,))
+    row = cur.fetchone()
+    try:
+        settings = json.loads((row[0] if row else None) or '{}')
+    except Exception:
+        settings = {}
+    clients = settings.get('clients') or []
+    by_email = {str(c.get('email') or ''): c for c in clients}
+    by_tg = {str(c.get('tgId') or ''): c for c in clients if c.get('tgId')}
+    now = int(time.time() * 1000)
+    added = updated = 0
+    try:
+        for rec in records:
+            if _apply_client(clients, by_email, by_tg, rec, flow, now):
+                added += 1
+            else:
+                updated += 1
+        settings['clients'] = clients
+        cur.execute('UPDATE inbounds SET settings=? WHERE id=?', (json.dumps(settings, ensure_ascii=False), inbound_id))
+        for rec in records:
+            email = str(rec.get('email') or '')
+            expiry = int(rec.get('expiry_ms') or 0)
+            try:
+                cur.execute('UPDATE client_traffics SET enable=1, expiry_time=?, reset=0 WHERE inbound_id=? AND email=?', (expiry, inbound_id, email))
+                if cur.rowcount == 0:
+                    cur.execute('INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online) VALUES (?, 1, ?, 0, 0, ?, 0, 0, 0, 0)', (inbound_id, email, expiry))
+            except sqlite3.OperationalError:
+                cur.execute('UPDATE client_traffics SET enable=1, expiry_time=? WHERE email=?', (expiry, email))
+                if cur.rowcount == 0:
+                    cur.execute('INSERT INTO client_traffics (enable, email, up, down, expiry_time) VALUES (1, ?, 0, 0, ?)', (email, expiry))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if params.get('restart', True):
+        _restart_xui()
+    return {'ok': True, 'inbound_id': inbound_id, 'added': added, 'updated': updated}
+
+
+def _touch_client_traffic(cur, inbound_id, client):
+    email = str(client.get('email') or '')
+    if not email:
+        return
+    expiry = int(client.get('expiryTime') or 0)
+    enable = 1 if client.get('enable') else 0
+    reset = int(client.get('reset') or 0)
+    cur.execute('SELECT 1 FROM client_traffics WHERE email=?', (email,))
+    if cur.fetchone() is None:
+        try:
+            cur.execute('INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online) VALUES (?, ?, ?, 0, 0, ?, 0, ?, 0, 0)', (inbound_id, enable, email, expiry, reset))
+        except sqlite3.OperationalError:
+            cur.execute('INSERT INTO client_traffics (enable, email, up, down, expiry_time) VALUES (?, ?, 0, 0, ?)', (enable, email, expiry))
+    else:
+        try:
+            cur.execute('UPDATE client_traffics SET enable=?, expiry_time=?, reset=? WHERE email=?', (enable, expiry, reset, email))
+        except sqlite3.OperationalError:
+            cur.execute('UPDATE client_traffics SET enable=?, expiry_time=? WHERE email=?', (enable, expiry, email))
+
+
+def sync_inbound(params):
+    port = int(params.get('port') or 0)
+    protocol = str(params.get('protocol') or '')
+    conn = _db()
+    cur = conn.cursor()
+    cur.execute('SELECT id, port, protocol, settings FROM inbounds')
+    rows = cur.fetchall()
+    target = None
+    for row in rows:
+        if row[2] == protocol and int(row[1] or 0) == port:
+            target = row
+            break
+    if target is None:
+        for row in rows:
+            if row[2] == protocol:
+                target = row
+                break
+    if target is None:
+        return {'ok': False, 'error': 'inbound_not_found'}
+    inbound_id = target[0]
+    try:
+        if params.get('full'):
+            try:
+                settings = json.loads(params.get('settings') or '{}')
+            except Exception:
+                settings = {}
+            try:
+                stream = json.loads(params.get('stream_settings') or '{}')
+            except Exception:
+                stream = {}
+            cur.execute('UPDATE inbounds SET port=?, protocol=?, settings=?, stream_settings=? WHERE id=?', (port, protocol, json.dumps(settings, ensure_ascii=False), json.dumps(stream, ensure_ascii=False), inbound_id))
+            touched = settings.get('clients') or []
+        else:
+            try:
+                settings = json.loads(target[3] or '{}')
+            except Exception:
+                settings = {}
+            removed = set(str(e) for e in (params.get('remove') or []))
+            touched = [c for c in (params.get('upsert') or []) if c.get('email')]
+            pending = {str(c.get('email')): c for c in touched}
+            merged = []
+            for c in settings.get('clients') or []:
+                email = str(c.get('email') or '')
+                if email in removed:
+                    continue
+                merged.append(pending.pop(email, c))
+            merged.extend(pending.values())
+            settings['clients'] = merged
+            cur.execute('UPDATE inbounds SET settings=? WHERE id=?', (json.dumps(settings, ensure_ascii=False), inbound_id))
+        for client in touched:
+            _touch_client_traffic(cur, inbound_id, client)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if params.get('restart', True):
+        _restart_xui()
+    return {'ok': True, 'id': inbound_id, 'touched': len(touched)}
+
+
+METHODS = {
+    'ping': lambda params: {'ok': True, 'pid': os.getpid()},
+    'sync_inbound': sync_inbound,
+    'get_status': get_status,
+    'get_xui_data': get_xui_data,
+    'get_client_traffic': get_client_traffic,
+    'get_all_client_traffics': get_all_client_traffics,
+    'upsert_clients': upsert_clients,
+}
+'''
+
+_REMOTE_AGENT_MAIN = r'''
+
+
+def main():
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        req_id = None
+        try:
+            req = json.loads(line)
+            req_id = req.get('id')
+            handler = METHODS.get(str(req.get('method') or ''))
+            if handler is None:
+                raise ValueError('unknown method')
+            reply = {'id': req_id, 'result': handler(req.get('params') or {})}
+        except Exception as e:
+            if isinstance(e, sqlite3.Error):
+                _reset_db()
+            reply = {'id': req_id, 'error': str(e) or type(e).__name__}
+        sys.stdout.write(json.dumps(reply, ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
+'''
+
+_REMOTE_AGENT_SOURCE = _REMOTE_AGENT_LIB + _REMOTE_AGENT_MAIN
+_REMOTE_AGENT_VERSION = hashlib.sha256(_REMOTE_AGENT_SOURCE.encode("utf-8")).hexdigest()[:12]
+
+SSHPoolKey: TypeAlias = tuple[str, int, str]
+
+_SSH_POOL: dict[SSHPoolKey, paramiko.SSHClient] = {}
+_SSH_POOL_LOCK = threading.Lock()
+_REMOTE_AGENT_SESSIONS: dict[SSHPoolKey, "_RemoteAgentSession"] = {}
+_REMOTE_AGENT_LOCK = threading.Lock()
+
+
+_REMOTE_CALL_STATE = threading.local()
+
+
+def _track_ssh_client(client: paramiko.SSHClient, pool_key: Optional[SSHPoolKey] = None) -> None:
+    """Remember a client used by the current _run_remote_blocking call, so a timed-out call can release it.
+
+    Pooled clients are shared with other calls, so they carry their pool key and are evicted rather than closed.
+    """
+    clients = getattr(_REMOTE_CALL_STATE, "clients", None)
+    if clients is not None:
+        clients[client] = pool_key
+
+
+def _ssh_pool_get(host: str, port: int, username: str, password: str) -> paramiko.SSHClient:
+    key: SSHPoolKey = (host, int(port), username)
+    with _SSH_POOL_LOCK:
+        client = _SSH_POOL.get(key)
+        if client is not None:
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                _track_ssh_client(client, key)
+                return client
+            _SSH_POOL.pop(key, None)
+            try:
+                client.close()
+            except Exception:
+                pass
+    client = paramiko.SSHClient()
+    _track_ssh_client(client)
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        hostname=host,
+        port=port,
+        username=username,
+        password=password,
+        timeout=8,
+        banner_timeout=8,
+        auth_timeout=8,
+        look_for_keys=False,
+        allow_agent=False,
+    )
+    transport = client.get_transport()
+    if transport is not None:
+        transport.set_keepalive(30)
+    with _SSH_POOL_LOCK:
+        existing = _SSH_POOL.get(key)
+        if existing is not None:
+            client.close()
+            _track_ssh_client(existing, key)
+            return existing
+        _SSH_POOL[key] = client
+    _track_ssh_client(client, key)
+    return client
+
+
+def _ssh_pool_drop(host: str, port: int, username: str) -> None:
+    key: SSHPoolKey = (host, int(port), username)
+    with _REMOTE_AGENT_LOCK:
+        session = _REMOTE_AGENT_SESSIONS.pop(key, None)
+    if session is not None:
+        session.close()
+    with _SSH_POOL_LOCK:
+        client = _SSH_POOL.pop(key, None)
+    if client is not None:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+def _remote_agent_path() -> str:
+    return f"{REMOTE_AGENT_DIR.rstrip('/')}/x-ui-bot-agent-{_REMOTE_AGENT_VERSION}.py"
+
+
+def _ensure_remote_agent_installed(client: paramiko.SSHClient) -> str:
+    path = _remote_agent_path()
+    sftp = client.open_sftp()
+    try:
+        try:
+            sftp.stat(path)
+            return path
+        except IOError:
+            pass
+        tmp_path = f"{path}.tmp"
+        sftp.putfo(BytesIO(_REMOTE_AGENT_SOURCE.encode("utf-8")), tmp_path)
+        sftp.chmod(tmp_path, 0o700)
+        sftp.posix_rename(tmp_path, path)
+        return path
+    finally:
+        sftp.close()
+
+
+class _RemoteAgentSession:
+    """One long-lived agent process on a node, spoken to as JSON lines over an SSH exec channel."""
+
+    def __init__(self, client: paramiko.SSHClient, path: str) -> None:
+        transport = client.get_transport()
+        if transport is None:
+            raise RuntimeError("ssh transport is not connected")
+        self.channel = transport.open_session()
+        self.channel.exec_command(f"python3 -u {shlex.quote(path)}")
+        self.stdout = self.channel.makefile("rb")
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def alive(self) -> bool:
+        return not self.channel.closed and not self.channel.exit_status_ready()
+
+    def call(self, method: str, params: Optional[dict[str, Any]], timeout: float) -> Any:
+        with self.lock:
+            self.next_id += 1
+            req_id = self.next_id
+            payload = json.dumps({"id": req_id, "method": method, "params": params or {}}, ensure_ascii=False)
+            self.channel.settimeout(timeout)
+            self.channel.sendall((payload + "\n").encode("utf-8"))
+            while True:
+                line = self.stdout.readline()
+                if not line:
+                    raise RuntimeError("agent channel closed")
+                reply = json.loads(line)
+                if not isinstance(reply, dict) or reply.get("id") != req_id:
+                    continue
+                if reply.get("error"):
+                    raise RuntimeError(f"agent error: {reply['error']}")
+                return reply.get("result")
+
+    def close(self) -> None:
+        try:
+            self.channel.close()
+        except Exception:
+            pass
+
+
+def _remote_agent_session(host: str, port: int, username: str, password: str) -> "_RemoteAgentSession":
+    key: SSHPoolKey = (host, int(port), username)
+    with _REMOTE_AGENT_LOCK:
+        session = _REMOTE_AGENT_SESSIONS.get(key)
+        if session is not None and session.alive():
+            return session
+        _REMOTE_AGENT_SESSIONS.pop(key, None)
+    if session is not None:
+        session.close()
+    client = _ssh_pool_get(host, port, username, password)
+    path = _ensure_remote_agent_installed(client)
+    session = _RemoteAgentSession(client, path)
+    with _REMOTE_AGENT_LOCK:
+        _REMOTE_AGENT_SESSIONS[key] = session
+    return session
+
+
+def _remote_agent_call(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    method: str,
+    params: Optional[dict[str, Any]] = None,
+    timeout: Optional[float] = None,
+) -> Any:
+    call_timeout = float(timeout or REMOTE_AGENT_CALL_TIMEOUT_SEC)
+    last_error: Optional[Exception] = None
+    for _ in range(2):
+        try:
+            session = _remote_agent_session(host, port, username, password)
+            return session.call(method, params, call_timeout)
+        except Exception as exc:
+            # A reply that timed out leaves the stream out of sync; start over on a fresh connection.
+            last_error = exc
+            _ssh_pool_drop(host, port, username)
+    raise RuntimeError(f"remote agent {method} failed: {last_error}")
+
+
+def _remote_agent_try(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    method: str,
+    params: Optional[dict[str, Any]] = None,
+    timeout: Optional[float] = None,
+) -> tuple[bool, Any]:
+    if not REMOTE_AGENT_ENABLE:
+        return False, None
+    try:
+        return True, _remote_agent_call(host, port, username, password, method, params, timeout)
+    except Exception as exc:
+        logging.warning(f"Remote agent {method} failed for {host}:{port}, falling back to one-shot SSH: {exc}")
+        return False, None
+
+def _ssh_fetch_remote_xui_data(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+) -> Optional[dict[str, Any]]:
+    used_agent, agent_data = _remote_agent_try(host, port, username, password, "get_xui_data")
+    if used_agent and isinstance(agent_data, dict):
+        return agent_data
+    client = None
+    try:
+        client = paramiko.SSHClient()
+        _track_ssh_client(client)
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            hostname=host,
+            port=port,
+            username=username,
+            password=password,
+            timeout=6,
+            banner_timeout=6,
+            auth_timeout=6,
+            look_for_keys=False,
+            allow_agent=False,
+        )
+        cmd = (
+            "python3 - <<'PY'\n"
+            "import json, sqlite3, os\n"
+            "db=os.getenv('XUI_DB_PATH','/etc/x-ui/x-ui.db')\n"
+            "conn=sqlite3.connect(db)\n"
+            "cur=conn.cursor()\n"
+            "cur.execute(\"SELECT key, value FROM settings WHERE key IN ('webPort','webBasePath','subEnable','subPort','subPath','subCertFile','webCertFile')\")\n"
+            "settings={k:v for k,v in cur.fetchall()}\n"
+            "cur.execute(\"SELECT port, stream_settings, protocol FROM inbounds\")\n"
+            "rows=cur.fetchall()\n"
+            "conn.close()\n"
+            "result={\n"
+            "    'web_port': settings.get('webPort'),\n"
+            "    'web_base_path': settings.get('webBasePath'),\n"
+            "    'sub_enable': settings.get('subEnable'),\n"
+            "    'sub_port': settings.get('subPort'),\n"
+            "    'sub_path': settings.get('subPath'),\n"
+            "    'sub_cert': settings.get('subCertFile'),\n"
+            "    'web_cert': settings.get('webCertFile'),\n"
+            "}\n"
+            "for port, stream_settings, protocol in rows:\n"
+            "    if protocol != 'vless':\n"
+            "        continue\n"
+            "    try:\n"
+            "        ss=json.loads(stream_settings or '{}')\n"
+            "    except Exception:\n"
+            "        continue\n"
+            "    reality=ss.get('realitySettings') or {}\n"
+            "    settings_inner=reality.get('settings') or {}\n"
+            "    public_key=settings_inner.get('publicKey')\n"
+            "    sni_list=reality.get('serverNames') or []\n"
+            "    sid_list=reality.get('shortIds') or []\n"
+            "    if public_key and sni_list and sid_list:\n"
+            "        result.update({\n"
+            "            'inbound_port': port,\n"
+            "            'public_key': public_key,\n"
+            "            'sni': sni_list[0],\n"
+            "            'sid': sid_list[0],\n"
+            "            'flow': settings_inner.get('flow')\n"
+            "        })\n"
+            "        break\n"
+            "print(json.dumps(result))\n"
+            "PY"
+        )
+        _, stdout, stderr = client.exec_command(cmd, timeout=12)
+        output = stdout.read().decode("utf-8", errors="ignore").strip()
+        error = stderr.read().decode("utf-8", errors="ignore").strip()
+        if not output:
+            if error:
+                logging.warning(f"SSH sync error for {host}:{port}: {error}")
+            return None
+        try:
+            data = json.loads(output)
+        except Exception:
+            logging.warning(f"SSH sync invalid json for {host}:{port}: {output}")
+            return None
+        if not isinstance(data, dict):
+            return None
+        if error:
+            logging.warning(f"SSH sync stderr for {host}:{port}: {error}")
+        return data
+    except Exception as exc:
+        logging.warning(f"SSH sync exception for {host}:{port}: {exc}")
+        return None
+    finally:
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+def _ssh_fetch_remote_server_status(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+) -> Optional[dict[str, Any]]:
+    used_agent, agent_data = _remote_agent_try(host, port, username, password, "get_status")
+    if used_agent and isinstance(agent_data, dict):
+        return agent_data
+    client = None
+    try:
+        client = paramiko.SSHClient()
+        _track_ssh_client(client)
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         client.connect(
             hostname=host,
@@ -2513,6 +3719,7 @@ def _ssh_run_remote_command(
     client = None
     try:
         client = paramiko.SSHClient()
+        _track_ssh_client(client)
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         client.connect(
             hostname=host,
@@ -2526,9 +3733,10 @@ def _ssh_run_remote_command(
             allow_agent=False,
         )
         _, stdout, stderr = client.exec_command(command, timeout=timeout)
-        rc = int(stdout.channel.recv_exit_status())
+        # Reads honour the channel timeout; the exit status is only waited for once the output is drained.
         out = stdout.read().decode("utf-8", errors="ignore").strip()
         err = stderr.read().decode("utf-8", errors="ignore").strip()
+        rc = int(stdout.channel.recv_exit_status())
         return rc, out, err
     except Exception as exc:
         return 1, "", str(exc)
@@ -2540,184 +3748,110 @@ def _ssh_run_remote_command(
                 pass
 
 
-def _ssh_update_remote_xray(
+def _ssh_pool_exec(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    command: str,
+    timeout: int = 180,
+) -> tuple[int, str, str]:
+    try:
+        client = _ssh_pool_get(host, port, username, password)
+        _, stdout, stderr = client.exec_command(command, timeout=timeout)
+        # Reads honour the channel timeout; the exit status is only waited for once the output is drained.
+        out = stdout.read().decode("utf-8", errors="ignore").strip()
+        err = stderr.read().decode("utf-8", errors="ignore").strip()
+        rc = int(stdout.channel.recv_exit_status())
+        return rc, out, err
+    except Exception as exc:
+        _ssh_pool_drop(host, port, username)
+        return 1, "", str(exc)
+
+_XRAY_REMOTE_CANDIDATES = (
+    "/usr/local/x-ui/bin/xray-linux-amd64",
+    "/usr/local/x-ui/bin/xray",
+    "/usr/bin/xray",
+)
+_XRAY_REMOTE_RESTART = "(systemctl restart x-ui >/dev/null 2>&1 || x-ui restart >/dev/null 2>&1 || true)"
+
+def _ssh_probe_remote_xray(
     host: str,
     port: int,
     username: str,
     password: str,
+) -> tuple[Optional[str], str, Optional[str]]:
+    candidates = " ".join(shlex.quote(p) for p in _XRAY_REMOTE_CANDIDATES)
+    command = (
+        f't=""; for p in {candidates}; do if [ -f "$p" ]; then t="$p"; break; fi; done; '
+        'if [ -z "$t" ]; then t="$(command -v xray || true)"; fi; '
+        'echo "$t"; uname -m; if [ -n "$t" ]; then "$t" version 2>/dev/null | head -n1; fi'
+    )
+    rc, out, _ = _ssh_pool_exec(host, port, username, password, command, 30)
+    lines = out.splitlines() if rc == 0 else []
+    if len(lines) < 2:
+        return None, "", None
+    target = lines[0].strip() or None
+    version = _extract_semver(lines[2]) if len(lines) > 2 else None
+    return target, lines[1].strip(), version
+
+def _ssh_install_remote_xray(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    target: str,
+    local_binary: str,
 ) -> tuple[bool, str]:
-    client = None
+    staged = f"{target}.new"
     try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            hostname=host,
-            port=port,
-            username=username,
-            password=password,
-            timeout=8,
-            banner_timeout=8,
-            auth_timeout=8,
-            look_for_keys=False,
-            allow_agent=False,
-        )
-        cmd = (
-            "python3 - <<'PY'\n"
-            "import io, json, os, platform, re, shutil, stat, subprocess, tempfile, urllib.request, zipfile\n"
-            "\n"
-            "def _extract_semver(text: str):\n"
-            "    m=re.search(r'(?P<v>v?\\d+\\.\\d+\\.\\d+)', text or '')\n"
-            "    if not m:\n"
-            "        return None\n"
-            "    v=m.group('v').lstrip('v')\n"
-            "    return v or None\n"
-            "\n"
-            "def _cmd_out(cmd):\n"
-            "    try:\n"
-            "        p=subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=8)\n"
-            "        return p.returncode, (p.stdout or '').strip()\n"
-            "    except Exception as e:\n"
-            "        return 1, str(e)\n"
-            "\n"
-            "def _get_target_path():\n"
-            "    candidates=(\n"
-            "        '/usr/local/x-ui/bin/xray-linux-amd64',\n"
-            "        '/usr/local/x-ui/bin/xray',\n"
-            "        '/usr/bin/xray',\n"
-            "    )\n"
-            "    for p in candidates:\n"
-            "        if os.path.isfile(p):\n"
-            "            return p\n"
-            "    rc, out=_cmd_out(['bash','-lc','command -v xray || true'])\n"
-            "    if rc==0 and out:\n"
-            "        p=out.splitlines()[0].strip()\n"
-            "        if p and os.path.isfile(p):\n"
-            "            return p\n"
-            "    return None\n"
-            "\n"
-            "def _select_asset(machine: str):\n"
-            "    m=(machine or '').strip().lower()\n"
-            "    if m in {'x86_64','amd64'}:\n"
-            "        return 'Xray-linux-64.zip'\n"
-            "    if m in {'aarch64','arm64'}:\n"
-            "        return 'Xray-linux-arm64-v8a.zip'\n"
-            "    if m in {'armv7l','armv7'}:\n"
-            "        return 'Xray-linux-arm32-v7a.zip'\n"
-            "    if m in {'armv6l','armv6'}:\n"
-            "        return 'Xray-linux-arm32-v6.zip'\n"
-            "    if m in {'i386','i686'}:\n"
-            "        return 'Xray-linux-32.zip'\n"
-            "    return None\n"
-            "\n"
-            "target=_get_target_path()\n"
-            "if not target:\n"
-            "    print(json.dumps({'ok': False, 'detail': 'Не найден путь к бинарнику Xray'}))\n"
-            "    raise SystemExit(0)\n"
-            "\n"
-            "before_rc, before_out=_cmd_out([target,'version'])\n"
-            "before_first=(before_out.splitlines()[0].strip() if before_out else '')\n"
-            "before_ver=_extract_semver(before_first) or (before_first if before_first else None)\n"
-            "\n"
-            "req=urllib.request.Request(\n"
-            "  'https://api.github.com/repos/XTLS/Xray-core/releases/latest',\n"
-            "  headers={'Accept':'application/vnd.github+json','User-Agent':'x-ui-bot'}\n"
-            ")\n"
-            "with urllib.request.urlopen(req, timeout=25) as resp:\n"
-            "    raw=resp.read().decode('utf-8', errors='replace')\n"
-            "release=json.loads(raw)\n"
-            "assets=release.get('assets') or []\n"
-            "if not isinstance(assets, list) or not assets:\n"
-            "    print(json.dumps({'ok': False, 'detail': 'Не найдены assets в релизе Xray-core'}))\n"
-            "    raise SystemExit(0)\n"
-            "\n"
-            "preferred=_select_asset(platform.machine())\n"
-            "chosen=None\n"
-            "for a in assets:\n"
-            "    if not isinstance(a, dict):\n"
-            "        continue\n"
-            "    name=str(a.get('name') or '')\n"
-            "    url=str(a.get('browser_download_url') or '')\n"
-            "    if not name.endswith('.zip') or not url:\n"
-            "        continue\n"
-            "    if preferred and name==preferred:\n"
-            "        chosen=(name, url)\n"
-            "        break\n"
-            "if not chosen:\n"
-            "    for a in assets:\n"
-            "        if not isinstance(a, dict):\n"
-            "            continue\n"
-            "        name=str(a.get('name') or '')\n"
-            "        url=str(a.get('browser_download_url') or '')\n"
-            "        if not name.endswith('.zip') or not url:\n"
-            "            continue\n"
-            "        if name.startswith('Xray-linux-') and 'dgst' not in name:\n"
-            "            chosen=(name, url)\n"
-            "            break\n"
-            "if not chosen:\n"
-            "    print(json.dumps({'ok': False, 'detail': 'Не удалось выбрать архив Xray под текущую архитектуру'}))\n"
-            "    raise SystemExit(0)\n"
-            "\n"
-            "name, url=chosen\n"
-            "req2=urllib.request.Request(url, headers={'User-Agent':'x-ui-bot'})\n"
-            "with urllib.request.urlopen(req2, timeout=60) as resp:\n"
-            "    zip_bytes=resp.read()\n"
-            "\n"
-            "zf=zipfile.ZipFile(io.BytesIO(zip_bytes))\n"
-            "xray_member=None\n"
-            "for info in zf.infolist():\n"
-            "    fn=info.filename\n"
-            "    if fn.endswith('/'):\n"
-            "        continue\n"
-            "    base=fn.rsplit('/',1)[-1]\n"
-            "    if base=='xray':\n"
-            "        xray_member=fn\n"
-            "        break\n"
-            "if not xray_member:\n"
-            "    print(json.dumps({'ok': False, 'detail': 'В архиве релиза не найден файл xray'}))\n"
-            "    raise SystemExit(0)\n"
-            "xray_bin=zf.read(xray_member)\n"
-            "\n"
-            "dir_name=os.path.dirname(target)\n"
-            "tmp_path=os.path.join(dir_name, '.xray.tmp')\n"
-            "with open(tmp_path, 'wb') as f:\n"
-            "    f.write(xray_bin)\n"
-            "os.chmod(tmp_path, 0o755)\n"
-            "os.replace(tmp_path, target)\n"
-            "\n"
-            "after_rc, after_out=_cmd_out([target,'version'])\n"
-            "after_first=(after_out.splitlines()[0].strip() if after_out else '')\n"
-            "after_ver=_extract_semver(after_first) or (after_first if after_first else None)\n"
-            "\n"
-            "os.system('systemctl restart x-ui >/dev/null 2>&1 || x-ui restart >/dev/null 2>&1 || true')\n"
-            "before_disp=before_ver or 'unknown'\n"
-            "after_disp=after_ver or 'unknown'\n"
-            "print(json.dumps({'ok': after_rc==0, 'detail': f\"{before_disp} → {after_disp}\"}))\n"
-            "PY"
-        )
-        _, stdout, stderr = client.exec_command(cmd, timeout=220)
-        output = stdout.read().decode("utf-8", errors="ignore").strip()
-        error = stderr.read().decode("utf-8", errors="ignore").strip()
-        if not output:
-            return False, error or "empty_output"
+        client = _ssh_pool_get(host, port, username, password)
+        sftp = client.open_sftp()
         try:
-            data = json.loads(output)
-        except Exception:
-            return False, output[:1500]
-        if not isinstance(data, dict):
-            return False, "invalid_json"
-        ok = bool(data.get("ok"))
-        detail = str(data.get("detail") or "").strip() or "—"
-        if error:
-            detail = f"{detail}\n{error}".strip()
-        return ok, detail[:1500]
+            sftp.put(local_binary, staged)
+            sftp.chmod(staged, 0o755)
+        finally:
+            sftp.close()
     except Exception as exc:
+        _ssh_pool_drop(host, port, username)
         return False, str(exc)[:1500]
-    finally:
-        if client is not None:
-            try:
-                client.close()
-            except Exception:
-                pass
+    q_target = shlex.quote(target)
+    q_staged = shlex.quote(staged)
+    q_backup = shlex.quote(f"{target}.bak")
+    # The staged binary must run before it replaces the live one; if x-ui does not come back afterwards
+    # the previous binary is restored from .bak on the spot.
+    command = (
+        f"{q_staged} version >/dev/null 2>&1 || {{ rm -f {q_staged}; echo staged_binary_failed; exit 2; }}; "
+        f"cp -p {q_target} {q_backup} && mv -f {q_staged} {q_target} || exit 3; "
+        f"{_XRAY_REMOTE_RESTART}; sleep 3; "
+        f"if {q_target} version >/dev/null 2>&1 && (systemctl is-active --quiet x-ui || pgrep -x x-ui >/dev/null); then "
+        f"{q_target} version | head -n1; "
+        f"else mv -f {q_backup} {q_target}; {_XRAY_REMOTE_RESTART}; echo rolled_back; exit 4; fi"
+    )
+    rc, out, err = _ssh_pool_exec(host, port, username, password, command, 120)
+    if rc != 0:
+        return False, (out or err or f"rc={rc}")[:1500]
+    return True, _extract_semver(out) or out[:200] or "unknown"
+
+def _ssh_rollback_remote_xray(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+) -> tuple[bool, str]:
+    target, _, _ = _ssh_probe_remote_xray(host, port, username, password)
+    if not target:
+        return False, "Не найден путь к бинарнику Xray"
+    q_target = shlex.quote(target)
+    q_backup = shlex.quote(f"{target}.bak")
+    command = (
+        f"[ -f {q_backup} ] || {{ echo no_backup; exit 2; }}; "
+        f"mv -f {q_backup} {q_target} && {_XRAY_REMOTE_RESTART}; {q_target} version | head -n1"
+    )
+    rc, out, err = _ssh_pool_exec(host, port, username, password, command, 90)
+    if rc != 0:
+        return False, (out or err or f"rc={rc}")[:1500]
+    return True, _extract_semver(out) or out[:200] or "unknown"
 
 def _get_master_inbound_payload() -> Optional[dict[str, Any]]:
     try:
@@ -2750,120 +3884,234 @@ def _ssh_sync_remote_inbound(
     password: str,
     inbound_payload: dict[str, Any],
 ) -> bool:
-    client = None
+    master_port = int(inbound_payload.get("port") or 0)
+    master_protocol = str(inbound_payload.get("protocol") or "")
+    settings_raw = str(inbound_payload.get("settings") or "")
+    if not master_port or not master_protocol or not settings_raw:
+        return False
+    params = {
+        "full": True,
+        "port": master_port,
+        "protocol": master_protocol,
+        "settings": settings_raw,
+        "stream_settings": str(inbound_payload.get("stream_settings") or ""),
+    }
+    ok, data = _remote_lib_call(host, port, username, password, "sync_inbound", params)
+    return bool(ok and isinstance(data, dict) and data.get("ok"))
+
+def _ssh_sync_remote_inbound_delta(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    inbound_payload: dict[str, Any],
+    upsert: list[dict[str, Any]],
+    remove: list[str],
+) -> bool:
+    params = {
+        "full": False,
+        "port": int(inbound_payload.get("port") or 0),
+        "protocol": str(inbound_payload.get("protocol") or ""),
+        "upsert": upsert,
+        "remove": remove,
+    }
+    ok, data = _remote_lib_call(host, port, username, password, "sync_inbound", params)
+    return bool(ok and isinstance(data, dict) and data.get("ok"))
+
+def _inbound_replication_snapshot(
+    inbound_payload: Mapping[str, Any],
+) -> Optional[tuple[str, dict[str, str], dict[str, dict[str, Any]]]]:
     try:
-        master_port = int(inbound_payload.get("port") or 0)
-        master_protocol = str(inbound_payload.get("protocol") or "")
-        settings_raw = str(inbound_payload.get("settings") or "")
-        stream_raw = str(inbound_payload.get("stream_settings") or "")
-        if not master_port or not master_protocol or not settings_raw:
-            return False
-        settings_b64 = base64.b64encode(settings_raw.encode("utf-8")).decode("utf-8")
-        stream_b64 = base64.b64encode(stream_raw.encode("utf-8")).decode("utf-8")
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            hostname=host,
-            port=port,
-            username=username,
-            password=password,
-            timeout=8,
-            banner_timeout=8,
-            auth_timeout=8,
-            look_for_keys=False,
-            allow_agent=False,
+        settings = json.loads(str(inbound_payload.get("settings") or ""))
+    except Exception:
+        return None
+    if not isinstance(settings, dict):
+        return None
+    clients = settings.pop("clients", None) or []
+    base_raw = json.dumps(
+        {
+            "port": inbound_payload.get("port"),
+            "protocol": inbound_payload.get("protocol"),
+            "settings": settings,
+            "stream_settings": inbound_payload.get("stream_settings"),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    base_hash = hashlib.sha256(base_raw.encode("utf-8")).hexdigest()
+    hashes: dict[str, str] = {}
+    by_email: dict[str, dict[str, Any]] = {}
+    for client in clients:
+        if not isinstance(client, dict):
+            continue
+        email = str(client.get("email") or "")
+        if not email:
+            continue
+        client_raw = json.dumps(client, sort_keys=True, ensure_ascii=False)
+        hashes[email] = hashlib.sha256(client_raw.encode("utf-8")).hexdigest()[:16]
+        by_email[email] = client
+    return base_hash, hashes, by_email
+
+def _inbound_client_delta(old: Mapping[str, str], new: Mapping[str, str]) -> tuple[list[str], list[str]]:
+    changed = [email for email, digest in new.items() if old.get(email) != digest]
+    removed = [email for email in old if email not in new]
+    return changed, removed
+
+def _get_inbound_replica_state(node_key: str) -> Optional[dict[str, Any]]:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT base_hash, client_hashes, full_synced_at FROM remote_inbound_replicas WHERE node_key=?",
+            (node_key,),
         )
-        cmd = (
-            "python3 - <<'PY'\n"
-            "import base64, json, sqlite3, os\n"
-            "db=os.getenv('XUI_DB_PATH','/etc/x-ui/x-ui.db')\n"
-            "settings_raw=base64.b64decode('" + settings_b64 + "').decode('utf-8', errors='ignore')\n"
-            "stream_raw=base64.b64decode('" + stream_b64 + "').decode('utf-8', errors='ignore')\n"
-            "try:\n"
-            "    settings=json.loads(settings_raw)\n"
-            "except Exception:\n"
-            "    settings={}\n"
-            "try:\n"
-            "    stream=json.loads(stream_raw)\n"
-            "except Exception:\n"
-            "    stream={}\n"
-            "conn=sqlite3.connect(db)\n"
-            "cur=conn.cursor()\n"
-            "cur.execute(\"SELECT id, port, protocol FROM inbounds\")\n"
-            "rows=cur.fetchall()\n"
-            "target_id=None\n"
-            "for iid, ip, proto in rows:\n"
-            "    if proto == '" + master_protocol + "' and int(ip or 0) == " + str(master_port) + ":\n"
-            "        target_id=iid\n"
-            "        break\n"
-            "if target_id is None:\n"
-            "    for iid, ip, proto in rows:\n"
-            "        if proto == '" + master_protocol + "':\n"
-            "            target_id=iid\n"
-            "            break\n"
-            "if target_id is None:\n"
-            "    print(json.dumps({'ok': False, 'error': 'inbound_not_found'}))\n"
-            "    conn.close()\n"
-            "    raise SystemExit(0)\n"
-            "cur.execute(\"UPDATE inbounds SET port=?, protocol=?, settings=?, stream_settings=? WHERE id=?\", "
-            "(" + str(master_port) + ", '" + master_protocol + "', json.dumps(settings, ensure_ascii=False), "
-            "json.dumps(stream, ensure_ascii=False), target_id))\n"
-            "clients=settings.get('clients') or []\n"
-            "for c in clients:\n"
-            "    email=str(c.get('email') or '')\n"
-            "    if not email:\n"
-            "        continue\n"
-            "    expiry=int(c.get('expiryTime') or 0)\n"
-            "    enable=1 if c.get('enable') else 0\n"
-            "    reset=int(c.get('reset') or 0)\n"
-            "    cur.execute(\"SELECT up, down, total, all_time, last_online FROM client_traffics WHERE email=?\", (email,))\n"
-            "    row=cur.fetchone()\n"
-            "    if row is None:\n"
-            "        try:\n"
-            "            cur.execute(\"INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online) VALUES (?, ?, ?, 0, 0, ?, 0, ?, 0, 0)\", (target_id, enable, email, expiry, reset))\n"
-            "        except Exception:\n"
-            "            try:\n"
-            "                cur.execute(\"INSERT INTO client_traffics (enable, email, up, down, expiry_time) VALUES (?, ?, 0, 0, ?)\", (enable, email, expiry))\n"
-            "            except Exception:\n"
-            "                pass\n"
-            "    else:\n"
-            "        try:\n"
-            "            cur.execute(\"UPDATE client_traffics SET enable=?, expiry_time=?, reset=? WHERE email=?\", (enable, expiry, reset, email))\n"
-            "        except Exception:\n"
-            "            try:\n"
-            "                cur.execute(\"UPDATE client_traffics SET enable=?, expiry_time=? WHERE email=?\", (enable, expiry, email))\n"
-            "            except Exception:\n"
-            "                pass\n"
-            "conn.commit()\n"
-            "conn.close()\n"
-            "os.system(\"systemctl restart x-ui >/dev/null 2>&1 || x-ui restart >/dev/null 2>&1 || true\")\n"
-            "print(json.dumps({'ok': True, 'id': target_id}))\n"
-            "PY"
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    try:
+        hashes = json.loads(row[1] or "{}")
+    except Exception:
+        return None
+    if not isinstance(hashes, dict):
+        return None
+    return {"base_hash": row[0], "client_hashes": hashes, "full_synced_at": int(row[2] or 0)}
+
+def _set_inbound_replica_state(node_key: str, base_hash: str, hashes: Mapping[str, str], full: bool) -> None:
+    now = int(time.time())
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO remote_inbound_replicas (node_key, base_hash, client_hashes, full_synced_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(node_key) DO UPDATE SET base_hash=excluded.base_hash, client_hashes=excluded.client_hashes, "
+            "full_synced_at=CASE WHEN ? THEN excluded.full_synced_at ELSE remote_inbound_replicas.full_synced_at END, "
+            "updated_at=excluded.updated_at",
+            (node_key, base_hash, json.dumps(dict(hashes), separators=(",", ":")), now, now, 1 if full else 0),
         )
-        _, stdout, stderr = client.exec_command(cmd, timeout=20)
-        output = stdout.read().decode("utf-8", errors="ignore").strip()
-        error = stderr.read().decode("utf-8", errors="ignore").strip()
-        if not output:
-            if error:
-                logging.warning(f"SSH inbound sync error for {host}:{port}: {error}")
-            return False
-        try:
-            data = json.loads(output)
-        except Exception:
-            logging.warning(f"SSH inbound sync invalid json for {host}:{port}: {output}")
-            return False
-        if error:
-            logging.warning(f"SSH inbound sync stderr for {host}:{port}: {error}")
-        return bool(data.get("ok"))
+        conn.commit()
+    finally:
+        conn.close()
+
+def _replicate_inbound_to_node(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    inbound_payload: dict[str, Any],
+) -> bool:
+    node_key = f"{host}:{int(port)}"
+    snapshot = _inbound_replication_snapshot(inbound_payload)
+    if snapshot is None:
+        return _ssh_sync_remote_inbound(host, port, username, password, inbound_payload)
+    base_hash, hashes, by_email = snapshot
+    state = _get_inbound_replica_state(node_key)
+    reconcile_due = (
+        state is None
+        or state["base_hash"] != base_hash
+        or REMOTE_FULL_SYNC_INTERVAL_SEC <= 0
+        or int(time.time()) - state["full_synced_at"] >= REMOTE_FULL_SYNC_INTERVAL_SEC
+    )
+    if state is None or reconcile_due:
+        ok = _ssh_sync_remote_inbound(host, port, username, password, inbound_payload)
+        if ok:
+            _set_inbound_replica_state(node_key, base_hash, hashes, full=True)
+        return ok
+    changed, removed = _inbound_client_delta(state["client_hashes"], hashes)
+    if not changed and not removed:
+        return True
+    ok = _ssh_sync_remote_inbound_delta(
+        host,
+        port,
+        username,
+        password,
+        inbound_payload,
+        [by_email[email] for email in changed],
+        removed,
+    )
+    if ok:
+        _set_inbound_replica_state(node_key, base_hash, hashes, full=False)
+    return ok
+
+def _ssh_run_python_script(client: paramiko.SSHClient, script: str, timeout: int) -> tuple[str, str]:
+    # The script goes over stdin rather than argv, so large payloads don't hit the remote ARG_MAX.
+    stdin, stdout, stderr = client.exec_command("python3 -", timeout=timeout)
+    stdin.write(script.encode("utf-8"))
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    output = stdout.read().decode("utf-8", errors="ignore").strip()
+    error = stderr.read().decode("utf-8", errors="ignore").strip()
+    return output, error
+
+def _remote_lib_call(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    method: str,
+    params: Optional[dict[str, Any]] = None,
+    timeout: int = 120,
+) -> tuple[bool, Any]:
+    used_agent, agent_data = _remote_agent_try(host, port, username, password, method, params, timeout)
+    if used_agent:
+        return True, agent_data
+    script = (
+        _REMOTE_AGENT_LIB
+        + "\nprint(json.dumps(METHODS["
+        + repr(method)
+        + "](json.loads("
+        + repr(json.dumps(params or {}, ensure_ascii=False))
+        + "))))\n"
+    )
+    try:
+        client = _ssh_pool_get(host, port, username, password)
+        output, error = _ssh_run_python_script(client, script, timeout)
     except Exception as exc:
-        logging.warning(f"SSH inbound sync exception for {host}:{port}: {exc}")
+        _ssh_pool_drop(host, port, username)
+        logging.warning(f"SSH {method} exception for {host}:{port}: {exc}")
+        return False, None
+    if not output:
+        if error:
+            logging.warning(f"SSH {method} error for {host}:{port}: {error}")
+        return False, None
+    try:
+        data = json.loads(output.splitlines()[-1])
+    except Exception:
+        logging.warning(f"SSH {method} invalid json for {host}:{port}: {output[:500]}")
+        return False, None
+    if error:
+        logging.warning(f"SSH {method} stderr for {host}:{port}: {error}")
+    return True, data
+
+def _ssh_upsert_remote_inbound_clients(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    inbound_id: int,
+    flow: str,
+    records: list[dict[str, Any]],
+) -> bool:
+    records = [r for r in records if r.get("email") and r.get("uuid") and r.get("sub_id")]
+    if not records:
         return False
-    finally:
-        if client is not None:
-            try:
-                client.close()
-            except Exception:
-                pass
+    params = {"inbound_id": int(inbound_id or 0), "flow": flow or "", "clients": records}
+    ok, data = _remote_lib_call(host, port, username, password, "upsert_clients", params)
+    return bool(ok and isinstance(data, dict) and data.get("ok"))
+
+def _ssh_fetch_remote_client_traffics(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    inbound_id: int,
+) -> Optional[list[dict[str, Any]]]:
+    ok, data = _remote_lib_call(host, port, username, password, "get_all_client_traffics", {"inbound_id": int(inbound_id or 0)})
+    if not ok or not isinstance(data, list):
+        return None
+    return [row for row in data if isinstance(row, dict) and row.get("email")]
 
 def _ssh_upsert_remote_inbound_client(
     host: str,
@@ -2880,219 +4128,113 @@ def _ssh_upsert_remote_inbound_client(
     comment: str,
     force_comment: bool = False,
 ) -> bool:
-    client = None
-    try:
-        inbound_id_int = int(inbound_id or 0)
-        expiry_ms_int = int(expiry_ms or 0)
-        if not email or not user_uuid or not sub_id:
-            return False
-
-        email_b64 = base64.b64encode(email.encode("utf-8")).decode("utf-8")
-        uuid_b64 = base64.b64encode(user_uuid.encode("utf-8")).decode("utf-8")
-        sub_b64 = base64.b64encode(sub_id.encode("utf-8")).decode("utf-8")
-        tg_b64 = base64.b64encode(str(tg_id).encode("utf-8")).decode("utf-8")
-        flow_b64 = base64.b64encode((flow or "").encode("utf-8")).decode("utf-8")
-        comment_b64 = base64.b64encode((comment or "").encode("utf-8")).decode("utf-8")
-
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            hostname=host,
-            port=port,
-            username=username,
-            password=password,
-            timeout=8,
-            banner_timeout=8,
-            auth_timeout=8,
-            look_for_keys=False,
-            allow_agent=False,
-        )
-        cmd = (
-            "python3 - <<'PY'\n"
-            "import base64, json, sqlite3, os, time\n"
-            "db=os.getenv('XUI_DB_PATH','/etc/x-ui/x-ui.db')\n"
-            f"inbound_id=int({inbound_id_int})\n"
-            f"expiry=int({expiry_ms_int})\n"
-            f"email=base64.b64decode('{email_b64}').decode('utf-8', errors='ignore')\n"
-            f"user_uuid=base64.b64decode('{uuid_b64}').decode('utf-8', errors='ignore')\n"
-            f"sub_id=base64.b64decode('{sub_b64}').decode('utf-8', errors='ignore')\n"
-            f"tg_id=base64.b64decode('{tg_b64}').decode('utf-8', errors='ignore')\n"
-            f"flow=base64.b64decode('{flow_b64}').decode('utf-8', errors='ignore')\n"
-            f"comment=base64.b64decode('{comment_b64}').decode('utf-8', errors='ignore')\n"
-            f"force_comment=bool(int({1 if force_comment else 0}))\n"
-            "conn=sqlite3.connect(db)\n"
-            "cur=conn.cursor()\n"
-            "target_id=None\n"
-            "if inbound_id > 0:\n"
-            "    cur.execute(\"SELECT id FROM inbounds WHERE id=?\", (inbound_id,))\n"
-            "    row=cur.fetchone()\n"
-            "    if row:\n"
-            "        target_id=int(row[0])\n"
-            "if target_id is None:\n"
-            "    cur.execute(\"SELECT id, protocol, stream_settings FROM inbounds\")\n"
-            "    rows=cur.fetchall()\n"
-            "    for iid, proto, stream_settings in rows:\n"
-            "        if proto != 'vless':\n"
-            "            continue\n"
-            "        try:\n"
-            "            ss=json.loads(stream_settings or '{}')\n"
-            "        except Exception:\n"
-            "            continue\n"
-            "        reality=ss.get('realitySettings') or {}\n"
-            "        settings_inner=(reality.get('settings') or {})\n"
-            "        public_key=settings_inner.get('publicKey')\n"
-            "        sni_list=reality.get('serverNames') or []\n"
-            "        sid_list=reality.get('shortIds') or []\n"
-            "        if public_key and sni_list and sid_list:\n"
-            "            target_id=int(iid)\n"
-            "            break\n"
-            "if target_id is None:\n"
-            "    cur.execute(\"SELECT id, protocol FROM inbounds\")\n"
-            "    rows=cur.fetchall()\n"
-            "    for iid, proto in rows:\n"
-            "        if proto == 'vless':\n"
-            "            target_id=int(iid)\n"
-            "            break\n"
-            "if target_id is None:\n"
-            "    print(json.dumps({'ok': False, 'error': 'inbound_not_found'}))\n"
-            "    conn.close()\n"
-            "    raise SystemExit(0)\n"
-            "inbound_id=int(target_id)\n"
-            "cur.execute('SELECT settings FROM inbounds WHERE id=?', (inbound_id,))\n"
-            "row=cur.fetchone()\n"
-            "if not row:\n"
-            "    print(json.dumps({'ok': False, 'error': 'inbound_not_found'}))\n"
-            "    conn.close()\n"
-            "    raise SystemExit(0)\n"
-            "settings_raw=row[0] or '{}'\n"
-            "try:\n"
-            "    settings=json.loads(settings_raw)\n"
-            "except Exception:\n"
-            "    settings={}\n"
-            "clients=settings.get('clients') or []\n"
-            "now=int(time.time()*1000)\n"
-            "updated=False\n"
-            "for c in clients:\n"
-            "    if str(c.get('email') or '')==email or str(c.get('tgId') or '')==tg_id:\n"
-            "        c['id']=user_uuid\n"
-            "        c['email']=email\n"
-            "        c['expiryTime']=expiry\n"
-            "        c['enable']=True\n"
-            "        c['subId']=sub_id\n"
-            "        try:\n"
-            "            c['tgId']=int(tg_id)\n"
-            "        except Exception:\n"
-            "            c['tgId']=tg_id\n"
-            "        if flow and not c.get('flow'):\n"
-            "            c['flow']=flow\n"
-            "        if comment:\n"
-            "            existing=c.get('comment')\n"
-            "            if force_comment or not existing or str(existing)!=comment:\n"
-            "                c['comment']=comment\n"
-            "            existing2=c.get('_comment')\n"
-            "            if force_comment or not existing2 or str(existing2)!=comment:\n"
-            "                c['_comment']=comment\n"
-            "        if not c.get('created_at'):\n"
-            "            c['created_at']=now\n"
-            "        c['updated_at']=now\n"
-            "        if 'reset' not in c:\n"
-            "            c['reset']=0\n"
-            "        updated=True\n"
-            "        break\n"
-            "if not updated:\n"
-            "    new_client={\n"
-            "        'id': user_uuid,\n"
-            "        'email': email,\n"
-            "        'limitIp': 0,\n"
-            "        'totalGB': 0,\n"
-            "        'expiryTime': expiry,\n"
-            "        'enable': True,\n"
-            "        'subId': sub_id,\n"
-            "        'created_at': now,\n"
-            "        'updated_at': now,\n"
-            "        'comment': comment,\n"
-            "        '_comment': comment,\n"
-            "        'reset': 0,\n"
-            "    }\n"
-            "    try:\n"
-            "        new_client['tgId']=int(tg_id)\n"
-            "    except Exception:\n"
-            "        new_client['tgId']=tg_id\n"
-            "    if flow:\n"
-            "        new_client['flow']=flow\n"
-            "    clients.append(new_client)\n"
-            "settings['clients']=clients\n"
-            "cur.execute('UPDATE inbounds SET settings=? WHERE id=?', (json.dumps(settings, ensure_ascii=False), inbound_id))\n"
-            "try:\n"
-            "    cur.execute('UPDATE client_traffics SET enable=1, expiry_time=?, reset=0 WHERE inbound_id=? AND email=?', (expiry, inbound_id, email))\n"
-            "    if cur.rowcount==0:\n"
-            "        cur.execute('INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online) VALUES (?, ?, ?, 0, 0, ?, 0, 0, 0, 0)', (inbound_id, 1, email, expiry))\n"
-            "except Exception:\n"
-            "    try:\n"
-            "        cur.execute('UPDATE client_traffics SET enable=1, expiry_time=? WHERE email=?', (expiry, email))\n"
-            "        if cur.rowcount==0:\n"
-            "            cur.execute('INSERT INTO client_traffics (enable, email, up, down, expiry_time) VALUES (1, ?, 0, 0, ?)', (email, expiry))\n"
-            "    except Exception:\n"
-            "        pass\n"
-            "conn.commit()\n"
-            "conn.close()\n"
-            "os.system('systemctl restart x-ui >/dev/null 2>&1 || x-ui restart >/dev/null 2>&1 || true')\n"
-            "print(json.dumps({'ok': True, 'updated': updated}))\n"
-            "PY"
-        )
-        _, stdout, stderr = client.exec_command(cmd, timeout=25)
-        output = stdout.read().decode("utf-8", errors="ignore").strip()
-        error = stderr.read().decode("utf-8", errors="ignore").strip()
-        if not output:
-            if error:
-                logging.warning(f"SSH client upsert error for {host}:{port}: {error}")
-            return False
-        try:
-            data = json.loads(output)
-        except Exception:
-            logging.warning(f"SSH client upsert invalid json for {host}:{port}: {output}")
-            return False
-        if error:
-            logging.warning(f"SSH client upsert stderr for {host}:{port}: {error}")
-        return bool(data.get("ok"))
-    except Exception as exc:
-        logging.warning(f"SSH client upsert exception for {host}:{port}: {exc}")
-        return False
-    finally:
-        if client is not None:
-            try:
-                client.close()
-            except Exception:
-                pass
+    record = _remote_client_record(tg_id, email, user_uuid, sub_id, expiry_ms, comment, force_comment)
+    return _ssh_upsert_remote_inbound_clients(host, port, username, password, inbound_id, flow, [record])
 
-async def _sync_mobile_inbound_client(
+def _remote_client_record(
     tg_id: str,
+    email: str,
     user_uuid: str,
     sub_id: str,
     expiry_ms: int,
     comment: str = "",
     force_comment: bool = False,
-) -> bool:
+) -> dict[str, Any]:
+    return {
+        "tg_id": str(tg_id),
+        "email": email,
+        "uuid": user_uuid,
+        "sub_id": sub_id,
+        "expiry_ms": int(expiry_ms or 0),
+        "comment": comment or "",
+        "force_comment": bool(force_comment),
+    }
+
+class _RemoteUpsertQueue:
+    """Coalesces client upserts that arrive close together into one batched push."""
+
+    def __init__(
+        self,
+        flush: Callable[[list[dict[str, Any]]], Awaitable[bool]],
+        delay_sec: float,
+        max_batch: int,
+    ) -> None:
+        self._flush = flush
+        self._delay_sec = max(0.0, delay_sec)
+        self._max_batch = max(1, max_batch)
+        self._pending: dict[str, tuple[dict[str, Any], list[asyncio.Future[bool]]]] = {}
+        self._task: Optional[asyncio.Task[None]] = None
+        self._full = asyncio.Event()
+
+    async def submit(self, record: dict[str, Any]) -> bool:
+        future: asyncio.Future[bool] = asyncio.get_running_loop().create_future()
+        key = str(record.get("email") or record.get("tg_id") or "")
+        previous = self._pending.get(key)
+        if previous is not None:
+            # Latest state wins; a forced comment rewrite from any merged update is kept.
+            record = dict(record, force_comment=bool(record.get("force_comment") or previous[0].get("force_comment")))
+            self._pending[key] = (record, previous[1] + [future])
+        else:
+            self._pending[key] = (record, [future])
+        if self._task is None or self._task.done():
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        if len(self._pending) >= self._max_batch:
+            self._full.set()
+        return await future
+
+    async def _run(self) -> None:
+        try:
+            await asyncio.wait_for(self._full.wait(), timeout=self._delay_sec)
+        except asyncio.TimeoutError:
+            pass
+        while self._pending:
+            keys = list(self._pending)[: self._max_batch]
+            batch = [self._pending.pop(key) for key in keys]
+            try:
+                ok = await self._flush([record for record, _ in batch])
+            except Exception as exc:
+                logging.warning(f"Batched client upsert failed: {exc}")
+                ok = False
+            for _, futures in batch:
+                for future in futures:
+                    if not future.done():
+                        future.set_result(ok)
+
+async def _sync_mobile_inbound_clients(records: list[dict[str, Any]]) -> bool:
     if not MOBILE_SSH_HOST or not MOBILE_SSH_USER or not MOBILE_SSH_PASSWORD:
         return False
-    email = _mobile_email(tg_id)
-    return await asyncio.get_running_loop().run_in_executor(
-        None,
-        _ssh_upsert_remote_inbound_client,
+    return await _run_remote_blocking(
+        _ssh_upsert_remote_inbound_clients,
         MOBILE_SSH_HOST,
         MOBILE_SSH_PORT,
         MOBILE_SSH_USER,
         MOBILE_SSH_PASSWORD,
         MOBILE_INBOUND_ID,
-        str(tg_id),
-        email,
-        user_uuid,
-        sub_id,
-        int(expiry_ms),
         MOBILE_FLOW,
-        comment,
-        bool(force_comment),
+        records,
+    )
+
+_MOBILE_UPSERT_QUEUE = _RemoteUpsertQueue(
+    lambda records: _sync_mobile_inbound_clients(records),
+    MOBILE_UPSERT_COALESCE_SEC,
+    MOBILE_UPSERT_BATCH_MAX,
+)
+
+async def _sync_mobile_inbound_client(
+    tg_id: str,
+    user_uuid: str,
+    sub_id: str,
+    expiry_ms: int,
+    comment: str = "",
+    force_comment: bool = False,
+) -> bool:
+    if not MOBILE_SSH_HOST or not MOBILE_SSH_USER or not MOBILE_SSH_PASSWORD:
+        return False
+    record = _remote_client_record(
+        str(tg_id), _mobile_email(tg_id), user_uuid, sub_id, int(expiry_ms), comment, bool(force_comment)
     )
+    return await _MOBILE_UPSERT_QUEUE.submit(record)
 
 def _sync_remote_node_data(
     host: str,
@@ -3107,7 +4249,7 @@ def _sync_remote_node_data(
     inbound_payload = _get_master_inbound_payload()
     inbound_synced = False
     if inbound_payload:
-        inbound_synced = _ssh_sync_remote_inbound(host, ssh_port, ssh_user, ssh_password, inbound_payload)
+        inbound_synced = _replicate_inbound_to_node(host, ssh_port, ssh_user, ssh_password, inbound_payload)
     if not inbound_synced:
         logging.warning(f"Remote inbound sync failed for {host}:{ssh_port}")
     web_port = _safe_int(ssh_data.get("web_port"))
@@ -3181,32 +4323,195 @@ def _sync_remote_node_data(
     node_ready = bool(location_ready and inbound_synced)
     return panel_ready, node_ready
 
-def _sync_remote_nodes_locations() -> bool:
-    nodes = _fetch_remote_nodes()
-    if not nodes:
-        return False
-    any_synced = False
-    for node in nodes:
+class FanoutResult(TypedDict):
+    index: int
+    ok: bool
+    value: Any
+    error: Optional[str]
+    elapsed_ms: int
+
+
+_REMOTE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=REMOTE_FANOUT_CONCURRENCY * 2,
+    thread_name_prefix="remote-node",
+)
+
+
+async def _run_remote_blocking(func: Callable[..., Any], *args: Any) -> Any:
+    # Blocking SSH calls get their own pool so a stuck node can't starve the default executor.
+    clients: dict[paramiko.SSHClient, Optional[SSHPoolKey]] = {}
+
+    def _call() -> Any:
+        _REMOTE_CALL_STATE.clients = clients
+        try:
+            return func(*args)
+        finally:
+            _REMOTE_CALL_STATE.clients = None
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_REMOTE_EXECUTOR, _call)
+    except asyncio.CancelledError:
+        # A fan-out timeout cancels only the await; closing the clients unblocks the worker thread as well.
+        # Pooled clients may be in use by other calls, so only this call's pool entry is evicted.
+        for client, pool_key in list(clients.items()):
+            if pool_key is not None:
+                with _SSH_POOL_LOCK:
+                    if _SSH_POOL.get(pool_key) is client:
+                        _SSH_POOL.pop(pool_key, None)
+                continue
+            try:
+                client.close()
+            except Exception:
+                pass
+        raise
+
+
+async def _fanout_nodes(
+    items: list[Any],
+    worker: Callable[[Any], Awaitable[Any]],
+    *,
+    concurrency: Optional[int] = None,
+    timeout: Optional[float] = None,
+    on_result: Optional[Callable[[FanoutResult], Awaitable[None]]] = None,
+) -> list[FanoutResult]:
+    limit = max(1, int(concurrency or REMOTE_FANOUT_CONCURRENCY))
+    deadline = float(REMOTE_FANOUT_NODE_TIMEOUT_SEC if timeout is None else timeout)
+    semaphore = asyncio.Semaphore(limit)
+    results: list[Optional[FanoutResult]] = [None] * len(items)
+
+    async def _run(index: int, item: Any) -> None:
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                if deadline > 0:
+                    value = await asyncio.wait_for(worker(item), timeout=deadline)
+                else:
+                    value = await worker(item)
+                result: FanoutResult = {"index": index, "ok": True, "value": value, "error": None, "elapsed_ms": 0}
+            except asyncio.TimeoutError:
+                result = {"index": index, "ok": False, "value": None, "error": "timeout", "elapsed_ms": 0}
+            except Exception as exc:
+                result = {"index": index, "ok": False, "value": None, "error": str(exc) or type(exc).__name__, "elapsed_ms": 0}
+            result["elapsed_ms"] = int((time.monotonic() - start) * 1000)
+        results[index] = result
+        if on_result is not None:
+            try:
+                await on_result(result)
+            except Exception as exc:
+                logging.warning(f"Fan-out progress callback failed: {exc}")
+
+    await asyncio.gather(*(_run(idx, item) for idx, item in enumerate(items)))
+    return [r for r in results if r is not None]
+
+
+class _FanoutProgressMessage:
+    """Edits one admin message with per-node lines as fan-out results arrive."""
+
+    def __init__(self, query: Any, header: str, lines: list[str], reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        self.query = query
+        self.header = header
+        self.lines = lines
+        self.reply_markup = reply_markup
+        self._last_edit = 0.0
+        self._lock = asyncio.Lock()
+
+    def render(self) -> str:
+        return f"{self.header}\n\n" + "\n".join(self.lines)
+
+    async def _edit(self, reply_markup: Optional[InlineKeyboardMarkup]) -> None:
+        try:
+            await self.query.edit_message_text(self.render(), reply_markup=reply_markup, parse_mode="Markdown")
+        except Exception as e:
+            if "Message is not modified" not in str(e):
+                logging.warning(f"Fan-out progress edit failed: {e}")
+        self._last_edit = time.monotonic()
+
+    async def start(self) -> None:
+        async with self._lock:
+            await self._edit(None)
+
+    async def set_line(self, index: int, line: str) -> None:
+        self.lines[index] = line
+        async with self._lock:
+            if time.monotonic() - self._last_edit >= REMOTE_FANOUT_EDIT_INTERVAL_SEC:
+                await self._edit(None)
+
+    async def finish(self) -> None:
+        async with self._lock:
+            await self._edit(self.reply_markup)
+
+
+def _remote_nodes_with_ssh() -> list[dict[str, Any]]:
+    nodes: list[dict[str, Any]] = []
+    for node in _fetch_remote_nodes():
         node_full = _get_remote_node(int(node["id"]))
         if not node_full:
             continue
-        ssh_user = node_full.get("ssh_user")
-        ssh_password = node_full.get("ssh_password")
-        if not ssh_user or not ssh_password:
+        if not node_full.get("ssh_user") or not node_full.get("ssh_password"):
             continue
-        host = node_full.get("host") or ""
-        ssh_port = int(node_full.get("port") or 22)
-        name = node_full.get("name") or host
-        panel_ready, location_ready = _sync_remote_node_data(
+        nodes.append(node_full)
+    return nodes
+
+
+async def _sync_remote_nodes_locations(
+    on_result: Optional[Callable[[FanoutResult], Awaitable[None]]] = None,
+    nodes: Optional[list[dict[str, Any]]] = None,
+) -> bool:
+    if nodes is None:
+        nodes = _remote_nodes_with_ssh()
+    if not nodes:
+        return False
+
+    async def _sync_one(node: dict[str, Any]) -> tuple[bool, bool]:
+        host = node.get("host") or ""
+        return await _run_remote_blocking(
+            _sync_remote_node_data,
             host,
-            ssh_port,
-            ssh_user,
-            ssh_password,
-            name,
+            int(node.get("port") or 22),
+            node.get("ssh_user"),
+            node.get("ssh_password"),
+            node.get("name") or host,
         )
-        if panel_ready or location_ready:
-            any_synced = True
-    return any_synced
+
+    results = await _fanout_nodes(nodes, _sync_one, on_result=on_result)
+    for result in results:
+        if not result["ok"]:
+            node = nodes[result["index"]]
+            logging.warning(f"Remote node sync failed for {node.get('host')}: {result['error']}")
+    return any(result["ok"] and any(result["value"]) for result in results)
+
+async def _sync_remote_nodes_with_progress(
+    query: Any,
+    lang: str,
+    nodes: Optional[list[dict[str, Any]]] = None,
+) -> bool:
+    """Sync nodes while one admin message shows a line per node as each finishes."""
+    if nodes is None:
+        nodes = _remote_nodes_with_ssh()
+    if not nodes:
+        return False
+    names = [_escape_markdown(str(node.get("name") or node.get("host") or "")) for node in nodes]
+    pending = t("remote_check_pending", lang)
+    progress = _FanoutProgressMessage(
+        query,
+        t("remote_nodes_sync_progress_title", lang),
+        [f"{idx}. {name} — {pending}" for idx, name in enumerate(names, start=1)],
+    )
+    await progress.start()
+
+    async def _on_result(result: FanoutResult) -> None:
+        idx = result["index"]
+        if result["ok"] and any(result["value"]):
+            status = t("remote_node_sync_ok", lang)
+        else:
+            status = t("remote_node_sync_failed", lang)
+            if result["error"]:
+                status += f" {_escape_markdown(result['error'][:100])}"
+        await progress.set_line(idx, f"{idx + 1}. {names[idx]} — {status}")
+
+    synced = await _sync_remote_nodes_locations(on_result=_on_result, nodes=nodes)
+    await progress.finish()
+    return synced
 
 def _get_master_inbound_hash() -> Optional[str]:
     payload = _get_master_inbound_payload()
@@ -3227,7 +4532,7 @@ async def _auto_sync_remote_nodes_job(context: ContextTypes.DEFAULT_TYPE) -> Non
     last_hash = _get_sync_state("master_inbound_hash")
     if inbound_hash == last_hash:
         return
-    await asyncio.get_running_loop().run_in_executor(None, _sync_remote_nodes_locations)
+    await _sync_remote_nodes_locations()
     _set_sync_state("master_inbound_hash", inbound_hash)
     _set_sync_state("master_inbound_synced_at", str(int(time.time())))
 
@@ -3243,6 +4548,11 @@ async def _check_tcp(host: str, port: int) -> bool:
     latency = await _check_tcp_latency(host, port)
     return latency is not None
 
+def _format_latency_label(latency: Optional[int], lang: str) -> str:
+    if latency is None:
+        return t("remote_check_fail", lang)
+    return f"{t('remote_check_ok', lang)} ({latency}ms)"
+
 async def _check_tcp_latency(host: str, port: int) -> Optional[int]:
     try:
         start = time.monotonic()
@@ -3258,6 +4568,283 @@ async def _check_tcp_latency(host: str, port: int) -> Optional[int]:
     except Exception:
         return None
 
+class NodeHealthSample(TypedDict):
+    ts: int
+    online: bool
+    cpu: float
+    ram: float
+    disk: float
+    rx: int
+    tx: int
+    latency: Optional[int]
+
+
+_NODE_HEALTH: dict[int, deque[NodeHealthSample]] = {}
+_NODE_XUI_CACHE: dict[int, tuple[float, dict[str, Any]]] = {}
+_NODE_XUI_CACHE_TTL_SEC = 600
+_SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def _sparkline(values: Iterable[Optional[float]], lo: Optional[float] = None, hi: Optional[float] = None) -> str:
+    points = list(values)
+    known = [v for v in points if v is not None]
+    if not known:
+        return ""
+    low = min(known) if lo is None else lo
+    high = max(known) if hi is None else hi
+    span = high - low
+    out = []
+    for value in points:
+        if value is None:
+            out.append(" ")
+            continue
+        if span <= 0:
+            out.append(_SPARK_CHARS[0])
+            continue
+        ratio = min(max((value - low) / span, 0.0), 1.0)
+        out.append(_SPARK_CHARS[int(round(ratio * (len(_SPARK_CHARS) - 1)))])
+    return "".join(out)
+
+
+def _node_health_ring(node_id: int) -> deque[NodeHealthSample]:
+    ring = _NODE_HEALTH.get(node_id)
+    if ring is None:
+        ring = deque(_load_node_health_history(node_id, NODE_HEALTH_RING_SIZE), maxlen=max(1, NODE_HEALTH_RING_SIZE))
+        _NODE_HEALTH[node_id] = ring
+    return ring
+
+
+def _node_health_latest(node_id: int) -> Optional[NodeHealthSample]:
+    ring = _node_health_ring(node_id)
+    return ring[-1] if ring else None
+
+
+def _node_health_sample(stats: Optional[Mapping[str, Any]], latency: Optional[int]) -> NodeHealthSample:
+    data = stats or {}
+    return {
+        "ts": int(time.time()),
+        "online": bool(stats),
+        "cpu": float(data.get("cpu") or 0.0),
+        "ram": float(data.get("ram_usage") or 0.0),
+        "disk": float(data.get("disk_usage") or 0.0),
+        "rx": int(data.get("rx_speed") or 0),
+        "tx": int(data.get("tx_speed") or 0),
+        "latency": latency,
+    }
+
+
+def _store_node_health_sample(node_id: int, sample: NodeHealthSample) -> None:
+    _node_health_ring(node_id).append(sample)
+    if not sample["online"]:
+        return
+    bucket_sec = max(1, NODE_HEALTH_BUCKET_SEC)
+    bucket_ts = sample["ts"] - sample["ts"] % bucket_sec
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO node_health_history (node_id, bucket_ts, cpu, ram, disk, rx, tx, latency, samples)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(node_id, bucket_ts) DO UPDATE SET
+                cpu=(cpu*samples + excluded.cpu)/(samples+1),
+                ram=(ram*samples + excluded.ram)/(samples+1),
+                disk=(disk*samples + excluded.disk)/(samples+1),
+                rx=(rx*samples + excluded.rx)/(samples+1),
+                tx=(tx*samples + excluded.tx)/(samples+1),
+                latency=CASE
+                    WHEN excluded.latency IS NULL THEN latency
+                    WHEN latency IS NULL THEN excluded.latency
+                    ELSE (latency*samples + excluded.latency)/(samples+1)
+                END,
+                samples=samples+1
+            """,
+            (node_id, bucket_ts, sample["cpu"], sample["ram"], sample["disk"], sample["rx"], sample["tx"], sample["latency"]),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _load_node_health_history(node_id: int, limit: int) -> list[NodeHealthSample]:
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT bucket_ts, cpu, ram, disk, rx, tx, latency FROM node_health_history "
+                "WHERE node_id=? ORDER BY bucket_ts DESC LIMIT ?",
+                (node_id, max(0, limit)),
+            )
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return []
+    return [
+        {
+            "ts": int(row[0]),
+            "online": True,
+            "cpu": float(row[1] or 0.0),
+            "ram": float(row[2] or 0.0),
+            "disk": float(row[3] or 0.0),
+            "rx": int(row[4] or 0),
+            "tx": int(row[5] or 0),
+            "latency": int(row[6]) if row[6] is not None else None,
+        }
+        for row in reversed(rows)
+    ]
+
+
+def _prune_node_health(active_ids: Iterable[int]) -> None:
+    keep = set(active_ids)
+    for node_id in list(_NODE_HEALTH):
+        if node_id not in keep:
+            _NODE_HEALTH.pop(node_id, None)
+            _NODE_XUI_CACHE.pop(node_id, None)
+    cutoff = int(time.time()) - max(1, NODE_HEALTH_RETENTION_DAYS) * 86400
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM node_health_history WHERE bucket_ts < ?", (cutoff,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def _probe_node_health(node: Mapping[str, Any]) -> NodeHealthSample:
+    node_id = int(node["id"])
+    host = str(node.get("host") or "")
+    port = int(node.get("port") or 22)
+    user = str(node.get("ssh_user") or "")
+    password = str(node.get("ssh_password") or "")
+    stats, latency = await asyncio.gather(
+        _run_remote_blocking(_ssh_fetch_remote_server_status, host, port, user, password),
+        _check_tcp_latency(host, port),
+    )
+    cached = _NODE_XUI_CACHE.get(node_id)
+    if stats and (cached is None or time.time() - cached[0] >= _NODE_XUI_CACHE_TTL_SEC):
+        xui_data = await _run_remote_blocking(_ssh_fetch_remote_xui_data, host, port, user, password)
+        if xui_data:
+            _NODE_XUI_CACHE[node_id] = (time.time(), xui_data)
+    sample = _node_health_sample(stats, latency)
+    _store_node_health_sample(node_id, sample)
+    return sample
+
+
+async def node_health_probe_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    nodes = _remote_nodes_with_ssh()
+    _prune_node_health(int(node["id"]) for node in nodes)
+    if not nodes:
+        return
+    results = await _fanout_nodes(nodes, _probe_node_health)
+    for node, result in zip(nodes, results):
+        if not result["ok"]:
+            _store_node_health_sample(int(node["id"]), _node_health_sample(None, None))
+            logging.warning(f"Node health probe failed for {node.get('host')}: {result['error']}")
+
+
+def _format_node_health_summary(sample: Optional[NodeHealthSample], lang: str) -> str:
+    if sample is None:
+        return t("node_health_no_data", lang)
+    if not sample["online"]:
+        return t("remote_check_fail", lang)
+    latency = f" · {sample['latency']}ms" if sample["latency"] is not None else ""
+    return f"CPU {sample['cpu']:.0f}% · RAM {sample['ram']:.0f}%{latency}"
+
+
+def _format_node_health_block(node_id: int, lang: str) -> str:
+    ring = list(_node_health_ring(node_id))
+    sample = ring[-1] if ring else None
+    if sample is None:
+        return t("node_health_no_data", lang)
+    online = [s for s in ring if s["online"]][-24:]
+    age = max(0, int(time.time()) - sample["ts"])
+    if not sample["online"]:
+        status = t("remote_check_fail", lang)
+    else:
+        status = _format_latency_label(sample["latency"], lang)
+    lines = [
+        f"{status} · {t('node_health_age', lang).format(seconds=age)}",
+        f"{t('cpu_label', lang)} {sample['cpu']:.1f}% `{_sparkline([s['cpu'] for s in online], 0, 100)}`",
+        f"{t('ram_label', lang)} {sample['ram']:.1f}% `{_sparkline([s['ram'] for s in online], 0, 100)}`",
+        f"{t('disk_label', lang)} {sample['disk']:.1f}%",
+        f"{t('upload_label', lang)} {format_bytes(sample['tx'])}/s `{_sparkline([s['tx'] for s in online], 0)}`",
+        f"{t('download_label', lang)} {format_bytes(sample['rx'])}/s `{_sparkline([s['rx'] for s in online], 0)}`",
+        f"{t('node_health_latency', lang)} `{_sparkline([s['latency'] for s in online], 0)}`",
+    ]
+    return "\n".join(lines)
+
+class XrayNodeUpdate(TypedDict):
+    ok: bool
+    detail: str
+    changed: bool
+
+
+async def _xray_update_node(node: Mapping[str, Any], release: XrayRelease) -> XrayNodeUpdate:
+    host = str(node.get("host") or "")
+    port = int(node.get("port") or 22)
+    user = str(node.get("ssh_user") or "")
+    password = str(node.get("ssh_password") or "")
+    target, machine, before = await _run_remote_blocking(_ssh_probe_remote_xray, host, port, user, password)
+    if not target:
+        return {"ok": False, "detail": "Не найден путь к бинарнику Xray", "changed": False}
+    if before and _version_tuple(before) >= _version_tuple(release["version"]):
+        return {"ok": True, "detail": before, "changed": False}
+    asset_name = _pick_xray_asset(release, machine)
+    if not asset_name:
+        return {"ok": False, "detail": f"Нет архива Xray для {machine or 'unknown'}", "changed": False}
+    cached_path, error = await _ensure_cached_xray_binary(release, asset_name)
+    if not cached_path:
+        return {"ok": False, "detail": error, "changed": False}
+    ok, detail = await _run_remote_blocking(_ssh_install_remote_xray, host, port, user, password, target, cached_path)
+    if not ok:
+        return {"ok": False, "detail": detail, "changed": False}
+    return {"ok": True, "detail": f"{before or 'unknown'} → {detail}", "changed": True}
+
+
+def _pick_xray_canary(nodes: list[dict[str, Any]], canary: str) -> int:
+    wanted = canary.strip().lower()
+    if wanted:
+        for idx, node in enumerate(nodes):
+            if wanted in (str(node.get("name") or "").lower(), str(node.get("host") or "").lower()):
+                return idx
+    return 0
+
+
+async def _rollout_xray(
+    nodes: list[dict[str, Any]],
+    update_node: Callable[[dict[str, Any]], Awaitable[XrayNodeUpdate]],
+    *,
+    concurrency: Optional[int] = None,
+    canary: Optional[str] = None,
+    on_result: Optional[Callable[[int, XrayNodeUpdate], Awaitable[None]]] = None,
+) -> tuple[list[Optional[XrayNodeUpdate]], bool]:
+    """Canary first, then waves of `concurrency` nodes; any failure stops the remaining waves."""
+    results: list[Optional[XrayNodeUpdate]] = [None] * len(nodes)
+    if not nodes:
+        return results, False
+    wave_size = max(1, concurrency or XRAY_ROLLOUT_CONCURRENCY)
+    first = _pick_xray_canary(nodes, XRAY_ROLLOUT_CANARY if canary is None else canary)
+    order = [first] + [idx for idx in range(len(nodes)) if idx != first]
+    waves = [order[:1]] + [order[i:i + wave_size] for i in range(1, len(order), wave_size)]
+
+    async def _update(idx: int) -> XrayNodeUpdate:
+        return await update_node(nodes[idx])
+
+    for wave in waves:
+        wave_results = await _fanout_nodes(wave, _update, concurrency=wave_size, timeout=XRAY_ROLLOUT_NODE_TIMEOUT_SEC)
+        for idx, fanout in zip(wave, wave_results):
+            node_result: XrayNodeUpdate = (
+                fanout["value"] if fanout["ok"] else {"ok": False, "detail": str(fanout["error"]), "changed": False}
+            )
+            results[idx] = node_result
+            if on_result is not None:
+                await on_result(idx, node_result)
+        if not all(node_result["ok"] for node_result in (results[idx] for idx in wave) if node_result is not None):
+            return results, True
+    return results, False
+
 def _get_user_client(tg_id: str) -> Optional[dict[str, Any]]:
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
@@ -3768,43 +5355,149 @@ def _get_sales_log_fuzzy_charge_dedupe_window_sec() -> int:
         return 60
     return max(0, value)
 
-def _dedupe_sales_log_rows(
-    rows: Iterable[tuple[str, int, int, str, Optional[str]]],
-) -> list[tuple[str, int, int, str, Optional[str]]]:
-    window_sec = _get_sales_log_dedupe_window_sec()
-    fuzzy_charge_window_sec = _get_sales_log_fuzzy_charge_dedupe_window_sec()
-    seen_charge_ids: set[str] = set()
-    last_ts_by_key: dict[tuple[str, int], int] = {}
-    last_idx_by_key: dict[tuple[str, int], int] = {}
-    out: list[tuple[str, int, int, str, Optional[str]]] = []
+# Sales ledger dedupe, done in SQL: repeated charge IDs keep their first row, then rows of the same
+# (tg_id, amount) form one sale while each row is within the dedupe window of the next newer one (the fuzzy
+# window when both rows carry a charge ID). A sale is listed under its newest row, with the newest known plan
+# and charge ID among its rows. Whether a row is the newest of its sale depends only on the next newer row,
+# so a page can be computed from a date range just below the cursor instead of the whole table.
+_SALES_LEDGER_SQL = """
+    WITH tx AS (
+        SELECT id, tg_id, amount, date, plan_id, {charge} AS charge_id,
+               ROW_NUMBER() OVER (PARTITION BY {charge} ORDER BY date, id) AS charge_rank
+        FROM transactions
+        WHERE tg_id != :excluded
+          AND (:since IS NULL OR date >= :since)
+          AND (:until IS NULL OR date <= :until)
+    ),
+    gaps AS (
+        SELECT *,
+               CASE WHEN LEAD(date) OVER w - date <= CASE
+                        WHEN charge_id IS NOT NULL AND LEAD(charge_id) OVER w IS NOT NULL THEN :fuzzy_window
+                        ELSE :window
+                    END
+                    THEN 0 ELSE 1 END AS is_head
+        FROM tx
+        WHERE charge_id IS NULL OR charge_rank = 1
+        WINDOW w AS (PARTITION BY tg_id, amount ORDER BY date, id)
+    ),
+    sales AS (
+        SELECT *, SUM(is_head) OVER (
+                   PARTITION BY tg_id, amount ORDER BY date DESC, id DESC ROWS UNBOUNDED PRECEDING
+               ) AS sale
+        FROM gaps
+    ),
+    ledger AS (
+        SELECT id, tg_id, amount, date, is_head,
+               FIRST_VALUE(plan_id) OVER (
+                   PARTITION BY tg_id, amount, sale
+                   ORDER BY COALESCE(plan_id, '') NOT IN ('', 'unknown') DESC, date DESC, id DESC
+               ) AS plan_id,
+               FIRST_VALUE(charge_id) OVER (
+                   PARTITION BY tg_id, amount, sale ORDER BY charge_id IS NULL, date DESC, id DESC
+               ) AS charge_id
+        FROM sales
+    )
+    SELECT id, tg_id, amount, date, plan_id, charge_id
+    FROM ledger
+    WHERE is_head = 1 AND (:before_date IS NULL OR (date, id) < (:before_date, :before_id))
+    ORDER BY date DESC, id DESC
+    LIMIT :limit
+"""
+_SALES_LOG_PAGE_SIZE = 20
+_SALES_LOG_SCAN_SPAN_SEC = 7 * 24 * 3600
 
-    for tg_id, amount, date_ts, plan_id, charge_id in rows:
-        key = (tg_id, amount)
-        last_ts = last_ts_by_key.get(key)
-        if charge_id:
-            if charge_id in seen_charge_ids:
-                continue
-            seen_charge_ids.add(charge_id)
-            active_window = fuzzy_charge_window_sec
-        else:
-            active_window = window_sec
-
-        if last_ts is not None and abs(last_ts - date_ts) <= active_window:
-            idx = last_idx_by_key.get(key)
-            if idx is not None:
-                kept_tg_id, kept_amount, kept_date_ts, kept_plan_id, kept_charge_id = out[idx]
-                kept_known = bool(kept_plan_id) and kept_plan_id != "unknown"
-                cur_known = bool(plan_id) and plan_id != "unknown"
-                if (not kept_known) and cur_known:
-                    out[idx] = (kept_tg_id, kept_amount, kept_date_ts, plan_id, kept_charge_id)
-                if kept_charge_id is None and charge_id:
-                    out[idx] = (kept_tg_id, kept_amount, kept_date_ts, kept_plan_id, charge_id)
-            continue
-        last_ts_by_key[key] = date_ts
-        last_idx_by_key[key] = len(out)
-        out.append((tg_id, amount, date_ts, plan_id, charge_id))
 
-    return out
+class SalesLedgerRow(TypedDict):
+    id: int
+    tg_id: str
+    amount: int
+    date: int
+    plan_id: str
+    charge_id: Optional[str]
+
+
+def _load_sales_ledger_page(
+    before: Optional[tuple[int, int]] = None,
+    limit: int = _SALES_LOG_PAGE_SIZE,
+) -> tuple[list[SalesLedgerRow], Optional[tuple[int, int]]]:
+    """Return one page of deduped sales, newest first, and the (date, id) keyset cursor of the next page.
+
+    The scanned date range below the cursor starts at _SALES_LOG_SCAN_SPAN_SEC and widens until the page is
+    full or the oldest transaction is reached.
+    """
+    window = _get_sales_log_dedupe_window_sec()
+    fuzzy_window = _get_sales_log_fuzzy_charge_dedupe_window_sec()
+    params: dict[str, Any] = {
+        "excluded": _ADMIN_STATS_EXCLUDED_TG_ID,
+        "window": window,
+        "fuzzy_window": fuzzy_window,
+        "before_date": before[0] if before else None,
+        "before_id": before[1] if before else None,
+        # The next newer row of a row just below the cursor decides whether that row starts a sale.
+        "until": before[0] + max(window, fuzzy_window) if before else None,
+        "limit": limit + 1,
+    }
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(date), MAX(date) FROM transactions")
+        oldest, newest = cursor.fetchone()
+        top = before[0] if before else int(newest or 0)
+        span = _SALES_LOG_SCAN_SPAN_SEC
+        while True:
+            params["since"] = top - span if oldest is not None and top - span > oldest else None
+            try:
+                cursor.execute(_SALES_LEDGER_SQL.format(charge="telegram_payment_charge_id"), params)
+            except sqlite3.OperationalError:
+                cursor.execute(_SALES_LEDGER_SQL.format(charge="NULL"), params)
+            fetched = cursor.fetchall()
+            if len(fetched) > limit or params["since"] is None:
+                break
+            span *= 4
+    finally:
+        conn.close()
+    rows: list[SalesLedgerRow] = [
+        {
+            "id": int(row_id),
+            "tg_id": str(tg_id),
+            "amount": int(amount or 0),
+            "date": int(date_ts or 0),
+            "plan_id": str(plan_id or "unknown"),
+            "charge_id": charge_id,
+        }
+        for row_id, tg_id, amount, date_ts, plan_id, charge_id in fetched
+    ]
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]["date"], rows[-1]["id"])
+
+
+def _sales_log_names(tg_ids: Iterable[str]) -> dict[str, str]:
+    """Map tg_id to the client comment, name or @username from the user search index (user_prefs as fallback)."""
+    rowids = sorted({rowid for rowid in (_user_search_rowid(tg_id) for tg_id in tg_ids) if rowid is not None})
+    if not rowids:
+        return {}
+    marks = ",".join("?" for _ in rowids)
+    names: dict[str, str] = {}
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT rowid, comment, name, username FROM user_search WHERE rowid IN ({marks})", rowids)
+        except sqlite3.OperationalError:
+            cursor.execute(
+                f"SELECT tg_id, NULL, TRIM(COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')), username "
+                f"FROM user_prefs WHERE tg_id IN ({marks})",
+                [str(rowid) for rowid in rowids],
+            )
+        for tg_id, comment, name, username in cursor.fetchall():
+            label = comment or name or (f"@{username}" if username else "")
+            if label:
+                names[str(tg_id)] = str(label)
+    finally:
+        conn.close()
+    return names
 
 _MISSED_TX_LOG_THROTTLE: dict[str, float] = {}
 
@@ -3832,6 +5525,58 @@ def get_client_tg_id(client: Dict[str, Any]) -> Optional[str]:
             return possible
     return None
 
+class ChatProfile(TypedDict):
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+
+# tg_id -> (expires_at monotonic, profile); None marks a chat Telegram refused to resolve (negative entry).
+_CHAT_PROFILE_CACHE: dict[str, tuple[float, Optional[ChatProfile]]] = {}
+_CHAT_PROFILE_CACHE_MAX = 50000
+
+
+def _remember_chat_profile(tg_id: Any, profile: Optional[ChatProfile]) -> None:
+    ttl = CHAT_PROFILE_TTL_SEC if profile is not None else CHAT_PROFILE_NEGATIVE_TTL_SEC
+    if ttl <= 0:
+        return
+    if len(_CHAT_PROFILE_CACHE) >= _CHAT_PROFILE_CACHE_MAX:
+        now = time.monotonic()
+        for key in [key for key, (expires, _p) in _CHAT_PROFILE_CACHE.items() if expires <= now]:
+            _CHAT_PROFILE_CACHE.pop(key, None)
+        if len(_CHAT_PROFILE_CACHE) >= _CHAT_PROFILE_CACHE_MAX:
+            _CHAT_PROFILE_CACHE.pop(next(iter(_CHAT_PROFILE_CACHE)), None)
+    _CHAT_PROFILE_CACHE[str(tg_id)] = (time.monotonic() + ttl, profile)
+
+
+async def _get_chat_profile(bot: Any, tg_id: Any, bucket: Optional["_TokenBucket"] = None) -> Optional[ChatProfile]:
+    """
+    get_chat through a TTL cache. Returns None for chats Telegram cannot resolve (cached for
+    CHAT_PROFILE_NEGATIVE_TTL_SEC); transient errors such as RetryAfter or timeouts are raised, not cached.
+    """
+    key = str(tg_id)
+    cached = _CHAT_PROFILE_CACHE.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    if bucket is not None:
+        await bucket.acquire()
+    try:
+        chat = await bot.get_chat(int(key) if key.lstrip("-").isdigit() else key)
+    except (BadRequest, Forbidden):
+        _remember_chat_profile(key, None)
+        return None
+    profile: ChatProfile = {
+        "username": getattr(chat, "username", None),
+        "first_name": getattr(chat, "first_name", None),
+        "last_name": getattr(chat, "last_name", None),
+    }
+    if cached is None or cached[1] != profile:
+        update_user_info(key, profile["username"], profile["first_name"], profile["last_name"])
+    else:
+        _remember_chat_profile(key, profile)
+    return profile
+
+
 def update_user_info(tg_id, username, first_name, last_name):
     try:
         conn = sqlite3.connect(BOT_DB_PATH)
@@ -3857,8 +5602,12 @@ def update_user_info(tg_id, username, first_name, last_name):
 
         conn.commit()
         conn.close()
+        _ADMIN_STATS.note_user(tg_id)
     except Exception as e:
         logging.error(f"Error updating user info: {e}")
+    name = " ".join(part for part in (first_name, last_name) if part)
+    _index_user_search([(tg_id, {"username": username, "name": name})])
+    _remember_chat_profile(tg_id, {"username": username, "first_name": first_name, "last_name": last_name})
 
 def get_flag_emoji(country_code):
     if not country_code:
@@ -3893,6 +5642,7 @@ def set_lang(tg_id, lang):
         cursor.execute("INSERT INTO user_prefs (tg_id, lang) VALUES (?, ?)", (str(tg_id), lang))
     conn.commit()
     conn.close()
+    _ADMIN_STATS.note_user(tg_id)
 
 def get_user_data(tg_id):
     conn = sqlite3.connect(BOT_DB_PATH)
@@ -3916,6 +5666,7 @@ def set_referrer(tg_id, referrer_id):
 
     conn.commit()
     conn.close()
+    _ADMIN_STATS.note_user(tg_id)
 
 def _parse_start_payload(args: list[str], tg_id: str) -> tuple[Optional[str], str]:
     if not args:
@@ -3963,6 +5714,7 @@ def record_start_payload(tg_id: str, start_payload: str) -> None:
         )
         conn.commit()
         conn.close()
+        _ADMIN_STATS.note_user(tg_id)
     except Exception as e:
         logging.error(f"Error recording start payload: {e}")
 
@@ -3994,6 +5746,7 @@ def mark_trial_used(tg_id):
     """, (str(tg_id), current_time, current_time))
     conn.commit()
     conn.close()
+    _ADMIN_STATS.note_trial(tg_id)
 
 def count_referrals(tg_id):
     conn = sqlite3.connect(BOT_DB_PATH)
@@ -4504,13 +6257,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
 
         # Check for welcome image
-        welcome_photo_path = "welcome.jpg"
+        welcome_key = _welcome_photo_key()
         text = "Please select your language / Пожалуйста, выберите язык:"
 
-        if os.path.exists(welcome_photo_path):
+        if welcome_key:
             try:
-                with open(welcome_photo_path, 'rb') as photo:
-                    await update.message.reply_photo(photo=photo, caption=text, reply_markup=InlineKeyboardMarkup(keyboard))
+                await _reply_welcome_photo(update.message, welcome_key, caption=text, reply_markup=InlineKeyboardMarkup(keyboard))
             except Exception as e:
                  logging.error(f"Failed to send welcome photo (start): {e}")
                  await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -4606,11 +6358,10 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, lan
              pass
 
     # Check for welcome image
-    welcome_photo_path = "welcome.jpg"
-    if os.path.exists(welcome_photo_path):
+    welcome_key = _welcome_photo_key()
+    if welcome_key:
         try:
-            with open(welcome_photo_path, 'rb') as photo:
-                await update.message.reply_photo(photo=photo, caption=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+            await _reply_welcome_photo(update.message, welcome_key, caption=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
         except Exception as e:
              logging.error(f"Failed to send welcome photo: {e}")
              await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
@@ -5133,6 +6884,124 @@ async def my_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
+# Telegram keeps every uploaded photo; re-sending its file_id costs no upload. QR codes are keyed by a hash
+# of the encoded link and render style, the welcome photo by its mtime/size.
+_QR_STYLE = "v1:L:10:4"
+_QR_RENDER_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="qr-render")
+_MEDIA_FILE_IDS: dict[str, str] = {}
+_WELCOME_PHOTO_PATH = "welcome.jpg"
+
+
+def _media_cache_get(key: str) -> Optional[str]:
+    file_id = _MEDIA_FILE_IDS.get(key)
+    if file_id is not None:
+        return file_id
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH)
+        try:
+            row = conn.execute("SELECT file_id FROM media_cache WHERE cache_key=?", (key,)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    if row and row[0]:
+        _MEDIA_FILE_IDS[key] = str(row[0])
+        return str(row[0])
+    return None
+
+
+def _media_cache_put(key: str, file_id: Optional[str]) -> None:
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH)
+        try:
+            if file_id:
+                conn.execute(
+                    "INSERT OR REPLACE INTO media_cache (cache_key, file_id, created_at) VALUES (?, ?, ?)",
+                    (key, file_id, int(time.time())),
+                )
+            else:
+                conn.execute("DELETE FROM media_cache WHERE cache_key=?", (key,))
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.warning(f"Failed to store media cache entry: {e}")
+    if file_id:
+        _MEDIA_FILE_IDS[key] = file_id
+    else:
+        _MEDIA_FILE_IDS.pop(key, None)
+
+
+async def _send_cached_photo(
+    key: str,
+    send: Callable[[Any], Awaitable[Any]],
+    produce: Callable[[], Awaitable[BytesIO]],
+) -> Any:
+    """Send by cached file_id when possible; otherwise upload what `produce` returns and remember its file_id."""
+    file_id = _media_cache_get(key)
+    if file_id:
+        try:
+            return await send(file_id)
+        except BadRequest as e:
+            logging.info(f"Cached file_id for {key[:24]} rejected, re-uploading: {e}")
+            _media_cache_put(key, None)
+    message = await send(await produce())
+    photos = getattr(message, "photo", None) or ()
+    if photos:
+        _media_cache_put(key, photos[-1].file_id)
+    return message
+
+
+def _render_qr_png(data: str) -> bytes:
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    bio = BytesIO()
+    img.save(bio, 'PNG')
+    return bio.getvalue()
+
+
+async def _send_qr_photo(bot: Any, chat_id: Any, data: str, **kwargs: Any) -> Any:
+    key = "qr:" + hashlib.sha256(f"{_QR_STYLE}\n{data}".encode("utf-8")).hexdigest()
+
+    async def _produce() -> BytesIO:
+        png = await asyncio.get_running_loop().run_in_executor(_QR_RENDER_EXECUTOR, _render_qr_png, data)
+        bio = BytesIO(png)
+        bio.name = 'qrcode.png'
+        return bio
+
+    return await _send_cached_photo(key, lambda photo: bot.send_photo(chat_id=chat_id, photo=photo, **kwargs), _produce)
+
+
+def _welcome_photo_key() -> Optional[str]:
+    try:
+        st = os.stat(_WELCOME_PHOTO_PATH)
+    except OSError:
+        return None
+    return f"welcome:{st.st_mtime_ns}:{st.st_size}"
+
+
+def _read_file_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def _reply_welcome_photo(message: Any, key: str, **kwargs: Any) -> Any:
+    async def _produce() -> BytesIO:
+        bio = BytesIO(await asyncio.to_thread(_read_file_bytes, _WELCOME_PHOTO_PATH))
+        bio.name = os.path.basename(_WELCOME_PHOTO_PATH)
+        return bio
+
+    return await _send_cached_photo(key, lambda photo: message.reply_photo(photo=photo, **kwargs), _produce)
+
+
 async def show_qrcode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -5186,25 +7055,10 @@ async def show_qrcode(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.reply_text(t("error_generic", lang))
                 return
 
-            # Generate QR
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(vless_link)
-            qr.make(fit=True)
-
-            img = qr.make_image(fill_color="black", back_color="white")
-            bio = BytesIO()
-            bio.name = 'qrcode.png'
-            img.save(bio, 'PNG')
-            bio.seek(0)
-
-            await context.bot.send_photo(
-                chat_id=tg_id,
-                photo=bio,
+            await _send_qr_photo(
+                context.bot,
+                tg_id,
+                vless_link,
                 caption=f"QR Code for: <code>{client_email}</code>",
                 parse_mode='HTML',
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_back", lang), callback_data='get_config')]])
@@ -6169,7 +8023,7 @@ async def admin_remote_panels_list(update: Update, context: ContextTypes.DEFAULT
     lang = get_lang(tg_id)
     panels = _fetch_remote_panels()
     if not panels:
-        await asyncio.get_running_loop().run_in_executor(None, _sync_remote_nodes_locations)
+        await _sync_remote_nodes_with_progress(query, lang)
         panels = _fetch_remote_panels()
     if not panels:
         text = t("remote_list_empty", lang)
@@ -6195,18 +8049,31 @@ async def admin_remote_panels_check(update: Update, context: ContextTypes.DEFAUL
         return
     lang = get_lang(tg_id)
     panels = _fetch_remote_panels()
-    if not panels:
-        text = t("remote_list_empty", lang)
-    else:
-        lines = []
-        for idx, panel in enumerate(panels, start=1):
-            ok = await _check_remote_panel(panel["base_url"])
-            status = t("remote_check_ok", lang) if ok else t("remote_check_fail", lang)
-            name = _escape_markdown(panel["name"] or "")
-            lines.append(f"{idx}. {name} — {status}")
-        text = f"{t('remote_panels_title', lang)}\n\n" + "\n".join(lines)
     keyboard = [[InlineKeyboardButton(t("btn_back", lang), callback_data="admin_remote_panels")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    if not panels:
+        await query.edit_message_text(t("remote_list_empty", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        return
+    names = [_escape_markdown(panel["name"] or "") for panel in panels]
+    pending = t("remote_check_pending", lang)
+    progress = _FanoutProgressMessage(
+        query,
+        t("remote_panels_title", lang),
+        [f"{idx}. {name} — {pending}" for idx, name in enumerate(names, start=1)],
+        InlineKeyboardMarkup(keyboard),
+    )
+    await progress.start()
+
+    async def _check(panel: dict[str, Any]) -> bool:
+        return await _check_remote_panel(panel["base_url"])
+
+    async def _on_result(result: FanoutResult) -> None:
+        ok = bool(result["ok"] and result["value"])
+        status = t("remote_check_ok", lang) if ok else t("remote_check_fail", lang)
+        idx = result["index"]
+        await progress.set_line(idx, f"{idx + 1}. {names[idx]} — {status}")
+
+    await _fanout_nodes(panels, _check, on_result=_on_result)
+    await progress.finish()
 
 async def admin_remote_panels_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -6270,7 +8137,7 @@ async def admin_remote_locations_list(update: Update, context: ContextTypes.DEFA
     lang = get_lang(tg_id)
     locations = _fetch_remote_locations()
     if not locations:
-        await asyncio.get_running_loop().run_in_executor(None, _sync_remote_nodes_locations)
+        await _sync_remote_nodes_with_progress(query, lang)
         locations = _fetch_remote_locations()
     if not locations:
         text = t("remote_list_empty", lang)
@@ -6297,21 +8164,31 @@ async def admin_remote_locations_check(update: Update, context: ContextTypes.DEF
         return
     lang = get_lang(tg_id)
     locations = _fetch_remote_locations()
-    if not locations:
-        text = t("remote_list_empty", lang)
-    else:
-        lines = []
-        for idx, location in enumerate(locations, start=1):
-            host = location["host"] or ""
-            port = location["port"] or 0
-            latency = await _check_tcp_latency(host, int(port))
-            status = t("remote_check_ok", lang) if latency is not None else t("remote_check_fail", lang)
-            latency_label = f"{status} ({latency}ms)" if latency is not None else status
-            name = _escape_markdown(location["name"] or "")
-            lines.append(f"{idx}. {name} — {latency_label}")
-        text = f"{t('remote_locations_title', lang)}\n\n" + "\n".join(lines)
     keyboard = [[InlineKeyboardButton(t("btn_back", lang), callback_data="admin_remote_locations")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    if not locations:
+        await query.edit_message_text(t("remote_list_empty", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        return
+    targets = [(location["host"] or "", int(location["port"] or 0)) for location in locations]
+    names = [_escape_markdown(location["name"] or "") for location in locations]
+    pending = t("remote_check_pending", lang)
+    progress = _FanoutProgressMessage(
+        query,
+        t("remote_locations_title", lang),
+        [f"{idx}. {name} — {pending}" for idx, name in enumerate(names, start=1)],
+        InlineKeyboardMarkup(keyboard),
+    )
+    await progress.start()
+
+    async def _check(target: tuple[str, int]) -> Optional[int]:
+        return await _check_tcp_latency(target[0], target[1])
+
+    async def _on_result(result: FanoutResult) -> None:
+        idx = result["index"]
+        latency = result["value"] if result["ok"] else None
+        await progress.set_line(idx, f"{idx + 1}. {names[idx]} — {_format_latency_label(latency, lang)}")
+
+    await _fanout_nodes(targets, _check, on_result=_on_result)
+    await progress.finish()
 
 async def admin_remote_locations_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -6442,12 +8319,7 @@ async def admin_remote_nodes_sync_action(update: Update, context: ContextTypes.D
     if not ssh_user or not ssh_password:
         await query.edit_message_text(t("remote_node_sync_missing_ssh", lang), parse_mode="Markdown")
         return
-    host = node.get("host") or ""
-    ssh_port = int(node.get("port") or 22)
-    panel_ready, location_ready = await asyncio.get_running_loop().run_in_executor(
-        None, _sync_remote_node_data, host, ssh_port, ssh_user, ssh_password, node.get("name") or host
-    )
-    if panel_ready or location_ready:
+    if await _sync_remote_nodes_with_progress(query, lang, [node]):
         await query.edit_message_text(t("remote_node_sync_ok", lang), parse_mode="Markdown")
     else:
         await query.edit_message_text(t("remote_node_sync_failed", lang), parse_mode="Markdown")
@@ -6461,30 +8333,39 @@ async def admin_remote_nodes_check(update: Update, context: ContextTypes.DEFAULT
         return
     lang = get_lang(tg_id)
     nodes = _fetch_remote_nodes()
-    lines = []
+    targets: list[tuple[str, int]] = []
+    names: list[str] = []
     local_settings = _get_local_panel_settings()
     local_port = local_settings.get("port") or "22"
     if IP:
-        latency = await _check_tcp_latency(IP, int(local_port))
-        status = t("remote_check_ok", lang) if latency is not None else t("remote_check_fail", lang)
-        latency_label = f"{status} ({latency}ms)" if latency is not None else status
-        local_name = _escape_markdown(t("local_node_label", lang))
-        lines.append(f"1. {local_name} — {latency_label}")
-    start_idx = len(lines) + 1
-    for idx, node in enumerate(nodes, start=start_idx):
-        host = node["host"] or ""
-        port = node["port"] or 22
-        latency = await _check_tcp_latency(host, int(port))
-        status = t("remote_check_ok", lang) if latency is not None else t("remote_check_fail", lang)
-        latency_label = f"{status} ({latency}ms)" if latency is not None else status
-        name = _escape_markdown(node["name"] or "")
-        lines.append(f"{idx}. {name} — {latency_label}")
-    if not lines:
-        text = t("remote_list_empty", lang)
-    else:
-        text = f"{t('remote_nodes_title', lang)}\n\n" + "\n".join(lines)
+        targets.append((IP, int(local_port)))
+        names.append(_escape_markdown(t("local_node_label", lang)))
+    for node in nodes:
+        targets.append((node["host"] or "", int(node["port"] or 22)))
+        names.append(_escape_markdown(node["name"] or ""))
     keyboard = [[InlineKeyboardButton(t("btn_back", lang), callback_data="admin_remote_nodes")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    if not targets:
+        await query.edit_message_text(t("remote_list_empty", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        return
+    pending = t("remote_check_pending", lang)
+    progress = _FanoutProgressMessage(
+        query,
+        t("remote_nodes_title", lang),
+        [f"{idx}. {name} — {pending}" for idx, name in enumerate(names, start=1)],
+        InlineKeyboardMarkup(keyboard),
+    )
+    await progress.start()
+
+    async def _check(target: tuple[str, int]) -> Optional[int]:
+        return await _check_tcp_latency(target[0], target[1])
+
+    async def _on_result(result: FanoutResult) -> None:
+        idx = result["index"]
+        latency = result["value"] if result["ok"] else None
+        await progress.set_line(idx, f"{idx + 1}. {names[idx]} — {_format_latency_label(latency, lang)}")
+
+    await _fanout_nodes(targets, _check, on_result=_on_result)
+    await progress.finish()
 
 async def admin_remote_nodes_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -6509,7 +8390,7 @@ async def user_locations_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     lang = get_lang(tg_id)
     locations = [loc for loc in _fetch_remote_locations() if loc.get("enabled")]
     if not locations:
-        await asyncio.get_running_loop().run_in_executor(None, _sync_remote_nodes_locations)
+        await _sync_remote_nodes_locations()
         locations = [loc for loc in _fetch_remote_locations() if loc.get("enabled")]
     if not locations:
         text = t("remote_list_empty", lang)
@@ -6933,14 +8814,18 @@ async def admin_update_xui_xray_mobile(update: Update, context: ContextTypes.DEF
         )
 
     if need_xray_update:
-        xray_ok, xray_details = await asyncio.get_running_loop().run_in_executor(
-            None,
-            _ssh_update_remote_xray,
-            MOBILE_SSH_HOST,
-            MOBILE_SSH_PORT,
-            MOBILE_SSH_USER,
-            MOBILE_SSH_PASSWORD,
-        )
+        mobile_node = {
+            "host": MOBILE_SSH_HOST,
+            "port": MOBILE_SSH_PORT,
+            "ssh_user": MOBILE_SSH_USER,
+            "ssh_password": MOBILE_SSH_PASSWORD,
+        }
+        release, release_error = await _fetch_xray_release()
+        if release is None:
+            xray_ok, xray_details = False, release_error
+        else:
+            xray_result = await _xray_update_node(mobile_node, release)
+            xray_ok, xray_details = xray_result["ok"], xray_result["detail"]
         if xray_ok:
             status_lines.append(f"{t('xray_version_label', lang)} ✅ {xray_details}")
             restart_needed = True
@@ -7008,12 +8893,17 @@ async def admin_server_nodes(update: Update, context: ContextTypes.DEFAULT_TYPE)
         host = _escape_markdown(node["host"] or "")
         port = node["port"] or 22
         location = _escape_markdown(_auto_location_name(node["host"] or ""))
-        lines.append(f"{idx}. {name} | {host}:{port} | {location}")
+        ring = list(_node_health_ring(int(node["id"])))
+        health = _format_node_health_summary(ring[-1] if ring else None, lang)
+        trend = _sparkline([s["cpu"] if s["online"] else None for s in ring[-12:]], 0, 100)
+        trend_part = f" `{trend}`" if trend.strip() else ""
+        lines.append(f"{idx}. {name} | {host}:{port} | {location}\n    {health}{trend_part}")
     text = f"{t('admin_server_nodes_title', lang)}\n\n" + "\n".join(lines)
     keyboard = [
         [InlineKeyboardButton(f"🔍 {node['name']}", callback_data=f"admin_server_node_{node['id']}")]
         for node in nodes
     ]
+    keyboard.append([InlineKeyboardButton(t("btn_xray_rollout", lang), callback_data="admin_xray_rollout")])
     keyboard.append([InlineKeyboardButton(t("btn_back", lang), callback_data="admin_server")])
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
@@ -7040,9 +8930,12 @@ async def admin_server_node_detail(update: Update, context: ContextTypes.DEFAULT
         keyboard = [[InlineKeyboardButton(t("btn_back", lang), callback_data="admin_server_nodes")]]
         await query.edit_message_text(t("remote_node_sync_missing_ssh", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         return
-    ssh_data = await asyncio.get_running_loop().run_in_executor(
-        None, _ssh_fetch_remote_xui_data, host, ssh_port, ssh_user, ssh_password
-    )
+    cached = _NODE_XUI_CACHE.get(int(node["id"]))
+    ssh_data = cached[1] if cached else None
+    if not ssh_data:
+        ssh_data = await _run_remote_blocking(_ssh_fetch_remote_xui_data, host, ssh_port, ssh_user, ssh_password)
+        if ssh_data:
+            _NODE_XUI_CACHE[int(node["id"])] = (time.time(), ssh_data)
     if not ssh_data:
         keyboard = [[InlineKeyboardButton(t("btn_back", lang), callback_data="admin_server_nodes")]]
         await query.edit_message_text(t("remote_node_sync_failed", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
@@ -7070,7 +8963,8 @@ async def admin_server_node_detail(update: Update, context: ContextTypes.DEFAULT
         f"• PBK: {_escape_markdown(public_key)}\n"
         f"• SNI: {_escape_markdown(sni)}\n"
         f"• SID: {_escape_markdown(sid)}\n"
-        f"• FLOW: {_escape_markdown(flow)}"
+        f"• FLOW: {_escape_markdown(flow)}\n\n"
+        f"{_format_node_health_block(int(node['id']), lang)}"
     )
     keyboard = [
         [InlineKeyboardButton(t("btn_remote_sync", lang), callback_data=f"admin_remote_nodes_sync_{node['id']}")],
@@ -7078,6 +8972,95 @@ async def admin_server_node_detail(update: Update, context: ContextTypes.DEFAULT
     ]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
+async def admin_xray_rollout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    tg_id = str(query.from_user.id)
+    if tg_id != ADMIN_ID:
+        return
+    lang = get_lang(tg_id)
+    keyboard = [[InlineKeyboardButton(t("btn_back", lang), callback_data="admin_server_nodes")]]
+    nodes = _remote_nodes_with_ssh()
+    if not nodes:
+        await query.edit_message_text(t("remote_list_empty", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        return
+    release, error = await _fetch_xray_release()
+    if release is None:
+        details = f"```{error[:1200] or '—'}```"
+        await query.edit_message_text(t("update_failed", lang).format(details=details), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        return
+    names = [_escape_markdown(str(node.get("name") or node.get("host") or "")) for node in nodes]
+    pending = t("remote_check_pending", lang)
+    progress = _FanoutProgressMessage(
+        query,
+        t("xray_rollout_title", lang).format(version=_escape_markdown(release["version"])),
+        [f"{idx}. {name} — {pending}" for idx, name in enumerate(names, start=1)],
+    )
+    await progress.start()
+
+    async def _on_result(idx: int, result: XrayNodeUpdate) -> None:
+        mark = "✅" if result["ok"] else "❌"
+        await progress.set_line(idx, f"{idx + 1}. {names[idx]} — {mark} {_escape_markdown(result['detail'][:200])}")
+
+    results, halted = await _rollout_xray(nodes, lambda node: _xray_update_node(node, release), on_result=_on_result)
+    for idx, result in enumerate(results):
+        if result is None:
+            progress.lines[idx] = f"{idx + 1}. {names[idx]} — {t('xray_rollout_skipped', lang)}"
+    if halted:
+        progress.lines.append("")
+        progress.lines.append(t("xray_rollout_halted", lang))
+    changed_ids = [int(nodes[idx]["id"]) for idx, result in enumerate(results) if result and result["changed"]]
+    _set_sync_state("xray_rollout_last", json.dumps(changed_ids))
+    if changed_ids:
+        keyboard.insert(0, [InlineKeyboardButton(t("btn_xray_rollback", lang), callback_data="admin_xray_rollback")])
+    progress.reply_markup = InlineKeyboardMarkup(keyboard)
+    await progress.finish()
+
+async def admin_xray_rollback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    tg_id = str(query.from_user.id)
+    if tg_id != ADMIN_ID:
+        return
+    lang = get_lang(tg_id)
+    keyboard = [[InlineKeyboardButton(t("btn_back", lang), callback_data="admin_server_nodes")]]
+    try:
+        node_ids = {int(v) for v in json.loads(_get_sync_state("xray_rollout_last") or "[]")}
+    except Exception:
+        node_ids = set()
+    nodes = [node for node in _remote_nodes_with_ssh() if int(node["id"]) in node_ids]
+    if not nodes:
+        await query.edit_message_text(t("xray_rollback_empty", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        return
+    names = [_escape_markdown(str(node.get("name") or node.get("host") or "")) for node in nodes]
+    pending = t("remote_check_pending", lang)
+    progress = _FanoutProgressMessage(
+        query,
+        t("xray_rollback_title", lang),
+        [f"{idx}. {name} — {pending}" for idx, name in enumerate(names, start=1)],
+        InlineKeyboardMarkup(keyboard),
+    )
+    await progress.start()
+
+    async def _rollback(node: dict[str, Any]) -> tuple[bool, str]:
+        return await _run_remote_blocking(
+            _ssh_rollback_remote_xray,
+            str(node.get("host") or ""),
+            int(node.get("port") or 22),
+            str(node.get("ssh_user") or ""),
+            str(node.get("ssh_password") or ""),
+        )
+
+    async def _on_result(result: FanoutResult) -> None:
+        idx = result["index"]
+        ok, detail = result["value"] if result["ok"] else (False, str(result["error"]))
+        mark = "✅" if ok else "❌"
+        await progress.set_line(idx, f"{idx + 1}. {names[idx]} — {mark} {_escape_markdown(detail[:200])}")
+
+    await _fanout_nodes(nodes, _rollback, concurrency=XRAY_ROLLOUT_CONCURRENCY, on_result=_on_result)
+    _set_sync_state("xray_rollout_last", "[]")
+    await progress.finish()
+
 def _health_check_bot_db() -> tuple[bool, str]:
     try:
         conn = sqlite3.connect(BOT_DB_PATH)
@@ -7151,6 +9134,9 @@ async def admin_health(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         _line(support_bot_ok, t("health_support_bot", lang)),
         _line(main_bot_ok, t("health_main_bot", lang)),
     ])
+    processor = getattr(application, "update_processor", None)
+    if isinstance(processor, _ChatOrderedUpdateProcessor):
+        text += "\n\n" + t("health_updates", lang).format(**processor.metrics())
 
     keyboard = [
         [InlineKeyboardButton(t("btn_refresh", lang), callback_data='admin_health')],
@@ -7379,6 +9365,273 @@ async def admin_edit_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+class AdminStatsCounters(TypedDict):
+    total_users: int
+    vpn_users: int
+    total_clients: int
+    active_subs: int
+    active_trials: int
+    expired_trials: int
+    total_revenue: int
+    total_sales: int
+
+
+# Transactions of this account are never counted as sales.
+_ADMIN_STATS_EXCLUDED_TG_ID = '369456269'
+
+
+class _AdminStatsView:
+    """Admin stats counters kept current by events and rebuilt from the databases by a periodic job.
+
+    Clients are keyed by email. Expiry crossings are applied lazily from a heap when the counters are read,
+    and sales follow the same island dedupe as _SALES_LEDGER_SQL (rows arrive in (date, id) order).
+    """
+
+    def __init__(self) -> None:
+        self.ready = False
+        self.built_at = 0.0
+        self._rebuilding = 0
+        self._backlog: list[tuple[str, tuple[Any, ...]]] = []
+        self._reset()
+
+    def _reset(self) -> None:
+        self._users: set[str] = set()
+        self._trial: set[str] = set()
+        self._paid: set[str] = set()
+        self._clients: dict[str, tuple[Optional[str], bool, int]] = {}
+        self._emails_by_tg: dict[str, set[str]] = {}
+        self._contrib: dict[str, tuple[int, int, int]] = {}
+        self._active = 0
+        self._active_trials = 0
+        self._expired_trials = 0
+        self._crossings: list[tuple[int, str]] = []
+        self._sales_by_tg: dict[str, tuple[int, int]] = {}
+        self._sales_all = (0, 0)
+        self._sales_vpn = (0, 0)
+        self._seen_charge_ids: set[str] = set()
+        self._last_sale: dict[tuple[str, int], tuple[int, bool]] = {}
+
+    def invalidate(self) -> None:
+        """Force a full rebuild on the next read, after bulk changes that emit no events."""
+        self.ready = False
+
+    def begin_rebuild(self) -> None:
+        self._rebuilding += 1
+
+    def abort_rebuild(self) -> None:
+        self._rebuilding = max(0, self._rebuilding - 1)
+        if not self._rebuilding:
+            self._backlog.clear()
+
+    def rebuild(
+        self,
+        users: set[str],
+        trial: set[str],
+        paid: set[str],
+        clients: list[Dict[str, Any]],
+        sales: list[tuple[str, int, int, Optional[str]]],
+        now_ms: int,
+    ) -> None:
+        self._reset()
+        self._users = users
+        self._trial = trial
+        self._paid = paid
+        for row in sales:
+            self._add_sale(*row)
+        for idx, client in enumerate(clients):
+            self._set_client(client, now_ms, fallback_key=f"#{idx}")
+        # Events that arrived while the sources were being read are replayed on top of the fresh state.
+        for kind, args in list(self._backlog):
+            self._apply(kind, args, now_ms)
+        self._rebuilding = max(0, self._rebuilding - 1)
+        if not self._rebuilding:
+            self._backlog.clear()
+        self.ready = True
+        self.built_at = time.time()
+
+    def _event(self, kind: str, *args: Any) -> None:
+        if self._rebuilding:
+            self._backlog.append((kind, args))
+        if self.ready:
+            self._apply(kind, args, int(time.time() * 1000))
+
+    def _apply(self, kind: str, args: tuple[Any, ...], now_ms: int) -> None:
+        if kind == "user":
+            self._users.add(args[0])
+        elif kind == "trial":
+            self._users.add(args[0])
+            self._trial.add(args[0])
+            self._refresh_tg(args[0], now_ms)
+        elif kind == "payment":
+            self._add_sale(*args)
+            if args[0] not in self._paid:
+                self._paid.add(args[0])
+                self._refresh_tg(args[0], now_ms)
+        elif kind == "client":
+            self._set_client(args[0], now_ms)
+
+    def note_user(self, tg_id: Any) -> None:
+        self._event("user", str(tg_id))
+
+    def note_trial(self, tg_id: Any) -> None:
+        self._event("trial", str(tg_id))
+
+    def note_payment(self, tg_id: Any, amount: int, date_ts: int, charge_id: Optional[str]) -> None:
+        self._event("payment", str(tg_id), int(amount), int(date_ts), charge_id)
+
+    def note_client(self, client: Dict[str, Any]) -> None:
+        self._event("client", dict(client))
+
+    def _add_sale(self, tg_id: str, amount: int, date_ts: int, charge_id: Optional[str]) -> None:
+        if tg_id == _ADMIN_STATS_EXCLUDED_TG_ID:
+            return
+        key = (tg_id, amount)
+        if charge_id:
+            if charge_id in self._seen_charge_ids:
+                return
+            self._seen_charge_ids.add(charge_id)
+        last = self._last_sale.get(key)
+        self._last_sale[key] = (date_ts, bool(charge_id))
+        if last is not None:
+            last_ts, last_charged = last
+            if charge_id and last_charged:
+                window = _get_sales_log_fuzzy_charge_dedupe_window_sec()
+            else:
+                window = _get_sales_log_dedupe_window_sec()
+            if abs(date_ts - last_ts) <= window:
+                return
+        sales, revenue = self._sales_by_tg.get(tg_id, (0, 0))
+        self._sales_by_tg[tg_id] = (sales + 1, revenue + amount)
+        self._sales_all = (self._sales_all[0] + 1, self._sales_all[1] + amount)
+        if tg_id in self._emails_by_tg:
+            self._sales_vpn = (self._sales_vpn[0] + 1, self._sales_vpn[1] + amount)
+
+    def _client_contrib(self, tg_id: Optional[str], enable: bool, expiry: int, now_ms: int) -> tuple[int, int, int]:
+        active = enable and (expiry == 0 or expiry > now_ms)
+        pure_trial = tg_id is not None and tg_id in self._trial and tg_id not in self._paid
+        return int(active), int(pure_trial and active), int(pure_trial and not active and 0 < expiry < now_ms)
+
+    def _recount(self, email: str, now_ms: int) -> None:
+        old = self._contrib.pop(email, (0, 0, 0))
+        self._active -= old[0]
+        self._active_trials -= old[1]
+        self._expired_trials -= old[2]
+        entry = self._clients.get(email)
+        if entry is None:
+            return
+        new = self._client_contrib(entry[0], entry[1], entry[2], now_ms)
+        self._contrib[email] = new
+        self._active += new[0]
+        self._active_trials += new[1]
+        self._expired_trials += new[2]
+
+    def _set_client(self, client: Dict[str, Any], now_ms: int, fallback_key: str = "") -> None:
+        email = str(client.get('email') or fallback_key)
+        if not email:
+            return
+        tg_id = get_client_tg_id(client)
+        expiry = int(client.get('expiryTime', 0) or 0)
+        previous = self._clients.get(email)
+        if previous is not None and previous[0] != tg_id and previous[0] is not None:
+            self._unlink_email(previous[0], email)
+        if tg_id is not None and tg_id not in self._emails_by_tg:
+            self._emails_by_tg[tg_id] = set()
+            sales, revenue = self._sales_by_tg.get(tg_id, (0, 0))
+            self._sales_vpn = (self._sales_vpn[0] + sales, self._sales_vpn[1] + revenue)
+        if tg_id is not None:
+            self._emails_by_tg[tg_id].add(email)
+        self._clients[email] = (tg_id, bool(client.get('enable', False)), expiry)
+        if expiry > now_ms:
+            heapq.heappush(self._crossings, (expiry, email))
+        self._recount(email, now_ms)
+
+    def _unlink_email(self, tg_id: str, email: str) -> None:
+        emails = self._emails_by_tg.get(tg_id)
+        if emails is None:
+            return
+        emails.discard(email)
+        if not emails:
+            # The user no longer has a VPN client: drop them from vpn_users and their sales from the VPN revenue.
+            del self._emails_by_tg[tg_id]
+            sales, revenue = self._sales_by_tg.get(tg_id, (0, 0))
+            self._sales_vpn = (self._sales_vpn[0] - sales, self._sales_vpn[1] - revenue)
+
+    def _refresh_tg(self, tg_id: str, now_ms: int) -> None:
+        for email in self._emails_by_tg.get(tg_id, ()):
+            self._recount(email, now_ms)
+
+    def counters(self, now_ms: int) -> AdminStatsCounters:
+        while self._crossings and self._crossings[0][0] < now_ms:
+            _expiry, email = heapq.heappop(self._crossings)
+            self._recount(email, now_ms)
+        # Revenue covers users that have a VPN client; with no clients at all every sale counts.
+        sales, revenue = self._sales_vpn if self._emails_by_tg else self._sales_all
+        return {
+            "total_users": len(self._users),
+            "vpn_users": len(self._emails_by_tg),
+            "total_clients": len(self._clients),
+            "active_subs": self._active,
+            "active_trials": self._active_trials,
+            "expired_trials": self._expired_trials,
+            "total_revenue": revenue,
+            "total_sales": sales,
+        }
+
+
+_ADMIN_STATS = _AdminStatsView()
+
+
+def _load_admin_stats_sources() -> tuple[set[str], set[str], set[str], list[Dict[str, Any]], list[tuple[str, int, int, Optional[str]]]]:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT tg_id FROM user_prefs")
+        users = {str(row[0]) for row in cursor.fetchall()}
+        cursor.execute("SELECT tg_id FROM user_prefs WHERE trial_used=1")
+        trial = {str(row[0]) for row in cursor.fetchall()}
+        cursor.execute("SELECT DISTINCT tg_id FROM transactions")
+        paid = {str(row[0]) for row in cursor.fetchall()}
+        try:
+            cursor.execute("SELECT tg_id, amount, date, telegram_payment_charge_id FROM transactions ORDER BY date, id")
+        except sqlite3.OperationalError:
+            cursor.execute("SELECT tg_id, amount, date, NULL FROM transactions ORDER BY date, id")
+        sales = [
+            (str(row[0]), int(row[1] or 0), int(row[2] or 0), _normalize_charge_id(row[3]))
+            for row in cursor.fetchall()
+        ]
+    finally:
+        conn.close()
+
+    clients: list[Dict[str, Any]] = []
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+        row = cursor.fetchone()
+        if row:
+            clients = json.loads(row[0]).get('clients', [])
+    finally:
+        conn.close()
+    return users, trial, paid, clients, sales
+
+
+async def _rebuild_admin_stats() -> None:
+    _ADMIN_STATS.begin_rebuild()
+    try:
+        sources = await asyncio.to_thread(_load_admin_stats_sources)
+    except Exception:
+        _ADMIN_STATS.abort_rebuild()
+        raise
+    _ADMIN_STATS.rebuild(*sources, now_ms=int(time.time() * 1000))
+
+
+async def admin_stats_reconcile_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await _rebuild_admin_stats()
+    except Exception as e:
+        logging.error(f"Failed to rebuild admin stats: {e}")
+
+
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -7394,119 +9647,27 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def _build_admin_stats_view(lang: str) -> tuple[str, InlineKeyboardMarkup]:
-    conn = sqlite3.connect(BOT_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM user_prefs")
-    total_users = cursor.fetchone()[0]
-
-    # Get trial users and paid users
-    cursor.execute("SELECT tg_id FROM user_prefs WHERE trial_used=1")
-    trial_users = set(row[0] for row in cursor.fetchall())
-
-    cursor.execute("SELECT DISTINCT tg_id FROM transactions")
-    paid_users = set(row[0] for row in cursor.fetchall())
+    if not _ADMIN_STATS.ready:
+        await _rebuild_admin_stats()
 
-    # Pure trial users are those who used trial but never paid
-    pure_trial_users = trial_users - paid_users
-
-    conn.close()
-
-    # Active subs
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-    row = cursor.fetchone()
-
-    # Online users count (last 10 seconds for real-time accuracy)
-    current_time_ms = int(time.time() * 1000)
-    threshold = current_time_ms - (10 * 1000)
-    cursor.execute("SELECT COUNT(DISTINCT email) FROM client_traffics WHERE inbound_id=? AND last_online > ?", (INBOUND_ID, threshold))
-    online_users = cursor.fetchone()[0]
-
-    conn.close()
-
-    active_subs = 0
-    total_clients = 0
-    vpn_users = set()
-
-    active_trials = 0
-    expired_trials = 0
-
-    if row:
-        settings = json.loads(row[0])
-        clients = settings.get('clients', [])
-        total_clients = len(clients)
-
-        for client in clients:
-            expiry = client.get('expiryTime', 0)
-            enable = client.get('enable', False)
-            client_tg_id = get_client_tg_id(client)
-            if client_tg_id is not None:
-                vpn_users.add(client_tg_id)
-
-            # Count overall active
-            if enable:
-                if expiry == 0 or expiry > current_time_ms:
-                    active_subs += 1
-
-            # Count trial stats
-            if client_tg_id in pure_trial_users:
-                if enable and (expiry == 0 or expiry > current_time_ms):
-                    active_trials += 1
-                elif enable and expiry > 0 and expiry < current_time_ms:
-                    expired_trials += 1
-                # If disabled, maybe expired or banned. Let's count as expired if expiry < now
-                elif not enable and expiry > 0 and expiry < current_time_ms:
-                     expired_trials += 1
-                # If just disabled but time left?
-                # Let's simplify: if in pure_trial_users and not active -> expired (roughly)
-                # Better:
-                # Active Trial = enable=True AND expiry > now
-                # Expired Trial = expiry < now (regardless of enable)
-
-                # Re-eval for trials:
-                # if expiry > 0 and expiry < current_time_ms: expired_trials += 1
-
-    vpn_users_count = len(vpn_users)
-
-    total_revenue = 0
-    total_sales = 0
-    try:
-        conn_bot2 = sqlite3.connect(BOT_DB_PATH)
-        cursor_bot2 = conn_bot2.cursor()
-        if vpn_users:
-            vpn_list = sorted(vpn_users)
-            placeholders = ",".join(["?"] * len(vpn_list))
-            try:
-                cursor_bot2.execute(
-                    f"SELECT tg_id, amount, date, plan_id, telegram_payment_charge_id "
-                    f"FROM transactions WHERE tg_id IN ({placeholders}) AND tg_id != '369456269'",
-                    tuple(vpn_list),
-                )
-            except sqlite3.OperationalError:
-                cursor_bot2.execute(
-                    f"SELECT tg_id, amount, date, plan_id, NULL "
-                    f"FROM transactions WHERE tg_id IN ({placeholders}) AND tg_id != '369456269'",
-                    tuple(vpn_list),
-                )
-        else:
-            try:
-                cursor_bot2.execute(
-                    "SELECT tg_id, amount, date, plan_id, telegram_payment_charge_id "
-                    "FROM transactions WHERE tg_id != '369456269'"
-                )
-            except sqlite3.OperationalError:
-                cursor_bot2.execute(
-                    "SELECT tg_id, amount, date, plan_id, NULL FROM transactions WHERE tg_id != '369456269'"
-                )
-        tx_rows = cursor_bot2.fetchall()
-        conn_bot2.close()
+    # Online users count (last 10 seconds for real-time accuracy)
+    current_time_ms = int(time.time() * 1000)
+    threshold = current_time_ms - (10 * 1000)
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(DISTINCT email) FROM client_traffics WHERE inbound_id=? AND last_online > ?", (INBOUND_ID, threshold))
+    online_users = cursor.fetchone()[0]
+    conn.close()
 
-        unique_rows = _dedupe_sales_log_rows(tx_rows)
-        total_sales = len(unique_rows)
-        total_revenue = sum(r[1] for r in unique_rows)
-    except Exception as e:
-        logging.error(f"Failed to compute sales stats: {e}")
+    stats = _ADMIN_STATS.counters(current_time_ms)
+    total_users = stats["total_users"]
+    vpn_users_count = stats["vpn_users"]
+    total_clients = stats["total_clients"]
+    active_subs = stats["active_subs"]
+    active_trials = stats["active_trials"]
+    expired_trials = stats["expired_trials"]
+    total_revenue = stats["total_revenue"]
+    total_sales = stats["total_sales"]
 
     text = f"{t('stats_header', lang)}\n\n" \
            f"{t('stats_users', lang)} {total_users}\n" \
@@ -7543,11 +9704,133 @@ async def _return_to_admin_stats_after_delay(message: Message, tg_id: str, delay
     try:
         await asyncio.sleep(delay_seconds)
         lang = get_lang(tg_id)
+        # The syncs feed their changes to _ADMIN_STATS as events, so the view is current without a rebuild.
         text, markup = await _build_admin_stats_view(lang)
         await message.edit_text(text, reply_markup=markup, parse_mode="Markdown")
     except Exception:
         return
 
+def _profile_nickname(username: Optional[str], first_name: Optional[str], last_name: Optional[str]) -> str:
+    if username:
+        return f"@{username}"
+    if first_name:
+        return f"{first_name} {last_name}" if last_name else str(first_name)
+    return ""
+
+
+def _nickname_sync_client_tg_id(client: dict[str, Any]) -> str:
+    tg_id = str(client.get('tgId', '') or '')
+    if tg_id.isdigit():
+        return tg_id
+    # Fallback: old clients only carry the id in the email (tg_ID or tg_ID_name)
+    email = str(client.get('email', '') or '')
+    if email.startswith('tg_'):
+        first = email[3:].split('_')[0]
+        if first.isdigit():
+            return first
+    return ""
+
+
+def _nickname_sync_comment(client: dict[str, Any]) -> str:
+    return str(client.get('comment') or client.get('_comment') or client.get('remark') or '')
+
+
+def _plan_nickname_sync(
+    clients: list[dict[str, Any]],
+    synced: Mapping[str, str],
+    profiles: Mapping[str, str],
+) -> tuple[dict[str, str], dict[str, str], int]:
+    """
+    Split clients into ones that need a Telegram lookup (no comment yet), ones whose comment we wrote
+    earlier and whose cached profile changed since (updated without a lookup), and the rest (skipped).
+    Returns (email -> tg_id to fetch, email -> new nickname or "" when only tgId needs restoring, skipped count).
+    """
+    to_fetch: dict[str, str] = {}
+    refreshed: dict[str, str] = {}
+    skipped = 0
+    for client in clients:
+        tg_id = _nickname_sync_client_tg_id(client)
+        email = str(client.get('email', '') or '')
+        if not tg_id or not email:
+            continue
+        comment = _nickname_sync_comment(client)
+        if not comment:
+            to_fetch[email] = tg_id
+            continue
+        cached = profiles.get(tg_id, "")
+        if synced.get(tg_id) == comment and cached and cached != comment:
+            refreshed[email] = cached
+        elif str(client.get('tgId', '')) != tg_id:
+            refreshed[email] = ""
+        else:
+            skipped += 1
+    return to_fetch, refreshed, skipped
+
+
+async def _fetch_sync_nickname(bot: Any, tg_id: str, fallback: str) -> str:
+    """Fetch the nickname from Telegram under the shared bulk rate limit; fall back to the cached profile."""
+    bucket = _telegram_bulk_bucket()
+    for _attempt in range(3):
+        try:
+            profile = await _get_chat_profile(bot, tg_id, bucket)
+        except RetryAfter as e:
+            bucket.pause(_retry_after_seconds(e))
+            continue
+        except Exception as e:
+            logging.warning(f"Sync: Failed to fetch chat {tg_id} from API: {e}")
+            break
+        if profile is None:
+            logging.warning(f"Sync: Telegram could not resolve chat {tg_id}")
+            break
+        return _profile_nickname(profile["username"], profile["first_name"], profile["last_name"]) or fallback
+    return fallback
+
+
+def _apply_nickname_sync(updates: Mapping[str, tuple[str, str, str]]) -> tuple[list[dict[str, Any]], list[tuple[str, str]]]:
+    """
+    Write comment/tgId for the given emails in one transaction on a fresh copy of the inbound settings.
+    Each update carries the comment the plan saw; a nickname is only written while the client's comment
+    still equals it (empty, or our earlier synced nick), so an admin edit made during the sync is kept.
+    Returns (changed clients, (tg_id, nick) pairs actually written).
+    """
+    if not updates:
+        return [], []
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+        row = cursor.fetchone()
+        if not row:
+            conn.rollback()
+            return [], []
+        settings = json.loads(row[0])
+        changed: list[dict[str, Any]] = []
+        written: list[tuple[str, str]] = []
+        for client in settings.get('clients', []):
+            change = updates.get(str(client.get('email', '') or ''))
+            if change is None:
+                continue
+            tg_id, nick, seen_comment = change
+            if nick and _nickname_sync_comment(client) == seen_comment:
+                client['comment'] = nick
+                client['_comment'] = nick
+                written.append((tg_id, nick))
+            elif str(client.get('tgId', '')) == tg_id:
+                continue
+            client['tgId'] = int(tg_id)
+            changed.append(client)
+        cursor.execute(
+            "UPDATE inbounds SET settings=? WHERE id=?",
+            (json.dumps(settings, ensure_ascii=False, separators=(",", ":")), INBOUND_ID),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    _index_user_search_clients(changed)
+    return changed, written
+
+
 async def admin_sync_nicknames(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     admin_tg_id = str(query.from_user.id)
@@ -7564,132 +9847,83 @@ async def admin_sync_nicknames(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.message.reply_text(t("sync_error_inbound", lang))
         return
 
-    settings = json.loads(row[0])
-    clients = settings.get('clients', [])
+    clients = json.loads(row[0]).get('clients', [])
 
-    updated_count = 0
+    conn_bot = sqlite3.connect(BOT_DB_PATH)
+    cursor_bot = conn_bot.cursor()
+    cursor_bot.execute("SELECT tg_id, nick FROM nickname_sync")
+    synced = {str(r[0]): str(r[1] or "") for r in cursor_bot.fetchall()}
+    cursor_bot.execute("SELECT tg_id, username, first_name, last_name FROM user_prefs")
+    profiles = {str(r[0]): _profile_nickname(r[1], r[2], r[3]) for r in cursor_bot.fetchall()}
+    conn_bot.close()
+
+    to_fetch, refreshed, skipped = _plan_nickname_sync(clients, synced, profiles)
+    updates: dict[str, tuple[str, str, str]] = {
+        email: (_nickname_sync_client_tg_id(client), refreshed[email], _nickname_sync_comment(client))
+        for client in clients
+        if (email := str(client.get('email', '') or '')) in refreshed
+    }
     failed_count = 0
-    total = len(clients)
+    total = len(to_fetch)
+    done = 0
 
     progress_msg = await context.bot.send_message(chat_id=query.from_user.id, text=t("sync_progress", lang).format(current=0, total=total))
+    last_edit = time.monotonic()
+
+    queue: asyncio.Queue[tuple[str, str]] = asyncio.Queue()
+    for item in to_fetch.items():
+        queue.put_nowait(item)
 
-    changed = False
-
-    for i, client in enumerate(clients):
-        tg_id = str(client.get('tgId', ''))
-
-        # Fallback: Extract tg_id from email if tgId field is empty
-        if not tg_id or not tg_id.isdigit():
-            email = client.get('email', '')
-            if email.startswith('tg_'):
-                possible_id = email[3:]
-                # Check if it has name part (tg_123_name) -> not supported by current new logic but possible old logic
-                # Actually new logic is just tg_ID.
-                # Let's try to split by _ and take first part
-                parts = possible_id.split('_')
-                if parts[0].isdigit():
-                    tg_id = parts[0]
-                    # Update the client object with the recovered tgId for future consistency
-                    client['tgId'] = int(tg_id)
-
-        if tg_id and tg_id.isdigit():
-            user_nick = ""
-            uname = None
-            fname = None
-            lname = None
-
-            # Try to get info from Telegram
+    async def _worker() -> None:
+        nonlocal failed_count, done, last_edit
+        while True:
             try:
-                chat = await context.bot.get_chat(tg_id)
-                uname = chat.username
-                fname = chat.first_name
-                lname = chat.last_name
-                # Update Bot DB
-                update_user_info(tg_id, uname, fname, lname)
-            except Exception as e:
-                logging.warning(f"Sync: Failed to fetch chat {tg_id} from API: {e}")
-                # Fallback to local DB
+                email, tg_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            nick = await _fetch_sync_nickname(context.bot, tg_id, profiles.get(tg_id, ""))
+            if nick:
+                updates[email] = (tg_id, nick, "")
+            else:
+                logging.warning(f"Sync: No nickname found for {tg_id}")
+                failed_count += 1
+            done += 1
+            now = time.monotonic()
+            if now - last_edit >= _NICKNAME_SYNC_PROGRESS_EDIT_SEC:
+                last_edit = now
                 try:
-                    conn_bot = sqlite3.connect(BOT_DB_PATH)
-                    cursor_bot = conn_bot.cursor()
-                    cursor_bot.execute("SELECT username, first_name, last_name FROM user_prefs WHERE tg_id=?", (tg_id,))
-                    row_u = cursor_bot.fetchone()
-                    conn_bot.close()
-                    if row_u:
-                        uname = row_u[0]
-                        fname = row_u[1]
-                        lname = row_u[2]
-                        logging.info(f"Sync: Found cached info for {tg_id}: {uname} {fname}")
+                    await progress_msg.edit_text(t("sync_progress", lang).format(current=done, total=total))
                 except Exception:
                     pass
 
-            # Construct nickname
-            if uname:
-                user_nick = f"@{uname}"
-            elif fname:
-                user_nick = fname
-                if lname:
-                    user_nick += f" {lname}"
-
-            try:
-                # 3. Update X-UI Comment (nickname)
-                if user_nick:
-                    # Check existing keys
-                    old_comment = client.get('comment', '')
-                    old_remark = client.get('_comment', '')
-                    old_u_remark = client.get('remark', '')
-
-                    if not old_comment and not old_remark and not old_u_remark:
-                         client['comment'] = user_nick
-                         client['_comment'] = user_nick
-
-                         # Ensure tgId is set correctly
-                         if 'tgId' not in client or not client['tgId']:
-                             client['tgId'] = int(tg_id)
-
-                         clients[i] = client
-                         changed = True
-                         updated_count += 1
-                         logging.info(f"Sync: Updated comment for {tg_id} -> {user_nick}")
-                else:
-                    logging.warning(f"Sync: No nickname found for {tg_id}")
-
-                # Also force update tgId if it was missing/mismatched
-                current_tgid = client.get('tgId')
-                if str(current_tgid) != str(tg_id):
-                    client['tgId'] = int(tg_id)
-                    clients[i] = client
-                    changed = True
-                    logging.info(f"Sync: Restored tgId for {tg_id}")
-
-            except Exception as e:
-                logging.error(f"Sync: Critical error processing client {tg_id}: {e}")
-                failed_count += 1
-
-        # Update progress
-        if (i + 1) % 2 == 0 or (i + 1) == total:
-            try:
-                await progress_msg.edit_text(t("sync_progress", lang).format(current=i+1, total=total))
-            except Exception:
-                pass
-
-        await asyncio.sleep(0.05)
+    await asyncio.gather(*(_worker() for _ in range(min(NICKNAME_SYNC_CONCURRENCY, max(1, total)))))
 
-    if changed:
-        # Save X-UI settings
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        new_settings = json.dumps(settings, indent=2)
-        cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (new_settings, INBOUND_ID))
-        conn.commit()
-        conn.close()
-        # Restart X-UI
-        # subprocess.run(["systemctl", "restart", "x-ui"])
-        proc = await asyncio.create_subprocess_exec("systemctl", "restart", "x-ui")
-        await proc.wait()
+    updated_count = 0
+    if updates:
+        try:
+            async with _XUI_SETTINGS_LOCK:
+                changed, written = await asyncio.to_thread(_apply_nickname_sync, updates)
+            updated_count = len(changed)
+            for client in changed:
+                _ADMIN_STATS.note_client(client)
+            skipped += len(updates) - updated_count
+            now_ts = int(time.time())
+            conn_bot = sqlite3.connect(BOT_DB_PATH)
+            conn_bot.executemany(
+                "INSERT OR REPLACE INTO nickname_sync (tg_id, nick, synced_at) VALUES (?, ?, ?)",
+                [(tg_id, nick, now_ts) for tg_id, nick in written],
+            )
+            conn_bot.commit()
+            conn_bot.close()
+        except Exception as e:
+            logging.error(f"Sync: Failed to save nicknames: {e}")
+            failed_count += len(updates)
+            updated_count = 0
 
     try:
-        await progress_msg.edit_text(t("sync_complete", lang).format(updated=updated_count, failed=failed_count))
+        await progress_msg.edit_text(
+            t("sync_nicknames_complete", lang).format(updated=updated_count, skipped=skipped, failed=failed_count)
+        )
     except Exception:
         pass
 
@@ -7729,12 +9963,12 @@ async def admin_sync_mobile_nicknames(update: Update, context: ContextTypes.DEFA
         await admin_stats(update, context)
         return
 
-    updated_count = 0
-    failed_count = 0
+    records: list[dict[str, Any]] = []
     progress_msg = await context.bot.send_message(
         chat_id=tg_id,
         text=t("sync_progress", lang).format(current=0, total=total),
     )
+    last_edit = time.monotonic()
 
     for i, row in enumerate(rows):
         sub_tg_id, user_uuid, sub_id, expiry_time = row
@@ -7744,11 +9978,12 @@ async def admin_sync_mobile_nicknames(update: Update, context: ContextTypes.DEFA
         fname = None
         lname = None
         try:
-            chat = await context.bot.get_chat(sub_tg_id_str)
-            uname = chat.username
-            fname = chat.first_name
-            lname = chat.last_name
-            update_user_info(sub_tg_id_str, uname, fname, lname)
+            profile = await _get_chat_profile(context.bot, sub_tg_id_str)
+            if profile is None:
+                raise LookupError(sub_tg_id_str)
+            uname = profile["username"]
+            fname = profile["first_name"]
+            lname = profile["last_name"]
         except Exception:
             try:
                 conn_bot = sqlite3.connect(BOT_DB_PATH)
@@ -7776,29 +10011,34 @@ async def admin_sync_mobile_nicknames(update: Update, context: ContextTypes.DEFA
         if not user_nick:
             user_nick = f"tg_{sub_tg_id_str}"
 
-        try:
-            ok = await _sync_mobile_inbound_client(
-                tg_id=sub_tg_id_str,
-                user_uuid=str(user_uuid),
-                sub_id=str(sub_id),
-                expiry_ms=int(expiry_time or 0),
-                comment=user_nick,
-                force_comment=True,
+        records.append(
+            _remote_client_record(
+                sub_tg_id_str,
+                _mobile_email(sub_tg_id_str),
+                str(user_uuid),
+                str(sub_id),
+                int(expiry_time or 0),
+                user_nick,
+                True,
             )
-            if ok:
-                updated_count += 1
-            else:
-                failed_count += 1
-        except Exception:
-            failed_count += 1
+        )
 
-        if (i + 1) % 2 == 0 or (i + 1) == total:
+        now = time.monotonic()
+        if now - last_edit >= _NICKNAME_SYNC_PROGRESS_EDIT_SEC or (i + 1) == total:
+            last_edit = now
             try:
                 await progress_msg.edit_text(t("sync_progress", lang).format(current=i + 1, total=total))
             except Exception:
                 pass
 
-        await asyncio.sleep(0.05)
+    # One remote transaction and a single x-ui restart for the whole batch.
+    try:
+        ok = await _sync_mobile_inbound_clients(records)
+    except Exception as e:
+        logging.warning(f"Mobile nickname batch sync failed: {e}")
+        ok = False
+    updated_count = len(records) if ok else 0
+    failed_count = len(records) - updated_count
 
     try:
         await progress_msg.edit_text(t("sync_complete", lang).format(updated=updated_count, failed=failed_count))
@@ -8085,12 +10325,13 @@ async def admin_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
             tg_id_str = str(item.get('tg_id', ''))
             if tg_id_str and tg_id_str.isdigit():
                 try:
-                    chat = await context.bot.get_chat(tg_id_str)
-                    # Also save to DB for next time!
-                    uname = chat.username
-                    fname = chat.first_name
-                    lname = chat.last_name
-                    update_user_info(tg_id_str, uname, fname, lname)
+                    # Cached and saved to DB for next time
+                    profile = await _get_chat_profile(context.bot, tg_id_str)
+                    if profile is None:
+                        raise LookupError(tg_id_str)
+                    uname = profile["username"]
+                    fname = profile["first_name"]
+                    lname = profile["last_name"]
 
                     if uname:
                         label = f"{label} (@{uname})"
@@ -8493,16 +10734,13 @@ async def admin_user_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     username += f" {db_lname}"
             else:
                 # Try fetch if not in DB
-                chat = await context.bot.get_chat(tg_id_val)
-                if chat.username:
-                    username = f"@{chat.username}"
-                    # Update DB
-                    update_user_info(tg_id_val, chat.username, chat.first_name, chat.last_name)
-                elif chat.first_name:
-                    username = chat.first_name
-                    if chat.last_name:
-                        username += f" {chat.last_name}"
-                    update_user_info(tg_id_val, None, chat.first_name, chat.last_name)
+                profile = await _get_chat_profile(context.bot, tg_id_val)
+                if profile and profile["username"]:
+                    username = f"@{profile['username']}"
+                elif profile and profile["first_name"]:
+                    username = profile["first_name"]
+                    if profile["last_name"]:
+                        username += f" {profile['last_name']}"
         except Exception:
             # logging.error(f"Failed to resolve username for {tg_id_val}: {e}")
             pass
@@ -9157,6 +11395,102 @@ def _flash_delete_is_permanent_error(err: Exception) -> bool:
         )
     return False
 
+class FlashCleanupStats(TypedDict):
+    total: int
+    deleted: int
+    failed: int
+    kept: int
+    errors: dict[str, int]
+    started_at: int
+    finished_at: int
+
+
+_FLASH_CLEANUP_LOCK = asyncio.Lock()
+
+
+def _save_flash_cleanup_stats(stats: FlashCleanupStats) -> None:
+    try:
+        _set_sync_state("flash_cleanup_stats", json.dumps(stats))
+    except sqlite3.Error as e:
+        logging.warning(f"Failed to store flash cleanup stats: {e}")
+
+
+async def _delete_flash_rows(bot: Any, rows: list[tuple[Any, Any, Any]]) -> tuple[list[int], FlashCleanupStats]:
+    """Delete flash messages grouped by chat; returns the flash_messages ids that can be dropped."""
+    by_chat: dict[str, list[tuple[int, int]]] = {}
+    for db_id, chat_id, msg_id in rows:
+        by_chat.setdefault(str(chat_id), []).append((int(db_id), int(msg_id)))
+    # deleteMessages only works within one chat, so chats with several pending flashes share a call.
+    batches: deque[tuple[str, list[tuple[int, int]]]] = deque(
+        (chat_id, items[i:i + 100]) for chat_id, items in by_chat.items() for i in range(0, len(items), 100)
+    )
+    stats: FlashCleanupStats = {
+        "total": len(rows),
+        "deleted": 0,
+        "failed": 0,
+        "kept": 0,
+        "errors": {},
+        "started_at": int(time.time()),
+        "finished_at": 0,
+    }
+    drop_ids: list[int] = []
+    bucket = _telegram_bulk_bucket()
+    last_save = time.monotonic()
+    _save_flash_cleanup_stats(stats)
+
+    async def _worker() -> None:
+        nonlocal last_save
+        while batches:
+            chat_id, items = batches.popleft()
+            message_ids = [msg_id for _, msg_id in items]
+            await bucket.acquire()
+            try:
+                if len(message_ids) == 1:
+                    await bot.delete_message(chat_id=chat_id, message_id=message_ids[0])
+                else:
+                    await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+                stats["deleted"] += len(items)
+                drop_ids.extend(db_id for db_id, _ in items)
+            except Exception as e:
+                if isinstance(e, RetryAfter):
+                    bucket.pause(_retry_after_seconds(e))
+                kind = type(e).__name__
+                stats["errors"][kind] = stats["errors"].get(kind, 0) + len(items)
+                if _flash_delete_is_permanent_error(e):
+                    stats["failed"] += len(items)
+                    drop_ids.extend(db_id for db_id, _ in items)
+                else:
+                    stats["kept"] += len(items)
+            if time.monotonic() - last_save >= 2.0:
+                last_save = time.monotonic()
+                _save_flash_cleanup_stats(stats)
+
+    await asyncio.gather(*(_worker() for _ in range(min(BROADCAST_CONCURRENCY, max(1, len(batches))))))
+    stats["finished_at"] = int(time.time())
+    _save_flash_cleanup_stats(stats)
+    return drop_ids, stats
+
+
+def _format_flash_cleanup_stats(raw: Optional[str]) -> str:
+    try:
+        stats = json.loads(raw or "")
+    except Exception:
+        return ""
+    if not isinstance(stats, dict) or not stats.get("total"):
+        return ""
+    done = int(stats.get("deleted", 0)) + int(stats.get("failed", 0)) + int(stats.get("kept", 0))
+    state = "✅" if stats.get("finished_at") else "⏳"
+    started = datetime.datetime.fromtimestamp(int(stats.get("started_at") or 0), tz=TIMEZONE).strftime("%d.%m %H:%M")
+    text = (
+        f"🧹 *Очистка Flash* ({started}): {state} {done}/{stats['total']}\n"
+        f"🗑 Удалено: {stats.get('deleted', 0)} | ❌ Ошибок: {stats.get('failed', 0)} | 🔁 На повтор: {stats.get('kept', 0)}\n"
+    )
+    errors = stats.get("errors") or {}
+    if isinstance(errors, dict) and errors:
+        text += ", ".join(f"{_escape_markdown(str(k))}: {v}" for k, v in sorted(errors.items(), key=lambda kv: -int(kv[1]))[:4]) + "\n"
+    return text + "\n"
+
+
 async def admin_flash_delete_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer("Удаление...")
@@ -9166,29 +11500,19 @@ async def admin_flash_delete_all(update: Update, context: ContextTypes.DEFAULT_T
         cursor = conn.cursor()
         cursor.execute("SELECT id, chat_id, message_id FROM flash_messages")
         rows = cursor.fetchall()
+        conn.close()
 
-        deleted_count = 0
-        failed_count = 0
-        for row in rows:
-            db_id, chat_id, msg_id = row
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                deleted_count += 1
-            except Exception as e:
-                if _flash_delete_is_permanent_error(e):
-                    failed_count += 1
-                elif isinstance(e, (TimedOut, NetworkError)):
-                    failed_count += 1
-                else:
-                    failed_count += 1
+        async with _FLASH_CLEANUP_LOCK:
+            _, stats = await _delete_flash_rows(context.bot, rows)
 
-        cursor.execute("DELETE FROM flash_messages")
+        conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+        conn.execute("DELETE FROM flash_messages")
         conn.commit()
         conn.close()
 
         await query.message.reply_text(
-            f"✅ Принудительно удалено: {deleted_count}\n"
-            f"⚠️ Не удалось удалить: {failed_count}"
+            f"✅ Принудительно удалено: {stats['deleted']}\n"
+            f"⚠️ Не удалось удалить: {stats['failed'] + stats['kept']}"
         )
         # Return to menu
         await admin_flash_menu(update, context)
@@ -9253,7 +11577,11 @@ async def admin_flash_errors(update: Update, context: ContextTypes.DEFAULT_TYPE)
     finally:
         conn.close()
 
-    text = "📉 *Недоставленные сообщения:*\n\n"
+    try:
+        cleanup_block = _format_flash_cleanup_stats(_get_sync_state("flash_cleanup_stats"))
+    except sqlite3.Error:
+        cleanup_block = ""
+    text = cleanup_block + "📉 *Недоставленные сообщения:*\n\n"
     if not rows:
         text += "Список пуст."
     else:
@@ -9284,50 +11612,337 @@ async def admin_flash_errors(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='admin_flash_menu')]]))
 
 async def cleanup_flash_messages(context: ContextTypes.DEFAULT_TYPE):
+    if _FLASH_CLEANUP_LOCK.locked():
+        return
+    try:
+        async with _FLASH_CLEANUP_LOCK:
+            current_ts = int(time.time())
+            conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, chat_id, message_id FROM flash_messages WHERE delete_at <= ?", (current_ts,))
+            rows = cursor.fetchall()
+            conn.close()
+
+            if not rows:
+                return
+
+            drop_ids, stats = await _delete_flash_rows(context.bot, rows)
+
+            if drop_ids:
+                conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+                conn.executemany("DELETE FROM flash_messages WHERE id=?", [(db_id,) for db_id in drop_ids])
+                conn.commit()
+                conn.close()
+                if stats["kept"] > 0:
+                    logging.info(f"Cleaned up {len(drop_ids)} flash messages (kept {stats['kept']} for retry).")
+                else:
+                    logging.info(f"Cleaned up {len(drop_ids)} flash messages.")
+
+    except Exception as e:
+        logging.error(f"Error in cleanup_flash_messages: {e}")
+
+# Admin user search runs on two FTS5 indexes keyed by Telegram ID (rowid): user_search holds separate columns
+# for ranked prefix matches, user_search_trigram one padded lowercase document per user for typo-tolerant
+# fallback matches. Both are optional; without FTS5 the search only resolves exact Telegram IDs.
+# A user can own several x-ui clients, so the email and comment columns hold one line per client, in the same order.
+_USER_SEARCH_COLUMNS = ("tg_id", "username", "name", "email", "comment")
+_USER_SEARCH_LIMIT = 10
+_USER_SEARCH_FUZZY_MIN_SCORE = 0.5
+_USER_SEARCH_REBUILD_CHUNK = 2000
+
+
+def _user_search_rowid(tg_id: Any) -> Optional[int]:
+    value = str(tg_id or "").strip()
+    return int(value) if value.isdigit() else None
+
+
+def _user_search_grams(text: str) -> set[str]:
+    grams: set[str] = set()
+    for word in text.lower().split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _user_search_doc(entry: Mapping[str, str]) -> str:
+    words = " ".join(entry.get(col) or "" for col in _USER_SEARCH_COLUMNS).replace("@", " ").lower().split()
+    return " ".join(f"  {word} " for word in words)
+
+
+def _user_search_put(cursor: sqlite3.Cursor, tg_id: Any, fields: Mapping[str, Optional[str]]) -> None:
+    """Merge the given columns into a user's entry (creating it) and refresh the trigram document."""
+    rowid = _user_search_rowid(tg_id)
+    if rowid is None:
+        return
+    cursor.execute(f"SELECT {', '.join(_USER_SEARCH_COLUMNS)} FROM user_search WHERE rowid=?", (rowid,))
+    row = cursor.fetchone()
+    entry = dict(zip(_USER_SEARCH_COLUMNS, row)) if row else {col: "" for col in _USER_SEARCH_COLUMNS}
+    entry.update({key: value or "" for key, value in fields.items()})
+    entry["tg_id"] = str(rowid)
+    cursor.execute("DELETE FROM user_search WHERE rowid=?", (rowid,))
+    cursor.execute(
+        "INSERT INTO user_search (rowid, tg_id, username, name, email, comment) VALUES (?, ?, ?, ?, ?, ?)",
+        (rowid, *(entry[col] for col in _USER_SEARCH_COLUMNS)),
+    )
+    try:
+        cursor.execute("DELETE FROM user_search_trigram WHERE rowid=?", (rowid,))
+        cursor.execute("INSERT INTO user_search_trigram (rowid, doc) VALUES (?, ?)", (rowid, _user_search_doc(entry)))
+    except sqlite3.OperationalError:
+        pass
+
+
+def _user_search_client_map(email_col: Optional[str], comment_col: Optional[str]) -> dict[str, str]:
+    comments = (comment_col or "").split("\n")
+    emails = (email_col or "").split("\n")
+    return {email: comments[idx] if idx < len(comments) else "" for idx, email in enumerate(emails) if email}
+
+
+def _user_search_client_columns(clients: Mapping[str, str]) -> dict[str, Optional[str]]:
+    return {"email": "\n".join(clients), "comment": "\n".join(clients.values())}
+
+
+def _user_search_put_client(cursor: sqlite3.Cursor, tg_id: Any, email: str, comment: Optional[str]) -> None:
+    """Add or replace one client's email and comment in a user's entry; comment=None removes the client."""
+    rowid = _user_search_rowid(tg_id)
+    if rowid is None or not email:
+        return
+    cursor.execute("SELECT email, comment FROM user_search WHERE rowid=?", (rowid,))
+    row = cursor.fetchone()
+    if row is None and comment is None:
+        return
+    clients = _user_search_client_map(*row) if row else {}
+    if comment is None:
+        if clients.pop(email, None) is None:
+            return
+    else:
+        clients[email] = comment.replace("\n", " ")
+    _user_search_put(cursor, rowid, _user_search_client_columns(clients))
+
+
+def _index_user_search(entries: Iterable[tuple[Any, Mapping[str, Optional[str]]]]) -> None:
     try:
-        current_ts = int(time.time())
         conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
-        cursor = conn.cursor()
+        try:
+            cursor = conn.cursor()
+            for tg_id, fields in entries:
+                _user_search_put(cursor, tg_id, fields)
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.debug(f"User search index update skipped: {e}")
 
-        cursor.execute("SELECT id, chat_id, message_id FROM flash_messages WHERE delete_at <= ?", (current_ts,))
-        rows = cursor.fetchall()
 
-        if not rows:
+def _user_search_client_fields(client: Mapping[str, Any]) -> tuple[Optional[str], dict[str, Optional[str]]]:
+    return get_client_tg_id(dict(client)), {
+        "email": str(client.get('email') or ""),
+        "comment": str(client.get('comment') or ""),
+    }
+
+
+def _index_user_search_clients(clients: Iterable[Mapping[str, Any]]) -> None:
+    entries = [_user_search_client_fields(client) for client in clients]
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+        try:
+            cursor = conn.cursor()
+            for tg_id, fields in entries:
+                _user_search_put_client(cursor, tg_id, fields["email"] or "", fields["comment"] or "")
+            conn.commit()
+        finally:
             conn.close()
-            return
+    except sqlite3.Error as e:
+        logging.debug(f"User search index update skipped: {e}")
 
-        deleted_count = 0
-        kept_count = 0
-        for row in rows:
-            db_id, chat_id, msg_id = row
+
+def _unindex_user_search_client(tg_id: Any, email: str) -> None:
+    """Drop one client from a user's entry, e.g. after it was rebound to another Telegram ID."""
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+        try:
+            _user_search_put_client(conn.cursor(), tg_id, email, None)
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.debug(f"User search index update skipped: {e}")
+
+
+def _drop_user_search(cursor: sqlite3.Cursor, tg_ids: Iterable[Any]) -> None:
+    rowids = [(rowid,) for rowid in (_user_search_rowid(tg_id) for tg_id in tg_ids) if rowid is not None]
+    for table in ("user_search", "user_search_trigram"):
+        try:
+            cursor.executemany(f"DELETE FROM {table} WHERE rowid=?", rowids)
+        except sqlite3.OperationalError:
+            pass
+
+
+def _rebuild_user_search_index() -> int:
+    entries: dict[int, dict[str, str]] = {}
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT tg_id, username, first_name, last_name FROM user_prefs")
+        for tg_id, username, first_name, last_name in cursor.fetchall():
+            rowid = _user_search_rowid(tg_id)
+            if rowid is not None:
+                name = " ".join(part for part in (first_name, last_name) if part)
+                entries[rowid] = {"tg_id": str(rowid), "username": username or "", "name": name, "email": "", "comment": ""}
+    finally:
+        conn.close()
+
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+        clients = json.loads(row[0]).get('clients', []) if row else []
+    except (sqlite3.Error, ValueError) as e:
+        logging.warning(f"User search rebuild without x-ui clients: {e}")
+        clients = []
+    client_maps: dict[int, dict[str, str]] = {}
+    for client in clients:
+        tg_id, fields = _user_search_client_fields(client)
+        rowid = _user_search_rowid(tg_id)
+        if rowid is None or not fields["email"]:
+            continue
+        entry = entries.setdefault(rowid, {col: "" for col in _USER_SEARCH_COLUMNS})
+        entry["tg_id"] = str(rowid)
+        client_maps.setdefault(rowid, {})[str(fields["email"])] = str(fields["comment"] or "").replace("\n", " ")
+    for rowid, client_map in client_maps.items():
+        entries[rowid].update({key: value or "" for key, value in _user_search_client_columns(client_map).items()})
+
+    # Replaced in small committed chunks so other writers are never locked out for the whole rebuild.
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT rowid FROM user_search")
+        stale = [(rowid,) for (rowid,) in cursor.fetchall() if rowid not in entries]
+        items = list(entries.items())
+        for start in range(0, max(len(items), len(stale)), _USER_SEARCH_REBUILD_CHUNK):
+            chunk = items[start:start + _USER_SEARCH_REBUILD_CHUNK]
+            gone = stale[start:start + _USER_SEARCH_REBUILD_CHUNK] + [(rowid,) for rowid, _entry in chunk]
+            cursor.executemany("DELETE FROM user_search WHERE rowid=?", gone)
+            cursor.executemany(
+                "INSERT INTO user_search (rowid, tg_id, username, name, email, comment) VALUES (?, ?, ?, ?, ?, ?)",
+                [(rowid, *(entry[col] for col in _USER_SEARCH_COLUMNS)) for rowid, entry in chunk],
+            )
             try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                cursor.execute("DELETE FROM flash_messages WHERE id=?", (db_id,))
-                deleted_count += 1
-            except Exception as e:
-                if _flash_delete_is_permanent_error(e):
-                    cursor.execute("DELETE FROM flash_messages WHERE id=?", (db_id,))
-                    deleted_count += 1
-                else:
-                    kept_count += 1
+                cursor.executemany("DELETE FROM user_search_trigram WHERE rowid=?", gone)
+                cursor.executemany(
+                    "INSERT INTO user_search_trigram (rowid, doc) VALUES (?, ?)",
+                    [(rowid, _user_search_doc(entry)) for rowid, entry in chunk],
+                )
+            except sqlite3.OperationalError:
+                pass
+            conn.commit()
+    finally:
+        conn.close()
+    return len(entries)
+
+
+async def user_search_rebuild_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        count = await asyncio.to_thread(_rebuild_user_search_index)
+        logging.info(f"User search index rebuilt: {count} users")
+    except sqlite3.Error as e:
+        logging.warning(f"User search index rebuild failed: {e}")
+
+
+def _search_users(query: str, limit: int = _USER_SEARCH_LIMIT) -> list[tuple[str, str, str]]:
+    """Return (tg_id, username, name) for the best matches: prefix hits by bm25 first, then fuzzy trigram hits."""
+    tokens = [tok for tok in query.replace("@", " ").split() if tok]
+    if not tokens:
+        return []
+    results: list[tuple[str, str, str]] = []
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        match = " ".join('"' + tok.replace('"', '""') + '"*' for tok in tokens)
+        cursor.execute(
+            "SELECT tg_id, username, name FROM user_search WHERE user_search MATCH ? "
+            "ORDER BY bm25(user_search, 10.0, 5.0, 3.0, 2.0, 1.0) LIMIT ?",
+            (match, limit),
+        )
+        results = [(str(r[0]), str(r[1] or ""), str(r[2] or "")) for r in cursor.fetchall()]
+
+        grams = _user_search_grams(" ".join(tokens))
+        if len(results) < limit and len(" ".join(tokens)) >= 3:
+            seen = {r[0] for r in results}
+            # Candidates come from the in-word trigrams only; the padded edge grams match nearly every row.
+            inner = sorted(gram for gram in grams if " " not in gram) or sorted(grams)
+            fuzzy_match = " OR ".join('"' + gram.replace('"', '""') + '"' for gram in inner)
+            try:
+                cursor.execute(
+                    "SELECT t.rowid, t.doc, s.username, s.name FROM user_search_trigram AS t "
+                    "JOIN user_search AS s ON s.rowid = t.rowid "
+                    "WHERE user_search_trigram MATCH ? ORDER BY bm25(user_search_trigram) LIMIT ?",
+                    (fuzzy_match, limit * 5),
+                )
+                scored = []
+                for rowid, doc, username, name in cursor.fetchall():
+                    if str(rowid) in seen:
+                        continue
+                    score = len(grams & _user_search_grams(str(doc))) / len(grams)
+                    if score >= _USER_SEARCH_FUZZY_MIN_SCORE:
+                        scored.append((score, str(rowid), str(username or ""), str(name or "")))
+                scored.sort(key=lambda item: -item[0])
+                results.extend((tg_id, username, name) for _score, tg_id, username, name in scored[: limit - len(results)])
+            except sqlite3.OperationalError:
+                pass
+    finally:
+        conn.close()
+    return results
+
+
+async def _reply_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, lang: str) -> None:
+    context.user_data['admin_action'] = None
+    query_text = text.strip()
+    if query_text.isdigit():
+        # An exact Telegram ID still opens the user card directly.
+        try:
+            conn = sqlite3.connect(BOT_DB_PATH)
+            known = conn.execute("SELECT 1 FROM user_prefs WHERE tg_id=?", (query_text,)).fetchone() is not None
+            conn.close()
+        except sqlite3.Error:
+            known = True
+        if known:
+            await admin_user_db_detail(update, context, query_text)
+            return
 
-        conn.commit()
-        conn.close()
-        if deleted_count > 0:
-            if kept_count > 0:
-                logging.info(f"Cleaned up {deleted_count} flash messages (kept {kept_count} for retry).")
-            else:
-                logging.info(f"Cleaned up {deleted_count} flash messages.")
+    try:
+        matches = await asyncio.to_thread(_search_users, query_text)
+    except sqlite3.Error as e:
+        logging.warning(f"User search unavailable: {e}")
+        matches = []
+    back_row = [InlineKeyboardButton(t("btn_back_admin", lang), callback_data='admin_panel')]
+    if not matches:
+        if query_text.isdigit():
+            await admin_user_db_detail(update, context, query_text)
+        else:
+            await update.message.reply_text(t("search_no_results", lang), reply_markup=InlineKeyboardMarkup([back_row]))
+        return
+
+    keyboard = []
+    for tg_id, username, name in matches:
+        label = " · ".join(part for part in (f"@{username}" if username else "", name, tg_id) if part)
+        keyboard.append([InlineKeyboardButton(label[:60], callback_data=f"admin_db_detail_{tg_id}")])
+    keyboard.append(back_row)
+    await update.message.reply_text(
+        t("search_results", lang).format(count=len(matches)),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
 
-    except Exception as e:
-        logging.error(f"Error in cleanup_flash_messages: {e}")
 
 async def admin_search_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     await query.edit_message_text(
-        "🔍 *Поиск пользователя*\n\nОтправьте *Telegram ID* пользователя для поиска в базе данных.",
+        "🔍 *Поиск пользователя*\n\nОтправьте *Telegram ID*, @username, имя, email или комментарий клиента.",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Отмена", callback_data='admin_panel')]]),
         parse_mode='Markdown'
     )
@@ -9341,69 +11956,56 @@ async def admin_sales_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_id = str(query.from_user.id)
     lang = get_lang(tg_id)
 
-    try:
-        conn = sqlite3.connect(BOT_DB_PATH)
-        cursor = conn.cursor()
+    # format: admin_sales_log or admin_sales_log_{date}_{id} (keyset cursor of the page)
+    before: Optional[tuple[int, int]] = None
+    parts = query.data.split('_')
+    if len(parts) == 5:
         try:
-            cursor.execute(
-                "SELECT tg_id, amount, date, plan_id, telegram_payment_charge_id "
-                "FROM transactions WHERE tg_id != '369456269' ORDER BY date DESC LIMIT 100"
-            )
-        except sqlite3.OperationalError:
-            cursor.execute(
-                "SELECT tg_id, amount, date, plan_id, NULL "
-                "FROM transactions WHERE tg_id != '369456269' ORDER BY date DESC LIMIT 100"
-            )
-        rows = _dedupe_sales_log_rows(cursor.fetchall())[:20]
-        conn.close()
+            before = (int(parts[3]), int(parts[4]))
+        except ValueError:
+            before = None
+
+    try:
+        rows, next_cursor = await asyncio.to_thread(_load_sales_ledger_page, before)
+        back_row = [InlineKeyboardButton(t("btn_back_admin", lang), callback_data='admin_panel')]
 
         if not rows:
+            keyboard = [back_row]
+            if before:
+                keyboard.insert(0, [InlineKeyboardButton(t("btn_sales_log_latest", lang), callback_data='admin_sales_log')])
             await query.edit_message_text(
                 t("sales_log_empty", lang),
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_back_admin", lang), callback_data='admin_panel')]]),
+                reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
             return
 
-        # Fetch client comments map (tg_id -> comment)
-        client_map = {}
-        try:
-            conn_xui = sqlite3.connect(DB_PATH)
-            cursor_xui = conn_xui.cursor()
-            cursor_xui.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-            row_xui = cursor_xui.fetchone()
-            conn_xui.close()
-
-            if row_xui:
-                settings = json.loads(row_xui[0])
-                clients = settings.get('clients', [])
-                for c in clients:
-                    cid = str(c.get('tgId', ''))
-                    comment = c.get('comment', '') or c.get('_comment', '') or c.get('remark', '')
-                    if cid and comment:
-                        client_map[cid] = comment
-        except Exception as e:
-            logging.error(f"Error fetching client comments: {e}")
+        names = await asyncio.to_thread(_sales_log_names, [row["tg_id"] for row in rows])
 
         text = t("sales_log_title", lang)
 
         for row in rows:
-            tg_id_tx, amount, date_ts, plan_id, _charge_id = row
-            date_str = datetime.datetime.fromtimestamp(date_ts, tz=TIMEZONE).strftime("%d.%m %H:%M")
+            date_str = datetime.datetime.fromtimestamp(row["date"], tz=TIMEZONE).strftime("%d.%m %H:%M")
 
             # Localize plan name
-            plan_display = TEXTS[lang].get(f"plan_{plan_id}", plan_id)
+            plan_display = TEXTS[lang].get(f"plan_{row['plan_id']}", row["plan_id"])
+            user_name = _escape_markdown(names.get(row["tg_id"], "Unknown"))
 
-            # Get name from map
-            user_name = client_map.get(tg_id_tx, "Unknown")
-            # If name is unknown, try to find in user_prefs?
-            # (Optional, but user specifically asked for comment cells)
+            text += f"📅 `{date_str}` | 🆔 `{row['tg_id']}`\n👤 {user_name}\n💳 {plan_display} | 💰 {row['amount']} XTR\n\n"
 
-            text += f"📅 `{date_str}` | 🆔 `{tg_id_tx}`\n👤 {user_name}\n💳 {plan_display} | 💰 {amount} XTR\n\n"
+        nav_row = []
+        if before:
+            nav_row.append(InlineKeyboardButton(t("btn_sales_log_latest", lang), callback_data='admin_sales_log'))
+        if next_cursor:
+            nav_row.append(InlineKeyboardButton(
+                t("btn_sales_log_older", lang),
+                callback_data=f"admin_sales_log_{next_cursor[0]}_{next_cursor[1]}",
+            ))
+        keyboard = [nav_row, back_row] if nav_row else [back_row]
 
         await query.edit_message_text(
             text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_back_admin", lang), callback_data='admin_panel')]]),
+            reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='Markdown'
         )
     except Exception as e:
@@ -9469,6 +12071,7 @@ async def admin_reset_trial_db(update: Update, context: ContextTypes.DEFAULT_TYP
     cursor.execute("UPDATE user_prefs SET trial_used=0, trial_activated_at=NULL WHERE tg_id=?", (tg_id,))
     conn.commit()
     conn.close()
+    _ADMIN_STATS.invalidate()
 
     await query.edit_message_text(f"✅ Пробный период для `{tg_id}` сброшен.", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ панель", callback_data='admin_panel')]]))
 
@@ -9486,8 +12089,10 @@ async def admin_delete_user_db(update: Update, context: ContextTypes.DEFAULT_TYP
     cursor = conn.cursor()
     cursor.execute("DELETE FROM user_prefs WHERE tg_id=?", (tg_id,))
     cursor.execute("DELETE FROM user_promos WHERE tg_id=?", (tg_id,))
+    _drop_user_search(cursor, [tg_id])
     conn.commit()
     conn.close()
+    _ADMIN_STATS.invalidate()
 
     await query.edit_message_text(f"✅ Пользователь `{tg_id}` удален из базы бота.", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ панель", callback_data='admin_panel')]]))
 
@@ -9539,7 +12144,9 @@ async def admin_cleanup_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
         cursor_bot.executemany("DELETE FROM user_promos WHERE tg_id=?", [(tg,) for tg in delete_ids])
         cursor_bot.executemany("DELETE FROM notifications WHERE tg_id=?", [(tg,) for tg in delete_ids])
         cursor_bot.executemany("DELETE FROM referral_bonuses WHERE referrer_id=? OR referred_id=?", [(tg, tg) for tg in delete_ids])
+        _drop_user_search(cursor_bot, delete_ids)
         conn_bot.commit()
+        _ADMIN_STATS.invalidate()
 
     conn_bot.close()
 
@@ -9757,6 +12364,8 @@ async def admin_db_sync_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         cursor_bot.execute(f"DELETE FROM user_promos WHERE tg_id IN ({placeholders})", tuple(delete_user_ids))
         cursor_bot.execute(f"DELETE FROM notifications WHERE tg_id IN ({placeholders})", tuple(delete_user_ids))
         cursor_bot.execute(f"DELETE FROM poll_votes WHERE tg_id IN ({placeholders})", tuple(delete_user_ids))
+        _drop_poll_voters(delete_user_ids)
+        _drop_user_search(cursor_bot, delete_user_ids)
         cursor_bot.execute(
             f"DELETE FROM referral_bonuses WHERE referrer_id IN ({placeholders}) OR referred_id IN ({placeholders})",
             tuple(delete_user_ids) + tuple(delete_user_ids),
@@ -9787,6 +12396,7 @@ async def admin_db_sync_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     conn_bot.commit()
     conn_bot.close()
+    _ADMIN_STATS.invalidate()
 
     await query.edit_message_text(
         t("db_sync_done", lang).format(
@@ -9799,6 +12409,415 @@ async def admin_db_sync_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown",
     )
 
+class _TokenBucket:
+    """Async token bucket; `pause` stops every consumer, e.g. after a RetryAfter from Telegram."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = max(0.001, float(rate))
+        self.capacity = max(1.0, float(capacity if capacity is not None else rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + max(0.0, seconds))
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_TELEGRAM_BULK_BUCKETS: dict[asyncio.AbstractEventLoop, _TokenBucket] = {}
+
+
+def _telegram_bulk_bucket() -> _TokenBucket:
+    # Shared by every bulk sender so that together they stay under Telegram's global limit.
+    loop = asyncio.get_running_loop()
+    bucket = _TELEGRAM_BULK_BUCKETS.get(loop)
+    if bucket is None:
+        for stale in [key for key in _TELEGRAM_BULK_BUCKETS if key.is_closed()]:
+            _TELEGRAM_BULK_BUCKETS.pop(stale, None)
+        bucket = _TokenBucket(BROADCAST_RATE_PER_SEC)
+        _TELEGRAM_BULK_BUCKETS[loop] = bucket
+    return bucket
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+_AUDIENCE_SEGMENTS: dict[str, str] = {
+    "all": "(in_prefs=1 OR has_client=1)",
+    "ru": "in_prefs=1 AND lang='ru'",
+    "en": "in_prefs=1 AND lang='en'",
+    "active": "has_client=1 AND (expiry_ms<=0 OR expiry_ms>:now_ms)",
+    "expired": "has_client=1 AND expiry_ms>0 AND expiry_ms<=:now_ms",
+    "trial": "paid=0 AND trial_used=1",
+    "paid": "paid=1",
+    "nopaid": "paid=0 AND (in_prefs=1 OR has_client=1)",
+    "mobile": "mobile=1",
+}
+
+
+def _sync_audience_clients(force: bool = False) -> None:
+    """Mirror x-ui clients (has_client/expiry_ms) into audience_members when the inbound changed."""
+    try:
+        conn_xui = sqlite3.connect(DB_PATH)
+        cursor_xui = conn_xui.cursor()
+        cursor_xui.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+        row = cursor_xui.fetchone()
+        conn_xui.close()
+    except Exception as e:
+        logging.error(f"Error getting X-UI users for audience: {e}")
+        return
+    raw = str(row[0] or "") if row else ""
+    digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    if not force and _get_sync_state("audience_clients_hash") == digest:
+        return
+    expiry_by_tg: dict[str, int] = {}
+    try:
+        clients = json.loads(raw).get("clients", []) if raw else []
+    except Exception:
+        clients = []
+    for client in clients:
+        client_tg_id = get_client_tg_id(client)
+        if client_tg_id is None:
+            continue
+        expiry = int(client.get("expiryTime") or 0)
+        previous = expiry_by_tg.get(client_tg_id)
+        # 0 (unlimited) and negative (starts on first use) both count as active, so they win over dates.
+        if previous is None or expiry <= 0 or (previous > 0 and expiry > previous):
+            expiry_by_tg[client_tg_id] = expiry
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS audience_clients_tmp (tg_id TEXT PRIMARY KEY, expiry_ms INTEGER)")
+        cursor.execute("DELETE FROM audience_clients_tmp")
+        cursor.executemany("INSERT INTO audience_clients_tmp (tg_id, expiry_ms) VALUES (?, ?)", list(expiry_by_tg.items()))
+        cursor.execute("INSERT OR IGNORE INTO audience_members (tg_id) SELECT tg_id FROM audience_clients_tmp")
+        cursor.execute(
+            "UPDATE audience_members SET has_client=0, expiry_ms=0 "
+            "WHERE has_client=1 AND tg_id NOT IN (SELECT tg_id FROM audience_clients_tmp)"
+        )
+        cursor.execute(
+            "UPDATE audience_members SET has_client=1, "
+            "expiry_ms=(SELECT c.expiry_ms FROM audience_clients_tmp c WHERE c.tg_id=audience_members.tg_id) "
+            "WHERE tg_id IN (SELECT tg_id FROM audience_clients_tmp)"
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    _set_sync_state("audience_clients_hash", digest)
+
+
+def _note_audience_clients(clients: Iterable[Mapping[str, Any]]) -> None:
+    """Apply clients just written to x-ui to audience_members, with the same expiry precedence as the full sync."""
+    rows = []
+    for client in clients:
+        client_tg_id = get_client_tg_id(dict(client))
+        if client_tg_id is not None:
+            rows.append((client_tg_id, int(client.get("expiryTime") or 0)))
+    if not rows:
+        return
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH)
+        try:
+            conn.executemany(
+                "INSERT INTO audience_members (tg_id, has_client, expiry_ms) VALUES (?, 1, ?) "
+                "ON CONFLICT(tg_id) DO UPDATE SET has_client=1, expiry_ms=CASE "
+                "WHEN audience_members.has_client=1 AND (audience_members.expiry_ms<=0 "
+                "OR (excluded.expiry_ms>0 AND audience_members.expiry_ms>excluded.expiry_ms)) "
+                "THEN audience_members.expiry_ms ELSE excluded.expiry_ms END",
+                rows,
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.debug(f"Audience update skipped: {e}")
+
+
+async def audience_sync_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Catches client changes made outside the bot's writers (panel edits, deletions); a no-op while unchanged.
+    await asyncio.to_thread(_sync_audience_clients)
+
+
+def _audience_query(segment: str, select: str, suffix: str = "", extra: tuple[Any, ...] = ()) -> list[tuple[Any, ...]]:
+    where = _AUDIENCE_SEGMENTS.get(segment)
+    if where is None:
+        return []
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        params: dict[str, Any] = {"now_ms": int(time.time() * 1000)}
+        params.update({f"p{idx}": value for idx, value in enumerate(extra)})
+        cursor.execute(f"SELECT {select} FROM audience_members WHERE {where} {suffix}", params)
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def _audience_ids(segment: str) -> list[str]:
+    return [str(row[0]) for row in _audience_query(segment, "tg_id")]
+
+
+def _audience_count(segment: str) -> int:
+    rows = _audience_query(segment, "COUNT(*)")
+    return int(rows[0][0]) if rows else 0
+
+
+def _audience_page(segment: str, page: int, per_page: int) -> tuple[list[tuple[str, str, str]], int]:
+    total = _audience_count(segment)
+    rows = _audience_query(
+        segment,
+        "tg_id, COALESCE(first_name, ''), COALESCE(username, '')",
+        "ORDER BY tg_id LIMIT :p0 OFFSET :p1",
+        (per_page, max(0, page) * per_page),
+    )
+    return [(str(r[0]), str(r[1]), str(r[2])) for r in rows], total
+
+
+def _resolve_broadcast_recipients(target: str, individual_ids: Iterable[str]) -> list[str]:
+    if target == 'individual':
+        return list(dict.fromkeys(str(uid) for uid in individual_ids))
+    # Once per broadcast, not per click: the recipient list must reflect the current x-ui clients.
+    _sync_audience_clients()
+    return _audience_ids(target)
+
+
+_BROADCAST_SEGMENT_NAMES = {
+    'active': "Активные",
+    'expired': "Истёкшие",
+    'trial': "Только пробный период",
+    'paid': "Покупатели",
+    'nopaid': "Без покупок",
+    'mobile': "3G/4G",
+}
+
+
+def _broadcast_target_name(target: str, total: int) -> str:
+    if target in _BROADCAST_SEGMENT_NAMES:
+        return _BROADCAST_SEGMENT_NAMES[target]
+    if target == 'en':
+        return "English (en)"
+    if target == 'ru':
+        return "Русский (ru)"
+    if target == 'individual':
+        return f"Индивидуально: {total}"
+    return "ВСЕМ"
+
+
+def _create_broadcast(admin_id: str, from_chat_id: int, message_id: int, target: str, recipients: list[str]) -> int:
+    now = int(time.time())
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO broadcasts (admin_id, from_chat_id, message_id, target, status, created_at) VALUES (?, ?, ?, ?, 'running', ?)",
+            (admin_id, from_chat_id, message_id, target, now),
+        )
+        broadcast_id = int(cursor.lastrowid or 0)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, tg_id, status, attempts, updated_at) VALUES (?, ?, 'pending', 0, ?)",
+            [(broadcast_id, uid, now) for uid in recipients],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return broadcast_id
+
+
+def _set_broadcast_status_message(broadcast_id: int, chat_id: int, message_id: int) -> None:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    conn.execute(
+        "UPDATE broadcasts SET status_chat_id=?, status_message_id=? WHERE id=?",
+        (chat_id, message_id, broadcast_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _broadcast_counts(broadcast_id: int) -> dict[str, int]:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id=? GROUP BY status", (broadcast_id,))
+    counts = {str(row[0]): int(row[1]) for row in cursor.fetchall()}
+    conn.close()
+    return counts
+
+
+def _store_broadcast_results(broadcast_id: int, rows: list[tuple[str, int, str, str]]) -> None:
+    if not rows:
+        return
+    now = int(time.time())
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        conn.executemany(
+            "UPDATE broadcast_recipients SET status=?, attempts=?, error=?, updated_at=? WHERE broadcast_id=? AND tg_id=?",
+            [(status, attempts, error, now, broadcast_id, uid) for uid, attempts, status, error in rows],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _format_broadcast_progress(target: str, counts: Mapping[str, int], finished: bool) -> str:
+    total = sum(counts.values())
+    sent = counts.get('sent', 0)
+    blocked = counts.get('blocked', 0)
+    failed = counts.get('failed', 0)
+    target_name = _broadcast_target_name(target, total)
+    if finished:
+        text = f"✅ Рассылка завершена ({target_name}).\n\n📤 Отправлено: {sent}\n🚫 Не доставлено (бот заблокирован): {blocked}"
+        if failed:
+            text += f"\n⚠️ Ошибки: {failed}"
+        return text
+    done = total - counts.get('pending', 0)
+    return f"⏳ Рассылка ({target_name}): {done}/{total}\n\n📤 Отправлено: {sent}\n🚫 Заблокировали: {blocked}\n⚠️ Ошибки: {failed}"
+
+
+async def _run_broadcast(bot: Any, broadcast_id: int) -> dict[str, int]:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT from_chat_id, message_id, target, status_chat_id, status_message_id FROM broadcasts WHERE id=?",
+        (broadcast_id,),
+    )
+    row = cursor.fetchone()
+    cursor.execute(
+        "SELECT tg_id, attempts FROM broadcast_recipients WHERE broadcast_id=? AND status='pending'",
+        (broadcast_id,),
+    )
+    pending = [(str(r[0]), int(r[1] or 0)) for r in cursor.fetchall()]
+    conn.close()
+    if not row:
+        return {}
+    from_chat_id, message_id, target, status_chat_id, status_message_id = row
+    bucket = _telegram_bulk_bucket()
+    queue: asyncio.Queue[tuple[str, int]] = asyncio.Queue()
+    for item in pending:
+        queue.put_nowait(item)
+    results: list[tuple[str, int, str, str]] = []
+    counts = _broadcast_counts(broadcast_id)
+    last_flush = time.monotonic()
+    last_edit = 0.0
+
+    async def _progress(finished: bool) -> None:
+        nonlocal last_edit
+        if not status_chat_id or not status_message_id:
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=status_chat_id,
+                message_id=status_message_id,
+                text=_format_broadcast_progress(str(target), counts, finished),
+            )
+        except RetryAfter as e:
+            bucket.pause(_retry_after_seconds(e))
+        except Exception as e:
+            if "Message is not modified" not in str(e):
+                logging.warning(f"Broadcast {broadcast_id} progress edit failed: {e}")
+        last_edit = time.monotonic()
+
+    async def _record(uid: str, attempts: int, status: str, error: str = "") -> None:
+        nonlocal last_flush
+        results.append((uid, attempts, status, error))
+        counts['pending'] = counts.get('pending', 0) - 1
+        counts[status] = counts.get(status, 0) + 1
+        now = time.monotonic()
+        if len(results) >= 200 or now - last_flush >= 1.0:
+            batch = results[:]
+            results.clear()
+            last_flush = now
+            _store_broadcast_results(broadcast_id, batch)
+        if now - last_edit >= BROADCAST_PROGRESS_EDIT_SEC:
+            await _progress(False)
+
+    async def _worker() -> None:
+        while True:
+            try:
+                uid, attempts = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await bucket.acquire()
+            attempts += 1
+            try:
+                await bot.copy_message(chat_id=uid, from_chat_id=from_chat_id, message_id=message_id)
+                await _record(uid, attempts, 'sent')
+            except RetryAfter as e:
+                bucket.pause(_retry_after_seconds(e))
+                if attempts < BROADCAST_MAX_ATTEMPTS:
+                    queue.put_nowait((uid, attempts))
+                else:
+                    await _record(uid, attempts, 'failed', str(e)[:200])
+            except Forbidden as e:
+                await _record(uid, attempts, 'blocked', str(e)[:200])
+            except (TimedOut, NetworkError) as e:
+                if attempts < BROADCAST_MAX_ATTEMPTS:
+                    queue.put_nowait((uid, attempts))
+                else:
+                    await _record(uid, attempts, 'failed', str(e)[:200])
+            except Exception as e:
+                status = 'blocked' if "blocked" in str(e) else 'failed'
+                await _record(uid, attempts, status, str(e)[:200])
+
+    await asyncio.gather(*(_worker() for _ in range(min(BROADCAST_CONCURRENCY, max(1, len(pending))))))
+    _store_broadcast_results(broadcast_id, results)
+    conn = sqlite3.connect(BOT_DB_PATH)
+    conn.execute("UPDATE broadcasts SET status='done', finished_at=? WHERE id=?", (int(time.time()), broadcast_id))
+    conn.commit()
+    conn.close()
+    counts = _broadcast_counts(broadcast_id)
+    await _progress(True)
+    return counts
+
+
+_BROADCAST_TASKS: dict[int, asyncio.Task[Any]] = {}
+
+
+def _start_broadcast_task(bot: Any, broadcast_id: int) -> None:
+    if broadcast_id in _BROADCAST_TASKS:
+        return
+
+    async def _run() -> None:
+        try:
+            await _run_broadcast(bot, broadcast_id)
+        except Exception as e:
+            logging.error(f"Broadcast {broadcast_id} failed: {e}")
+        finally:
+            _BROADCAST_TASKS.pop(broadcast_id, None)
+
+    _BROADCAST_TASKS[broadcast_id] = asyncio.create_task(_run())
+
+
+async def resume_broadcasts(bot: Any) -> None:
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")
+        ids = [int(row[0]) for row in cursor.fetchall()]
+        conn.close()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to load unfinished broadcasts: {e}")
+        return
+    for broadcast_id in ids:
+        logging.info(f"Resuming broadcast {broadcast_id}")
+        _start_broadcast_task(bot, broadcast_id)
+
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -9810,6 +12829,18 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton(t("btn_broadcast_all", lang), callback_data='admin_broadcast_all')],
         [InlineKeyboardButton(t("btn_broadcast_en", lang), callback_data='admin_broadcast_en')],
         [InlineKeyboardButton(t("btn_broadcast_ru", lang), callback_data='admin_broadcast_ru')],
+        [
+            InlineKeyboardButton(t("btn_broadcast_active", lang), callback_data='admin_broadcast_active'),
+            InlineKeyboardButton(t("btn_broadcast_expired", lang), callback_data='admin_broadcast_expired'),
+        ],
+        [
+            InlineKeyboardButton(t("btn_broadcast_paid", lang), callback_data='admin_broadcast_paid'),
+            InlineKeyboardButton(t("btn_broadcast_nopaid", lang), callback_data='admin_broadcast_nopaid'),
+        ],
+        [
+            InlineKeyboardButton(t("btn_broadcast_trial", lang), callback_data='admin_broadcast_trial'),
+            InlineKeyboardButton(t("btn_broadcast_mobile", lang), callback_data='admin_broadcast_mobile'),
+        ],
         [InlineKeyboardButton(t("btn_broadcast_individual", lang), callback_data='admin_broadcast_individual')],
         [InlineKeyboardButton(t("btn_cancel", lang), callback_data='admin_panel')]
     ]
@@ -9820,15 +12851,11 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
-def get_users_pagination_keyboard(users, selected_ids, page, lang='ru', users_per_page=10):
-    total_pages = math.ceil(len(users) / users_per_page)
+def get_users_pagination_keyboard(current_users, total, selected_ids, page, lang='ru', users_per_page=10):
+    total_pages = math.ceil(total / users_per_page)
     if total_pages == 0:
         total_pages = 1
 
-    start = page * users_per_page
-    end = start + users_per_page
-    current_users = users[start:end]
-
     keyboard = []
     for u in current_users:
         uid = str(u[0])
@@ -9877,40 +12904,8 @@ async def admin_broadcast_target(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data['broadcast_selected_ids'] = []
         context.user_data['broadcast_target'] = 'individual'
 
-        users_by_id: dict[str, tuple[str, str, str]] = {}
-        try:
-            conn = sqlite3.connect(BOT_DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT tg_id, first_name, username FROM user_prefs")
-            for tg, first_name, username in cursor.fetchall():
-                tg_str = str(tg)
-                users_by_id[tg_str] = (tg_str, first_name or "", username or "")
-            conn.close()
-        except Exception:
-            users_by_id = {}
-
-        try:
-            conn_xui = sqlite3.connect(DB_PATH)
-            cursor_xui = conn_xui.cursor()
-            cursor_xui.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-            row = cursor_xui.fetchone()
-            conn_xui.close()
-
-            if row:
-                settings = json.loads(row[0])
-                clients = settings.get("clients", [])
-                for client in clients:
-                    client_tg_id = get_client_tg_id(client)
-                    if client_tg_id is None:
-                        continue
-                    if client_tg_id not in users_by_id:
-                        users_by_id[client_tg_id] = (client_tg_id, "", "")
-        except Exception:
-            pass
-
-        users = list(users_by_id.values())
-
-        keyboard = get_users_pagination_keyboard(users, [], 0, lang)
+        users, total = _audience_page('all', 0, 10)
+        keyboard = get_users_pagination_keyboard(users, total, [], 0, lang)
         await query.edit_message_text(
             t("broadcast_individual_title", lang),
             reply_markup=keyboard,
@@ -9930,13 +12925,8 @@ async def admin_broadcast_target(update: Update, context: ContextTypes.DEFAULT_T
 
         context.user_data['broadcast_selected_ids'] = selected
 
-        conn = sqlite3.connect(BOT_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT tg_id, first_name, username FROM user_prefs")
-        users = cursor.fetchall()
-        conn.close()
-
-        keyboard = get_users_pagination_keyboard(users, selected, page, lang)
+        users, total = _audience_page('all', page, 10)
+        keyboard = get_users_pagination_keyboard(users, total, selected, page, lang)
         try:
             await query.edit_message_reply_markup(reply_markup=keyboard)
         except Exception:
@@ -9948,13 +12938,8 @@ async def admin_broadcast_target(update: Update, context: ContextTypes.DEFAULT_T
         page = int(parts[3])
         selected = context.user_data.get('broadcast_selected_ids', [])
 
-        conn = sqlite3.connect(BOT_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT tg_id, first_name, username FROM user_prefs")
-        users = cursor.fetchall()
-        conn.close()
-
-        keyboard = get_users_pagination_keyboard(users, selected, page, lang)
+        users, total = _audience_page('all', page, 10)
+        keyboard = get_users_pagination_keyboard(users, total, selected, page, lang)
         try:
             await query.edit_message_reply_markup(reply_markup=keyboard)
         except Exception:
@@ -9985,11 +12970,10 @@ async def admin_broadcast_target(update: Update, context: ContextTypes.DEFAULT_T
     target = action
     context.user_data['broadcast_target'] = target
 
-    target_name = t("btn_broadcast_all", lang)
-    if target == 'en':
-        target_name = t("btn_broadcast_en", lang)
-    if target == 'ru':
-        target_name = t("btn_broadcast_ru", lang)
+    if target not in _AUDIENCE_SEGMENTS:
+        return
+    target_name = t(f"btn_broadcast_{target}", lang)
+    target_name = f"{target_name} ({_audience_count(target)})"
 
     await query.edit_message_text(
         t("broadcast_general_prompt", lang).format(target=target_name),
@@ -10086,79 +13070,86 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Не удалось получить ID пользователя.", reply_markup=ReplyKeyboardRemove())
                 return
 
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-            row = cursor.fetchone()
+            async with _XUI_SETTINGS_LOCK:
+                conn = sqlite3.connect(DB_PATH)
+                cursor = conn.cursor()
+                cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+                row = cursor.fetchone()
 
-            if not row:
-                await update.message.reply_text("❌ Входящее соединение не найдено.", reply_markup=ReplyKeyboardRemove())
-                conn.close()
-                return
+                if not row:
+                    await update.message.reply_text("❌ Входящее соединение не найдено.", reply_markup=ReplyKeyboardRemove())
+                    conn.close()
+                    return
 
-            settings = json.loads(row[0])
-            clients = settings.get('clients', [])
+                settings = json.loads(row[0])
+                clients = settings.get('clients', [])
 
-            found = False
-            client_email = ""
-            old_email = ""
+                found = False
+                client_email = ""
+                old_email = ""
 
-            for client in clients:
-                if client.get('id') == uid:
-                    old_email = client.get('email')
-                    client['tgId'] = int(target_tg_id) if target_tg_id.isdigit() else target_tg_id
-                    client['email'] = f"tg_{target_tg_id}" # Update email to match standard format
-                    client['updated_at'] = int(time.time() * 1000)
-                    client_email = client.get('email')
-                    found = True
-                    break
+                old_tg_id: Optional[str] = None
+                for client in clients:
+                    if client.get('id') == uid:
+                        old_email = client.get('email')
+                        old_tg_id = get_client_tg_id(client)
+                        client['tgId'] = int(target_tg_id) if target_tg_id.isdigit() else target_tg_id
+                        client['email'] = f"tg_{target_tg_id}" # Update email to match standard format
+                        client['updated_at'] = int(time.time() * 1000)
+                        client_email = client.get('email')
+                        found = True
+                        break
 
-            if found:
-                # Need to update client_traffics as well because email changed
-                # We rename old email to new email in client_traffics table
-                try:
-                    if old_email and client_email and old_email != client_email:
-                         # Check if record exists for old email
-                         conn.execute("UPDATE client_traffics SET email=? WHERE email=?", (client_email, old_email))
-                         # Also update traffic_history if we want to preserve history
-                         conn_bot = sqlite3.connect(BOT_DB_PATH)
-                         conn_bot.execute("UPDATE traffic_history SET email=? WHERE email=?", (client_email, old_email))
-                         conn_bot.commit()
-                         conn_bot.close()
-
-                         # Force update current traffic from client dict to client_traffics table
-                         # Because X-UI might overwrite it with 0 if we just changed email?
-                         # Or maybe client dict has the correct current values 'up' and 'down'.
-                         current_up = client.get('up', 0)
-                         current_down = client.get('down', 0)
-                         if current_up > 0 or current_down > 0:
-                             conn.execute("UPDATE client_traffics SET up=?, down=? WHERE email=?", (current_up, current_down, client_email))
+                if found:
+                    # Need to update client_traffics as well because email changed
+                    # We rename old email to new email in client_traffics table
+                    try:
+                        if old_email and client_email and old_email != client_email:
+                             # Check if record exists for old email
+                             conn.execute("UPDATE client_traffics SET email=? WHERE email=?", (client_email, old_email))
+                             # Also update traffic_history if we want to preserve history
+                             conn_bot = sqlite3.connect(BOT_DB_PATH)
+                             conn_bot.execute("UPDATE traffic_history SET email=? WHERE email=?", (client_email, old_email))
+                             conn_bot.commit()
+                             conn_bot.close()
+
+                             # Force update current traffic from client dict to client_traffics table
+                             # Because X-UI might overwrite it with 0 if we just changed email?
+                             # Or maybe client dict has the correct current values 'up' and 'down'.
+                             current_up = client.get('up', 0)
+                             current_down = client.get('down', 0)
+                             if current_up > 0 or current_down > 0:
+                                 conn.execute("UPDATE client_traffics SET up=?, down=? WHERE email=?", (current_up, current_down, client_email))
 
-                except Exception as e:
-                     logging.error(f"Error migrating stats: {e}")
+                    except Exception as e:
+                         logging.error(f"Error migrating stats: {e}")
 
-                new_settings = json.dumps(settings, indent=2)
-                cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (new_settings, INBOUND_ID))
-                conn.commit()
-                conn.close()
+                    new_settings = json.dumps(settings, indent=2)
+                    cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (new_settings, INBOUND_ID))
+                    conn.commit()
+                    conn.close()
+                    _ADMIN_STATS.invalidate()
+                    if old_tg_id and old_email:
+                        _unindex_user_search_client(old_tg_id, old_email)
+                    _index_user_search_clients([c for c in clients if c.get('email') == client_email])
 
-                # Restart X-UI
-                await _systemctl("restart", "x-ui")
+                    # Restart X-UI
+                    await _systemctl("restart", "x-ui")
 
-                await update.message.reply_text(f"✅ *Успешно!*\nКлиент `{client_email}` перепривязан к Telegram ID `{target_tg_id}`.\n\n🔄 *Внимание:* Для корректного отображения статистики и работы подписки, бот автоматически обновил email клиента на `{client_email}`.\n\nX-UI перезапущен.", parse_mode='Markdown', reply_markup=ReplyKeyboardRemove())
+                    await update.message.reply_text(f"✅ *Успешно!*\nКлиент `{client_email}` перепривязан к Telegram ID `{target_tg_id}`.\n\n🔄 *Внимание:* Для корректного отображения статистики и работы подписки, бот автоматически обновил email клиента на `{client_email}`.\n\nX-UI перезапущен.", parse_mode='Markdown', reply_markup=ReplyKeyboardRemove())
 
-                # Show admin user detail again
-                keyboard = [
-                    [InlineKeyboardButton("🔄 Перепривязать пользователя", callback_data=f'admin_rebind_{uid}')],
-                    [InlineKeyboardButton("🔙 Назад к списку", callback_data='admin_users_0')]
-                ]
-                await update.message.reply_text(f"👤 Клиент: {client_email}", reply_markup=InlineKeyboardMarkup(keyboard))
+                    # Show admin user detail again
+                    keyboard = [
+                        [InlineKeyboardButton("🔄 Перепривязать пользователя", callback_data=f'admin_rebind_{uid}')],
+                        [InlineKeyboardButton("🔙 Назад к списку", callback_data='admin_users_0')]
+                    ]
+                    await update.message.reply_text(f"👤 Клиент: {client_email}", reply_markup=InlineKeyboardMarkup(keyboard))
 
-                context.user_data['admin_action'] = None
-                context.user_data['rebind_uid'] = None
-            else:
-                conn.close()
-                await update.message.reply_text(f"❌ Клиент с UUID `{uid}` не найден.", reply_markup=ReplyKeyboardRemove())
+                    context.user_data['admin_action'] = None
+                    context.user_data['rebind_uid'] = None
+                else:
+                    conn.close()
+                    await update.message.reply_text(f"❌ Клиент с UUID `{uid}` не найден.", reply_markup=ReplyKeyboardRemove())
             return
 
         if action == 'awaiting_promo_data':
@@ -10401,37 +13392,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Clear previous flash errors
                 cursor.execute("DELETE FROM flash_delivery_errors")
                 conn.commit()
-
-                users = []
-                # Sync X-UI
-                try:
-                    conn_xui = sqlite3.connect(DB_PATH)
-                    cursor_xui = conn_xui.cursor()
-                    cursor_xui.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-                    row = cursor_xui.fetchone()
-                    conn_xui.close()
-                    if row:
-                        settings = json.loads(row[0])
-                        clients = settings.get('clients', [])
-                        for client in clients:
-                            tid = client.get('tgId')
-                            if tid:
-                                users.append((str(tid),))
-                except Exception:
-                    pass
-
-                cursor.execute("SELECT tg_id FROM user_prefs")
-                bot_users = cursor.fetchall()
-
-                # Merge
-                user_ids = set([u[0] for u in users])
-                for u in bot_users:
-                    if u[0] not in user_ids:
-                        users.append(u)
-                        user_ids.add(u[0])
-
                 conn.close()
 
+                users = [(uid,) for uid in await asyncio.to_thread(_resolve_broadcast_recipients, 'all', [])]
+
                 sent = 0
                 blocked = 0
                 delete_at = int(time.time()) + (duration * 60)
@@ -10514,99 +13478,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         elif action == 'awaiting_broadcast':
             # Use copy_message to support all content types (text, photo, video, sticker, etc.)
-            msg_id = update.message.message_id
-            chat_id_from = update.message.chat_id
             target = context.user_data.get('broadcast_target', 'all')
+            recipients = await asyncio.to_thread(_resolve_broadcast_recipients, target, context.user_data.get('broadcast_users', []))
+            broadcast_id = _create_broadcast(tg_id, update.message.chat_id, update.message.message_id, target, recipients)
 
-            conn = sqlite3.connect(BOT_DB_PATH)
-            cursor = conn.cursor()
-
-            users = []
-
-            if target == 'all':
-                # Sync all active users from X-UI DB first
-                try:
-                    conn_xui = sqlite3.connect(DB_PATH)
-                    cursor_xui = conn_xui.cursor()
-                    cursor_xui.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-                    row = cursor_xui.fetchone()
-                    conn_xui.close()
-
-                    if row:
-                        settings = json.loads(row[0])
-                        clients = settings.get('clients', [])
-                        for client in clients:
-                            tg_id = client.get('tgId')
-                            if tg_id:
-                                users.append((str(tg_id),))
-                except Exception as e:
-                     logging.error(f"Error getting X-UI users for broadcast: {e}")
-
-                # Also get users from bot DB who might not be active in X-UI anymore but are in bot
-                cursor.execute("SELECT tg_id FROM user_prefs")
-                bot_users = cursor.fetchall()
-
-                # Merge lists, unique IDs
-                user_ids = set([u[0] for u in users])
-                for u in bot_users:
-                    if u[0] not in user_ids:
-                        users.append(u)
-                        user_ids.add(u[0])
-
-            elif target == 'individual':
-                user_ids = context.user_data.get('broadcast_users', [])
-                users = [(uid,) for uid in user_ids]
-            else:
-                cursor.execute("SELECT tg_id FROM user_prefs WHERE lang=?", (target,))
-                users = cursor.fetchall()
-
-            conn.close()
-
-            sent = 0
-            blocked = 0
-
-            target_name = "ВСЕМ"
-            if target == 'en':
-                target_name = "English (en)"
-            if target == 'ru':
-                target_name = "Русский (ru)"
-            if target == 'individual':
-                target_name = f"Индивидуально: {len(users)}"
-
-            status_msg = await update.message.reply_text(f"⏳ Рассылка запущена ({target_name})...")
-
-            for user_row in users:
-                user_id = str(user_row[0])
-                # Skip sending to self (admin) if desired, or keep it for verification
-                if str(user_id) == str(tg_id):
-                    # We can skip the sender to avoid double notification, or just let it be
-                    pass
-
-                try:
-                    await context.bot.copy_message(chat_id=user_id, from_chat_id=chat_id_from, message_id=msg_id)
-                    sent += 1
-                    await asyncio.sleep(0.05) # Rate limit protection
-                except Exception as e:
-                    if "Forbidden" in str(e) or "blocked" in str(e):
-                        blocked += 1
-                    pass
-
-            await status_msg.edit_text(f"✅ Рассылка завершена ({target_name}).\n\n📤 Отправлено: {sent}\n🚫 Не доставлено (бот заблокирован): {blocked}")
+            status_msg = await update.message.reply_text(
+                f"⏳ Рассылка запущена ({_broadcast_target_name(target, len(recipients))})..."
+            )
+            _set_broadcast_status_message(broadcast_id, status_msg.chat_id, status_msg.message_id)
+            _start_broadcast_task(context.bot, broadcast_id)
             context.user_data['admin_action'] = None
             context.user_data['broadcast_target'] = None
             return
 
         elif action == 'awaiting_search_user':
-            if not text:
-                return
-            target_id = text.strip()
-            # Simple validation
-            if not target_id.isdigit():
-                await update.message.reply_text("❌ Ошибка: ID должен состоять из цифр.")
+            if not text or not text.strip():
                 return
-
-            await admin_user_db_detail(update, context, target_id)
-            context.user_data['admin_action'] = None
+            await _reply_user_search(update, context, text, lang)
             return
 
         elif action == 'awaiting_limit_ip':
@@ -10623,37 +13511,38 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # Update X-UI DB
             try:
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-                row = cursor.fetchone()
+                async with _XUI_SETTINGS_LOCK:
+                    conn = sqlite3.connect(DB_PATH)
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+                    row = cursor.fetchone()
 
-                if row:
-                    settings = json.loads(row[0])
-                    clients = settings.get('clients', [])
-
-                    found = False
-                    for client in clients:
-                        if client.get('id') == uid:
-                            client['limitIp'] = new_limit
-                            found = True
-                            break
+                    if row:
+                        settings = json.loads(row[0])
+                        clients = settings.get('clients', [])
 
-                    if found:
-                        new_settings = json.dumps(settings)
-                        cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (new_settings, INBOUND_ID))
-                        conn.commit()
+                        found = False
+                        for client in clients:
+                            if client.get('id') == uid:
+                                client['limitIp'] = new_limit
+                                found = True
+                                break
+
+                        if found:
+                            new_settings = json.dumps(settings)
+                            cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (new_settings, INBOUND_ID))
+                            conn.commit()
 
-                        # Restart X-UI
-                        await _systemctl("restart", "x-ui")
+                            # Restart X-UI
+                            await _systemctl("restart", "x-ui")
 
-                        await update.message.reply_text(t("limit_ip_success", lang).format(limit=new_limit if new_limit > 0 else "Unlimited"))
+                            await update.message.reply_text(t("limit_ip_success", lang).format(limit=new_limit if new_limit > 0 else "Unlimited"))
+                        else:
+                            await update.message.reply_text(t("msg_client_not_found", lang))
                     else:
-                        await update.message.reply_text(t("msg_client_not_found", lang))
-                else:
-                    await update.message.reply_text(t("sync_error_inbound", lang))
+                        await update.message.reply_text(t("sync_error_inbound", lang))
 
-                conn.close()
+                    conn.close()
 
             except Exception as e:
                 logging.error(f"Error updating limitIp: {e}")
@@ -10777,120 +13666,482 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['admin_action'] = None
         return
 
-    # --- Admin Reply Logic (Legacy/Main Bot fallback) ---
-    if tg_id == ADMIN_ID and update.message.reply_to_message:
-        # Check if replying to a forwarded message or our alert
-        # We need to extract the original user ID from the alert text
-        # Alert format: ... User: @name (`123456789`) ...
+    # --- Admin Reply Logic (Legacy/Main Bot fallback) ---
+    if tg_id == ADMIN_ID and update.message.reply_to_message:
+        # Check if replying to a forwarded message or our alert
+        # We need to extract the original user ID from the alert text
+        # Alert format: ... User: @name (`123456789`) ...
+
+        reply_text = update.message.reply_to_message.caption or update.message.reply_to_message.text
+        if not reply_text:
+            return
+
+        import re
+        # Look for (`123456789`) pattern
+        match = re.search(r'\(`(\d+)`\)', reply_text)
+        if match:
+            target_user_id = match.group(1)
+
+            try:
+                # Send anonymous reply
+                target_lang = get_lang(target_user_id)
+                reply_body = t("support_reply_template", target_lang).format(text=text)
+
+                await context.bot.send_message(chat_id=target_user_id, text=reply_body, parse_mode='Markdown')
+                await update.message.reply_text(t("admin_reply_sent", "ru"))
+
+            except Exception as e:
+                await update.message.reply_text(f"❌ Failed to send reply: {e}")
+        return
+
+    if action == 'awaiting_search_user':
+        if not text or not text.strip():
+            return
+        await _reply_user_search(update, context, text, lang)
+        return
+
+    if context.user_data.get('awaiting_promo'):
+        if not text:
+            return
+        tg_id = str(update.message.from_user.id)
+        lang = get_lang(tg_id)
+        code = text.strip()
+
+        # Check promo with case insensitivity handled by DB
+        days, actual_code = check_promo(code, tg_id)
+
+        if days == "USED":
+             await update.message.reply_text(t("promo_used", lang))
+        elif days is None:
+             await update.message.reply_text(t("promo_invalid", lang))
+        else:
+             username = update.message.from_user.username or update.message.from_user.first_name
+             log_action(f"ACTION: User {tg_id} (@{username}) redeemed promo code: {actual_code} ({days} days).")
+             redeem_promo_db(actual_code, tg_id)
+
+             await process_subscription(tg_id, days, update, context, lang)
+
+            # Celebration animation
+             msg = await update.message.reply_text("🎆")
+             await asyncio.sleep(0.5)
+             await msg.edit_text("🎆 🎇")
+             await asyncio.sleep(0.5)
+             await msg.edit_text("🎆 🎇 ✨")
+             await asyncio.sleep(0.5)
+             # Replace animation with the detailed success message
+             await msg.edit_text(t("promo_success", lang).format(days=days), parse_mode='Markdown')
+
+        context.user_data['awaiting_promo'] = False
+        return
+
+async def initiate_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    tg_id = str(query.from_user.id)
+    lang = get_lang(tg_id)
+
+    plan_key = query.data.split('_', 1)[1]
+    current_prices = get_prices()
+
+    if plan_key not in current_prices:
+        return
+
+    plan = current_prices[plan_key]
+
+    chat_id = query.message.chat_id
+    title = t("invoice_title_mobile", lang) if str(plan_key).startswith("m_") else t("invoice_title", lang)
+    description = t(f"label_{plan_key}", lang)
+    payload = plan_key
+    currency = "XTR"
+    price = plan['amount']
+    prices = [LabeledPrice(description, price)]
+
+    await context.bot.send_invoice(
+        chat_id=chat_id,
+        title=title,
+        description=description,
+        payload=payload,
+        provider_token="",
+        currency=currency,
+        prices=prices
+    )
+
+async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.pre_checkout_query
+    current_prices = get_prices()
+    if query.invoice_payload not in current_prices:
+        await query.answer(ok=False, error_message="Invalid plan selected.")
+    else:
+        await query.answer(ok=True)
+
+# Paid subscriptions are queued in payment_jobs (keyed by the Telegram charge id, or "tx:<id>" when there is none)
+# in the same commit as the transaction row. The handler acknowledges the payment and starts a task that drives
+# its own job; payment_jobs_job retries failed jobs without the original update and applies all due grants for
+# the main inbound inside one x-ui stop/start window. Job states: pending -> running -> applied -> done (or failed).
+_PAYMENT_JOB_BATCH = 50
+_PAYMENT_JOB_BACKOFF_BASE_SEC = 30.0
+_PAYMENT_JOB_HANDOFF_SEC = 60
+_PAYMENT_JOB_STALE_SEC = 900
+
+
+class PaymentJob(TypedDict):
+    job_key: str
+    tx_id: Optional[int]
+    tg_id: str
+    plan_id: str
+    amount: int
+    days: int
+    attempts: int
+
+
+def _payment_job_from_row(row: tuple[Any, ...]) -> PaymentJob:
+    return {
+        "job_key": str(row[0]),
+        "tx_id": int(row[1]) if row[1] is not None else None,
+        "tg_id": str(row[2]),
+        "plan_id": str(row[3] or ""),
+        "amount": int(row[4] or 0),
+        "days": int(row[5] or 0),
+        "attempts": int(row[6] or 0),
+    }
+
+
+_PAYMENT_JOB_COLUMNS = "charge_id, tx_id, tg_id, plan_id, amount, days, attempts"
+
+
+class GrantResult(enum.IntEnum):
+    """Outcome of a process_*_subscription call; falsy only when the subscription itself was not applied."""
+
+    FAILED = 0
+    GRANTED = 1
+    NOTIFY_FAILED = 2
+
+
+def _enqueue_payment_job(
+    cursor: sqlite3.Cursor, job_key: str, tx_id: Optional[int], tg_id: str, plan_id: str, amount: int, days: int
+) -> bool:
+    now = int(time.time())
+    try:
+        cursor.execute(
+            "INSERT OR IGNORE INTO payment_jobs (charge_id, tx_id, tg_id, plan_id, amount, days, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            # The handler gets the first attempt; the worker only steps in after the hand-off window.
+            (job_key, tx_id, tg_id, plan_id, amount, days, now + _PAYMENT_JOB_HANDOFF_SEC, now, now),
+        )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to queue payment job {job_key}: {e}")
+        return False
+    return True
+
+
+def _claim_payment_job(job_key: str) -> bool:
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE payment_jobs SET status='running', attempts=attempts+1, updated_at=? "
+            "WHERE charge_id=? AND status='pending'",
+            (int(time.time()), job_key),
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+    finally:
+        conn.close()
+
+
+def _claim_due_payment_jobs(now: int) -> tuple[list[PaymentJob], list[PaymentJob], list[PaymentJob]]:
+    """Return (claimed pending jobs, applied jobs awaiting settlement, jobs that died while running)."""
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT {_PAYMENT_JOB_COLUMNS} FROM payment_jobs "
+            "WHERE status='pending' AND next_attempt_at<=? ORDER BY created_at LIMIT ?",
+            (now, _PAYMENT_JOB_BATCH),
+        )
+        claimed: list[PaymentJob] = []
+        for row in cursor.fetchall():
+            cursor.execute(
+                "UPDATE payment_jobs SET status='running', attempts=attempts+1, updated_at=? "
+                "WHERE charge_id=? AND status='pending'",
+                (now, row[0]),
+            )
+            if cursor.rowcount > 0:
+                job = _payment_job_from_row(row)
+                job["attempts"] += 1
+                claimed.append(job)
+        cursor.execute(
+            f"SELECT {_PAYMENT_JOB_COLUMNS} FROM payment_jobs WHERE status='applied' AND updated_at<=? LIMIT ?",
+            (now - _PAYMENT_JOB_HANDOFF_SEC, _PAYMENT_JOB_BATCH),
+        )
+        applied = [_payment_job_from_row(row) for row in cursor.fetchall()]
+        cursor.execute(
+            f"SELECT {_PAYMENT_JOB_COLUMNS} FROM payment_jobs WHERE status='running' AND updated_at<=? LIMIT ?",
+            (now - _PAYMENT_JOB_STALE_SEC, _PAYMENT_JOB_BATCH),
+        )
+        stale = [_payment_job_from_row(row) for row in cursor.fetchall()]
+        # A job that was running during a crash may or may not have reached x-ui, so it is not replayed blindly.
+        cursor.executemany(
+            "UPDATE payment_jobs SET status='failed', last_error='interrupted', updated_at=? WHERE charge_id=? AND status='running'",
+            [(now, job["job_key"]) for job in stale],
+        )
+        conn.commit()
+        return claimed, applied, stale
+    finally:
+        conn.close()
+
+
+def _mark_payment_job_applied(job_key: Optional[str]) -> None:
+    """Called right after a grant commits, so a later failure (notifying the user) can't requeue it."""
+    if not job_key:
+        return
+    try:
+        _finish_payment_attempt(job_key, None)
+    except sqlite3.Error as e:
+        # The job stays 'running' and is reported as interrupted instead of being replayed.
+        logging.error(f"Failed to mark payment job {job_key} applied: {e}")
+
+
+def _finish_payment_attempt(job_key: str, error: Optional[str]) -> str:
+    """Record the outcome of one fulfilment attempt and return the job's new status."""
+    now = int(time.time())
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        if error is None:
+            cursor.execute(
+                "UPDATE payment_jobs SET status='applied', last_error=NULL, updated_at=? WHERE charge_id=? AND status='running'",
+                (now, job_key),
+            )
+            conn.commit()
+            return "applied"
+        cursor.execute("SELECT attempts, status FROM payment_jobs WHERE charge_id=?", (job_key,))
+        row = cursor.fetchone()
+        if row and row[1] != "running":
+            # Already marked applied right after the grant committed; a later error must not requeue it.
+            return str(row[1])
+        attempts = int(row[0] or 0) if row else 0
+        if attempts >= PAYMENT_JOB_MAX_ATTEMPTS:
+            status, next_at = "failed", now
+        else:
+            delay = min(PAYMENT_JOB_BACKOFF_MAX_SEC, _PAYMENT_JOB_BACKOFF_BASE_SEC * (2 ** max(0, attempts - 1)))
+            status, next_at = "pending", now + int(delay)
+        cursor.execute(
+            "UPDATE payment_jobs SET status=?, next_attempt_at=?, last_error=?, updated_at=? WHERE charge_id=? AND status='running'",
+            (status, next_at, error[:500], now, job_key),
+        )
+        conn.commit()
+        return status
+    finally:
+        conn.close()
+
+
+def _settle_payment(
+    job_key: Optional[str], charge_id: Optional[str], tx_id: Optional[int], tg_id: str, amount: int
+) -> Optional[tuple[Optional[str], bool, int]]:
+    """Mark a fulfilled payment processed and book referral rewards in one commit.
+
+    Returns (referrer_id, granted_bonus_days, cashback_amount), or None if the job was already settled.
+    """
+    now = int(time.time())
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        if job_key:
+            cursor.execute(
+                "UPDATE payment_jobs SET status='done', updated_at=? WHERE charge_id=? AND status IN ('running', 'applied')",
+                (now, job_key),
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return None
+        if charge_id:
+            cursor.execute(
+                "UPDATE transactions SET processed_at=? WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
+                (now, charge_id),
+            )
+        elif tx_id:
+            cursor.execute("UPDATE transactions SET processed_at=? WHERE id=? AND processed_at IS NULL", (now, tx_id))
+
+        referrer_id: Optional[str] = None
+        granted_days = False
+        cashback_amount = 0
+        cursor.execute("SAVEPOINT referral")
+        try:
+            cursor.execute("SELECT referrer_id FROM user_prefs WHERE tg_id=?", (tg_id,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                referrer_id = str(row[0])
+                if referrer_id.isdigit() and referrer_id != tg_id:
+                    cursor.execute(
+                        "INSERT OR IGNORE INTO referral_day_bonuses (referrer_id, referred_id, days, date) "
+                        "VALUES (?, ?, ?, ?)",
+                        (referrer_id, tg_id, REF_BONUS_DAYS, now),
+                    )
+                    granted_days = cursor.rowcount > 0
+                # 10% Cashback Logic
+                cashback_amount = int(amount * 0.10)
+                if cashback_amount > 0:
+                    cursor.execute("UPDATE user_prefs SET balance = balance + ? WHERE tg_id=?", (cashback_amount, referrer_id))
+                    cursor.execute(
+                        "INSERT INTO referral_bonuses (referrer_id, referred_id, amount, type, date) VALUES (?, ?, ?, 'cashback', ?)",
+                        (referrer_id, tg_id, cashback_amount, now),
+                    )
+            cursor.execute("RELEASE referral")
+        except sqlite3.Error as e:
+            cursor.execute("ROLLBACK TO referral")
+            cursor.execute("RELEASE referral")
+            logging.error(f"Error checking referral bonus: {e}")
+            referrer_id, granted_days, cashback_amount = None, False, 0
+        conn.commit()
+        return referrer_id, granted_days, cashback_amount
+    finally:
+        conn.close()
+
 
-        reply_text = update.message.reply_to_message.caption or update.message.reply_to_message.text
-        if not reply_text:
-            return
+async def _reward_referrer(
+    context: ContextTypes.DEFAULT_TYPE, referrer_id: Optional[str], granted_days: bool, cashback_amount: int
+) -> None:
+    if not referrer_id:
+        return
+    try:
+        if granted_days:
+            await add_days_to_user(referrer_id, REF_BONUS_DAYS, context)
 
-        import re
-        # Look for (`123456789`) pattern
-        match = re.search(r'\(`(\d+)`\)', reply_text)
-        if match:
-            target_user_id = match.group(1)
+            ref_lang = get_lang(referrer_id)
+            msg_text = (
+                f"🎉 **Referral Bonus!**\n\nUser you invited has purchased a subscription.\nYou received +{REF_BONUS_DAYS} days!"
+            )
+            if ref_lang == "ru":
+                msg_text = (
+                    f"🎉 **Реферальный бонус!**\n\nПриглашенный вами пользователь купил подписку.\nВам начислено +{REF_BONUS_DAYS} дней!"
+                )
 
             try:
-                # Send anonymous reply
-                target_lang = get_lang(target_user_id)
-                reply_body = t("support_reply_template", target_lang).format(text=text)
-
-                await context.bot.send_message(chat_id=target_user_id, text=reply_body, parse_mode='Markdown')
-                await update.message.reply_text(t("admin_reply_sent", "ru"))
+                await context.bot.send_message(chat_id=referrer_id, text=msg_text, parse_mode="Markdown")
+            except Exception:
+                pass
 
-            except Exception as e:
-                await update.message.reply_text(f"❌ Failed to send reply: {e}")
-        return
+        if cashback_amount > 0:
+            # Notify referrer about cashback
+            cb_lang = get_lang(referrer_id)
+            cb_text = f"💰 **Cashback!**\n\n+ {cashback_amount} Stars (10%) from referral purchase!"
+            if cb_lang == 'ru':
+                cb_text = f"💰 **Кэшбэк!**\n\n+ {cashback_amount} Stars (10%) от покупки реферала!"
 
-    if action == 'awaiting_search_user':
-        if not text:
-            return
-        tg_id_search = text.strip()
+            try:
+                await context.bot.send_message(chat_id=referrer_id, text=cb_text, parse_mode='Markdown')
+            except Exception:
+                pass
+    except Exception as e:
+        logging.error(f"Error checking referral bonus: {e}")
 
-        if not tg_id_search.isdigit():
-            await update.message.reply_text(t("search_error_digit", lang))
-            return
 
-        context.user_data['admin_action'] = None
-        await admin_user_db_detail(update, context, tg_id_search)
-        return
+def _payment_job_charge_id(job: PaymentJob) -> Optional[str]:
+    return None if job["job_key"].startswith("tx:") else job["job_key"]
 
-    if context.user_data.get('awaiting_promo'):
-        if not text:
-            return
-        tg_id = str(update.message.from_user.id)
-        lang = get_lang(tg_id)
-        code = text.strip()
 
-        # Check promo with case insensitivity handled by DB
-        days, actual_code = check_promo(code, tg_id)
+async def _fulfil_payment_job(
+    context: ContextTypes.DEFAULT_TYPE, job: PaymentJob, settings_locked: bool = False
+) -> Optional[str]:
+    """Apply a queued payment without the original update. Returns an error string, or None on success.
 
-        if days == "USED":
-             await update.message.reply_text(t("promo_used", lang))
-        elif days is None:
-             await update.message.reply_text(t("promo_invalid", lang))
+    settings_locked means the caller already holds _XUI_SETTINGS_LOCK for main-inbound grants.
+    """
+    tg_id, days, plan_id = job["tg_id"], job["days"], job["plan_id"]
+    try:
+        if plan_id == "ru_bridge":
+            if await _add_days_ru_bridge(tg_id, days) is None:
+                return "ru_bridge_failed"
+            _mark_payment_job_applied(job["job_key"])
+        elif plan_id.startswith("m_"):
+            data = _upsert_mobile_subscription(tg_id, days)
+            if not data:
+                return "mobile_db_failed"
+            synced = await _sync_mobile_inbound_client(
+                tg_id=tg_id,
+                user_uuid=str(data["uuid"]),
+                sub_id=str(data["sub_id"]),
+                expiry_ms=int(data["expiry_time"]),
+                comment=f"tg_{tg_id}",
+            )
+            if not synced:
+                return "mobile_inbound_failed"
+            _mark_payment_job_applied(job["job_key"])
+        elif settings_locked:
+            await _add_days_to_user_locked(tg_id, days, job_key=job["job_key"])
         else:
-             username = update.message.from_user.username or update.message.from_user.first_name
-             log_action(f"ACTION: User {tg_id} (@{username}) redeemed promo code: {actual_code} ({days} days).")
-             redeem_promo_db(actual_code, tg_id)
-
-             await process_subscription(tg_id, days, update, context, lang)
+            await add_days_to_user(tg_id, days, context, job_key=job["job_key"])
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return None
 
-            # Celebration animation
-             msg = await update.message.reply_text("🎆")
-             await asyncio.sleep(0.5)
-             await msg.edit_text("🎆 🎇")
-             await asyncio.sleep(0.5)
-             await msg.edit_text("🎆 🎇 ✨")
-             await asyncio.sleep(0.5)
-             # Replace animation with the detailed success message
-             await msg.edit_text(t("promo_success", lang).format(days=days), parse_mode='Markdown')
 
-        context.user_data['awaiting_promo'] = False
+async def _settle_payment_job(context: ContextTypes.DEFAULT_TYPE, job: PaymentJob, notify_user: bool) -> None:
+    settled = await asyncio.to_thread(
+        _settle_payment, job["job_key"], _payment_job_charge_id(job), job["tx_id"], job["tg_id"], job["amount"]
+    )
+    if settled is None:
         return
+    log_action(f"SUCCESS: Queued payment applied for {job['tg_id']} ({job['plan_id']}, job {job['job_key']})")
+    if notify_user:
+        try:
+            text = t("payment_job_applied", get_lang(job["tg_id"])).format(amount=job["amount"], days=job["days"])
+            await context.bot.send_message(chat_id=job["tg_id"], text=text)
+        except Exception:
+            pass
+    await _reward_referrer(context, *settled)
+
+
+async def _alert_failed_payment_job(context: ContextTypes.DEFAULT_TYPE, job: PaymentJob, reason: str) -> None:
+    log_action(f"ERROR: Payment job {job['job_key']} for {job['tg_id']} failed: {reason}")
+    await _send_admin_message(
+        context,
+        f"⚠️ **PAYMENT NOT APPLIED**\n"
+        f"User: `{job['tg_id']}`\n"
+        f"Amount: {job['amount']}\n"
+        f"Plan: `{job['plan_id']}`\n"
+        f"Days: {job['days']}\n"
+        f"Charge: `{job['job_key']}`\n"
+        f"Reason: {_escape_markdown(reason[:200])}",
+    )
 
-async def initiate_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    tg_id = str(query.from_user.id)
-    lang = get_lang(tg_id)
-
-    plan_key = query.data.split('_', 1)[1]
-    current_prices = get_prices()
 
-    if plan_key not in current_prices:
+async def payment_jobs_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Retry queued payments the handler could not finish and settle ones interrupted after fulfilment."""
+    try:
+        claimed, applied, stale = await asyncio.to_thread(_claim_due_payment_jobs, int(time.time()))
+    except sqlite3.Error as e:
+        logging.error(f"Failed to read payment jobs: {e}")
         return
 
-    plan = current_prices[plan_key]
-
-    chat_id = query.message.chat_id
-    title = t("invoice_title_mobile", lang) if str(plan_key).startswith("m_") else t("invoice_title", lang)
-    description = t(f"label_{plan_key}", lang)
-    payload = plan_key
-    currency = "XTR"
-    price = plan['amount']
-    prices = [LabeledPrice(description, price)]
+    for job in stale:
+        await _alert_failed_payment_job(context, job, "interrupted while applying, check the subscription manually")
+
+    async def _apply_local(jobs: list[PaymentJob]) -> list[Optional[str]]:
+        # The settings lock is taken before x-ui is stopped, so x-ui is never down while the batch waits for it.
+        async with _XUI_SETTINGS_LOCK, _xui_write_window():
+            return [await _fulfil_payment_job(context, job, settings_locked=True) for job in jobs]
+
+    local = [job for job in claimed if job["plan_id"] != "ru_bridge" and not job["plan_id"].startswith("m_")]
+    remote = [job for job in claimed if job not in local]
+    # Remote grants run concurrently so the per-node upsert queues can merge them into one SSH round-trip.
+    remote_results = asyncio.gather(*(_fulfil_payment_job(context, job) for job in remote))
+    local_results = await _apply_local(local) if local else []
+    outcomes = list(zip(local, local_results)) + list(zip(remote, await remote_results))
+
+    for job, error in outcomes:
+        status = await asyncio.to_thread(_finish_payment_attempt, job["job_key"], error)
+        if status == "applied":
+            applied.append(job)
+        elif status == "failed":
+            await _alert_failed_payment_job(context, job, error or "unknown error")
+        else:
+            logging.warning(f"Payment job {job['job_key']} attempt {job['attempts']} failed: {error}")
 
-    await context.bot.send_invoice(
-        chat_id=chat_id,
-        title=title,
-        description=description,
-        payload=payload,
-        provider_token="",
-        currency=currency,
-        prices=prices
-    )
+    for job in applied:
+        await _settle_payment_job(context, job, notify_user=True)
 
-async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.pre_checkout_query
-    current_prices = get_prices()
-    if query.invoice_payload not in current_prices:
-        await query.answer(ok=False, error_message="Invalid plan selected.")
-    else:
-        await query.answer(ok=True)
 
 async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # CRITICAL: Record payment IMMEDIATELY to prevent loss in case of crash later
@@ -10900,9 +14151,12 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
         tg_id = str(update.message.from_user.id)
         start_payload = get_user_last_start_payload(tg_id)
         charge_id = _normalize_charge_id(getattr(payment, "telegram_payment_charge_id", None))
+        current_prices = get_prices()
+        plan = current_prices.get(payload)
 
-        # 1. Immediate DB Insert (Fail-safe)
+        # 1. Immediate DB Insert (Fail-safe), queued for fulfilment in the same commit
         inserted_tx_id: Optional[int] = None
+        job_key: Optional[str] = None
         try:
             conn = sqlite3.connect(BOT_DB_PATH)
             cursor = conn.cursor()
@@ -10982,16 +14236,19 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
                             (tg_id, amount, date_ts, payload),
                         )
                 inserted_tx_id = cursor.lastrowid if cursor.lastrowid else None
+            if plan and (charge_id or inserted_tx_id):
+                key = charge_id or f"tx:{inserted_tx_id}"
+                if _enqueue_payment_job(cursor, key, inserted_tx_id, tg_id, payload, amount, int(plan['days'])):
+                    job_key = key
             conn.commit()
             conn.close()
+            if inserted_tx_id:
+                _ADMIN_STATS.note_payment(tg_id, amount, date_ts, charge_id)
             log_action(f"SUCCESS: Transaction recorded for {tg_id} (Amount: {amount})")
         except Exception as db_e:
             log_action(f"CRITICAL DB ERROR: Failed to save transaction for {tg_id}: {db_e}")
             # Even if DB fails, we try to proceed, but this is bad.
 
-        current_prices = get_prices()
-        plan = current_prices.get(payload)
-
         if not plan:
             log_action(f"ERROR: Plan not found for payload: {payload}. User {tg_id} paid {payment.total_amount}.")
             try:
@@ -11002,210 +14259,203 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
             # But we already saved tx, so admin can check.
             return
 
-        lang = get_lang(tg_id)
         days_to_add = plan['days']
 
         log_action(f"ACTION: User {tg_id} (@{update.message.from_user.username}) purchased subscription: {payload} ({plan['amount']} XTR).")
 
-        # Celebration animation for Payment
-        msg = await update.message.reply_text("🎆")
-        await asyncio.sleep(1.0)
-        await msg.edit_text("🎆 🎇")
-        await asyncio.sleep(0.75)
-        await msg.edit_text("🎆 🎇 ✨")
-        await asyncio.sleep(0.5)
-        await msg.edit_text("🎉 ОПЛАТА ПРОШЛА УСПЕШНО! 🎉")
+        # Acknowledge right away; the grant, its confirmation and the admin notice run in the background.
+        await update.message.reply_text("🎉 ОПЛАТА ПРОШЛА УСПЕШНО! 🎉")
+        _start_payment_task(
+            _complete_paid_subscription(
+                update,
+                context,
+                tg_id,
+                str(payload),
+                int(payment.total_amount),
+                int(days_to_add),
+                charge_id,
+                inserted_tx_id,
+                job_key,
+            )
+        )
 
-        # Notify Admin
+    except Exception as e:
+        log_action(f"CRITICAL ERROR in successful_payment: {e}")
+        _record_payment_error()
         try:
-            admin_lang = get_lang(ADMIN_ID)
-            buyer_username = update.message.from_user.username or "NoUsername"
-            plan_name = t(f"plan_{payload}", admin_lang)
-            now_ms = int(time.time() * 1000)
-            old_expiry_ms = _get_mobile_subscription_expiry_ms(tg_id) if str(payload).startswith("m_") else _get_user_client_expiry_ms(tg_id)
-            ms_to_add = days_to_add * 24 * 60 * 60 * 1000
+            await context.bot.send_message(chat_id=ADMIN_ID, text=f"⚠️ CRITICAL PAYMENT ERROR: {e}")
+        except Exception:
+            pass
 
-            if admin_lang == "ru":
-                title = "💰 *Оплата подписки*"
-                type_new = "Новая подписка"
-                type_renew = "Продление"
-                type_reactivate = "Возобновление"
-                label_type = "🧾 Тип"
-                label_user = "👤 Пользователь"
-                label_plan = "💳 Тариф"
-                label_amount = "💸 Сумма"
-                label_added = "➕ Добавлено"
-                unit_days = "дн."
-                label_before = "⏳ Было"
-                label_after = "✅ Стало"
-                label_charge = "🧷 Charge"
-                fallback_expiry = "—"
-            else:
-                title = "💰 *Subscription payment*"
-                type_new = "New subscription"
-                type_renew = "Renewal"
-                type_reactivate = "Reactivation"
-                label_type = "🧾 Type"
-                label_user = "👤 User"
-                label_plan = "💳 Plan"
-                label_amount = "💸 Amount"
-                label_added = "➕ Added"
-                unit_days = "days"
-                label_before = "⏳ Before"
-                label_after = "✅ After"
-                label_charge = "🧷 Charge"
-                fallback_expiry = "—"
-
-            if old_expiry_ms is None:
-                sale_type = type_new
-                new_expiry_ms = now_ms + ms_to_add
-            elif old_expiry_ms == 0:
-                sale_type = type_renew
-                new_expiry_ms = 0
-            elif old_expiry_ms < now_ms:
-                sale_type = type_reactivate
-                new_expiry_ms = now_ms + ms_to_add
-            else:
-                sale_type = type_renew
-                new_expiry_ms = old_expiry_ms + ms_to_add
-
-            old_expiry_disp = fallback_expiry if old_expiry_ms is None else format_expiry_display(old_expiry_ms, admin_lang, now_ms=now_ms)
-            new_expiry_disp = format_expiry_display(new_expiry_ms, admin_lang, now_ms=now_ms)
-            safe_buyer_username = _escape_markdown(buyer_username)
-            safe_plan_name = _escape_markdown(plan_name)
-            safe_old_expiry = _escape_markdown(old_expiry_disp)
-            safe_new_expiry = _escape_markdown(new_expiry_disp)
-
-            admin_msg = (
-                f"{title}\n\n"
-                f"{label_type}: *{sale_type}*\n"
-                f"{label_user}: @{safe_buyer_username} (`{tg_id}`)\n"
-                f"{label_plan}: {safe_plan_name}\n"
-                f"{label_amount}: {payment.total_amount} Stars\n"
-                f"{label_added}: {days_to_add} {unit_days}\n"
-                f"{label_before}: {safe_old_expiry}\n"
-                f"{label_after}: {safe_new_expiry}"
-            )
-            if charge_id:
-                admin_msg += f"\n{label_charge}: `{charge_id}`"
 
-            # Send via Support Bot first, then fallback to Main Bot
-            support_bot = context.bot_data.get('support_bot') if isinstance(context.bot_data, dict) else None
-            sent = False
-            if support_bot:
-                try:
-                    await support_bot.send_message(chat_id=ADMIN_ID, text=admin_msg, parse_mode='Markdown')
-                    sent = True
-                except Exception as e:
-                    logging.error(f"Failed to send sales notification via support bot: {e}")
+_PAYMENT_TASKS: set[asyncio.Task[Any]] = set()
 
-            if not sent:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=admin_msg, parse_mode='Markdown')
 
-        except Exception as e:
-            logging.error(f"Failed to notify admin: {e}")
+def _start_payment_task(coro: Coroutine[Any, Any, None]) -> None:
+    task = asyncio.create_task(coro)
+    _PAYMENT_TASKS.add(task)
+    task.add_done_callback(_PAYMENT_TASKS.discard)
 
-        processed_ok = False
-        if payload == "ru_bridge":
-            processed_ok = await process_ru_bridge_subscription(tg_id, days_to_add, update, context, lang)
-        elif str(payload).startswith("m_"):
-            processed_ok = await process_mobile_subscription(tg_id, days_to_add, update, context, lang)
-        else:
-            processed_ok = await process_subscription(tg_id, days_to_add, update, context, lang)
-        if processed_ok and charge_id:
-            try:
-                conn = sqlite3.connect(BOT_DB_PATH)
-                conn.execute(
-                    "UPDATE transactions SET processed_at=? "
-                    "WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
-                    (int(time.time()), charge_id),
-                )
-                conn.commit()
-                conn.close()
-            except Exception as e:
-                logging.error(f"Failed to mark transaction as processed (charge_id: {charge_id}): {e}")
-        if processed_ok and inserted_tx_id and not charge_id:
-            try:
-                conn = sqlite3.connect(BOT_DB_PATH)
-                conn.execute(
-                    "UPDATE transactions SET processed_at=? WHERE id=? AND processed_at IS NULL",
-                    (int(time.time()), inserted_tx_id),
-                )
-                conn.commit()
-                conn.close()
-            except Exception as e:
-                logging.error(f"Failed to mark transaction as processed (id: {inserted_tx_id}): {e}")
 
-        # Check Referral Bonus (7 days for referrer)
-        try:
-            conn = sqlite3.connect(BOT_DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT referrer_id FROM user_prefs WHERE tg_id=?", (tg_id,))
-            row = cursor.fetchone()
-            conn.close()
+async def _notify_admin_of_sale(
+    context: ContextTypes.DEFAULT_TYPE,
+    tg_id: str,
+    username: Optional[str],
+    payload: str,
+    amount: int,
+    days_to_add: int,
+    charge_id: Optional[str],
+) -> None:
+    try:
+        admin_lang = get_lang(ADMIN_ID)
+        buyer_username = username or "NoUsername"
+        plan_name = t(f"plan_{payload}", admin_lang)
+        now_ms = int(time.time() * 1000)
+        old_expiry_ms = _get_mobile_subscription_expiry_ms(tg_id) if str(payload).startswith("m_") else _get_user_client_expiry_ms(tg_id)
+        ms_to_add = days_to_add * 24 * 60 * 60 * 1000
 
-            if row and row[0]:
-                referrer_id = row[0]
-                referrer_id = str(referrer_id)
-                granted_days = False
-                if referrer_id.isdigit() and referrer_id != tg_id:
-                    try:
-                        conn = sqlite3.connect(BOT_DB_PATH)
-                        cursor = conn.cursor()
-                        now = int(time.time())
-                        cursor.execute(
-                            "INSERT OR IGNORE INTO referral_day_bonuses (referrer_id, referred_id, days, date) "
-                            "VALUES (?, ?, ?, ?)",
-                            (referrer_id, tg_id, REF_BONUS_DAYS, now),
-                        )
-                        granted_days = cursor.rowcount > 0
-                        conn.commit()
-                        conn.close()
-                    except Exception:
-                        granted_days = False
+        if admin_lang == "ru":
+            title = "💰 *Оплата подписки*"
+            type_new = "Новая подписка"
+            type_renew = "Продление"
+            type_reactivate = "Возобновление"
+            label_type = "🧾 Тип"
+            label_user = "👤 Пользователь"
+            label_plan = "💳 Тариф"
+            label_amount = "💸 Сумма"
+            label_added = "➕ Добавлено"
+            unit_days = "дн."
+            label_before = "⏳ Было"
+            label_after = "✅ Стало"
+            label_charge = "🧷 Charge"
+            fallback_expiry = "—"
+        else:
+            title = "💰 *Subscription payment*"
+            type_new = "New subscription"
+            type_renew = "Renewal"
+            type_reactivate = "Reactivation"
+            label_type = "🧾 Type"
+            label_user = "👤 User"
+            label_plan = "💳 Plan"
+            label_amount = "💸 Amount"
+            label_added = "➕ Added"
+            unit_days = "days"
+            label_before = "⏳ Before"
+            label_after = "✅ After"
+            label_charge = "🧷 Charge"
+            fallback_expiry = "—"
+
+        if old_expiry_ms is None:
+            sale_type = type_new
+            new_expiry_ms = now_ms + ms_to_add
+        elif old_expiry_ms == 0:
+            sale_type = type_renew
+            new_expiry_ms = 0
+        elif old_expiry_ms < now_ms:
+            sale_type = type_reactivate
+            new_expiry_ms = now_ms + ms_to_add
+        else:
+            sale_type = type_renew
+            new_expiry_ms = old_expiry_ms + ms_to_add
+
+        old_expiry_disp = fallback_expiry if old_expiry_ms is None else format_expiry_display(old_expiry_ms, admin_lang, now_ms=now_ms)
+        new_expiry_disp = format_expiry_display(new_expiry_ms, admin_lang, now_ms=now_ms)
+        safe_buyer_username = _escape_markdown(buyer_username)
+        safe_plan_name = _escape_markdown(plan_name)
+        safe_old_expiry = _escape_markdown(old_expiry_disp)
+        safe_new_expiry = _escape_markdown(new_expiry_disp)
+
+        admin_msg = (
+            f"{title}\n\n"
+            f"{label_type}: *{sale_type}*\n"
+            f"{label_user}: @{safe_buyer_username} (`{tg_id}`)\n"
+            f"{label_plan}: {safe_plan_name}\n"
+            f"{label_amount}: {amount} Stars\n"
+            f"{label_added}: {days_to_add} {unit_days}\n"
+            f"{label_before}: {safe_old_expiry}\n"
+            f"{label_after}: {safe_new_expiry}"
+        )
+        if charge_id:
+            admin_msg += f"\n{label_charge}: `{charge_id}`"
 
-                if granted_days:
-                    await add_days_to_user(referrer_id, REF_BONUS_DAYS, context)
+        # The outbox sends it via the support bot first, then falls back to the main bot
+        await _send_admin_message(context, admin_msg)
 
-                    ref_lang = get_lang(referrer_id)
-                    msg_text = (
-                        f"🎉 **Referral Bonus!**\n\nUser you invited has purchased a subscription.\nYou received +{REF_BONUS_DAYS} days!"
-                    )
-                    if ref_lang == "ru":
-                        msg_text = (
-                            f"🎉 **Реферальный бонус!**\n\nПриглашенный вами пользователь купил подписку.\nВам начислено +{REF_BONUS_DAYS} дней!"
-                        )
+    except Exception as e:
+        logging.error(f"Failed to notify admin: {e}")
 
-                    try:
-                        await context.bot.send_message(chat_id=referrer_id, text=msg_text, parse_mode="Markdown")
-                    except Exception:
-                        pass
 
-            # 10% Cashback Logic
-            cashback_amount = int(payment.total_amount * 0.10)
-            if cashback_amount > 0 and row and row[0]:
-                referrer_id = row[0]
-                conn = sqlite3.connect(BOT_DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute("UPDATE user_prefs SET balance = balance + ? WHERE tg_id=?", (cashback_amount, referrer_id))
-                cursor.execute("INSERT INTO referral_bonuses (referrer_id, referred_id, amount, type, date) VALUES (?, ?, ?, 'cashback', ?)",
-                               (referrer_id, tg_id, cashback_amount, int(time.time())))
-                conn.commit()
-                conn.close()
+async def _complete_paid_subscription(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    tg_id: str,
+    payload: str,
+    amount: int,
+    days_to_add: int,
+    charge_id: Optional[str],
+    inserted_tx_id: Optional[int],
+    job_key: Optional[str],
+) -> None:
+    """Grant a payment successful_payment has already acknowledged, then confirm it to the user."""
+    try:
+        lang = get_lang(tg_id)
+        await _notify_admin_of_sale(
+            context, tg_id, update.message.from_user.username, payload, amount, days_to_add, charge_id
+        )
 
-                # Notify referrer about cashback
-                cb_lang = get_lang(referrer_id)
-                cb_text = f"💰 **Cashback!**\n\n+ {cashback_amount} Stars (10%) from referral purchase!"
-                if cb_lang == 'ru':
-                    cb_text = f"💰 **Кэшбэк!**\n\n+ {cashback_amount} Stars (10%) от покупки реферала!"
+        # The handler is the job's first worker; if the payment worker already owns it, leave it there.
+        if job_key:
+            try:
+                if not _claim_payment_job(job_key):
+                    return
+            except sqlite3.Error as e:
+                # The row is still pending, so the payment worker picks it up after the hand-off window.
+                logging.error(f"Failed to claim payment job {job_key}: {e}")
+                return
 
-                try:
-                    await context.bot.send_message(chat_id=referrer_id, text=cb_text, parse_mode='Markdown')
-                except Exception:
-                    pass
+        # The process_* call marks the job applied as soon as the grant commits.
+        if payload == "ru_bridge":
+            result = await process_ru_bridge_subscription(tg_id, days_to_add, update, context, lang, job_key=job_key)
+        elif str(payload).startswith("m_"):
+            result = await process_mobile_subscription(tg_id, days_to_add, update, context, lang, job_key=job_key)
+        else:
+            result = await process_subscription(tg_id, days_to_add, update, context, lang, job_key=job_key)
+        processed_ok = result != GrantResult.FAILED
+        if result == GrantResult.NOTIFY_FAILED:
+            logging.warning(f"Payment for {tg_id} applied but the confirmation could not be sent")
 
-        except Exception as e:
-            logging.error(f"Error checking referral bonus: {e}")
+        if job_key and not processed_ok:
+            try:
+                status = _finish_payment_attempt(job_key, "fulfilment failed")
+            except sqlite3.Error as e:
+                logging.error(f"Failed to update payment job {job_key}: {e}")
+                status = "pending"
+            if status == "failed":
+                await _alert_failed_payment_job(
+                    context,
+                    {
+                        "job_key": job_key, "tx_id": inserted_tx_id, "tg_id": tg_id, "plan_id": payload,
+                        "amount": amount, "days": days_to_add, "attempts": PAYMENT_JOB_MAX_ATTEMPTS,
+                    },
+                    "fulfilment failed",
+                )
+            # The payment worker retries it with backoff.
+            return
+
+        # Check Referral Bonus (7 days for referrer) and cashback, booked together with processed_at
+        try:
+            settled = _settle_payment(
+                job_key,
+                charge_id if processed_ok else None,
+                inserted_tx_id if processed_ok else None,
+                tg_id,
+                amount,
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Failed to settle payment for {tg_id} (charge_id: {charge_id}): {e}")
+            settled = None
+        if settled:
+            await _reward_referrer(context, *settled)
 
     except Exception as e:
         log_action(f"CRITICAL ERROR in successful_payment: {e}")
@@ -11215,8 +14465,14 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
         except Exception:
             pass
 
-async def add_days_to_user(tg_id, days_to_add, context):
+async def add_days_to_user(tg_id, days_to_add, context, job_key: Optional[str] = None):
     # Simplified version of process_subscription for background tasks
+    async with _XUI_SETTINGS_LOCK:
+        await _add_days_to_user_locked(tg_id, days_to_add, job_key)
+
+
+async def _add_days_to_user_locked(tg_id, days_to_add, job_key: Optional[str] = None):
+    """add_days_to_user for callers that already hold _XUI_SETTINGS_LOCK."""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
@@ -11294,13 +14550,14 @@ async def add_days_to_user(tg_id, days_to_add, context):
         """, (INBOUND_ID, 1, f"tg_{tg_id}", new_expiry))
 
     # Stop X-UI to prevent overwrite
-    await _systemctl("stop", "x-ui")
-
-    cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (json.dumps(settings), INBOUND_ID))
-    conn.commit()
+    async with _xui_write_window():
+        cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (json.dumps(settings), INBOUND_ID))
+        conn.commit()
     conn.close()
-
-    await _systemctl("start", "x-ui")
+    _mark_payment_job_applied(job_key)
+    _ADMIN_STATS.note_client(user_client if user_client else new_client)
+    _index_user_search_clients([user_client if user_client else new_client])
+    _note_audience_clients([user_client if user_client else new_client])
 
 def _fetch_ru_bridge_subscription(tg_id: str) -> Optional[dict[str, Any]]:
     try:
@@ -11493,86 +14750,87 @@ def _upsert_mobile_subscription(tg_id: str, days_to_add: int) -> Optional[dict[s
 
 async def _sync_ru_bridge_inbound_client(tg_id: str, user_uuid: str, sub_id: str, expiry_ms: int) -> bool:
     inbound_id = _resolve_ru_bridge_inbound_id()
-    if inbound_id is None:
-        return False
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT settings FROM inbounds WHERE id=?", (inbound_id,))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
-            return False
-        settings_raw = row[0] or "{}"
-        try:
-            settings = json.loads(settings_raw)
-        except Exception:
-            settings = {}
-        clients = settings.get("clients", [])
-        email = _ru_bridge_email(tg_id)
-        user_client = None
-        client_index = -1
-        for idx, client in enumerate(clients):
-            if str(client.get("tgId")) == str(tg_id) or client.get("email") == email:
-                user_client = client
-                client_index = idx
-                break
-        current_time_ms = int(time.time() * 1000)
-        flow_value = RU_BRIDGE_FLOW or ""
-        if user_client:
-            user_client["id"] = user_uuid
-            user_client["email"] = email
-            user_client["expiryTime"] = expiry_ms
-            user_client["enable"] = True
-            user_client["subId"] = sub_id
-            user_client["tgId"] = int(tg_id) if tg_id.isdigit() else tg_id
-            if flow_value and not user_client.get("flow"):
-                user_client["flow"] = flow_value
-            user_client["updated_at"] = current_time_ms
-            if not user_client.get("created_at"):
-                user_client["created_at"] = current_time_ms
-            clients[client_index] = user_client
-        else:
-            new_client = {
-                "id": user_uuid,
-                "email": email,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": expiry_ms,
-                "enable": True,
-                "tgId": int(tg_id) if tg_id.isdigit() else tg_id,
-                "subId": sub_id,
-                "created_at": current_time_ms,
-                "updated_at": current_time_ms,
-                "comment": "RU-Bridge",
-                "reset": 0,
-            }
-            if flow_value:
-                new_client["flow"] = flow_value
-            clients.append(new_client)
-        settings["clients"] = clients
-        if email:
+    if inbound_id is None:
+        return False
+    try:
+        async with _XUI_SETTINGS_LOCK:
+            conn = sqlite3.connect(DB_PATH)
+            cursor = conn.cursor()
+            cursor.execute("SELECT settings FROM inbounds WHERE id=?", (inbound_id,))
+            row = cursor.fetchone()
+            if not row:
+                conn.close()
+                return False
+            settings_raw = row[0] or "{}"
             try:
-                cursor.execute(
-                    "UPDATE client_traffics SET expiry_time=?, enable=1 WHERE inbound_id=? AND email=?",
-                    (expiry_ms, inbound_id, email),
-                )
-                if cursor.rowcount == 0:
+                settings = json.loads(settings_raw)
+            except Exception:
+                settings = {}
+            clients = settings.get("clients", [])
+            email = _ru_bridge_email(tg_id)
+            user_client = None
+            client_index = -1
+            for idx, client in enumerate(clients):
+                if str(client.get("tgId")) == str(tg_id) or client.get("email") == email:
+                    user_client = client
+                    client_index = idx
+                    break
+            current_time_ms = int(time.time() * 1000)
+            flow_value = RU_BRIDGE_FLOW or ""
+            if user_client:
+                user_client["id"] = user_uuid
+                user_client["email"] = email
+                user_client["expiryTime"] = expiry_ms
+                user_client["enable"] = True
+                user_client["subId"] = sub_id
+                user_client["tgId"] = int(tg_id) if tg_id.isdigit() else tg_id
+                if flow_value and not user_client.get("flow"):
+                    user_client["flow"] = flow_value
+                user_client["updated_at"] = current_time_ms
+                if not user_client.get("created_at"):
+                    user_client["created_at"] = current_time_ms
+                clients[client_index] = user_client
+            else:
+                new_client = {
+                    "id": user_uuid,
+                    "email": email,
+                    "limitIp": 0,
+                    "totalGB": 0,
+                    "expiryTime": expiry_ms,
+                    "enable": True,
+                    "tgId": int(tg_id) if tg_id.isdigit() else tg_id,
+                    "subId": sub_id,
+                    "created_at": current_time_ms,
+                    "updated_at": current_time_ms,
+                    "comment": "RU-Bridge",
+                    "reset": 0,
+                }
+                if flow_value:
+                    new_client["flow"] = flow_value
+                clients.append(new_client)
+            settings["clients"] = clients
+            if email:
+                try:
                     cursor.execute(
-                        "INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online) "
-                        "VALUES (?, ?, ?, 0, 0, ?, 0, 0, 0, 0)",
-                        (inbound_id, 1, email, expiry_ms),
+                        "UPDATE client_traffics SET expiry_time=?, enable=1 WHERE inbound_id=? AND email=?",
+                        (expiry_ms, inbound_id, email),
                     )
-            except Exception as e:
-                logging.error(f"Error updating client_traffics for RU-Bridge: {e}")
-        await _systemctl("stop", XUI_SYSTEMD_SERVICE)
-        cursor.execute(
-            "UPDATE inbounds SET settings=? WHERE id=?",
-            (json.dumps(settings), inbound_id),
-        )
-        conn.commit()
-        conn.close()
-        await _systemctl("start", XUI_SYSTEMD_SERVICE)
+                    if cursor.rowcount == 0:
+                        cursor.execute(
+                            "INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online) "
+                            "VALUES (?, ?, ?, 0, 0, ?, 0, 0, 0, 0)",
+                            (inbound_id, 1, email, expiry_ms),
+                        )
+                except Exception as e:
+                    logging.error(f"Error updating client_traffics for RU-Bridge: {e}")
+            await _systemctl("stop", XUI_SYSTEMD_SERVICE)
+            cursor.execute(
+                "UPDATE inbounds SET settings=? WHERE id=?",
+                (json.dumps(settings), inbound_id),
+            )
+            conn.commit()
+            conn.close()
+            await _systemctl("start", XUI_SYSTEMD_SERVICE)
         return True
     except Exception as e:
         logging.error(f"Failed to sync RU-Bridge inbound client: {e}")
@@ -11592,7 +14850,7 @@ async def _add_days_ru_bridge(tg_id: str, days_to_add: int) -> Optional[int]:
         return None
     return int(data["expiry_time"])
 
-async def process_ru_bridge_subscription(tg_id, days_to_add, update, context, lang, is_callback=False) -> bool:
+async def process_ru_bridge_subscription(tg_id, days_to_add, update, context, lang, is_callback=False, job_key: Optional[str] = None) -> GrantResult:
     if not _ru_bridge_location():
         try:
             if is_callback:
@@ -11607,7 +14865,7 @@ async def process_ru_bridge_subscription(tg_id, days_to_add, update, context, la
                 )
         except Exception:
             pass
-        return False
+        return GrantResult.FAILED
     if _resolve_ru_bridge_inbound_id() is None:
         try:
             if is_callback:
@@ -11622,7 +14880,8 @@ async def process_ru_bridge_subscription(tg_id, days_to_add, update, context, la
                 )
         except Exception:
             pass
-        return False
+        return GrantResult.FAILED
+    granted = False
     try:
         data = _upsert_ru_bridge_subscription(tg_id, days_to_add)
         if not data:
@@ -11635,6 +14894,8 @@ async def process_ru_bridge_subscription(tg_id, days_to_add, update, context, la
         )
         if not synced:
             raise RuntimeError("ru_bridge_inbound_failed")
+        granted = True
+        _mark_payment_job_applied(job_key)
         msg_key = "ru_bridge_success_extended" if days_to_add > 0 else "ru_bridge_success_updated"
         if data.get("created"):
             msg_key = "ru_bridge_success_created"
@@ -11652,8 +14913,11 @@ async def process_ru_bridge_subscription(tg_id, days_to_add, update, context, la
                 await context.bot.send_message(chat_id=tg_id, text=text, parse_mode='Markdown', reply_markup=reply_markup)
         else:
             await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
-        return True
+        return GrantResult.GRANTED
     except Exception as e:
+        if granted:
+            logging.error(f"RU-Bridge subscription applied for {tg_id} but the confirmation failed: {e}")
+            return GrantResult.NOTIFY_FAILED
         logging.error(f"Error processing RU-Bridge subscription: {e}")
         if is_callback:
             try:
@@ -11662,10 +14926,10 @@ async def process_ru_bridge_subscription(tg_id, days_to_add, update, context, la
                 pass
         else:
             await update.message.reply_text(t("error_generic", lang))
-        return False
+        return GrantResult.FAILED
 
 
-async def process_mobile_subscription(tg_id, days_to_add, update, context, lang, is_callback=False) -> bool:
+async def process_mobile_subscription(tg_id, days_to_add, update, context, lang, is_callback=False, job_key: Optional[str] = None) -> GrantResult:
     if not _mobile_feature_enabled():
         try:
             if is_callback:
@@ -11682,7 +14946,8 @@ async def process_mobile_subscription(tg_id, days_to_add, update, context, lang,
                 )
         except Exception:
             pass
-        return False
+        return GrantResult.FAILED
+    granted = False
     try:
         data = _upsert_mobile_subscription(str(tg_id), int(days_to_add))
         if not data:
@@ -11711,6 +14976,8 @@ async def process_mobile_subscription(tg_id, days_to_add, update, context, lang,
         )
         if not synced:
             raise RuntimeError("mobile_inbound_failed")
+        granted = True
+        _mark_payment_job_applied(job_key)
         msg_key = "mobile_success_extended" if int(days_to_add) > 0 else "mobile_success_updated"
         if data.get("created"):
             msg_key = "mobile_success_created"
@@ -11730,8 +14997,11 @@ async def process_mobile_subscription(tg_id, days_to_add, update, context, lang,
                 await context.bot.send_message(chat_id=tg_id, text=text, parse_mode="Markdown", reply_markup=reply_markup)
         else:
             await update.message.reply_text(text, parse_mode="Markdown", reply_markup=reply_markup)
-        return True
+        return GrantResult.GRANTED
     except Exception as e:
+        if granted:
+            logging.error(f"Mobile subscription applied for {tg_id} but the confirmation failed: {e}")
+            return GrantResult.NOTIFY_FAILED
         logging.error(f"Error processing mobile subscription: {e}")
         if is_callback:
             try:
@@ -11740,7 +15010,7 @@ async def process_mobile_subscription(tg_id, days_to_add, update, context, lang,
                 pass
         else:
             await update.message.reply_text(t("error_generic", lang))
-        return False
+        return GrantResult.FAILED
 
 async def ru_bridge_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -11845,99 +15115,175 @@ async def ru_bridge_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
-def _ssh_fetch_remote_client_traffic(
-    host: str,
-    port: int,
-    username: str,
-    password: str,
-    email: str,
-) -> Optional[dict[str, Any]]:
-    client = None
+async def _fetch_mobile_remote_xui_data() -> Optional[dict[str, Any]]:
+    if not _mobile_feature_enabled():
+        return None
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        _ssh_fetch_remote_xui_data,
+        MOBILE_SSH_HOST,
+        MOBILE_SSH_PORT,
+        MOBILE_SSH_USER,
+        MOBILE_SSH_PASSWORD,
+    )
+
+
+def _store_mobile_traffic_cache(rows: list[dict[str, Any]], fetched_at: int) -> None:
+    conn = sqlite3.connect(BOT_DB_PATH)
     try:
-        email_b64 = base64.b64encode(email.encode("utf-8")).decode("utf-8")
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            hostname=host,
-            port=port,
-            username=username,
-            password=password,
-            timeout=6,
-            banner_timeout=6,
-            auth_timeout=6,
-            look_for_keys=False,
-            allow_agent=False,
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM mobile_client_traffics")
+        cursor.executemany(
+            "INSERT OR REPLACE INTO mobile_client_traffics "
+            "(email, inbound_id, enable, up, down, total, expiry_time, last_online, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    str(row.get("email") or ""),
+                    int(row.get("inbound_id") or 0),
+                    1 if row.get("enable") else 0,
+                    int(row.get("up") or 0),
+                    int(row.get("down") or 0),
+                    int(row.get("total") or 0),
+                    int(row.get("expiry_time") or 0),
+                    int(row.get("last_online") or 0),
+                    fetched_at,
+                )
+                for row in rows
+            ],
         )
-        cmd = (
-            "python3 - <<'PY'\n"
-            "import base64, json, sqlite3, os\n"
-            "db=os.getenv('XUI_DB_PATH','/etc/x-ui/x-ui.db')\n"
-            "email=base64.b64decode('" + email_b64 + "').decode('utf-8', errors='ignore')\n"
-            "conn=sqlite3.connect(db)\n"
-            "cur=conn.cursor()\n"
-            "cur.execute('SELECT up, down, expiry_time, last_online FROM client_traffics WHERE email=? LIMIT 1', (email,))\n"
-            "row=cur.fetchone()\n"
-            "conn.close()\n"
-            "if row:\n"
-            "    up, down, expiry_time, last_online = row\n"
-            "    print(json.dumps({'ok': True, 'up': up or 0, 'down': down or 0, 'expiry_time': expiry_time or 0, 'last_online': last_online or 0}))\n"
-            "else:\n"
-            "    print(json.dumps({'ok': False}))\n"
-            "PY"
+        conn.commit()
+    finally:
+        conn.close()
+    _set_sync_state("mobile_traffic_fetched_at", str(fetched_at))
+
+def _get_mobile_traffic_cache(email: str) -> Optional[dict[str, Any]]:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT up, down, total, expiry_time, last_online, fetched_at FROM mobile_client_traffics WHERE email=?",
+            (email,),
         )
-        _, stdout, stderr = client.exec_command(cmd, timeout=12)
-        output = stdout.read().decode("utf-8", errors="ignore").strip()
-        error = stderr.read().decode("utf-8", errors="ignore").strip()
-        if not output:
-            if error:
-                logging.warning(f"SSH traffic fetch error for {host}:{port}: {error}")
-            return None
-        try:
-            data = json.loads(output)
-        except Exception:
-            logging.warning(f"SSH traffic fetch invalid json for {host}:{port}: {output}")
-            return None
-        if not isinstance(data, dict):
-            return None
-        if error:
-            logging.warning(f"SSH traffic fetch stderr for {host}:{port}: {error}")
-        return data
-    except Exception as exc:
-        logging.warning(f"SSH traffic fetch exception for {host}:{port}: {exc}")
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    if not row:
         return None
+    return {
+        "up": int(row[0] or 0),
+        "down": int(row[1] or 0),
+        "total": int(row[2] or 0),
+        "expiry_time": int(row[3] or 0),
+        "last_online": int(row[4] or 0),
+        "fetched_at": int(row[5] or 0),
+    }
+
+def _mobile_cache_ttl_sec() -> int:
+    # Two refresh periods when the refresh job runs, so one failed refresh doesn't force per-click SSH.
+    return 2 * MOBILE_TRAFFIC_REFRESH_SEC if MOBILE_TRAFFIC_REFRESH_SEC > 0 else MOBILE_CACHE_FALLBACK_TTL_SEC
+
+def _store_mobile_client_traffic(email: str, traffic: dict[str, Any], fetched_at: int) -> None:
+    conn = sqlite3.connect(BOT_DB_PATH)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO mobile_client_traffics "
+            "(email, inbound_id, enable, up, down, total, expiry_time, last_online, fetched_at) "
+            "VALUES (?, 0, 1, ?, ?, 0, ?, ?, ?)",
+            (
+                email,
+                int(traffic.get("up") or 0),
+                int(traffic.get("down") or 0),
+                int(traffic.get("expiry_time") or 0),
+                int(traffic.get("last_online") or 0),
+                fetched_at,
+            ),
+        )
+        conn.commit()
     finally:
-        if client is not None:
-            try:
-                client.close()
-            except Exception:
-                pass
+        conn.close()
 
+_MOBILE_TRAFFIC_FETCH_TIMEOUT_SEC = 12
+_MOBILE_TRAFFIC_REFRESH_TASKS: dict[str, asyncio.Task[Any]] = {}
 
-async def _fetch_mobile_remote_xui_data() -> Optional[dict[str, Any]]:
-    if not _mobile_feature_enabled():
-        return None
-    return await asyncio.get_running_loop().run_in_executor(
-        None,
-        _ssh_fetch_remote_xui_data,
+
+async def _fetch_mobile_client_traffic(email: str) -> Optional[dict[str, Any]]:
+    ok, fresh = await _run_remote_blocking(
+        _remote_lib_call,
         MOBILE_SSH_HOST,
         MOBILE_SSH_PORT,
         MOBILE_SSH_USER,
         MOBILE_SSH_PASSWORD,
+        "get_client_traffic",
+        {"email": email},
+        _MOBILE_TRAFFIC_FETCH_TIMEOUT_SEC,
     )
+    if not ok or not isinstance(fresh, dict) or not fresh.get("ok"):
+        return None
+    _store_mobile_client_traffic(email, fresh, int(time.time()))
+    return _get_mobile_traffic_cache(email)
+
+
+def _start_mobile_traffic_refresh(email: str) -> None:
+    if email in _MOBILE_TRAFFIC_REFRESH_TASKS:
+        return
+
+    async def _run() -> None:
+        try:
+            await _fetch_mobile_client_traffic(email)
+        except Exception as e:
+            logging.warning(f"Mobile traffic refresh for {email} failed: {e}")
+        finally:
+            _MOBILE_TRAFFIC_REFRESH_TASKS.pop(email, None)
 
+    _MOBILE_TRAFFIC_REFRESH_TASKS[email] = asyncio.create_task(_run())
 
-async def _fetch_mobile_remote_client_traffic(email: str) -> Optional[dict[str, Any]]:
+
+async def _get_mobile_client_traffic(email: str) -> Optional[dict[str, Any]]:
+    """Cached traffic of one mobile client.
+
+    A stale entry is returned as is and refreshed in the background; only a client with no entry at all
+    waits for a short SSH fetch.
+    """
+    traffic = _get_mobile_traffic_cache(email)
+    if traffic is not None:
+        if int(time.time()) - traffic["fetched_at"] > _mobile_cache_ttl_sec():
+            _start_mobile_traffic_refresh(email)
+        return traffic
+    return await _fetch_mobile_client_traffic(email)
+
+async def _get_mobile_xui_data() -> Optional[dict[str, Any]]:
+    raw = _get_fresh_sync_state("mobile_xui_data", _mobile_cache_ttl_sec())
+    if raw:
+        try:
+            data = json.loads(raw)
+            if isinstance(data, dict):
+                return data
+        except Exception:
+            pass
+    data = await _fetch_mobile_remote_xui_data()
+    if data:
+        _set_sync_state("mobile_xui_data", json.dumps(data, ensure_ascii=False))
+    return data
+
+async def refresh_mobile_cache_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _mobile_feature_enabled():
-        return None
-    return await asyncio.get_running_loop().run_in_executor(
-        None,
-        _ssh_fetch_remote_client_traffic,
+        return
+    rows = await _run_remote_blocking(
+        _ssh_fetch_remote_client_traffics,
         MOBILE_SSH_HOST,
         MOBILE_SSH_PORT,
         MOBILE_SSH_USER,
         MOBILE_SSH_PASSWORD,
-        email,
+        0,
     )
+    if rows is None:
+        logging.warning("Mobile traffic cache refresh failed")
+    else:
+        _store_mobile_traffic_cache(rows, int(time.time()))
+    xui_data = await _fetch_mobile_remote_xui_data()
+    if xui_data:
+        _set_sync_state("mobile_xui_data", json.dumps(xui_data, ensure_ascii=False))
 
 
 async def mobile_config(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -12028,7 +15374,7 @@ async def mobile_config(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await query.edit_message_text(t("error_generic", lang))
         return
 
-    remote = await _fetch_mobile_remote_xui_data()
+    remote = await _get_mobile_xui_data()
     if not remote:
         await query.edit_message_text(t("error_generic", lang))
         return
@@ -12093,7 +15439,7 @@ async def show_mobile_qrcode(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text(t("error_generic", lang))
         return
 
-    remote = await _fetch_mobile_remote_xui_data()
+    remote = await _get_mobile_xui_data()
     if not remote:
         await query.edit_message_text(t("error_generic", lang))
         return
@@ -12102,25 +15448,11 @@ async def show_mobile_qrcode(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text(t("error_generic", lang))
         return
 
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(sub_link)
-    qr.make(fit=True)
-
-    img = qr.make_image(fill_color="black", back_color="white")
-    bio = BytesIO()
-    bio.name = "qrcode.png"
-    img.save(bio, "PNG")
-    bio.seek(0)
-
     client_email = _mobile_email(tg_id)
-    await context.bot.send_photo(
-        chat_id=tg_id,
-        photo=bio,
+    await _send_qr_photo(
+        context.bot,
+        tg_id,
+        sub_link,
         caption=f"Subscription QR for: <code>{html.escape(client_email)}</code>",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_back", lang), callback_data="mobile_config")]]),
@@ -12157,8 +15489,8 @@ async def mobile_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
 
     email = _mobile_email(tg_id)
-    traffic = await _fetch_mobile_remote_client_traffic(email)
-    if not traffic or not traffic.get("ok"):
+    traffic = await _get_mobile_client_traffic(email)
+    if not traffic:
         text = "Нет данных по трафику 3G/4G." if lang == "ru" else "No 3G/4G traffic data found."
         try:
             await query.edit_message_text(
@@ -12183,7 +15515,8 @@ async def mobile_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         f"{title}\n\n"
         f"⬇️ Download: {down / (1024 ** 3):.2f} GB\n"
         f"⬆️ Upload: {up / (1024 ** 3):.2f} GB\n"
-        f"📦 Total: {total / (1024 ** 3):.2f} GB"
+        f"📦 Total: {total / (1024 ** 3):.2f} GB\n\n"
+        f"{t('mobile_traffic_updated_ago', lang).format(seconds=max(0, int(time.time()) - traffic['fetched_at']))}"
     )
 
     try:
@@ -12202,186 +15535,190 @@ async def mobile_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         )
 
 
-async def process_subscription(tg_id, days_to_add, update, context, lang, is_callback=False) -> bool:
+async def process_subscription(tg_id, days_to_add, update, context, lang, is_callback=False, job_key: Optional[str] = None) -> GrantResult:
+    granted = False
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-        row = cursor.fetchone()
-
-        if not row:
-            if is_callback:
-                try:
-                    await update.callback_query.edit_message_text("Error: Inbound not found.")
-                except Exception as e:
-                    if "Message is not modified" not in str(e):
-                         await update.callback_query.message.delete()
-                         await context.bot.send_message(chat_id=tg_id, text="Error: Inbound not found.")
-            else:
-                await update.message.reply_text("Error: Inbound not found.")
-            conn.close()
-            return False
-
-        settings = json.loads(row[0])
-        clients = settings.get('clients', [])
-
-        user_client = None
-        client_index = -1
-
-        for idx, client in enumerate(clients):
-            if str(client.get('tgId')) == tg_id or client.get('email') == f"tg_{tg_id}":
-                user_client = client
-                client_index = idx
-                break
-
-        current_time_ms = int(time.time() * 1000)
-        ms_to_add = days_to_add * 24 * 60 * 60 * 1000
-
-        if user_client:
-            current_expiry = user_client.get('expiryTime', 0)
-
-            # Ensure email is updated if nickname is available
-            # Check if email is in old format tg_ID or just different
-            # We can't easily fetch nickname here without API call, which is slow.
-            # But if we have it in DB, we can use it.
-            # However, to avoid complexity, we can just respect the existing email
-            # UNLESS we are creating a NEW one.
-            # If updating existing, we keep email unless Admin syncs it.
-
-            if current_expiry == 0:
-                new_expiry = 0 # Remain unlimited
-            elif current_expiry < current_time_ms:
-                new_expiry = current_time_ms + ms_to_add
-            else:
-                new_expiry = current_expiry + ms_to_add
+        async with _XUI_SETTINGS_LOCK:
+            conn = sqlite3.connect(DB_PATH)
+            cursor = conn.cursor()
+            cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+            row = cursor.fetchone()
 
-            # Update comment with latest nickname if available (User Request: auto-update comment on any sub action)
-            try:
-                user = None
-                if update.callback_query:
-                    user = update.callback_query.from_user
-                elif update.message:
-                    user = update.message.from_user
-
-                if user:
-                    user_nick = ""
-                    if user.username:
-                        user_nick = f"@{user.username}"
-                    elif user.first_name:
-                        user_nick = user.first_name
-                        if user.last_name:
-                            user_nick += f" {user.last_name}"
-
-                    if user_nick:
-                        # Only write if comment is empty, or user wants force update?
-                        # User said: "в дальнейшем при любых подписках... сразу туда заполнять данные в эти комментарии"
-                        # Implicitly means we should ensure it's set.
-                        # And: "Если в комментарии уже есть чтото, то пропускаем перезапись."
-
-                        old_comment = user_client.get('comment', '')
-                        if not old_comment:
-                            user_client['comment'] = user_nick
-            except Exception:
-                pass
+            if not row:
+                if is_callback:
+                    try:
+                        await update.callback_query.edit_message_text("Error: Inbound not found.")
+                    except Exception as e:
+                        if "Message is not modified" not in str(e):
+                             await update.callback_query.message.delete()
+                             await context.bot.send_message(chat_id=tg_id, text="Error: Inbound not found.")
+                else:
+                    await update.message.reply_text("Error: Inbound not found.")
+                conn.close()
+                return GrantResult.FAILED
 
-            user_client['expiryTime'] = new_expiry
-            user_client['enable'] = True
-            user_client['updated_at'] = current_time_ms
-            clients[client_index] = user_client
+            settings = json.loads(row[0])
+            clients = settings.get('clients', [])
 
-            # IMPORTANT: Assign updated clients list back to settings (was missing for update case)
-            settings['clients'] = clients
+            user_client = None
+            client_index = -1
 
-            msg_key = "success_extended"
-            if days_to_add < 0:
-                msg_key = "success_updated"
+            for idx, client in enumerate(clients):
+                if str(client.get('tgId')) == tg_id or client.get('email') == f"tg_{tg_id}":
+                    user_client = client
+                    client_index = idx
+                    break
 
-            # Special case: If unlimited, we might want to tell user "You have unlimited, no changes made"
-            # but usually extending unlimited is just ... unlimited.
-            if current_expiry == 0:
-                 # If unlimited, we don't change expiry, but we might want to re-enable if disabled
-                 pass
-        else:
-            u_uuid = str(uuid.uuid4())
-            new_expiry = current_time_ms + ms_to_add
+            current_time_ms = int(time.time() * 1000)
+            ms_to_add = days_to_add * 24 * 60 * 60 * 1000
 
-            # Try to get nickname for new client
-            uname_val = ""
-            try:
-                # Check DB first
-                conn_db = sqlite3.connect(BOT_DB_PATH)
-                cursor_db = conn_db.cursor()
-                cursor_db.execute("SELECT username, first_name, last_name FROM user_prefs WHERE tg_id=?", (tg_id,))
-                row_db = cursor_db.fetchone()
-                conn_db.close()
-
-                if row_db:
-                    if row_db[0]:
-                        uname_val = f"@{row_db[0]}"
-                    elif row_db[1]:
-                        uname_val = row_db[1]
-                        if row_db[2]:
-                            uname_val += f" {row_db[2]}"
+            if user_client:
+                current_expiry = user_client.get('expiryTime', 0)
+
+                # Ensure email is updated if nickname is available
+                # Check if email is in old format tg_ID or just different
+                # We can't easily fetch nickname here without API call, which is slow.
+                # But if we have it in DB, we can use it.
+                # However, to avoid complexity, we can just respect the existing email
+                # UNLESS we are creating a NEW one.
+                # If updating existing, we keep email unless Admin syncs it.
+
+                if current_expiry == 0:
+                    new_expiry = 0 # Remain unlimited
+                elif current_expiry < current_time_ms:
+                    new_expiry = current_time_ms + ms_to_add
                 else:
-                    # Fetch
-                    chat = await context.bot.get_chat(tg_id)
-                    if chat.username:
-                        uname_val = f"@{chat.username}"
-                    elif chat.first_name:
-                        uname_val = chat.first_name
-                        if chat.last_name:
-                            uname_val += f" {chat.last_name}"
-            except Exception:
-                pass
+                    new_expiry = current_expiry + ms_to_add
 
-            if not uname_val:
-                uname_val = "User"
-
-            # Use simple tg_ID for email, put nickname in comment
-            new_email = f"tg_{tg_id}"
-
-            new_client = {
-                "id": u_uuid,
-                "email": new_email,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": new_expiry,
-                "enable": True,
-                "tgId": int(tg_id) if tg_id.isdigit() else tg_id,
-                "subId": str(uuid.uuid4()).replace('-', '')[:16],
-                "flow": "xtls-rprx-vision",
-                "created_at": current_time_ms,
-                "updated_at": current_time_ms,
-                "comment": uname_val, # Use full nickname
-                "reset": 0
-            }
-            clients.append(new_client)
-            settings['clients'] = clients
-            msg_key = "success_created"
+                # Update comment with latest nickname if available (User Request: auto-update comment on any sub action)
+                try:
+                    user = None
+                    if update.callback_query:
+                        user = update.callback_query.from_user
+                    elif update.message:
+                        user = update.message.from_user
+
+                    if user:
+                        user_nick = ""
+                        if user.username:
+                            user_nick = f"@{user.username}"
+                        elif user.first_name:
+                            user_nick = user.first_name
+                            if user.last_name:
+                                user_nick += f" {user.last_name}"
+
+                        if user_nick:
+                            # Only write if comment is empty, or user wants force update?
+                            # User said: "в дальнейшем при любых подписках... сразу туда заполнять данные в эти комментарии"
+                            # Implicitly means we should ensure it's set.
+                            # And: "Если в комментарии уже есть чтото, то пропускаем перезапись."
+
+                            old_comment = user_client.get('comment', '')
+                            if not old_comment:
+                                user_client['comment'] = user_nick
+                except Exception:
+                    pass
 
-            # Insert into client_traffics
-            cursor.execute("""
-                INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online)
-                VALUES (?, ?, ?, 0, 0, ?, 0, 0, 0, 0)
-            """, (INBOUND_ID, 1, new_email, new_expiry))
+                user_client['expiryTime'] = new_expiry
+                user_client['enable'] = True
+                user_client['updated_at'] = current_time_ms
+                clients[client_index] = user_client
 
-        # Also update client_traffics with new expiry
-        if user_client:
-             email = user_client.get('email')
-             if email:
-                 try:
-                     conn.execute("UPDATE client_traffics SET expiry_time=?, enable=1 WHERE email=?", (new_expiry, email))
-                 except Exception as e:
-                     logging.error(f"Error updating client_traffics for existing user: {e}")
+                # IMPORTANT: Assign updated clients list back to settings (was missing for update case)
+                settings['clients'] = clients
 
-        # Stop X-UI to prevent overwrite
-        await _systemctl("stop", "x-ui")
+                msg_key = "success_extended"
+                if days_to_add < 0:
+                    msg_key = "success_updated"
 
-        cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (json.dumps(settings), INBOUND_ID))
-        conn.commit()
-        conn.close()
+                # Special case: If unlimited, we might want to tell user "You have unlimited, no changes made"
+                # but usually extending unlimited is just ... unlimited.
+                if current_expiry == 0:
+                     # If unlimited, we don't change expiry, but we might want to re-enable if disabled
+                     pass
+            else:
+                u_uuid = str(uuid.uuid4())
+                new_expiry = current_time_ms + ms_to_add
+
+                # Try to get nickname for new client
+                uname_val = ""
+                try:
+                    # Check DB first
+                    conn_db = sqlite3.connect(BOT_DB_PATH)
+                    cursor_db = conn_db.cursor()
+                    cursor_db.execute("SELECT username, first_name, last_name FROM user_prefs WHERE tg_id=?", (tg_id,))
+                    row_db = cursor_db.fetchone()
+                    conn_db.close()
+
+                    if row_db:
+                        if row_db[0]:
+                            uname_val = f"@{row_db[0]}"
+                        elif row_db[1]:
+                            uname_val = row_db[1]
+                            if row_db[2]:
+                                uname_val += f" {row_db[2]}"
+                    else:
+                        # Fetch
+                        profile = await _get_chat_profile(context.bot, tg_id)
+                        if profile and profile["username"]:
+                            uname_val = f"@{profile['username']}"
+                        elif profile and profile["first_name"]:
+                            uname_val = profile["first_name"]
+                            if profile["last_name"]:
+                                uname_val += f" {profile['last_name']}"
+                except Exception:
+                    pass
 
-        await _systemctl("start", "x-ui")
+                if not uname_val:
+                    uname_val = "User"
+
+                # Use simple tg_ID for email, put nickname in comment
+                new_email = f"tg_{tg_id}"
+
+                new_client = {
+                    "id": u_uuid,
+                    "email": new_email,
+                    "limitIp": 0,
+                    "totalGB": 0,
+                    "expiryTime": new_expiry,
+                    "enable": True,
+                    "tgId": int(tg_id) if tg_id.isdigit() else tg_id,
+                    "subId": str(uuid.uuid4()).replace('-', '')[:16],
+                    "flow": "xtls-rprx-vision",
+                    "created_at": current_time_ms,
+                    "updated_at": current_time_ms,
+                    "comment": uname_val, # Use full nickname
+                    "reset": 0
+                }
+                clients.append(new_client)
+                settings['clients'] = clients
+                msg_key = "success_created"
+
+                # Insert into client_traffics
+                cursor.execute("""
+                    INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online)
+                    VALUES (?, ?, ?, 0, 0, ?, 0, 0, 0, 0)
+                """, (INBOUND_ID, 1, new_email, new_expiry))
+
+            # Also update client_traffics with new expiry
+            if user_client:
+                 email = user_client.get('email')
+                 if email:
+                     try:
+                         conn.execute("UPDATE client_traffics SET expiry_time=?, enable=1 WHERE email=?", (new_expiry, email))
+                     except Exception as e:
+                         logging.error(f"Error updating client_traffics for existing user: {e}")
+
+            # Stop X-UI to prevent overwrite
+            async with _xui_write_window():
+                cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (json.dumps(settings), INBOUND_ID))
+                conn.commit()
+            conn.close()
+        granted = True
+        _mark_payment_job_applied(job_key)
+        _ADMIN_STATS.note_client(user_client if user_client else new_client)
+        _index_user_search_clients([user_client if user_client else new_client])
+        _note_audience_clients([user_client if user_client else new_client])
 
         expiry_date = format_expiry_display(new_expiry, lang)
 
@@ -12405,8 +15742,11 @@ async def process_subscription(tg_id, days_to_add, update, context, lang, is_cal
         else:
              await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 
-        return True
+        return GrantResult.GRANTED
     except Exception as e:
+        if granted:
+            logging.error(f"Subscription applied for {tg_id} but the confirmation failed: {e}")
+            return GrantResult.NOTIFY_FAILED
         logging.error(f"Error processing subscription: {e}")
         if is_callback:
              try:
@@ -12417,7 +15757,7 @@ async def process_subscription(tg_id, days_to_add, update, context, lang, is_cal
                       await context.bot.send_message(chat_id=tg_id, text=t("error_generic", lang))
         else:
              await update.message.reply_text(t("error_generic", lang))
-        return False
+        return GrantResult.FAILED
 
 async def get_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -13113,158 +16453,267 @@ async def send_daily_report_job(context: ContextTypes.DEFAULT_TYPE) -> None:
             f"🕒 Generated: {now_dt.strftime('%Y-%m-%d %H:%M:%S')}"
         )
 
-    await _send_admin_message(context, msg)
+    await _send_admin_message(context, msg)
+
+# Expiry reminders are driven by a min-heap of (due, until, kind, tg_id, expiry_ms) events built from the
+# inbound clients; the heap is rebuilt only when clients, trials or payments change (plus a periodic full
+# rebuild), and each tick just pops what is due instead of re-scanning every client. A send that fails is
+# pushed back with a backoff while its window is still open.
+_EXPIRY_REMINDERS_PAID = (
+    ("expiry_warning_7d", "expiry_warning_7d", 7 * 3600, 6 * 3600),
+    ("expiry_warning_3d", "expiry_warning_3d", 3 * 3600, 2 * 3600),
+    ("expiry_warning_24h", "expiry_warning", 24 * 3600, 0),
+)
+_EXPIRY_REMINDERS_TRIAL = (
+    ("expiry_warning_24h", "trial_expiring", 24 * 3600, 0),
+)
+_TRIAL_FOLLOWUP_WINDOW_SEC = 48 * 3600
+_WINBACK_WINDOW_SEC = (3 * 86400, 7 * 86400)
+_EXPIRY_FULL_REBUILD_SEC = 3600
+_EXPIRY_RETRY_BASE_SEC = 60
+_EXPIRY_RETRY_MAX_SEC = 3600
+
+_EXPIRY_HEAP: list[tuple[float, float, str, str, int]] = []
+_EXPIRY_SIGNATURE: Optional[str] = None
+_EXPIRY_TRIAL_USERS: set[str] = set()
+_EXPIRY_PAID_USERS: set[str] = set()
+_EXPIRY_SENT: dict[tuple[str, str], int] = {}
+_EXPIRY_RETRIES: dict[tuple[str, str, int], int] = {}
+
+
+def _expiry_source_signature(now: float) -> str:
+    """
+    Cheap change marker for the schedule sources, without touching the settings blob: x-ui keeps
+    client_traffics.expiry_time in step with the inbound clients, and the bot DB triggers bump a version
+    on every payment or trial change. The hour bucket forces a periodic full rebuild for edits neither covers.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT COUNT(*), TOTAL(expiry_time), MAX(id) FROM client_traffics WHERE inbound_id=?",
+            (INBOUND_ID,),
+        )
+        xui_marker = cursor.fetchone()
+    finally:
+        conn.close()
+    version = _get_sync_state("expiry_sources_version") or "0"
+    return f"{xui_marker}|{version}|{int(now // _EXPIRY_FULL_REBUILD_SEC)}"
+
 
-async def check_expiring_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+def _load_expiry_clients() -> list[dict[str, Any]]:
+    conn = sqlite3.connect(DB_PATH)
     try:
-        logging.info("Checking for expiring subscriptions...")
-        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
         row = cursor.fetchone()
+    finally:
+        conn.close()
+    raw = str(row[0] or "") if row else ""
+    return json.loads(raw).get("clients", []) if raw else []
 
-        if not row:
-            conn.close()
-            return
 
-        settings = json.loads(row[0])
-        clients = settings.get('clients', [])
+def _expiry_is_trial(tg_id: str) -> bool:
+    return tg_id in _EXPIRY_TRIAL_USERS and tg_id not in _EXPIRY_PAID_USERS
 
-        current_time = time.time() * 1000
-        one_hour_ms = 60 * 60 * 1000
-        one_day_ms = 24 * one_hour_ms
 
-        # Connect to Bot DB for notifications
-        conn_bot = sqlite3.connect(BOT_DB_PATH)
+def _rebuild_expiry_schedule(clients: list[dict[str, Any]], now: float) -> None:
+    """Preload trial/paid sets and sent notifications, then heapify upcoming thresholds for every client."""
+    conn_bot = sqlite3.connect(BOT_DB_PATH)
+    try:
         cursor_bot = conn_bot.cursor()
+        cursor_bot.execute("SELECT tg_id FROM user_prefs WHERE trial_used=1")
+        trial_users = {str(row[0]) for row in cursor_bot.fetchall()}
+        cursor_bot.execute("SELECT DISTINCT tg_id FROM transactions")
+        paid_users = {str(row[0]) for row in cursor_bot.fetchall()}
+        cursor_bot.execute(
+            "SELECT tg_id, type, date FROM notifications "
+            "WHERE type IN ('expiry_warning_7d', 'expiry_warning_3d', 'expiry_warning_24h', 'trial_expired_followup') "
+            "OR type LIKE 'winback_%'"
+        )
+        sent = {(str(row[0]), str(row[1])): int(row[2] or 0) for row in cursor_bot.fetchall()}
+    finally:
+        conn_bot.close()
 
-        for client in clients:
-            expiry_time = client.get('expiryTime', 0)
-            tg_id = str(client.get('tgId', ''))
+    _EXPIRY_TRIAL_USERS.clear()
+    _EXPIRY_TRIAL_USERS.update(trial_users)
+    _EXPIRY_PAID_USERS.clear()
+    _EXPIRY_PAID_USERS.update(paid_users)
+    _EXPIRY_SENT.clear()
+    _EXPIRY_SENT.update(sent)
 
-            if expiry_time > 0 and tg_id and tg_id.isdigit():
-                time_left = expiry_time - current_time
+    events: list[tuple[float, float, str, str, int]] = []
+    for client in clients:
+        expiry_ms = int(client.get('expiryTime', 0) or 0)
+        tg_id = str(client.get('tgId', '') or '')
+        if expiry_ms <= 0 or not tg_id:
+            continue
+        expiry = expiry_ms / 1000
+        if tg_id.isdigit():
+            reminders = _EXPIRY_REMINDERS_TRIAL if _expiry_is_trial(tg_id) else _EXPIRY_REMINDERS_PAID
+            for notif_type, _msg_key, upper, lower in reminders:
+                events.append((expiry - upper, expiry - lower, notif_type, tg_id, expiry_ms))
+            events.append((expiry, expiry + _TRIAL_FOLLOWUP_WINDOW_SEC, "trial_expired_followup", tg_id, expiry_ms))
+        events.append((expiry + _WINBACK_WINDOW_SEC[0], expiry + _WINBACK_WINDOW_SEC[1], "winback", tg_id, expiry_ms))
 
-                # Check if it's a Trial User (heuristic: trial_used=1 in prefs)
-                is_trial = False
-                cursor_bot.execute("SELECT trial_used FROM user_prefs WHERE tg_id=?", (tg_id,))
-                pref = cursor_bot.fetchone()
-                if pref and pref[0]:
-                    # Check if they have any paid transactions
-                    cursor_bot.execute("SELECT 1 FROM transactions WHERE tg_id=?", (tg_id,))
-                    if not cursor_bot.fetchone():
-                        is_trial = True
-
-                if is_trial:
-                    reminders = [
-                        ("expiry_warning_24h", "trial_expiring", one_day_ms, 0),
-                    ]
-                else:
-                    reminders = [
-                        ("expiry_warning_7d", "expiry_warning_7d", 7 * one_hour_ms, 6 * one_hour_ms),
-                        ("expiry_warning_3d", "expiry_warning_3d", 3 * one_hour_ms, 2 * one_hour_ms),
-                        ("expiry_warning_24h", "expiry_warning", one_day_ms, 0),
-                    ]
+    heap = [event for event in events if event[1] > now]
+    heapq.heapify(heap)
+    _EXPIRY_HEAP[:] = heap
 
-                for notif_type, msg_key, upper, lower in reminders:
-                    if lower < time_left <= upper:
-                        cursor_bot.execute("SELECT date FROM notifications WHERE tg_id=? AND type=?", (tg_id, notif_type))
-                        notif = cursor_bot.fetchone()
-
-                        should_send = True
-                        if notif and (time.time() - notif[0]) < 86400:
-                            should_send = False
-
-                        if should_send:
-                            try:
-                                user_lang = get_lang(tg_id)
-                                await context.bot.send_message(
-                                    chat_id=tg_id,
-                                    text=t(msg_key, user_lang),
-                                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_renew", user_lang), callback_data='shop')]]),
-                                    parse_mode='Markdown'
-                                )
-                                cursor_bot.execute("INSERT OR REPLACE INTO notifications (tg_id, type, date) VALUES (?, ?, ?)",
-                                                   (tg_id, notif_type, int(time.time())))
-                                conn_bot.commit()
-                                logging.info(f"Sent expiry warning to {tg_id} ({notif_type})")
-                            except Exception as ex:
-                                logging.warning(f"Failed to send warning to {tg_id}: {ex}")
-                        break
 
+def _mark_expiry_notification(tg_id: str, notif_type: str) -> None:
+    sent_at = int(time.time())
+    conn_bot = sqlite3.connect(BOT_DB_PATH)
+    try:
+        conn_bot.execute("INSERT OR REPLACE INTO notifications (tg_id, type, date) VALUES (?, ?, ?)", (tg_id, notif_type, sent_at))
+        conn_bot.commit()
+    finally:
         conn_bot.close()
-        conn.close()
-    except Exception as e:
-        logging.error(f"Error in check_expiring_subscriptions: {e}")
+    _EXPIRY_SENT[(tg_id, notif_type)] = sent_at
+
+
+async def _send_expiry_reminder(bot: Any, tg_id: str, kind: str, expiry_ms: int, now: float) -> bool:
+    """Returns False only when the send itself failed and the event should be retried."""
+    time_left = expiry_ms / 1000 - now
+    is_trial = _expiry_is_trial(tg_id)
+    reminders = _EXPIRY_REMINDERS_TRIAL if is_trial else _EXPIRY_REMINDERS_PAID
+    # Same precedence as the old scan: the first window containing time_left wins.
+    match = next((r for r in reminders if r[3] < time_left <= r[2]), None)
+    if match is None or match[0] != kind:
+        return True
+    notif_type, msg_key = match[0], match[1]
+    last_sent = _EXPIRY_SENT.get((tg_id, notif_type))
+    if last_sent is not None and (now - last_sent) < 86400:
+        return True
+    try:
+        user_lang = get_lang(tg_id)
+        await bot.send_message(
+            chat_id=tg_id,
+            text=t(msg_key, user_lang),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_renew", user_lang), callback_data='shop')]]),
+            parse_mode='Markdown'
+        )
+        _mark_expiry_notification(tg_id, notif_type)
+        logging.info(f"Sent expiry warning to {tg_id} ({notif_type})")
+    except Forbidden as ex:
+        logging.info(f"Skipping expiry warning for {tg_id}: {ex}")
+    except Exception as ex:
+        logging.warning(f"Failed to send warning to {tg_id}: {ex}")
+        return False
+    return True
+
+
+async def _send_trial_followup(bot: Any, tg_id: str) -> bool:
+    """Encourage pure trial users whose trial expired within the last 48h to buy."""
+    if not _expiry_is_trial(tg_id) or (tg_id, 'trial_expired_followup') in _EXPIRY_SENT:
+        return True
+    try:
+        user_lang = get_lang(tg_id)
+        await bot.send_message(
+            chat_id=tg_id,
+            text=t("trial_expired", user_lang),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_buy", user_lang), callback_data='shop')]]),
+            parse_mode='Markdown'
+        )
+        _mark_expiry_notification(tg_id, 'trial_expired_followup')
+        logging.info(f"Sent trial expired followup to {tg_id}")
+    except Forbidden as ex:
+        logging.info(f"Skipping trial followup for {tg_id}: {ex}")
+    except Exception as ex:
+        logging.warning(f"Failed to send trial followup to {tg_id}: {ex}")
+        return False
+    return True
+
 
-async def check_expired_trials(context: ContextTypes.DEFAULT_TYPE):
+async def _send_winback(bot: Any, tg_id: str, expiry: int) -> bool:
     """
-    Check for users whose trial expired recently and encourage them to buy.
+    Send a one-off 3-day promo to a paying user whose subscription expired 3-7 days ago.
+    Each expiry event is handled once (notification key winback_{expiry}).
     """
+    # Retention is for paying customers only, not trial abusers.
+    if tg_id not in _EXPIRY_PAID_USERS:
+        return True
+    notification_key = f"winback_{expiry}"
+    if (tg_id, notification_key) in _EXPIRY_SENT:
+        return True
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-        row = cursor.fetchone()
+        # Generate unique promo code
+        suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
+        code = f"WB{suffix}"
 
-        if not row:
-            conn.close()
-            return
+        # Create promo in DB (3 days bonus)
+        conn_bot = sqlite3.connect(BOT_DB_PATH)
+        try:
+            conn_bot.execute("INSERT OR IGNORE INTO promo_codes (code, days, max_uses) VALUES (?, ?, ?)", (code, 3, 1))
+            conn_bot.commit()
+        finally:
+            conn_bot.close()
 
-        settings = json.loads(row[0])
-        clients = settings.get('clients', [])
+        lang = get_lang(tg_id)
+        msg_text = (
+            "👋 **We miss you!**\n\n"
+            "Your subscription expired recently. We'd love to see you back!\n"
+            f"🎁 Here is a special gift: **3 Days Free Access**\n\n"
+            f"👇 Activate code: `{code}`"
+        )
+        if lang == 'ru':
+            msg_text = (
+                "👋 **Мы скучаем!**\n\n"
+                "Ваша подписка недавно истекла. Возвращайтесь!\n"
+                f"🎁 Ваш подарок: **3 дня бесплатно**\n\n"
+                f"👇 Активируйте код: `{code}`"
+            )
 
-        current_time = time.time() * 1000
+        await bot.send_message(chat_id=tg_id, text=msg_text, parse_mode='Markdown')
 
-        conn_bot = sqlite3.connect(BOT_DB_PATH)
-        cursor_bot = conn_bot.cursor()
+        # Mark as sent for THIS expiry timestamp
+        _mark_expiry_notification(tg_id, notification_key)
+        logging.info(f"Sent Win-back to {tg_id} for expiry {expiry}")
+    except Forbidden as e:
+        logging.info(f"Skipping winback for {tg_id}: {e}")
+    except Exception as e:
+        logging.error(f"Failed to send winback to {tg_id}: {e}")
+        return False
+    return True
 
-        for client in clients:
-            expiry_time = client.get('expiryTime', 0)
-            tg_id = str(client.get('tgId', ''))
-
-            if expiry_time > 0 and tg_id and tg_id.isdigit():
-                # Check if expired
-                if expiry_time < current_time:
-                    # Check if expired RECENTLY (e.g., within last 24 hours)
-                    # We don't want to spam old users.
-                    # Expiry time is in ms.
-                    ms_since_expiry = current_time - expiry_time
-                    hours_since_expiry = ms_since_expiry / (1000 * 3600)
-
-                    if 0 < hours_since_expiry < 48: # Window of 48h after expiry
-                        # Check if Trial User
-                        cursor_bot.execute("SELECT trial_used FROM user_prefs WHERE tg_id=?", (tg_id,))
-                        pref = cursor_bot.fetchone()
-
-                        if pref and pref[0]: # Has used trial
-                            # Check if PAID user (don't annoy paid users who expired)
-                            cursor_bot.execute("SELECT 1 FROM transactions WHERE tg_id=?", (tg_id,))
-                            if not cursor_bot.fetchone():
-                                # Pure Trial user who expired recently.
-
-                                # Check if already notified
-                                cursor_bot.execute("SELECT date FROM notifications WHERE tg_id=? AND type='trial_expired_followup'", (tg_id,))
-                                if not cursor_bot.fetchone():
-                                    try:
-                                        user_lang = get_lang(tg_id)
-                                        await context.bot.send_message(
-                                            chat_id=tg_id,
-                                            text=t("trial_expired", user_lang),
-                                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t("btn_buy", user_lang), callback_data='shop')]]),
-                                            parse_mode='Markdown'
-                                        )
-                                        cursor_bot.execute("INSERT OR REPLACE INTO notifications (tg_id, type, date) VALUES (?, ?, ?)",
-                                                           (tg_id, 'trial_expired_followup', int(time.time())))
-                                        conn_bot.commit()
-                                        logging.info(f"Sent trial expired followup to {tg_id}")
-                                    except Exception as ex:
-                                        logging.warning(f"Failed to send trial followup to {tg_id}: {ex}")
 
-        conn_bot.close()
-        conn.close()
+async def expiry_scheduler_job(context: ContextTypes.DEFAULT_TYPE):
+    """Fire expiry reminders, trial follow-ups and win-backs whose thresholds are due."""
+    global _EXPIRY_SIGNATURE
+    now = time.time()
+    try:
+        signature = _expiry_source_signature(now)
+        if signature != _EXPIRY_SIGNATURE:
+            _rebuild_expiry_schedule(_load_expiry_clients(), now)
+            _EXPIRY_SIGNATURE = signature
     except Exception as e:
-        logging.error(f"Error in check_expired_trials: {e}")
+        logging.error(f"Error in expiry_scheduler_job: {e}")
+    while _EXPIRY_HEAP and _EXPIRY_HEAP[0][0] <= now:
+        event = heapq.heappop(_EXPIRY_HEAP)
+        _due, until, kind, tg_id, expiry_ms = event
+        if until <= now:
+            continue
+        retry_key = (tg_id, kind, expiry_ms)
+        try:
+            if kind == "trial_expired_followup":
+                delivered = await _send_trial_followup(context.bot, tg_id)
+            elif kind == "winback":
+                delivered = await _send_winback(context.bot, tg_id, expiry_ms)
+            else:
+                delivered = await _send_expiry_reminder(context.bot, tg_id, kind, expiry_ms, now)
+        except Exception as e:
+            logging.error(f"Error in expiry_scheduler_job for {tg_id} ({kind}): {e}")
+            delivered = False
+        if delivered:
+            _EXPIRY_RETRIES.pop(retry_key, None)
+            continue
+        attempt = _EXPIRY_RETRIES.get(retry_key, 0)
+        retry_at = now + min(_EXPIRY_RETRY_MAX_SEC, _EXPIRY_RETRY_BASE_SEC * 2 ** attempt)
+        if retry_at < until:
+            _EXPIRY_RETRIES[retry_key] = attempt + 1
+            heapq.heappush(_EXPIRY_HEAP, (retry_at, until, kind, tg_id, expiry_ms))
+        else:
+            _EXPIRY_RETRIES.pop(retry_key, None)
 
 async def watch_access_log(app):
     """
@@ -13411,49 +16860,51 @@ async def admin_delete_client_confirm(update: Update, context: ContextTypes.DEFA
     except IndexError:
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-    row = cursor.fetchone()
+    async with _XUI_SETTINGS_LOCK:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
+        row = cursor.fetchone()
 
-    if not row:
-        conn.close()
-        await query.edit_message_text("❌ Входящее соединение не найдено.")
-        return
+        if not row:
+            conn.close()
+            await query.edit_message_text("❌ Входящее соединение не найдено.")
+            return
 
-    settings = json.loads(row[0])
-    clients = settings.get('clients', [])
+        settings = json.loads(row[0])
+        clients = settings.get('clients', [])
 
-    # Find email for cleanup
-    email = None
-    for c in clients:
-        if c.get('id') == uid:
-            email = c.get('email')
-            break
+        # Find email for cleanup
+        email = None
+        for c in clients:
+            if c.get('id') == uid:
+                email = c.get('email')
+                break
 
-    # Filter out the client
-    initial_len = len(clients)
-    clients = [c for c in clients if c.get('id') != uid]
+        # Filter out the client
+        initial_len = len(clients)
+        clients = [c for c in clients if c.get('id') != uid]
 
-    if len(clients) == initial_len:
-        conn.close()
-        await query.edit_message_text("❌ Клиент не найден или уже удален.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К списку", callback_data='admin_users_0')]]))
-        return
+        if len(clients) == initial_len:
+            conn.close()
+            await query.edit_message_text("❌ Клиент не найден или уже удален.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К списку", callback_data='admin_users_0')]]))
+            return
 
-    # Save back
-    settings['clients'] = clients
-    new_settings = json.dumps(settings, indent=2)
-    cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (new_settings, INBOUND_ID))
+        # Save back
+        settings['clients'] = clients
+        new_settings = json.dumps(settings, indent=2)
+        cursor.execute("UPDATE inbounds SET settings=? WHERE id=?", (new_settings, INBOUND_ID))
 
-    # Clean up client_traffics if email found
-    if email:
-        try:
-             cursor.execute("DELETE FROM client_traffics WHERE email=?", (email,))
-        except sqlite3.Error:
-            pass
+        # Clean up client_traffics if email found
+        if email:
+            try:
+                 cursor.execute("DELETE FROM client_traffics WHERE email=?", (email,))
+            except sqlite3.Error:
+                pass
 
-    conn.commit()
-    conn.close()
+        conn.commit()
+        conn.close()
+    _ADMIN_STATS.invalidate()
 
     # Restart X-UI
     await _systemctl("restart", "x-ui")
@@ -13499,27 +16950,114 @@ async def admin_poll_new(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
-def generate_poll_message(poll_id, lang):
+# Live poll state: votes/counters are kept in memory (rebuilt from poll_votes on first use),
+# new votes are written back in batches by flush_poll_votes.
+_POLL_META: dict[int, tuple[str, list[str], int]] = {}
+_POLL_VOTES: dict[int, dict[str, int]] = {}
+_POLL_COUNTS: dict[int, dict[int, int]] = {}
+_POLL_PENDING: dict[tuple[int, str], int] = {}
+_POLL_RENDER_TASKS: dict[tuple[int, int], asyncio.Task[Any]] = {}
+_POLL_RENDER_LATEST: dict[tuple[int, int], tuple[int, str]] = {}
+_POLL_STATE_LOADED = False
+
+
+def _load_poll_tallies() -> None:
+    global _POLL_STATE_LOADED
+    _POLL_VOTES.clear()
+    _POLL_COUNTS.clear()
+    conn = sqlite3.connect(BOT_DB_PATH)
     try:
-        conn = sqlite3.connect(BOT_DB_PATH)
         cursor = conn.cursor()
+        cursor.execute("SELECT poll_id, tg_id, option_index FROM poll_votes")
+        for poll_id, voter, option_idx in cursor.fetchall():
+            _POLL_VOTES.setdefault(int(poll_id), {})[str(voter)] = int(option_idx)
+            counts = _POLL_COUNTS.setdefault(int(poll_id), {})
+            counts[int(option_idx)] = counts.get(int(option_idx), 0) + 1
+    finally:
+        conn.close()
+    for (poll_id, voter), option_idx in _POLL_PENDING.items():
+        _apply_poll_vote(poll_id, voter, option_idx)
+    _POLL_STATE_LOADED = True
 
-        # Get Poll
-        cursor.execute("SELECT question, options, active FROM polls WHERE id=?", (poll_id,))
-        row = cursor.fetchone()
 
-        if not row:
-            conn.close()
-            return None, None
+def _apply_poll_vote(poll_id: int, voter: str, option_idx: int) -> bool:
+    votes = _POLL_VOTES.setdefault(poll_id, {})
+    counts = _POLL_COUNTS.setdefault(poll_id, {})
+    previous = votes.get(voter)
+    if previous == option_idx:
+        return False
+    if previous is not None:
+        counts[previous] = counts.get(previous, 1) - 1
+    votes[voter] = option_idx
+    counts[option_idx] = counts.get(option_idx, 0) + 1
+    return True
+
+
+def _record_poll_vote(poll_id: int, voter: str, option_idx: int) -> bool:
+    if not _POLL_STATE_LOADED:
+        _load_poll_tallies()
+    changed = _apply_poll_vote(poll_id, voter, option_idx)
+    if changed:
+        _POLL_PENDING[(poll_id, voter)] = option_idx
+    return changed
 
-        question, options_json, active = row
-        options = json.loads(options_json)
 
-        # Get Votes
-        cursor.execute("SELECT option_index, COUNT(*) FROM poll_votes WHERE poll_id=? GROUP BY option_index", (poll_id,))
-        vote_counts = {row[0]: row[1] for row in cursor.fetchall()}
+def _drop_poll_voters(voters: Iterable[str]) -> None:
+    dropped = set(voters)
+    for key in [key for key in _POLL_PENDING if key[1] in dropped]:
+        _POLL_PENDING.pop(key, None)
+    for poll_id, votes in _POLL_VOTES.items():
+        counts = _POLL_COUNTS.setdefault(poll_id, {})
+        for voter in dropped & votes.keys():
+            option_idx = votes.pop(voter)
+            counts[option_idx] = counts.get(option_idx, 1) - 1
 
+
+async def flush_poll_votes(context: Optional[ContextTypes.DEFAULT_TYPE] = None) -> None:
+    if not _POLL_PENDING:
+        return
+    batch = list(_POLL_PENDING.items())
+    _POLL_PENDING.clear()
+    try:
+        conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+        conn.executemany(
+            "INSERT OR REPLACE INTO poll_votes (poll_id, tg_id, option_index) VALUES (?, ?, ?)",
+            [(poll_id, voter, option_idx) for (poll_id, voter), option_idx in batch],
+        )
+        conn.commit()
         conn.close()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to flush poll votes: {e}")
+        for key, option_idx in batch:
+            _POLL_PENDING.setdefault(key, option_idx)
+
+
+def _get_poll_meta(poll_id: int) -> Optional[tuple[str, list[str], int]]:
+    meta = _POLL_META.get(poll_id)
+    if meta is not None:
+        return meta
+    conn = sqlite3.connect(BOT_DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT question, options, active FROM polls WHERE id=?", (poll_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return None
+    meta = (str(row[0]), list(json.loads(row[1])), int(row[2] or 0))
+    _POLL_META[poll_id] = meta
+    return meta
+
+
+def generate_poll_message(poll_id, lang):
+    try:
+        meta = _get_poll_meta(int(poll_id))
+        if meta is None:
+            return None, None
+        question, options, active = meta
+
+        if not _POLL_STATE_LOADED:
+            _load_poll_tallies()
+        vote_counts = _POLL_COUNTS.get(int(poll_id), {})
 
         total_votes = sum(vote_counts.values())
 
@@ -13551,6 +17089,35 @@ def generate_poll_message(poll_id, lang):
         logging.error(f"Error generating poll message: {e}")
         return None, None
 
+
+def _schedule_poll_render(bot: Any, chat_id: int, message_id: int, poll_id: int, lang: str) -> None:
+    """Re-render a poll message once per debounce window, however many votes arrive for it."""
+    key = (chat_id, message_id)
+    _POLL_RENDER_LATEST[key] = (poll_id, lang)
+    if key in _POLL_RENDER_TASKS:
+        return
+
+    async def _render() -> None:
+        try:
+            await asyncio.sleep(POLL_RENDER_DEBOUNCE_SEC)
+            latest_poll_id, latest_lang = _POLL_RENDER_LATEST.pop(key, (poll_id, lang))
+            text, reply_markup = generate_poll_message(latest_poll_id, latest_lang)
+            if text:
+                await bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=text,
+                    reply_markup=reply_markup,
+                    parse_mode='Markdown',
+                )
+        except Exception:
+            pass  # Message not modified
+        finally:
+            _POLL_RENDER_TASKS.pop(key, None)
+
+    _POLL_RENDER_TASKS[key] = asyncio.create_task(_render())
+
+
 async def handle_poll_vote(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     tg_id = str(query.from_user.id)
@@ -13561,23 +17128,14 @@ async def handle_poll_vote(update: Update, context: ContextTypes.DEFAULT_TYPE):
     poll_id = int(parts[2])
     option_idx = int(parts[3])
 
-    conn = sqlite3.connect(BOT_DB_PATH)
-    cursor = conn.cursor()
-
-    # Save vote (upsert)
-    cursor.execute("INSERT OR REPLACE INTO poll_votes (poll_id, tg_id, option_index) VALUES (?, ?, ?)", (poll_id, tg_id, option_idx))
-    conn.commit()
-    conn.close()
-
-    text, reply_markup = generate_poll_message(poll_id, lang)
-
-    try:
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-    except Exception:
-        pass # Message not modified
+    changed = _record_poll_vote(poll_id, tg_id, option_idx)
 
     await query.answer(t("poll_vote_registered", lang))
 
+    message = query.message
+    if changed and message is not None:
+        _schedule_poll_render(context.bot, message.chat_id, message.message_id, poll_id, lang)
+
 async def handle_poll_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     tg_id = str(query.from_user.id)
@@ -13848,126 +17406,293 @@ async def detect_suspicious_activity(context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logging.error(f"Error in detect_suspicious_activity: {e}")
 
+CallbackRouteHandler: TypeAlias = Callable[[Any, Any], Awaitable[Any]]
+
+
+class CallbackRoute(TypedDict):
+    key: str
+    exact: bool
+    handler: CallbackRouteHandler
+    order: int
+    rest: Optional[re.Pattern[str]]
+
+
+class _CallbackMatch(TypedDict):
+    route: CallbackRoute
+    args: list[str]
+
+
+def _callback_route_regex(route: CallbackRoute) -> str:
+    if route["exact"]:
+        return re.escape(route["key"]) + "$"
+    if route["rest"] is not None:
+        return re.escape(route["key"]) + f"(?:{route['rest'].pattern})$"
+    return re.escape(route["key"])
+
+
+class _CallbackTrie:
+    """
+    Routes callback_data to a handler by walking a character trie once: an exact route for the whole
+    string wins, otherwise the longest registered prefix. The text after a prefix is split on "_" into args;
+    a prefix registered with ``rest`` only matches when that text fully matches the pattern.
+    """
+
+    _EXACT = "\0exact"
+    _PREFIX = "\0prefix"
+
+    def __init__(self) -> None:
+        self.routes: list[CallbackRoute] = []
+        self._root: dict[str, Any] = {}
+
+    def exact(self, key: str, handler: CallbackRouteHandler) -> None:
+        self._add(key, handler, True)
+
+    def prefix(self, key: str, handler: CallbackRouteHandler, rest: Optional[str] = None) -> None:
+        self._add(key, handler, False, re.compile(rest) if rest is not None else None)
+
+    def _add(self, key: str, handler: CallbackRouteHandler, exact: bool, rest: Optional[re.Pattern[str]] = None) -> None:
+        route: CallbackRoute = {"key": key, "exact": exact, "handler": handler, "order": len(self.routes), "rest": rest}
+        self.routes.append(route)
+        node = self._root
+        for ch in key:
+            node = node.setdefault(ch, {})
+        # First registration wins for a duplicate key, as with the ordered handler list; ambiguities() reports it.
+        node.setdefault(self._EXACT if exact else self._PREFIX, route)
+
+    def match(self, data: str) -> Optional[_CallbackMatch]:
+        node = self._root
+        best: Optional[CallbackRoute] = node.get(self._PREFIX)
+        for ch in data:
+            child: Optional[dict[str, Any]] = node.get(ch)
+            if child is None:
+                break
+            node = child
+            best = node.get(self._PREFIX, best)
+        else:
+            exact_route = node.get(self._EXACT)
+            if exact_route is not None:
+                return {"route": exact_route, "args": []}
+        if best is None:
+            return None
+        rest = data[len(best["key"]):]
+        if best["rest"] is not None and not best["rest"].fullmatch(rest):
+            return None
+        return {"route": best, "args": rest.split("_") if rest else []}
+
+    def ambiguities(self) -> list[str]:
+        """
+        Routes the trie would resolve differently from the old first-match handler list: duplicate keys, and
+        a prefix registered before a longer route it covers (the longer one used to be unreachable).
+        """
+        problems: list[str] = []
+        seen: dict[tuple[str, bool], CallbackRoute] = {}
+        for route in self.routes:
+            ident = (route["key"], route["exact"])
+            if ident in seen:
+                problems.append(f"duplicate {'exact' if route['exact'] else 'prefix'} route {route['key']!r}")
+            seen.setdefault(ident, route)
+        prefixes = [route for route in self.routes if not route["exact"]]
+        for shorter in prefixes:
+            for other in self.routes:
+                if other is shorter or other["order"] < shorter["order"]:
+                    continue
+                if other["key"] != shorter["key"] and other["key"].startswith(shorter["key"]):
+                    problems.append(f"prefix {shorter['key']!r} shadows later route {other['key']!r}")
+        return problems
+
+    def pattern(self) -> str:
+        """Equivalent regex, for logs and introspection only; dispatch never uses it."""
+        return "^(?:" + "|".join(_callback_route_regex(r) for r in self.routes) + ")"
+
+
+class _CallbackTrieHandler(BaseHandler[TelegramUpdate, Any, Any]):
+    """Single CallbackQuery handler that dispatches through a _CallbackTrie; the suffix args land in context.args."""
+
+    def __init__(self, trie: _CallbackTrie) -> None:
+        super().__init__(self._unrouted)
+        self.trie = trie
+        self.pattern = trie.pattern()
+
+    @staticmethod
+    async def _unrouted(update: Any, context: Any) -> None:
+        return None
+
+    def check_update(self, update: object) -> Optional[_CallbackMatch]:
+        if isinstance(update, TelegramUpdate) and update.callback_query is not None:
+            data = update.callback_query.data
+            if isinstance(data, str):
+                return self.trie.match(data)
+        return None
+
+    async def handle_update(self, update: Any, application: Any, check_result: Any, context: Any) -> Any:
+        context.args = check_result["args"]
+        return await check_result["route"]["handler"](update, context)
+
+
+def _benchmark_callback_dispatch(
+    trie: _CallbackTrie,
+    samples: list[str],
+    rounds: int = 200,
+) -> dict[str, float]:
+    """Average ns per dispatch: trie lookup vs. scanning the equivalent ordered regex list."""
+    compiled = [re.compile("^" + _callback_route_regex(r)) for r in trie.routes]
+    started = time.perf_counter_ns()
+    for _ in range(rounds):
+        for data in samples:
+            trie.match(data)
+    trie_ns = (time.perf_counter_ns() - started) / max(1, rounds * len(samples))
+    started = time.perf_counter_ns()
+    for _ in range(rounds):
+        for data in samples:
+            for regex in compiled:
+                if regex.match(data):
+                    break
+    regex_ns = (time.perf_counter_ns() - started) / max(1, rounds * len(samples))
+    return {"trie_ns": trie_ns, "regex_ns": regex_ns, "routes": float(len(trie.routes))}
+
+
 def register_handlers(application):
+    callbacks = _CallbackTrie()
     application.add_handler(CommandHandler('start', start))
-    application.add_handler(CallbackQueryHandler(set_language, pattern='^set_lang_'))
-    application.add_handler(CallbackQueryHandler(change_lang, pattern='^change_lang$'))
-    application.add_handler(CallbackQueryHandler(shop, pattern='^shop$'))
-    application.add_handler(CallbackQueryHandler(mobile_menu, pattern='^mobile_menu$'))
-    application.add_handler(CallbackQueryHandler(mobile_shop, pattern='^mobile_shop$'))
-    application.add_handler(CallbackQueryHandler(how_to_buy_stars, pattern='^how_to_buy_stars$'))
-    application.add_handler(CallbackQueryHandler(back_to_main, pattern='^back_to_main$'))
-    application.add_handler(CallbackQueryHandler(initiate_payment, pattern='^buy_'))
-    application.add_handler(CallbackQueryHandler(get_config, pattern='^get_config$'))
-    application.add_handler(CallbackQueryHandler(mobile_config, pattern='^mobile_config$'))
-    application.add_handler(CallbackQueryHandler(mobile_stats, pattern='^mobile_stats$'))
-    application.add_handler(CallbackQueryHandler(show_mobile_qrcode, pattern='^mobile_show_qrcode$'))
-    application.add_handler(CallbackQueryHandler(ru_bridge_config, pattern='^ru_bridge_config$'))
-    application.add_handler(CallbackQueryHandler(user_locations_menu, pattern='^user_locations$'))
-    application.add_handler(CallbackQueryHandler(user_location_select, pattern='^user_location_'))
-    application.add_handler(CallbackQueryHandler(stats, pattern='^stats$'))
-    application.add_handler(CallbackQueryHandler(try_trial, pattern='^try_trial$'))
-    application.add_handler(CallbackQueryHandler(try_trial_3d, pattern='^try_trial_3d$'))
-    application.add_handler(CallbackQueryHandler(try_trial_mobile, pattern='^try_trial_mobile$'))
-    application.add_handler(CallbackQueryHandler(enter_promo, pattern='^enter_promo$'))
-    application.add_handler(CallbackQueryHandler(referral, pattern='^referral$'))
-    application.add_handler(CallbackQueryHandler(my_referrals, pattern='^my_referrals$'))
-    application.add_handler(CallbackQueryHandler(show_qrcode, pattern='^show_qrcode$'))
-    application.add_handler(CallbackQueryHandler(instructions, pattern='^instructions$'))
-    application.add_handler(CallbackQueryHandler(show_instruction, pattern='^instr_'))
+    callbacks.prefix('set_lang_', set_language)
+    callbacks.exact('change_lang', change_lang)
+    callbacks.exact('shop', shop)
+    callbacks.exact('mobile_menu', mobile_menu)
+    callbacks.exact('mobile_shop', mobile_shop)
+    callbacks.exact('how_to_buy_stars', how_to_buy_stars)
+    callbacks.exact('back_to_main', back_to_main)
+    callbacks.prefix('buy_', initiate_payment)
+    callbacks.exact('get_config', get_config)
+    callbacks.exact('mobile_config', mobile_config)
+    callbacks.exact('mobile_stats', mobile_stats)
+    callbacks.exact('mobile_show_qrcode', show_mobile_qrcode)
+    callbacks.exact('ru_bridge_config', ru_bridge_config)
+    callbacks.exact('user_locations', user_locations_menu)
+    callbacks.prefix('user_location_', user_location_select)
+    callbacks.exact('stats', stats)
+    callbacks.exact('try_trial', try_trial)
+    callbacks.exact('try_trial_3d', try_trial_3d)
+    callbacks.exact('try_trial_mobile', try_trial_mobile)
+    callbacks.exact('enter_promo', enter_promo)
+    callbacks.exact('referral', referral)
+    callbacks.exact('my_referrals', my_referrals)
+    callbacks.exact('show_qrcode', show_qrcode)
+    callbacks.exact('instructions', instructions)
+    callbacks.prefix('instr_', show_instruction)
 
     application.add_handler(CommandHandler('admin', admin_panel))
     application.add_handler(CommandHandler('health', admin_health))
-    application.add_handler(CallbackQueryHandler(admin_panel, pattern='^admin_panel$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_panels, pattern='^admin_remote_panels$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_panels_add, pattern='^admin_remote_panels_add$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_panels_list, pattern='^admin_remote_panels_list$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_panels_check, pattern='^admin_remote_panels_check$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_panels_delete, pattern='^admin_remote_panels_del_'))
-    application.add_handler(CallbackQueryHandler(admin_remote_locations, pattern='^admin_remote_locations$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_locations_add, pattern='^admin_remote_locations_add$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_locations_list, pattern='^admin_remote_locations_list$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_locations_check, pattern='^admin_remote_locations_check$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_locations_delete, pattern='^admin_remote_locations_del_'))
-    application.add_handler(CallbackQueryHandler(admin_remote_nodes, pattern='^admin_remote_nodes$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_nodes_add, pattern='^admin_remote_nodes_add$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_nodes_list, pattern='^admin_remote_nodes_list$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_nodes_check, pattern='^admin_remote_nodes_check$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_nodes_sync_menu, pattern='^admin_remote_nodes_sync_menu$'))
-    application.add_handler(CallbackQueryHandler(admin_remote_nodes_sync_action, pattern='^admin_remote_nodes_sync_'))
-    application.add_handler(CallbackQueryHandler(admin_remote_nodes_delete, pattern='^admin_remote_nodes_del_'))
-    application.add_handler(CallbackQueryHandler(admin_health, pattern='^admin_health$'))
-    application.add_handler(CallbackQueryHandler(admin_stats, pattern='^admin_stats$'))
-    application.add_handler(CallbackQueryHandler(admin_cleanup_db, pattern='^admin_cleanup_db$'))
-    application.add_handler(CallbackQueryHandler(admin_db_audit, pattern='^admin_db_audit$'))
-    application.add_handler(CallbackQueryHandler(admin_db_sync_confirm, pattern='^admin_db_sync_confirm$'))
-    application.add_handler(CallbackQueryHandler(admin_db_sync_all, pattern='^admin_db_sync_all$'))
-    application.add_handler(CallbackQueryHandler(admin_sync_nicknames, pattern='^admin_sync_nicks$'))
-    application.add_handler(CallbackQueryHandler(admin_sync_mobile_nicknames, pattern='^admin_sync_mobile_nicks$'))
-    application.add_handler(CallbackQueryHandler(admin_server, pattern='^admin_server$'))
-    application.add_handler(CallbackQueryHandler(admin_server_mobile, pattern='^admin_server_mobile$'))
-    application.add_handler(CallbackQueryHandler(admin_server_live, pattern='^admin_server_live$'))
-    application.add_handler(CallbackQueryHandler(admin_server_nodes, pattern='^admin_server_nodes$'))
-    application.add_handler(CallbackQueryHandler(admin_server_node_detail, pattern='^admin_server_node_'))
-    application.add_handler(CallbackQueryHandler(admin_update_xui_xray, pattern='^admin_update_xui_xray$'))
-    application.add_handler(CallbackQueryHandler(admin_update_xui_xray_mobile, pattern='^admin_update_xui_xray_mobile$'))
-    application.add_handler(CallbackQueryHandler(admin_rebind_user, pattern='^admin_rebind_'))
-    application.add_handler(CallbackQueryHandler(admin_users_list, pattern='^admin_users_'))
-    application.add_handler(CallbackQueryHandler(admin_user_detail, pattern='^admin_u_'))
-    application.add_handler(CallbackQueryHandler(admin_reset_trial, pattern='^admin_reset_trial_'))
-    application.add_handler(CallbackQueryHandler(admin_prices, pattern='^admin_prices$'))
-    application.add_handler(CallbackQueryHandler(admin_edit_price, pattern='^admin_edit_price_'))
-    application.add_handler(CallbackQueryHandler(admin_new_promo, pattern='^admin_new_promo$'))
-    application.add_handler(CallbackQueryHandler(admin_promos_menu, pattern='^admin_promos_menu$'))
-    application.add_handler(CallbackQueryHandler(admin_promo_list, pattern='^admin_promo_list$'))
-    application.add_handler(CallbackQueryHandler(admin_promo_uses, pattern='^admin_promo_uses_'))
-    application.add_handler(CallbackQueryHandler(admin_promo_user_detail, pattern='^admin_promo_u_'))
-    application.add_handler(CallbackQueryHandler(admin_revoke_promo_code_menu, pattern='^admin_revoke_code_menu_'))
-    application.add_handler(CallbackQueryHandler(admin_revoke_promo_code_action, pattern='^admin_revoke_code_act_'))
-    application.add_handler(CallbackQueryHandler(admin_revoke_user_promo_menu, pattern='^admin_revoke_user_menu_'))
-    application.add_handler(CallbackQueryHandler(admin_revoke_user_promo_confirm, pattern='^admin_revoke_user_conf_'))
-    application.add_handler(CallbackQueryHandler(admin_revoke_user_promo_action, pattern='^admin_revoke_user_act_'))
-    application.add_handler(CallbackQueryHandler(admin_broadcast, pattern='^admin_broadcast$'))
-    application.add_handler(CallbackQueryHandler(admin_broadcast_target, pattern='^admin_broadcast_(all|en|ru|individual|toggle|page|confirm).*'))
-    application.add_handler(CallbackQueryHandler(admin_poll_menu, pattern='^admin_poll_menu$'))
-    application.add_handler(CallbackQueryHandler(admin_poll_new, pattern='^admin_poll_new$'))
-    application.add_handler(CallbackQueryHandler(admin_poll_send, pattern='^admin_poll_send$'))
-    application.add_handler(CallbackQueryHandler(handle_poll_vote, pattern='^poll_vote_'))
-    application.add_handler(CallbackQueryHandler(handle_poll_refresh, pattern='^poll_refresh_'))
-    application.add_handler(CallbackQueryHandler(admin_sales_log, pattern='^admin_sales_log$'))
-    application.add_handler(CallbackQueryHandler(admin_backup_menu, pattern='^admin_backup_menu$'))
-    application.add_handler(CallbackQueryHandler(admin_create_backup, pattern='^admin_create_backup$'))
-    application.add_handler(CallbackQueryHandler(admin_restore_menu, pattern=r'^admin_restore_menu(_\d+)?$'))
-    application.add_handler(CallbackQueryHandler(admin_restore_select, pattern='^admin_restore_sel_'))
-    application.add_handler(CallbackQueryHandler(admin_restore_confirm, pattern='^admin_restore_do_'))
-    application.add_handler(CallbackQueryHandler(admin_restart_xui, pattern='^admin_restart_xui$'))
-    application.add_handler(CallbackQueryHandler(admin_restart_bot, pattern='^admin_restart_bot$'))
-    application.add_handler(CallbackQueryHandler(admin_backup_delete_do, pattern='^admin_backup_del_do_'))
-    application.add_handler(CallbackQueryHandler(admin_backup_delete_confirm, pattern='^admin_backup_del_'))
-    application.add_handler(CallbackQueryHandler(admin_restore_uploaded_as_xui, pattern='^admin_upload_restore_xui$'))
-    application.add_handler(CallbackQueryHandler(admin_restore_uploaded_as_bot, pattern='^admin_upload_restore_bot$'))
-    application.add_handler(CallbackQueryHandler(admin_restore_uploaded_do_xui, pattern='^admin_upload_restore_do_xui$'))
-    application.add_handler(CallbackQueryHandler(admin_restore_uploaded_do_bot, pattern='^admin_upload_restore_do_bot$'))
-    application.add_handler(CallbackQueryHandler(admin_view_logs, pattern='^admin_logs$'))
-    application.add_handler(CallbackQueryHandler(admin_clear_logs, pattern='^admin_clear_logs$'))
-
-    application.add_handler(CallbackQueryHandler(admin_search_user, pattern='^admin_search_user$'))
-    application.add_handler(CallbackQueryHandler(admin_db_detail_callback, pattern='^admin_db_detail_'))
-    application.add_handler(CallbackQueryHandler(admin_reset_trial_db, pattern='^admin_rt_db_'))
-    application.add_handler(CallbackQueryHandler(admin_delete_user_db, pattern='^admin_del_db_'))
-    application.add_handler(CallbackQueryHandler(admin_delete_client_ask, pattern='^admin_del_client_ask_'))
-    application.add_handler(CallbackQueryHandler(admin_delete_client_confirm, pattern='^admin_del_client_confirm_'))
-    application.add_handler(CallbackQueryHandler(admin_edit_limit_ip, pattern='^admin_edit_limit_ip_'))
-    application.add_handler(CallbackQueryHandler(admin_ip_history, pattern='^admin_ip_history_'))
-    application.add_handler(CallbackQueryHandler(admin_suspicious_users, pattern='^admin_suspicious.*'))
-    application.add_handler(CallbackQueryHandler(admin_leaderboard, pattern='^admin_leaderboard'))
-
-    application.add_handler(CallbackQueryHandler(admin_flash_menu, pattern='^admin_flash_menu$'))
-    application.add_handler(CallbackQueryHandler(admin_flash_select, pattern='^admin_flash_sel_'))
-    application.add_handler(CallbackQueryHandler(admin_flash_delete_all, pattern='^admin_flash_delete_all$'))
-    application.add_handler(CallbackQueryHandler(admin_flash_errors, pattern='^admin_flash_errors$'))
-
-    application.add_handler(CallbackQueryHandler(support_menu, pattern='^support_menu$'))
+    callbacks.exact('admin_panel', admin_panel)
+    callbacks.exact('admin_remote_panels', admin_remote_panels)
+    callbacks.exact('admin_remote_panels_add', admin_remote_panels_add)
+    callbacks.exact('admin_remote_panels_list', admin_remote_panels_list)
+    callbacks.exact('admin_remote_panels_check', admin_remote_panels_check)
+    callbacks.prefix('admin_remote_panels_del_', admin_remote_panels_delete)
+    callbacks.exact('admin_remote_locations', admin_remote_locations)
+    callbacks.exact('admin_remote_locations_add', admin_remote_locations_add)
+    callbacks.exact('admin_remote_locations_list', admin_remote_locations_list)
+    callbacks.exact('admin_remote_locations_check', admin_remote_locations_check)
+    callbacks.prefix('admin_remote_locations_del_', admin_remote_locations_delete)
+    callbacks.exact('admin_remote_nodes', admin_remote_nodes)
+    callbacks.exact('admin_remote_nodes_add', admin_remote_nodes_add)
+    callbacks.exact('admin_remote_nodes_list', admin_remote_nodes_list)
+    callbacks.exact('admin_remote_nodes_check', admin_remote_nodes_check)
+    callbacks.exact('admin_remote_nodes_sync_menu', admin_remote_nodes_sync_menu)
+    callbacks.prefix('admin_remote_nodes_sync_', admin_remote_nodes_sync_action)
+    callbacks.prefix('admin_remote_nodes_del_', admin_remote_nodes_delete)
+    callbacks.exact('admin_health', admin_health)
+    callbacks.exact('admin_stats', admin_stats)
+    callbacks.exact('admin_cleanup_db', admin_cleanup_db)
+    callbacks.exact('admin_db_audit', admin_db_audit)
+    callbacks.exact('admin_db_sync_confirm', admin_db_sync_confirm)
+    callbacks.exact('admin_db_sync_all', admin_db_sync_all)
+    callbacks.exact('admin_sync_nicks', admin_sync_nicknames)
+    callbacks.exact('admin_sync_mobile_nicks', admin_sync_mobile_nicknames)
+    callbacks.exact('admin_server', admin_server)
+    callbacks.exact('admin_server_mobile', admin_server_mobile)
+    callbacks.exact('admin_server_live', admin_server_live)
+    callbacks.exact('admin_server_nodes', admin_server_nodes)
+    callbacks.prefix('admin_server_node_', admin_server_node_detail)
+    callbacks.exact('admin_update_xui_xray', admin_update_xui_xray)
+    callbacks.exact('admin_update_xui_xray_mobile', admin_update_xui_xray_mobile)
+    callbacks.exact('admin_xray_rollout', admin_xray_rollout)
+    callbacks.exact('admin_xray_rollback', admin_xray_rollback)
+    callbacks.prefix('admin_rebind_', admin_rebind_user)
+    callbacks.prefix('admin_users_', admin_users_list)
+    callbacks.prefix('admin_u_', admin_user_detail)
+    callbacks.prefix('admin_reset_trial_', admin_reset_trial)
+    callbacks.exact('admin_prices', admin_prices)
+    callbacks.prefix('admin_edit_price_', admin_edit_price)
+    callbacks.exact('admin_new_promo', admin_new_promo)
+    callbacks.exact('admin_promos_menu', admin_promos_menu)
+    callbacks.exact('admin_promo_list', admin_promo_list)
+    callbacks.prefix('admin_promo_uses_', admin_promo_uses)
+    callbacks.prefix('admin_promo_u_', admin_promo_user_detail)
+    callbacks.prefix('admin_revoke_code_menu_', admin_revoke_promo_code_menu)
+    callbacks.prefix('admin_revoke_code_act_', admin_revoke_promo_code_action)
+    callbacks.prefix('admin_revoke_user_menu_', admin_revoke_user_promo_menu)
+    callbacks.prefix('admin_revoke_user_conf_', admin_revoke_user_promo_confirm)
+    callbacks.prefix('admin_revoke_user_act_', admin_revoke_user_promo_action)
+    callbacks.exact('admin_broadcast', admin_broadcast)
+    callbacks.prefix('admin_broadcast_all', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_en', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_ru', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_active', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_expired', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_trial', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_paid', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_nopaid', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_mobile', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_individual', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_toggle', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_page', admin_broadcast_target)
+    callbacks.prefix('admin_broadcast_confirm', admin_broadcast_target)
+    callbacks.exact('admin_poll_menu', admin_poll_menu)
+    callbacks.exact('admin_poll_new', admin_poll_new)
+    callbacks.exact('admin_poll_send', admin_poll_send)
+    callbacks.prefix('poll_vote_', handle_poll_vote)
+    callbacks.prefix('poll_refresh_', handle_poll_refresh)
+    callbacks.exact('admin_sales_log', admin_sales_log)
+    callbacks.prefix('admin_sales_log_', admin_sales_log)
+    callbacks.exact('admin_backup_menu', admin_backup_menu)
+    callbacks.exact('admin_create_backup', admin_create_backup)
+    callbacks.exact('admin_restore_menu', admin_restore_menu)
+    callbacks.prefix('admin_restore_menu_', admin_restore_menu, rest=r'\d+')
+    callbacks.prefix('admin_restore_sel_', admin_restore_select)
+    callbacks.prefix('admin_restore_do_', admin_restore_confirm)
+    callbacks.exact('admin_restart_xui', admin_restart_xui)
+    callbacks.exact('admin_restart_bot', admin_restart_bot)
+    callbacks.prefix('admin_backup_del_do_', admin_backup_delete_do)
+    callbacks.prefix('admin_backup_del_', admin_backup_delete_confirm)
+    callbacks.exact('admin_upload_restore_xui', admin_restore_uploaded_as_xui)
+    callbacks.exact('admin_upload_restore_bot', admin_restore_uploaded_as_bot)
+    callbacks.exact('admin_upload_restore_do_xui', admin_restore_uploaded_do_xui)
+    callbacks.exact('admin_upload_restore_do_bot', admin_restore_uploaded_do_bot)
+    callbacks.exact('admin_logs', admin_view_logs)
+    callbacks.exact('admin_clear_logs', admin_clear_logs)
+
+    callbacks.exact('admin_search_user', admin_search_user)
+    callbacks.prefix('admin_db_detail_', admin_db_detail_callback)
+    callbacks.prefix('admin_rt_db_', admin_reset_trial_db)
+    callbacks.prefix('admin_del_db_', admin_delete_user_db)
+    callbacks.prefix('admin_del_client_ask_', admin_delete_client_ask)
+    callbacks.prefix('admin_del_client_confirm_', admin_delete_client_confirm)
+    callbacks.prefix('admin_edit_limit_ip_', admin_edit_limit_ip)
+    callbacks.prefix('admin_ip_history_', admin_ip_history)
+    callbacks.prefix('admin_suspicious', admin_suspicious_users)
+    callbacks.prefix('admin_leaderboard', admin_leaderboard)
+
+    callbacks.exact('admin_flash_menu', admin_flash_menu)
+    callbacks.prefix('admin_flash_sel_', admin_flash_select)
+    callbacks.exact('admin_flash_delete_all', admin_flash_delete_all)
+    callbacks.exact('admin_flash_errors', admin_flash_errors)
+
+    callbacks.exact('support_menu', support_menu)
+
+    ambiguous = callbacks.ambiguities()
+    if ambiguous:
+        raise RuntimeError("Ambiguous callback routes: " + "; ".join(ambiguous))
+    application.add_handler(_CallbackTrieHandler(callbacks))
 
     application.add_handler(MessageHandler(~filters.COMMAND & ~filters.SUCCESSFUL_PAYMENT, handle_message))
 
@@ -14039,46 +17764,174 @@ def _record_admin_delivery_error(error: Exception, text: str) -> None:
         pass
 
 
-async def _send_admin_message(context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
-    if not ADMIN_ID:
-        return
+# Admin notifications go through a durable outbox: callers only insert a row (identical pending texts are
+# coalesced into one with a repeat counter) and a per-loop worker delivers them with exponential backoff.
+_ADMIN_OUTBOX_BATCH = 20
+_ADMIN_OUTBOX_IDLE_SEC = 30.0
+_ADMIN_OUTBOX_BACKOFF_BASE_SEC = 5.0
+_ADMIN_OUTBOX_WORKERS: dict[asyncio.AbstractEventLoop, tuple[asyncio.Task[Any], asyncio.Event]] = {}
 
-    application = getattr(context, "application", None)
-    support_bot = None
-    if application is not None:
-        bot_data = getattr(application, "bot_data", None)
-        if isinstance(bot_data, dict):
-            support_bot = bot_data.get("support_bot")
 
-    async def _try_send(bot) -> tuple[bool, Exception | None]:
+def _enqueue_admin_message(text: str) -> None:
+    now = time.time()
+    dedupe_key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        conn.execute(
+            "INSERT INTO admin_outbox (dedupe_key, text, created_at, next_attempt_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(dedupe_key) DO UPDATE SET repeat_count=repeat_count+1, last_seen_at=excluded.created_at",
+            (dedupe_key, text, now, now),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _admin_outbox_due(now: float) -> tuple[list[tuple[int, str, int, int]], Optional[float]]:
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, text, repeat_count, attempts FROM admin_outbox WHERE next_attempt_at<=? ORDER BY id LIMIT ?",
+            (now, _ADMIN_OUTBOX_BATCH),
+        )
+        rows = [(int(r[0]), str(r[1]), int(r[2] or 1), int(r[3] or 0)) for r in cursor.fetchall()]
+        cursor.execute("SELECT MIN(next_attempt_at) FROM admin_outbox WHERE next_attempt_at>?", (now,))
+        next_row = cursor.fetchone()
+        return rows, (float(next_row[0]) if next_row and next_row[0] is not None else None)
+    finally:
+        conn.close()
+
+
+def _admin_outbox_finish(row_id: int, error: Optional[Exception], attempts: int, delay: float, repeat_count: int) -> bool:
+    """Settle a delivery attempt; returns True when alerts merged in meanwhile were left due right away."""
+    requeued = False
+    conn = sqlite3.connect(BOT_DB_PATH, timeout=10)
+    try:
+        if error is None or attempts >= ADMIN_OUTBOX_MAX_ATTEMPTS:
+            # Alerts coalesced into the row while it was being sent are not covered by this send:
+            # keep them pending as a fresh row instead of deleting them with it.
+            cursor = conn.execute("DELETE FROM admin_outbox WHERE id=? AND repeat_count=?", (row_id, repeat_count))
+            if cursor.rowcount == 0:
+                conn.execute(
+                    "UPDATE admin_outbox SET repeat_count=repeat_count-?, attempts=0, next_attempt_at=?, last_error=NULL WHERE id=?",
+                    (repeat_count, time.time(), row_id),
+                )
+                requeued = True
+        else:
+            conn.execute(
+                "UPDATE admin_outbox SET attempts=?, next_attempt_at=?, last_error=? WHERE id=?",
+                (attempts, time.time() + delay, str(error)[:500], row_id),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    return requeued
+
+
+async def _deliver_admin_message(bots: list[Any], text: str) -> Optional[Exception]:
+    err: Optional[Exception] = None
+    for bot in bots:
         if not bot:
-            return False, None
+            continue
         try:
             await bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode='Markdown')
-            return True, None
+            return None
         except BadRequest:
             try:
                 await bot.send_message(chat_id=ADMIN_ID, text=text)
-                return True, None
+                return None
             except Exception as e:
-                return False, e
+                err = e
+        except Exception as e:
+            err = e
+    return err or RuntimeError("admin notify failed: no bot available")
+
+
+async def _admin_outbox_worker(bots: Callable[[], list[Any]], wake: asyncio.Event) -> None:
+    while True:
+        try:
+            now = time.time()
+            rows, next_due = await asyncio.to_thread(_admin_outbox_due, now)
+            for row_id, text, repeat_count, attempts in rows:
+                body = f"{text}\n\n(×{repeat_count})" if repeat_count > 1 else text
+                err = await _deliver_admin_message(bots(), body)
+                attempts += 1
+                if isinstance(err, RetryAfter):
+                    delay = _retry_after_seconds(err)
+                else:
+                    delay = min(ADMIN_OUTBOX_BACKOFF_MAX_SEC, _ADMIN_OUTBOX_BACKOFF_BASE_SEC * (2 ** (attempts - 1)))
+                    delay *= random.uniform(0.8, 1.2)
+                if err is not None and attempts >= ADMIN_OUTBOX_MAX_ATTEMPTS:
+                    logging.error(f"Failed to send admin message: {err}")
+                    log_action(f"ERROR: Failed to send admin message: {err}")
+                    _record_admin_delivery_error(err, text)
+                elif err is not None:
+                    logging.warning(f"Admin message delivery failed (attempt {attempts}), retrying in {delay:.0f}s: {err}")
+                if await asyncio.to_thread(_admin_outbox_finish, row_id, err, attempts, delay, repeat_count):
+                    next_due = time.time()
+                if isinstance(err, RetryAfter):
+                    break
+            if len(rows) >= _ADMIN_OUTBOX_BATCH:
+                continue
+            timeout = _ADMIN_OUTBOX_IDLE_SEC if next_due is None else max(0.05, min(_ADMIN_OUTBOX_IDLE_SEC, next_due - time.time()))
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            return False, e
+            logging.error(f"Admin outbox worker error: {e}")
+            await asyncio.sleep(_ADMIN_OUTBOX_BACKOFF_BASE_SEC)
+
+
+def _ensure_admin_outbox_worker(bots: Callable[[], list[Any]]) -> asyncio.Event:
+    loop = asyncio.get_running_loop()
+    entry = _ADMIN_OUTBOX_WORKERS.get(loop)
+    if entry is not None and not entry[0].done():
+        return entry[1]
+    for stale in [key for key in _ADMIN_OUTBOX_WORKERS if key.is_closed()]:
+        _ADMIN_OUTBOX_WORKERS.pop(stale, None)
+    wake = asyncio.Event()
+    task = asyncio.create_task(_admin_outbox_worker(bots, wake))
+    _ADMIN_OUTBOX_WORKERS[loop] = (task, wake)
+    return wake
+
 
-    ok, err = await _try_send(support_bot)
-    if ok:
-        return
+def _admin_outbox_bots(application: Any, fallback_bot: Any = None) -> Callable[[], list[Any]]:
+    def _bots() -> list[Any]:
+        support_bot = None
+        if application is not None:
+            bot_data = getattr(application, "bot_data", None)
+            if isinstance(bot_data, dict):
+                support_bot = bot_data.get("support_bot")
+        main_bot = getattr(application, "bot", None) if application is not None else None
+        return [support_bot, main_bot or fallback_bot]
 
-    ok, err = await _try_send(context.bot)
-    if ok:
-        return
+    return _bots
+
+
+async def _send_admin_message(context: ContextTypes.DEFAULT_TYPE, text: str) -> bool:
+    """Queue a Markdown message for the admin and return whether it was queued.
+
+    Delivery (support bot first, then main bot) happens in the outbox worker.
+    """
+    if not ADMIN_ID:
+        return False
 
-    if err is None:
-        err = RuntimeError("admin notify failed: no bot available")
+    try:
+        _enqueue_admin_message(text)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to queue admin message: {e}")
+        _record_admin_delivery_error(e, text)
+        return False
 
-    logging.error(f"Failed to send admin message: {err}")
-    log_action(f"ERROR: Failed to send admin message: {err}")
-    _record_admin_delivery_error(err, text)
+    # A handler's context carries the same bot_data and bot as its application.
+    application = getattr(context, "application", None) or context
+    _ensure_admin_outbox_worker(_admin_outbox_bots(application, getattr(context, "bot", None))).set()
+    return True
 
 
 def _monitor_can_alert(key: str, now: float) -> bool:
@@ -14309,18 +18162,17 @@ async def _monitor_fetch_user_profile(
         if bot is None:
             return None, None, None
 
-        chat = await bot.get_chat(chat_id=int(str(tg_id)))
-        username = getattr(chat, "username", None)
-        first_name = getattr(chat, "first_name", None)
-        last_name = getattr(chat, "last_name", None)
+        profile = await _get_chat_profile(bot, str(tg_id))
+        if profile is None:
+            return None, None, None
+        username = profile["username"]
+        first_name = profile["first_name"]
+        last_name = profile["last_name"]
 
         username_s = str(username).strip() if username else None
         first_name_s = str(first_name).strip() if first_name else None
         last_name_s = str(last_name).strip() if last_name else None
 
-        if username_s or first_name_s or last_name_s:
-            update_user_info(str(tg_id), username_s, first_name_s, last_name_s)
-
         return username_s, first_name_s, last_name_s
     except Exception:
         return None, None, None
@@ -14529,11 +18381,9 @@ async def send_error_digest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
         if last_ts > 0:
             lines.append(f"  at: {_fmt_dt(last_ts)}")
 
-    payload = "\n".join(lines)[:3900]
-    try:
-        await context.bot.send_message(chat_id=ADMIN_ID, text=payload)
-    except Exception as e:
-        logging.error(f"Failed to send error digest: {e}")
+    payload = _escape_markdown("\n".join(lines))[:3900]
+    # Keep the digest until the outbox has it; delivery retries are the outbox's job from here.
+    if not await _send_admin_message(context, payload):
         return
 
     _ERROR_DIGEST.clear()
@@ -14604,17 +18454,9 @@ async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYP
         if suppressed > 0:
             suppressed_line = f"\n\nsuppressed={suppressed} window={_ERROR_NOTIFY_INTERVAL_SEC}s"
         payload = f"BOT ERROR\n{summary}\n\n{err_text}{suppressed_line}"
-        payload = payload[:3900]
+        payload = _escape_markdown(payload)[:3900]
 
-        if not ADMIN_ID:
-            return
-        try:
-            application = getattr(context, "application", None)
-            if application is None:
-                return
-            await application.bot.send_message(chat_id=ADMIN_ID, text=payload)
-        except Exception as send_ex:
-            logging.error(f"Failed to notify admin about error: {send_ex}")
+        await _send_admin_message(context, payload)
     except Exception as ex:
         logging.error(f"global_error_handler failed: {ex}")
 
@@ -14683,362 +18525,623 @@ async def admin_bot_reply_handler(update: Update, context: ContextTypes.DEFAULT_
             except Exception as e:
                 await update.message.reply_text(f"❌ Failed to send reply: {e}")
 
-async def check_missed_transactions(context: ContextTypes.DEFAULT_TYPE):
-    """
-    Background task to check for missing Star transactions (every minute).
-    Recovers payments that were successful in Telegram but missing in local DB.
-    """
-    try:
-        # 1. Fetch recent Star Transactions from Telegram
-        # We fetch last 20 to be efficient.
-        try:
-            # Try using the wrapper method if available (v20+)
-            result = await context.bot.get_star_transactions(limit=20)
-            # In PTB v21+, returns StarTransactions object which has .transactions list
-            if hasattr(result, 'transactions'):
-                txs = list(result.transactions)
-            else:
-                txs = list(result)
-        except Exception:
-             # Fallback: Try raw API if wrapper fails or method not found
-             return
+# For oldest-first history the cursor is the number of transactions already reconciled plus the id and date of
+# the last one, so each run pages forward from it (with a small overlap) instead of re-reading a fixed tail.
+# The ordering is read from the page dates; newest-first history, or a cursor whose anchor no longer matches,
+# is rescanned from the top down to the last reconciled date instead.
+_STAR_TX_PAGE_LIMIT = 100
+_STAR_TX_MAX_PAGES = 50
+_STAR_TX_CURSOR_OVERLAP = 5
+_STAR_TX_RECENT_SKIP_SEC = 60
+_STAR_TX_RESCAN_MARGIN_SEC = 3600
+# charge id -> transaction date, per bot DB; pruned to the rescan window after every run.
+_STAR_TX_DONE: dict[str, dict[str, int]] = {}
 
-        if not txs:
-            return
 
-        conn = sqlite3.connect(BOT_DB_PATH)
-        cursor = conn.cursor()
+class StarTxCursor(TypedDict):
+    offset: int
+    last_id: Optional[str]
+    last_date: int
 
-        current_prices = get_prices()
 
-        for tx in txs:
-            # Filter for incoming payments (source is User)
-            if not tx.source:
-                continue
+def _star_tx_user_id(tx: Any) -> Optional[str]:
+    source = getattr(tx, "source", None)
+    if not source:
+        return None
+    # TransactionPartnerUser(user=User(...)); older library versions exposed the id directly
+    if hasattr(source, 'user'):
+        return str(source.user.id)
+    if hasattr(source, 'id'):
+        return str(source.id)
+    return None
 
-            # source might be User object or Chat object, or just ID if using some library versions
-            # In python-telegram-bot v20+, StarTransaction.source is TransactionPartnerUser or similar.
 
-            tg_id = None
-            if hasattr(tx.source, 'user'):
-                # TransactionPartnerUser(user=User(...))
-                tg_id = str(tx.source.user.id)
-            elif hasattr(tx.source, 'id'):
-                tg_id = str(tx.source.id)
+def _load_star_tx_cursor() -> Optional[StarTxCursor]:
+    try:
+        raw = _get_sync_state("star_tx_cursor")
+    except sqlite3.Error:
+        return None
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+        return {
+            "offset": max(0, int(data.get("offset", 0))),
+            "last_id": _normalize_charge_id(data.get("last_id")),
+            # Cursors saved before last_date was stored fall back to the time they were written.
+            "last_date": int(data.get("last_date") or data.get("ts") or 0),
+        }
+    except (ValueError, TypeError, AttributeError):
+        return None
 
-            if not tg_id:
-                continue
 
-            amount = tx.amount
-            date = int(tx.date.timestamp())
-            charge_id = _normalize_charge_id(getattr(tx, "id", None))
-            if not charge_id:
-                continue
+def _save_star_tx_cursor(state: StarTxCursor) -> None:
+    try:
+        _set_sync_state("star_tx_cursor", json.dumps({**state, "ts": int(time.time())}))
+    except sqlite3.Error as e:
+        logging.warning(f"Failed to save Star transaction cursor: {e}")
 
-            # Safety: Skip very recent transactions (< 60s) to avoid race with webhook
-            if (time.time() - date) < 60:
-                continue
 
-            cursor.execute(
-                "SELECT processed_at, plan_id FROM transactions WHERE telegram_payment_charge_id=? LIMIT 1",
-                (charge_id,),
-            )
-            existing_row = cursor.fetchone()
-            if existing_row and existing_row[0]:
-                continue
+def _star_tx_newest_first(txs: list[Any]) -> bool:
+    """Read the page ordering from its dates; a page with a single date counts as oldest-first."""
+    dates = [int(tx.date.timestamp()) for tx in txs]
+    return len(dates) > 1 and dates[0] > dates[-1]
 
-            if not existing_row:
-                reconcile_window_sec_raw = os.getenv("MISSED_TX_RECONCILE_WINDOW_SEC", "7200")
-                try:
-                    reconcile_window_sec = max(0, int(reconcile_window_sec_raw))
-                except ValueError:
-                    reconcile_window_sec = 7200
 
-                if reconcile_window_sec > 0:
-                    try:
-                        cursor.execute(
-                            "SELECT id, plan_id "
-                            "FROM transactions "
-                            "WHERE tg_id=? AND amount=? "
-                            "AND (telegram_payment_charge_id IS NULL OR telegram_payment_charge_id='') "
-                            "AND date BETWEEN ? AND ? "
-                            "ORDER BY ABS(date - ?) ASC "
-                            "LIMIT 1",
-                            (
-                                tg_id,
-                                amount,
-                                date - reconcile_window_sec,
-                                date + reconcile_window_sec,
-                                date,
-                            ),
-                        )
-                        candidate = cursor.fetchone()
-                        if candidate:
-                            candidate_id, candidate_plan_id = candidate
-                            cursor.execute(
-                                "UPDATE transactions SET telegram_payment_charge_id=? WHERE id=? "
-                                "AND (telegram_payment_charge_id IS NULL OR telegram_payment_charge_id='')",
-                                (charge_id, candidate_id),
-                            )
-                            conn.commit()
-                            cursor.execute(
-                                "SELECT processed_at, plan_id FROM transactions WHERE telegram_payment_charge_id=? LIMIT 1",
-                                (charge_id,),
-                            )
-                            existing_row = cursor.fetchone()
-                    except sqlite3.OperationalError:
-                        pass
+def _star_tx_anchor_matches(txs: list[Any], page_offset: int, state: StarTxCursor) -> bool:
+    """Check that the last reconciled transaction still sits where the stored count says it is."""
+    if state["offset"] == 0:
+        return True
+    idx = state["offset"] - 1 - page_offset
+    if idx < 0 or idx >= len(txs):
+        return False
+    tx = txs[idx]
+    if state["last_id"]:
+        return _normalize_charge_id(getattr(tx, "id", None)) == state["last_id"]
+    return int(tx.date.timestamp()) == state["last_date"]
 
-            should_extend = not existing_row
 
-            now_sec = time.time()
-            last_logged = _MISSED_TX_LOG_THROTTLE.get(str(charge_id))
-            if should_extend and (last_logged is None or (now_sec - last_logged) >= 300):
-                log_action(
-                    f"WARNING: Found MISSING/UNPROCESSED payment: "
-                    f"User {tg_id}, Amount {amount}, Date {date}, Charge {charge_id}. Recovering..."
+async def _fetch_star_transactions_page(bot: Any, offset: int) -> Optional[list[Any]]:
+    try:
+        result = await bot.get_star_transactions(offset=offset, limit=_STAR_TX_PAGE_LIMIT)
+    except Exception as e:
+        logging.warning(f"Failed to fetch Star transactions at offset {offset}: {e}")
+        return None
+    # In PTB v21+, returns StarTransactions object which has .transactions list
+    if hasattr(result, 'transactions'):
+        return list(result.transactions)
+    return list(result)
+
+
+async def _reconcile_star_transaction(
+    context: ContextTypes.DEFAULT_TYPE,
+    conn: sqlite3.Connection,
+    tg_id: str,
+    amount: int,
+    date: int,
+    charge_id: str,
+    existing_row: Optional[tuple[Any, ...]],
+    current_prices: Mapping[str, Any],
+) -> bool:
+    """Apply one incoming Star payment that is missing or unprocessed locally. False means retry on a later run."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT status FROM payment_jobs WHERE charge_id=? AND status NOT IN ('done', 'failed')",
+            (charge_id,),
+        )
+        live_job = cursor.fetchone()
+    except sqlite3.OperationalError:
+        live_job = None
+    if live_job:
+        # The payment job still owns this charge and books processed_at when it settles.
+        return True
+    if not existing_row:
+        reconcile_window_sec_raw = os.getenv("MISSED_TX_RECONCILE_WINDOW_SEC", "7200")
+        try:
+            reconcile_window_sec = max(0, int(reconcile_window_sec_raw))
+        except ValueError:
+            reconcile_window_sec = 7200
+
+        if reconcile_window_sec > 0:
+            try:
+                cursor.execute(
+                    "SELECT id, plan_id "
+                    "FROM transactions "
+                    "WHERE tg_id=? AND amount=? "
+                    "AND (telegram_payment_charge_id IS NULL OR telegram_payment_charge_id='') "
+                    "AND date BETWEEN ? AND ? "
+                    "ORDER BY ABS(date - ?) ASC "
+                    "LIMIT 1",
+                    (
+                        tg_id,
+                        amount,
+                        date - reconcile_window_sec,
+                        date + reconcile_window_sec,
+                        date,
+                    ),
                 )
-                _MISSED_TX_LOG_THROTTLE[str(charge_id)] = now_sec
-
-            original_plan_id = existing_row[1] if existing_row else None
-            plan_id = original_plan_id if original_plan_id else "unknown"
-            if plan_id == "unknown":
-                inferred = _infer_plan_id_from_amount(amount, current_prices)
-                if inferred:
-                    plan_id = inferred
-
-            if plan_id == "unknown":
-                if amount >= 900:
-                    plan_id = "1_year"
-                elif amount >= 250:
-                    plan_id = "3_months"
-                elif amount >= 100:
-                    plan_id = "1_month"
-                elif amount >= 60:
-                    plan_id = "2_weeks"
-                elif amount >= 40:
-                    plan_id = "1_week"
-
-            if existing_row and (not original_plan_id or original_plan_id == "unknown") and plan_id != "unknown":
-                try:
+                candidate = cursor.fetchone()
+                if candidate:
+                    candidate_id, candidate_plan_id = candidate
                     cursor.execute(
-                        "UPDATE transactions SET plan_id=? "
-                        "WHERE telegram_payment_charge_id=? AND (plan_id IS NULL OR plan_id='' OR plan_id='unknown')",
-                        (plan_id, charge_id),
+                        "UPDATE transactions SET telegram_payment_charge_id=? WHERE id=? "
+                        "AND (telegram_payment_charge_id IS NULL OR telegram_payment_charge_id='')",
+                        (charge_id, candidate_id),
                     )
                     conn.commit()
-                except Exception:
-                    pass
-
-            if not existing_row:
-                try:
                     cursor.execute(
-                        "INSERT INTO transactions (tg_id, amount, date, plan_id, telegram_payment_charge_id, processed_at) "
-                        "VALUES (?, ?, ?, ?, ?, NULL)",
-                        (tg_id, amount, date, plan_id, charge_id),
+                        "SELECT processed_at, plan_id FROM transactions WHERE telegram_payment_charge_id=? LIMIT 1",
+                        (charge_id,),
                     )
-                    conn.commit()
-                except Exception as e:
-                    log_action(f"ERROR saving missing tx: {e}")
-                    continue
+                    existing_row = cursor.fetchone()
+            except sqlite3.OperationalError:
+                pass
 
-            days = 0
-            if plan_id in current_prices:
-                days = current_prices[plan_id]['days']
-            elif plan_id == "1_year":
-                days = 365
-            elif plan_id == "3_months":
-                days = 90
-            elif plan_id == "1_month":
-                days = 30
-            elif plan_id == "2_weeks":
-                days = 14
-            elif plan_id == "1_week":
-                days = 7
-
-            if days <= 0:
-                try:
-                    cursor.execute(
-                        "UPDATE transactions SET processed_at=? "
-                        "WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
-                        (int(time.time()), charge_id),
-                    )
-                    conn.commit()
-                except Exception as e:
-                    log_action(f"ERROR marking unhandled tx as processed (charge_id: {charge_id}): {e}")
-                continue
+    should_extend = not existing_row
 
-            if days > 0 and should_extend:
-                try:
-                    if plan_id == "ru_bridge":
-                        new_expiry = await _add_days_ru_bridge(tg_id, days)
-                        if new_expiry is None:
-                            raise RuntimeError("RU-Bridge extension failed")
-                    else:
-                        await add_days_to_user(tg_id, days, context)
-                    cursor.execute(
-                        "UPDATE transactions SET processed_at=? "
-                        "WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
-                        (int(time.time()), charge_id),
+    now_sec = time.time()
+    last_logged = _MISSED_TX_LOG_THROTTLE.get(str(charge_id))
+    if should_extend and (last_logged is None or (now_sec - last_logged) >= 300):
+        log_action(
+            f"WARNING: Found MISSING/UNPROCESSED payment: "
+            f"User {tg_id}, Amount {amount}, Date {date}, Charge {charge_id}. Recovering..."
+        )
+        _MISSED_TX_LOG_THROTTLE[str(charge_id)] = now_sec
+
+    original_plan_id = existing_row[1] if existing_row else None
+    plan_id = original_plan_id if original_plan_id else "unknown"
+    if plan_id == "unknown":
+        inferred = _infer_plan_id_from_amount(amount, current_prices)
+        if inferred:
+            plan_id = inferred
+
+    if plan_id == "unknown":
+        if amount >= 900:
+            plan_id = "1_year"
+        elif amount >= 250:
+            plan_id = "3_months"
+        elif amount >= 100:
+            plan_id = "1_month"
+        elif amount >= 60:
+            plan_id = "2_weeks"
+        elif amount >= 40:
+            plan_id = "1_week"
+
+    if existing_row and (not original_plan_id or original_plan_id == "unknown") and plan_id != "unknown":
+        try:
+            cursor.execute(
+                "UPDATE transactions SET plan_id=? "
+                "WHERE telegram_payment_charge_id=? AND (plan_id IS NULL OR plan_id='' OR plan_id='unknown')",
+                (plan_id, charge_id),
+            )
+        except Exception:
+            pass
+
+    if not existing_row:
+        try:
+            cursor.execute(
+                "INSERT INTO transactions (tg_id, amount, date, plan_id, telegram_payment_charge_id, processed_at) "
+                "VALUES (?, ?, ?, ?, ?, NULL)",
+                (tg_id, amount, date, plan_id, charge_id),
+            )
+            conn.commit()
+            _ADMIN_STATS.note_payment(tg_id, amount, date, charge_id)
+        except Exception as e:
+            log_action(f"ERROR saving missing tx: {e}")
+            return False
+
+    days = 0
+    if plan_id in current_prices:
+        days = current_prices[plan_id]['days']
+    elif plan_id == "1_year":
+        days = 365
+    elif plan_id == "3_months":
+        days = 90
+    elif plan_id == "1_month":
+        days = 30
+    elif plan_id == "2_weeks":
+        days = 14
+    elif plan_id == "1_week":
+        days = 7
+
+    if days <= 0:
+        try:
+            cursor.execute(
+                "UPDATE transactions SET processed_at=? "
+                "WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
+                (int(time.time()), charge_id),
+            )
+        except Exception as e:
+            log_action(f"ERROR marking unhandled tx as processed (charge_id: {charge_id}): {e}")
+        return True
+
+    if days > 0 and should_extend:
+        try:
+            if plan_id == "ru_bridge":
+                new_expiry = await _add_days_ru_bridge(tg_id, days)
+                if new_expiry is None:
+                    raise RuntimeError("RU-Bridge extension failed")
+            else:
+                await add_days_to_user(tg_id, days, context)
+            cursor.execute(
+                "UPDATE transactions SET processed_at=? "
+                "WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
+                (int(time.time()), charge_id),
+            )
+            conn.commit()
+        except Exception as e:
+            log_action(f"ERROR applying recovered tx (charge_id: {charge_id}): {e}")
+            return False
+
+        try:
+            lang = get_lang(tg_id)
+            if plan_id == "ru_bridge":
+                msg_text = (
+                    f"✅ *Payment Restored!*\n\nWe found a missing payment of {amount} Stars.\n"
+                    f"Your RU-Bridge access has been extended by {days} days."
+                )
+                if lang == 'ru':
+                    msg_text = (
+                        f"✅ *Платеж восстановлен!*\n\nМы обнаружили потерянный платеж на {amount} Stars.\n"
+                        f"Ваша RU-Bridge подписка продлена на {days} дн."
+                    )
+            else:
+                msg_text = (
+                    f"✅ *Payment Restored!*\n\nWe found a missing payment of {amount} Stars.\n"
+                    f"Your subscription has been extended by {days} days."
+                )
+                if lang == 'ru':
+                    msg_text = (
+                        f"✅ *Платеж восстановлен!*\n\nМы обнаружили потерянный платеж на {amount} Stars.\n"
+                        f"Ваша подписка продлена на {days} дн."
                     )
-                    conn.commit()
-                except Exception as e:
-                    log_action(f"ERROR applying recovered tx (charge_id: {charge_id}): {e}")
-                    continue
 
-                try:
-                    lang = get_lang(tg_id)
-                    if plan_id == "ru_bridge":
-                        msg_text = (
-                            f"✅ *Payment Restored!*\n\nWe found a missing payment of {amount} Stars.\n"
-                            f"Your RU-Bridge access has been extended by {days} days."
-                        )
-                        if lang == 'ru':
-                            msg_text = (
-                                f"✅ *Платеж восстановлен!*\n\nМы обнаружили потерянный платеж на {amount} Stars.\n"
-                                f"Ваша RU-Bridge подписка продлена на {days} дн."
-                            )
-                    else:
-                        msg_text = (
-                            f"✅ *Payment Restored!*\n\nWe found a missing payment of {amount} Stars.\n"
-                            f"Your subscription has been extended by {days} days."
-                        )
-                        if lang == 'ru':
-                            msg_text = (
-                                f"✅ *Платеж восстановлен!*\n\nМы обнаружили потерянный платеж на {amount} Stars.\n"
-                                f"Ваша подписка продлена на {days} дн."
-                            )
+            await context.bot.send_message(chat_id=tg_id, text=msg_text, parse_mode='Markdown')
+        except Exception:
+            pass
+
+        admin_msg = (
+            f"⚠️ **RESTORED PAYMENT**\n"
+            f"User: `{tg_id}`\n"
+            f"Amount: {amount}\n"
+            f"Plan: `{plan_id}`\n"
+            f"Added: {days} days\n"
+            f"Charge: `{charge_id}`"
+        )
+        await _send_admin_message(context, admin_msg)
+    if days > 0 and not should_extend:
+        try:
+            cursor.execute(
+                "UPDATE transactions SET processed_at=? "
+                "WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
+                (int(time.time()), charge_id),
+            )
+        except Exception as e:
+            log_action(f"ERROR marking existing tx as processed (charge_id: {charge_id}): {e}")
+    return True
 
-                    await context.bot.send_message(chat_id=tg_id, text=msg_text, parse_mode='Markdown')
-                except Exception:
-                    pass
 
-                admin_msg = (
-                    f"⚠️ **RESTORED PAYMENT**\n"
-                    f"User: `{tg_id}`\n"
-                    f"Amount: {amount}\n"
-                    f"Plan: `{plan_id}`\n"
-                    f"Added: {days} days\n"
-                    f"Charge: `{charge_id}`"
+async def check_missed_transactions(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Background task to check for missing Star transactions (every minute).
+    Recovers payments that were successful in Telegram but missing in local DB.
+    """
+    try:
+        state = _load_star_tx_cursor()
+        # Without a cursor (first run) older history is only counted, not replayed.
+        replay_after = time.time() - STAR_TX_BOOTSTRAP_LOOKBACK_SEC if state is None else 0.0
+        offset = max(0, state["offset"] - _STAR_TX_CURSOR_OVERLAP) if state else 0
+        txs = await _fetch_star_transactions_page(context.bot, offset)
+        if txs is None:
+            return
+        newest_first = _star_tx_newest_first(txs)
+        # The overlap only re-reads the anchor; transactions the cursor already counted are not replayed.
+        counted = state["offset"] if state else 0
+        if state is not None and (newest_first or not _star_tx_anchor_matches(txs, offset, state)):
+            counted = 0
+            if not newest_first:
+                logging.warning(
+                    f"Star transaction cursor at {state['offset']} no longer matches {state['last_id']}, rescanning by date"
                 )
-                await _send_admin_message(context, admin_msg)
-            if days > 0 and not should_extend:
-                try:
+            replay_after = max(0.0, float(state["last_date"] - _STAR_TX_RESCAN_MARGIN_SEC))
+            if offset:
+                offset = 0
+                txs = await _fetch_star_transactions_page(context.bot, offset)
+                if txs is None:
+                    return
+        done = _STAR_TX_DONE.setdefault(BOT_DB_PATH, {})
+        current_prices = get_prices()
+
+        if state is None:
+            new_state: StarTxCursor = {"offset": 0, "last_id": None, "last_date": int(replay_after)}
+        elif newest_first:
+            new_state = {"offset": 0, "last_id": None, "last_date": state["last_date"]}
+        else:
+            new_state = {"offset": state["offset"], "last_id": state["last_id"], "last_date": state["last_date"]}
+        oldest_blocked: Optional[int] = None
+        blocked = False
+
+        conn = sqlite3.connect(BOT_DB_PATH)
+        try:
+            for _page in range(_STAR_TX_MAX_PAGES):
+                charge_ids = [_normalize_charge_id(getattr(tx, "id", None)) for tx in txs]
+                pending = [c for c in charge_ids if c and c not in done]
+                existing: dict[str, tuple[Any, ...]] = {}
+                cursor = conn.cursor()
+                for chunk_start in range(0, len(pending), 500):
+                    chunk = pending[chunk_start:chunk_start + 500]
                     cursor.execute(
-                        "UPDATE transactions SET processed_at=? "
-                        "WHERE telegram_payment_charge_id=? AND processed_at IS NULL",
-                        (int(time.time()), charge_id),
+                        "SELECT telegram_payment_charge_id, processed_at, plan_id FROM transactions "
+                        f"WHERE telegram_payment_charge_id IN ({','.join('?' * len(chunk))})",
+                        chunk,
                     )
-                    conn.commit()
-                except Exception as e:
-                    log_action(f"ERROR marking existing tx as processed (charge_id: {charge_id}): {e}")
+                    existing.update({str(row[0]): (row[1], row[2]) for row in cursor.fetchall()})
 
-        conn.close()
+                for idx, tx in enumerate(txs):
+                    if offset + idx < counted:
+                        continue
+                    charge_id = charge_ids[idx]
+                    date = int(tx.date.timestamp())
+                    ok = True
+                    if charge_id and charge_id not in done:
+                        tg_id = _star_tx_user_id(tx)
+                        existing_row = existing.get(charge_id)
+                        if not tg_id or (existing_row and existing_row[0]) or date < replay_after:
+                            # Outgoing (refunds, withdrawals), already processed, or outside the replay window
+                            pass
+                        elif (time.time() - date) < _STAR_TX_RECENT_SKIP_SEC:
+                            # Skip very recent transactions to avoid racing successful_payment
+                            ok = False
+                        else:
+                            ok = await _reconcile_star_transaction(
+                                context, conn, tg_id, tx.amount, date, charge_id, existing_row, current_prices
+                            )
+                        if ok:
+                            done[charge_id] = date
+                    if newest_first:
+                        # The next rescan has to reach back to the oldest transaction still waiting for a retry.
+                        if not ok:
+                            oldest_blocked = date if oldest_blocked is None else min(oldest_blocked, date)
+                        elif new_state["last_id"] is None:
+                            new_state = {"offset": 0, "last_id": charge_id, "last_date": date}
+                        continue
+                    if not ok:
+                        blocked = True
+                    if not blocked:
+                        new_state = {"offset": offset + idx + 1, "last_id": charge_id, "last_date": date}
+
+                conn.commit()
+                if len(txs) < _STAR_TX_PAGE_LIMIT:
+                    break
+                if newest_first and int(txs[-1].date.timestamp()) < replay_after:
+                    break
+                offset += len(txs)
+                next_txs = await _fetch_star_transactions_page(context.bot, offset)
+                if next_txs is None:
+                    if newest_first:
+                        # Older pages went unchecked, so the next run rescans down to the same bound.
+                        oldest_blocked = int(replay_after)
+                    break
+                txs = next_txs
+        finally:
+            conn.close()
+
+        if oldest_blocked is not None:
+            new_state["last_date"] = min(new_state["last_date"], oldest_blocked)
+        if new_state != state:
+            _save_star_tx_cursor(new_state)
+        prune_before = new_state["last_date"] - _STAR_TX_RESCAN_MARGIN_SEC
+        for charge_id in [c for c, date in done.items() if date < prune_before]:
+            del done[charge_id]
 
     except Exception as e:
         import traceback
         logging.error(f"Error in check_missed_transactions: {e}\n{traceback.format_exc()}")
 
-async def check_winback_users(context: ContextTypes.DEFAULT_TYPE):
+
+_UPDATE_PROCESSOR_ADMISSION_LIMIT = 4096
+
+
+class _ChatOrderedUpdateProcessor(BaseUpdateProcessor):
     """
-    Check for users whose subscription expired 3-7 days ago and send them a promo code.
-    Runs daily.
-
-    Logic:
-    1. Find users expired between 3 and 7 days ago.
-    2. Check if this specific expiration event has been handled (using expiry timestamp).
-    3. Ensure it wasn't just a trial expiration (check if they have payment history).
-    4. Send promo.
+    Process up to max_concurrent_updates updates at once while keeping updates of one chat
+    (or one user, for chat-less updates like pre-checkout queries) strictly in arrival order.
     """
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT settings FROM inbounds WHERE id=?", (INBOUND_ID,))
-        row = cursor.fetchone()
-        conn.close()
-
-        if not row:
-            return
 
-        settings = json.loads(row[0])
-        clients = settings.get('clients', [])
+    def __init__(self, workers: int, wait_samples: int = 512):
+        # PTB's own semaphore is acquired before ordering is known, so it is left effectively unbounded;
+        # the worker limit is applied after the per-chat lock to keep queued chats from pinning workers.
+        super().__init__(_UPDATE_PROCESSOR_ADMISSION_LIMIT)
+        self.workers = max(1, workers)
+        self._worker_slots = asyncio.BoundedSemaphore(self.workers)
+        self._chat_locks: dict[str, asyncio.Lock] = {}
+        self._chat_pending: dict[str, int] = {}
+        self._waits: deque[float] = deque(maxlen=wait_samples)
+        self.running = 0
+        self.processed = 0
+        self.max_wait = 0.0
+        self.max_chat_depth = 0
+
+    @staticmethod
+    def _ordering_key(update: object) -> str:
+        if isinstance(update, TelegramUpdate):
+            if update.effective_chat is not None:
+                return f"c{update.effective_chat.id}"
+            if update.effective_user is not None:
+                return f"u{update.effective_user.id}"
+        return "_"
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._ordering_key(update)
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._chat_locks[key] = lock
+        depth = self._chat_pending.get(key, 0) + 1
+        self._chat_pending[key] = depth
+        self.max_chat_depth = max(self.max_chat_depth, depth)
+        queued_at = time.monotonic()
+        try:
+            # asyncio.Lock wakes waiters FIFO, so same-chat updates keep their arrival order.
+            async with lock:
+                async with self._worker_slots:
+                    wait = time.monotonic() - queued_at
+                    self._waits.append(wait)
+                    self.max_wait = max(self.max_wait, wait)
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+        finally:
+            remaining = self._chat_pending.get(key, 1) - 1
+            if remaining <= 0:
+                self._chat_pending.pop(key, None)
+                self._chat_locks.pop(key, None)
+            else:
+                self._chat_pending[key] = remaining
 
-        current_time_ms = int(time.time() * 1000)
-        day_ms = 24 * 3600 * 1000
+    async def initialize(self) -> None:
+        pass
 
-        # Range: Expired between 3 and 7 days ago
-        threshold_start = current_time_ms - (7 * day_ms)
-        threshold_end = current_time_ms - (3 * day_ms)
+    async def shutdown(self) -> None:
+        pass
 
-        conn_bot = sqlite3.connect(BOT_DB_PATH)
-        cursor_bot = conn_bot.cursor()
+    def metrics(self) -> dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            "running": self.running,
+            "limit": self.workers,
+            "queued": max(0, sum(self._chat_pending.values()) - self.running),
+            "chats": len(self._chat_pending),
+            "processed": self.processed,
+            "wait_avg_ms": int(sum(waits) / len(waits) * 1000) if waits else 0,
+            "wait_p95_ms": int(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000) if waits else 0,
+            "wait_max_ms": int(self.max_wait * 1000),
+            "max_chat_depth": self.max_chat_depth,
+        }
 
-        # Get list of users who have EVER paid (to avoid sending win-back to trial abusers)
-        cursor_bot.execute("SELECT DISTINCT tg_id FROM transactions")
-        paid_users = set(row[0] for row in cursor_bot.fetchall())
 
-        for client in clients:
-            expiry = client.get('expiryTime', 0)
-            tg_id = str(client.get('tgId', ''))
+# Webhook mode: one local asyncio HTTP listener receives updates for the main and support bots
+# (each on its own path, each with its own secret token) and puts them on the application's update_queue.
+_WEBHOOK_MAX_BODY = 1024 * 1024
+_WEBHOOK_STATUS_TEXT = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+_WEBHOOK_SERVER: Optional[asyncio.base_events.Server] = None
 
-            if not tg_id or expiry == 0:
-                continue
 
-            # Filter 1: Must be a paid user (Retention strategy is for paying customers)
-            if tg_id not in paid_users:
-                continue
+def _webhook_route(token: str, name: str) -> tuple[str, str, str]:
+    """Return (path, public url, secret) for a bot; the secret defaults to a hash of its token."""
+    base = WEBHOOK_URL.rstrip("/")
+    path = (urlparse(base).path.rstrip("/") or "") + f"/{name}"
+    secret = WEBHOOK_SECRET or hashlib.sha256(f"webhook:{token}".encode("utf-8")).hexdigest()
+    return path, f"{base}/{name}", secret
 
-            # Filter 2: Check if in range (3-7 days ago)
-            if threshold_start < expiry < threshold_end:
 
-                # Filter 3: Check if THIS specific expiry event was already handled.
-                # We use a unique key: winback_{expiry_timestamp}
-                notification_key = f"winback_{expiry}"
+async def _write_webhook_response(writer: asyncio.StreamWriter, status: int, keep_alive: bool) -> None:
+    body = _WEBHOOK_STATUS_TEXT.get(status, "").encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {_WEBHOOK_STATUS_TEXT.get(status, '')}\r\n"
+        f"Content-Type: text/plain\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
 
-                cursor_bot.execute("SELECT 1 FROM notifications WHERE tg_id=? AND type=?", (tg_id, notification_key))
-                if cursor_bot.fetchone():
-                    continue
 
-                # Send Win-back
-                try:
-                    # Generate unique promo code
-                    suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-                    code = f"WB{suffix}"
+async def _handle_webhook_request(
+    reader: asyncio.StreamReader,
+    routes: Mapping[str, tuple[str, Any]],
+) -> Optional[tuple[int, bool]]:
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        return 400, False
+    method, target, version = parts
+    headers: dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        return 400, False
+    if length < 0 or length > _WEBHOOK_MAX_BODY:
+        return 413, False
+    body = await reader.readexactly(length) if length else b""
+
+    route = routes.get(urlparse(target).path)
+    if route is None:
+        return 404, keep_alive
+    if method != "POST":
+        return 405, keep_alive
+    secret, application = route
+    if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), secret):
+        return 401, keep_alive
+    try:
+        update = TelegramUpdate.de_json(json.loads(body), application.bot)
+    except Exception as e:
+        logging.warning(f"Rejected malformed webhook update: {e}")
+        return 400, keep_alive
+    if update is None:
+        return 400, keep_alive
+    await application.update_queue.put(update)
+    return 200, keep_alive
+
+
+async def _serve_webhook_connection(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    routes: Mapping[str, tuple[str, Any]],
+) -> None:
+    try:
+        while True:
+            result = await _handle_webhook_request(reader, routes)
+            if result is None:
+                break
+            status, keep_alive = result
+            await _write_webhook_response(writer, status, keep_alive)
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        logging.error(f"Webhook connection error: {e}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
 
-                    # Create promo in DB (3 days bonus)
-                    cursor_bot.execute("INSERT OR IGNORE INTO promo_codes (code, days, max_uses) VALUES (?, ?, ?)", (code, 3, 1))
 
-                    lang = get_lang(tg_id)
-                    msg_text = (
-                        "👋 **We miss you!**\n\n"
-                        "Your subscription expired recently. We'd love to see you back!\n"
-                        f"🎁 Here is a special gift: **3 Days Free Access**\n\n"
-                        f"👇 Activate code: `{code}`"
-                    )
-                    if lang == 'ru':
-                        msg_text = (
-                            "👋 **Мы скучаем!**\n\n"
-                            "Ваша подписка недавно истекла. Возвращайтесь!\n"
-                            f"🎁 Ваш подарок: **3 дня бесплатно**\n\n"
-                            f"👇 Активируйте код: `{code}`"
-                        )
+async def _start_webhook_listener(
+    routes: Mapping[str, tuple[str, Any]],
+    host: str,
+    port: int,
+) -> asyncio.base_events.Server:
+    async def _on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await _serve_webhook_connection(reader, writer, routes)
 
-                    await context.bot.send_message(chat_id=tg_id, text=msg_text, parse_mode='Markdown')
+    return await asyncio.start_server(_on_connect, host, port)
 
-                    # Mark as sent for THIS expiry timestamp
-                    cursor_bot.execute("INSERT INTO notifications (tg_id, type, date) VALUES (?, ?, ?)",
-                                       (tg_id, notification_key, int(time.time())))
-                    conn_bot.commit()
-                    logging.info(f"Sent Win-back to {tg_id} for expiry {expiry}")
 
-                except Exception as e:
-                    logging.error(f"Failed to send winback to {tg_id}: {e}")
+async def _register_webhook(application: Any, token: str, name: str, routes: dict[str, tuple[str, Any]]) -> None:
+    path, url, secret = _webhook_route(token, name)
+    routes[path] = (secret, application)
+    await application.bot.set_webhook(url=url, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+    logging.info(f"Webhook for {name} bot set to {url}")
 
-        conn_bot.close()
-    except Exception as e:
-        logging.error(f"Error in check_winback_users: {e}")
 
 async def main():
+    global _WEBHOOK_SERVER
     init_db()
     try:
         updated = backfill_unknown_transaction_plan_ids()
@@ -15048,6 +19151,10 @@ async def main():
         pass
 
     _start_multi_sub_server()
+    try:
+        _load_poll_tallies()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to load poll tallies: {e}")
 
     # 1. Main Bot App
     request = HTTPXRequest(
@@ -15057,26 +19164,35 @@ async def main():
         pool_timeout=5.0,
         httpx_kwargs={"transport": httpx.AsyncHTTPTransport(local_address="0.0.0.0")},
     )
-    app_main = ApplicationBuilder().token(TOKEN).request(request).post_init(post_init).build()
+    app_main = ApplicationBuilder().token(TOKEN).request(request).concurrent_updates(_ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY)).post_init(post_init).build()
     app_main.add_error_handler(global_error_handler)
     register_handlers(app_main)
 
     # Job Queue for Main Bot
     job_queue = app_main.job_queue
-    job_queue.run_repeating(check_expiring_subscriptions, interval=3600, first=10) # Changed to hourly
-    job_queue.run_repeating(check_expired_trials, interval=3600, first=20) # New job
+    job_queue.run_repeating(expiry_scheduler_job, interval=EXPIRY_SCHEDULER_TICK_SEC, first=10)
     job_queue.run_repeating(log_traffic_stats, interval=3600, first=5)
     job_queue.run_repeating(cleanup_flash_messages, interval=60, first=10)
     job_queue.run_repeating(detect_suspicious_activity, interval=300, first=30)
     job_queue.run_repeating(check_missed_transactions, interval=60, first=30)
+    job_queue.run_repeating(payment_jobs_job, interval=PAYMENT_JOB_TICK_SEC, first=20)
+    job_queue.run_repeating(admin_stats_reconcile_job, interval=ADMIN_STATS_RECONCILE_SEC, first=90)
+    job_queue.run_repeating(user_search_rebuild_job, interval=USER_SEARCH_REBUILD_SEC, first=5)
+    job_queue.run_repeating(audience_sync_job, interval=AUDIENCE_SYNC_SEC, first=20)
     job_queue.run_repeating(monitor_thresholds_job, interval=_MONITOR_INTERVAL_SEC, first=60)
     if AUTO_SYNC_INTERVAL_SEC > 0:
         job_queue.run_repeating(_auto_sync_remote_nodes_job, interval=AUTO_SYNC_INTERVAL_SEC, first=30)
+    if _mobile_feature_enabled() and MOBILE_TRAFFIC_REFRESH_SEC > 0:
+        job_queue.run_repeating(refresh_mobile_cache_job, interval=MOBILE_TRAFFIC_REFRESH_SEC, first=15)
+    job_queue.run_repeating(flush_poll_votes, interval=POLL_VOTE_FLUSH_SEC, first=POLL_VOTE_FLUSH_SEC)
+    if GITHUB_RELEASE_REFRESH_SEC > 0:
+        job_queue.run_repeating(refresh_github_releases_job, interval=GITHUB_RELEASE_REFRESH_SEC, first=60)
+    if NODE_HEALTH_PROBE_SEC > 0:
+        job_queue.run_repeating(node_health_probe_job, interval=NODE_HEALTH_PROBE_SEC, first=45)
 
     # New jobs for Backup and Winback (Daily)
     # Run backup at ~4 AM (assuming start time is arbitrary, we just set interval=24h)
     job_queue.run_repeating(send_backup_to_admin_job, interval=86400, first=14400) # 24h, first run after 4h
-    job_queue.run_repeating(check_winback_users, interval=86400, first=18000) # 24h, first run after 5h
     if _DAILY_REPORT_ENABLED > 0:
         first_report = _DAILY_REPORT_FIRST_SEC if _DAILY_REPORT_FIRST_SEC > 0 else 21600
         job_queue.run_repeating(send_daily_report_job, interval=86400, first=first_report)
@@ -15084,18 +19200,31 @@ async def main():
         first = _ERROR_DIGEST_FIRST_SEC if _ERROR_DIGEST_FIRST_SEC > 0 else 3600
         job_queue.run_repeating(send_error_digest_job, interval=_ERROR_DIGEST_INTERVAL_SEC, first=first)
 
+    # Routes are filled in as each bot registers its webhook; the listener is up before Telegram is told about it.
+    webhook_routes: dict[str, tuple[str, Any]] = {}
+    if WEBHOOK_URL:
+        _WEBHOOK_SERVER = await _start_webhook_listener(webhook_routes, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        logging.info(f"Webhook listener started on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+
     # Initialize Main Bot
     await app_main.initialize()
     await app_main.start()
-    await app_main.updater.start_polling()
+    # Deliver admin notifications left in the outbox by a previous run.
+    _ensure_admin_outbox_worker(_admin_outbox_bots(app_main)).set()
+    if WEBHOOK_URL:
+        await _register_webhook(app_main, str(TOKEN), "main", webhook_routes)
+    else:
+        await app_main.updater.start_polling()
 
     me = await app_main.bot.get_me()
     print(f"🤖 Main Bot Started: @{me.username}")
+    # Broadcasts interrupted by a restart carry on from their saved progress.
+    asyncio.create_task(resume_broadcasts(app_main.bot))
 
     # 2. Support Bot App (Optional)
     if SUPPORT_BOT_TOKEN:
         try:
-            app_support = ApplicationBuilder().token(SUPPORT_BOT_TOKEN).request(request).build()
+            app_support = ApplicationBuilder().token(SUPPORT_BOT_TOKEN).request(request).concurrent_updates(_ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY)).build()
             app_support.add_error_handler(global_error_handler)
 
             # Register Handler for Support Bot
@@ -15108,7 +19237,10 @@ async def main():
 
             await app_support.initialize()
             await app_support.start()
-            await app_support.updater.start_polling()
+            if WEBHOOK_URL:
+                await _register_webhook(app_support, SUPPORT_BOT_TOKEN, "support", webhook_routes)
+            else:
+                await app_support.updater.start_polling()
 
             sup_me = await app_support.bot.get_me()
             print(f"🤖 Support Bot Started: @{sup_me.username}")
@@ -15117,9 +19249,20 @@ async def main():
     else:
         logging.info("Support Bot Token not provided. Running in Single Bot Mode.")
 
-    # Keep alive
+    # Keep alive until SIGTERM/SIGINT; the default SIGTERM action would skip the cleanup below.
     stop_event = asyncio.Event()
-    await stop_event.wait()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop_event.wait()
+    finally:
+        # Votes still buffered since the last periodic flush.
+        await flush_poll_votes()
+        await _close_github_http()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+@pytest.fixture
+def search_db(tmp_path, monkeypatch):
+    clients = [
+        {"email": "tg_301", "tgId": 301, "comment": "office router"},
+        {"email": "tg_302", "tgId": 302, "comment": ""},
+    ]
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": clients}),))
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "_ADMIN_STATS", bot._AdminStatsView())
+    bot.init_db()
+    bot.update_user_info(301, "dmitry_iv", "Dmitry", "Ivanov")
+    bot.update_user_info(302, "anna_k", "Anna", "Kuznetsova")
+    bot._index_user_search_clients(clients)
+    return tmp_path / "bot.db"
+
+
+def _ids(query: str) -> list[str]:
+    return [tg_id for tg_id, _username, _name in bot._search_users(query)]
+
+
+def test_search_users_by_prefix_typo_and_client_fields(search_db) -> None:
+    assert _ids("dmit")[0] == "301"
+    assert _ids("@anna")[0] == "302"
+    assert _ids("ivamov")[0] == "301"
+    assert _ids("office") == ["301"]
+    assert _ids("tg_302")[0] == "302"
+    assert _ids("zzzz") == []
+
+
+def test_search_index_follows_deletes_and_rebuilds(search_db) -> None:
+    conn = sqlite3.connect(search_db)
+    bot._drop_user_search(conn.cursor(), ["302"])
+    conn.commit()
+    conn.close()
+    assert "302" not in _ids("anna")
+
+    assert bot._rebuild_user_search_index() == 2
+    assert _ids("anna")[0] == "302"
+    assert _ids("office") == ["301"]
+
+
+def test_search_index_keeps_every_client_of_a_user(search_db) -> None:
+    bot._index_user_search_clients([{"email": "tg_301_phone", "tgId": 301, "comment": "pixel phone"}])
+    assert _ids("office") == ["301"]
+    assert _ids("pixel") == ["301"]
+
+    # The phone client is rebound to another user: only its own fields move
+    bot._unindex_user_search_client("301", "tg_301_phone")
+    bot._index_user_search_clients([{"email": "tg_302", "tgId": 302, "comment": "pixel phone"}])
+    assert _ids("pixel") == ["302"]
+    assert _ids("office") == ["301"]
+
+    bot._index_user_search_clients([{"email": "tg_303", "tgId": 303, "comment": "spare"}])
+    bot._index_user_search_clients([{"email": "tg_303b", "tgId": 303, "comment": "tablet"}])
+    assert bot._rebuild_user_search_index() == 2
+    assert _ids("pixel") == []
+    assert _ids("office") == ["301"]
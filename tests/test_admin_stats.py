@@ -0,0 +1,155 @@
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+@pytest.mark.asyncio
+async def test_admin_stats_events_match_full_rebuild(tmp_path, monkeypatch) -> None:
+    now_ms = int(time.time() * 1000)
+    day_ms = 24 * 3600 * 1000
+    clients = [
+        {"email": "tg_201", "tgId": 201, "enable": True, "expiryTime": now_ms + day_ms},
+        {"email": "tg_202", "tgId": 202, "enable": True, "expiryTime": now_ms + 400},
+        {"email": "tg_203", "tgId": 203, "enable": True, "expiryTime": 0},
+    ]
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("CREATE TABLE client_traffics (email TEXT, inbound_id INTEGER, last_online INTEGER)")
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": clients}),))
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "_ADMIN_STATS", bot._AdminStatsView())
+    bot.init_db()
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.execute("INSERT INTO user_prefs (tg_id, lang, trial_used) VALUES ('201', 'en', 1)")
+    conn.execute("INSERT INTO user_prefs (tg_id, lang, trial_used) VALUES ('202', 'en', 1)")
+    conn.execute("INSERT INTO user_prefs (tg_id, lang) VALUES ('203', 'en')")
+    conn.execute("INSERT INTO transactions (tg_id, amount, date, plan_id) VALUES ('203', 100, ?, '1_month')", (now_ms // 1000,))
+    conn.commit()
+    conn.close()
+
+    await bot._build_admin_stats_view("en")
+    stats = bot._ADMIN_STATS.counters(now_ms)
+    assert (stats["active_trials"], stats["expired_trials"], stats["total_revenue"]) == (2, 0, 100)
+
+    # Events: a new user pays (and gets a client), and the trial of 202 runs out without any DB read
+    bot.update_user_info(204, "u204", None, None)
+    bot._ADMIN_STATS.note_payment("204", 250, now_ms // 1000, "charge-204")
+    bot._ADMIN_STATS.note_payment("204", 250, now_ms // 1000, "charge-204")
+    new_client = {"email": "tg_204", "tgId": 204, "enable": True, "expiryTime": now_ms + 30 * day_ms}
+    bot._ADMIN_STATS.note_client(new_client)
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.execute("INSERT INTO transactions (tg_id, amount, date, plan_id, telegram_payment_charge_id) VALUES ('204', 250, ?, '1_month', 'charge-204')", (now_ms // 1000,))
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("UPDATE inbounds SET settings=? WHERE id=1", (json.dumps({"clients": clients + [new_client]}),))
+    conn.commit()
+    conn.close()
+
+    later_ms = now_ms + 1000
+    incremental = bot._ADMIN_STATS.counters(later_ms)
+    assert incremental == {
+        "total_users": 4,
+        "vpn_users": 4,
+        "total_clients": 4,
+        "active_subs": 3,
+        "active_trials": 1,
+        "expired_trials": 1,
+        "total_revenue": 350,
+        "total_sales": 2,
+    }
+
+    rebuilt = bot._AdminStatsView()
+    rebuilt.begin_rebuild()
+    rebuilt.rebuild(*bot._load_admin_stats_sources(), now_ms=later_ms)
+    assert rebuilt.counters(later_ms) == incremental
+
+
+def test_admin_stats_drops_users_whose_last_client_moved_away() -> None:
+    now_ms = int(time.time() * 1000)
+    view = bot._AdminStatsView()
+    view.begin_rebuild()
+    view.rebuild(
+        {"301", "302"},
+        set(),
+        {"301"},
+        [{"email": "tg_301", "tgId": 301, "enable": True, "expiryTime": 0}],
+        [("301", 100, now_ms // 1000, "charge-301")],
+        now_ms=now_ms,
+    )
+    assert (view.counters(now_ms)["vpn_users"], view.counters(now_ms)["total_revenue"]) == (1, 100)
+
+    # The client is rebound to 302: 301 no longer has a client, 302 has one but never paid.
+    view.note_client({"email": "tg_301", "tgId": 302, "enable": True, "expiryTime": 0})
+    stats = view.counters(now_ms)
+    assert stats["vpn_users"] == 1
+    assert (stats["total_sales"], stats["total_revenue"]) == (0, 0)
+
+
+def test_sales_ledger_dedupes_in_sql_and_pages_by_keyset(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    conn = sqlite3.connect(tmp_path / "xui.db")
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": []}),))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "xui.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "_ADMIN_STATS", bot._AdminStatsView())
+    monkeypatch.setattr(bot, "_SALES_LOG_SCAN_SPAN_SEC", 3600)
+    bot.init_db()
+    base = 1_700_000_000
+    rows = [
+        # One sale recorded twice: the reconciler row carries no plan, the later manual row no charge ID
+        ('401', 250, base, 'unknown', 'charge-401'),
+        ('401', 250, base + 300, '1_month', None),
+        # Two real purchases a few minutes apart with their own charge IDs
+        ('402', 100, base + 1000, '1_month', 'charge-402a'),
+        ('402', 100, base + 1200, '1_month', 'charge-402b'),
+        ('369456269', 100, base + 1300, '1_month', 'charge-excluded'),
+    ]
+    rows += [(str(500 + i), 100, base + 4000 + i * 3000, '1_month', f'charge-5{i}') for i in range(5)]
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.executemany(
+        "INSERT INTO transactions (tg_id, amount, date, plan_id, telegram_payment_charge_id) VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+    bot.update_user_info(401, "buyer401", "Olga", None)
+
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = bot._load_sales_ledger_page(cursor, limit=3)
+        pages.append(page)
+        if cursor is None:
+            break
+    ledger = [row for page in pages for row in page]
+    assert [len(page) for page in pages] == [3, 3, 2]
+    assert [row["tg_id"] for row in ledger] == ['504', '503', '502', '501', '500', '402', '402', '401']
+    assert (ledger[-1]["date"], ledger[-1]["plan_id"], ledger[-1]["charge_id"]) == (base + 300, '1_month', 'charge-401')
+
+    stats = bot._AdminStatsView()
+    stats.begin_rebuild()
+    stats.rebuild(*bot._load_admin_stats_sources(), now_ms=base * 1000)
+    assert stats.counters(base * 1000)["total_sales"] == len(ledger)
+
+    assert bot._sales_log_names(['401', '402']) == {'401': 'Olga'}
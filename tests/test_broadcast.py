@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Any
+
+import pytest
+from telegram.error import Forbidden, RetryAfter
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+class _FakeBot:
+    def __init__(self, retry_once: set[str], blocked: set[str]) -> None:
+        self.retry_once = set(retry_once)
+        self.blocked = blocked
+        self.sent: list[str] = []
+        self.edits: list[str] = []
+        self.in_flight = 0
+        self.peak = 0
+
+    async def copy_message(self, chat_id: str, from_chat_id: int, message_id: int) -> None:
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if chat_id in self.retry_once:
+                self.retry_once.discard(chat_id)
+                raise RetryAfter(0)
+            if chat_id in self.blocked:
+                raise Forbidden("Forbidden: bot was blocked by the user")
+            self.sent.append(chat_id)
+        finally:
+            self.in_flight -= 1
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs: Any) -> None:
+        self.edits.append(text)
+
+
+@pytest.fixture
+def broadcast_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "BROADCAST_RATE_PER_SEC", 1000)
+    monkeypatch.setattr(bot, "BROADCAST_CONCURRENCY", 4)
+    monkeypatch.setattr(bot, "_TELEGRAM_BULK_BUCKETS", {})
+    bot.init_db()
+    return tmp_path / "bot.db"
+
+
+@pytest.mark.asyncio
+async def test_broadcast_sends_concurrently_and_records_status(broadcast_db) -> None:
+    recipients = [str(i) for i in range(1, 21)]
+    broadcast_id = bot._create_broadcast("999", 999, 42, "all", recipients)
+    bot._set_broadcast_status_message(broadcast_id, 999, 7)
+    fake = _FakeBot(retry_once={"3"}, blocked={"5", "6"})
+
+    counts = await bot._run_broadcast(fake, broadcast_id)
+
+    assert counts == {"sent": 18, "blocked": 2}
+    assert sorted(fake.sent, key=int) == [r for r in recipients if r not in {"5", "6"}]
+    assert 1 < fake.peak <= 4
+    assert fake.edits[-1].startswith("✅ Рассылка завершена")
+    conn = sqlite3.connect(broadcast_db)
+    status = conn.execute("SELECT status FROM broadcasts WHERE id=?", (broadcast_id,)).fetchone()[0]
+    attempts = conn.execute("SELECT attempts FROM broadcast_recipients WHERE tg_id='3'").fetchone()[0]
+    conn.close()
+    assert status == "done"
+    assert attempts == 2
+
+
+@pytest.mark.asyncio
+async def test_broadcast_resume_skips_already_sent(broadcast_db) -> None:
+    broadcast_id = bot._create_broadcast("999", 999, 42, "ru", ["1", "2", "3"])
+    bot._store_broadcast_results(broadcast_id, [("1", 1, "sent", "")])
+    fake = _FakeBot(retry_once=set(), blocked=set())
+
+    await bot.resume_broadcasts(fake)
+    await asyncio.wait_for(asyncio.gather(*bot._BROADCAST_TASKS.values()), timeout=5)
+
+    assert sorted(fake.sent) == ["2", "3"]
+    assert bot._broadcast_counts(broadcast_id) == {"sent": 3}
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate_and_honours_pause() -> None:
+    bucket = bot._TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        await bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+    bucket.pause(0.1)
+    paused_at = time.monotonic()
+    await bucket.acquire()
+    assert time.monotonic() - paused_at >= 0.09
+
+
+def test_audience_segments_follow_source_tables(broadcast_db, tmp_path, monkeypatch) -> None:
+    xui_db = tmp_path / "x-ui.db"
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db))
+    now_ms = int(time.time() * 1000)
+    clients = [
+        {"email": "tg_1", "tgId": 1, "expiryTime": now_ms + 86_400_000},
+        {"email": "tg_2", "tgId": 2, "expiryTime": now_ms - 86_400_000},
+        {"email": "tg_5", "tgId": 5, "expiryTime": 0},
+    ]
+    conn = sqlite3.connect(xui_db)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("INSERT INTO inbounds VALUES (1, ?)", (json.dumps({"clients": clients}),))
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(broadcast_db)
+    conn.executemany(
+        "INSERT INTO user_prefs (tg_id, lang, trial_used, first_name) VALUES (?, ?, ?, ?)",
+        [("1", "ru", 1, "A"), ("2", "en", 1, "B"), ("3", "ru", 1, "C"), ("4", "en", 0, "D")],
+    )
+    conn.execute("INSERT INTO transactions (tg_id, amount, date, plan_id) VALUES ('1', 100, 0, '1_month')")
+    conn.execute("INSERT INTO mobile_subscriptions (tg_id, uuid, expiry_time) VALUES ('4', 'u', 0)")
+    conn.commit()
+    conn.close()
+
+    def ids(segment: str) -> list[str]:
+        return sorted(bot._audience_ids(segment), key=int)
+
+    # x-ui clients reach the audience through the periodic sync, not through reads.
+    assert ids("active") == []
+    bot._sync_audience_clients()
+
+    assert ids("all") == ["1", "2", "3", "4", "5"]
+    assert ids("ru") == ["1", "3"]
+    assert ids("active") == ["1", "5"]
+    assert ids("expired") == ["2"]
+    assert ids("paid") == ["1"]
+    assert ids("trial") == ["2", "3"]
+    assert ids("nopaid") == ["2", "3", "4", "5"]
+    assert ids("mobile") == ["4"]
+
+    page, total = bot._audience_page("all", 1, 2)
+    assert total == 5
+    assert page == [("3", "C", ""), ("4", "D", "")]
+
+    conn = sqlite3.connect(broadcast_db)
+    conn.execute("UPDATE user_prefs SET lang='en' WHERE tg_id='3'")
+    conn.execute("DELETE FROM mobile_subscriptions WHERE tg_id='4'")
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(xui_db)
+    conn.execute("UPDATE inbounds SET settings=? WHERE id=1", (json.dumps({"clients": clients[:1]}),))
+    conn.commit()
+    conn.close()
+
+    assert ids("ru") == ["1"]
+    assert ids("mobile") == []
+    assert ids("expired") == ["2"]
+    assert bot._resolve_broadcast_recipients("expired", []) == []
+    assert ids("expired") == []
+    assert ids("all") == ["1", "2", "3", "4"]
+
+    # A client written by the bot itself is applied at once, keeping the latest expiry.
+    bot._note_audience_clients([{"email": "tg_6", "tgId": 6, "expiryTime": now_ms - 1000}])
+    assert ids("expired") == ["6"]
+    bot._note_audience_clients([{"email": "tg_6", "tgId": 6, "expiryTime": now_ms + 86_400_000}])
+    assert ids("expired") == []
+    assert "6" in ids("active")
@@ -0,0 +1,107 @@
+import os
+import re
+import sys
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+def _registered_trie() -> "bot._CallbackTrie":
+    app_mock = MagicMock()
+    bot.register_handlers(app_mock)
+    handlers = [call[0][0] for call in app_mock.add_handler.call_args_list]
+    routers = [h for h in handlers if isinstance(h, bot._CallbackTrieHandler)]
+    assert len(routers) == 1
+    return routers[0].trie
+
+
+def test_registered_routes_resolve_like_before() -> None:
+    trie = _registered_trie()
+    assert trie.ambiguities() == []
+
+    cases = {
+        "shop": bot.shop,
+        "buy_1_month": bot.initiate_payment,
+        "admin_server_nodes": bot.admin_server_nodes,
+        "admin_server_node_3": bot.admin_server_node_detail,
+        "admin_remote_nodes_sync_menu": bot.admin_remote_nodes_sync_menu,
+        "admin_remote_nodes_sync_2": bot.admin_remote_nodes_sync_action,
+        "admin_backup_del_do_x.zip": bot.admin_backup_delete_do,
+        "admin_backup_del_x.zip": bot.admin_backup_delete_confirm,
+        "admin_restore_menu": bot.admin_restore_menu,
+        "admin_restore_menu_2": bot.admin_restore_menu,
+        "admin_broadcast": bot.admin_broadcast,
+        "admin_broadcast_page_2": bot.admin_broadcast_target,
+        "admin_suspicious_page_1": bot.admin_suspicious_users,
+        "poll_vote_5_1": bot.handle_poll_vote,
+    }
+    for data, handler in cases.items():
+        match = trie.match(data)
+        assert match is not None, data
+        assert match["route"]["handler"] is handler, data
+
+    assert trie.match("poll_vote_5_1")["args"] == ["5", "1"]
+    assert trie.match("admin_restore_menu_x") is None
+    assert trie.match("admin_restore_menu_2_3") is None
+    assert trie.match("unknown_button") is None
+    assert trie.match("shopping") is None
+
+
+def test_ambiguity_check_reports_shadowed_and_duplicate_routes() -> None:
+    trie = bot._CallbackTrie()
+    handler = AsyncMock()
+    trie.prefix("admin_backup_del_", handler)
+    trie.prefix("admin_backup_del_do_", handler)
+    trie.exact("shop", handler)
+    trie.exact("shop", handler)
+    problems = trie.ambiguities()
+    assert any("shadows" in p and "admin_backup_del_do_" in p for p in problems)
+    assert any("duplicate" in p and "'shop'" in p for p in problems)
+
+
+@pytest.mark.asyncio
+async def test_trie_handler_passes_parsed_args() -> None:
+    trie = bot._CallbackTrie()
+    seen = {}
+
+    async def _vote(update, context):
+        seen["args"] = list(context.args)
+
+    trie.prefix("poll_vote_", _vote)
+    handler = bot._CallbackTrieHandler(trie)
+    update = bot.TelegramUpdate.de_json(
+        {
+            "update_id": 1,
+            "callback_query": {"id": "1", "from": {"id": 5, "is_bot": False, "first_name": "T"}, "chat_instance": "1", "data": "poll_vote_9_2"},
+        },
+        None,
+    )
+    check = handler.check_update(update)
+    assert check is not None
+    await handler.handle_update(update, MagicMock(), check, MagicMock())
+    assert seen["args"] == ["9", "2"]
+
+
+def test_trie_routes_every_registered_pattern_like_the_ordered_regexes() -> None:
+    trie = _registered_trie()
+    compiled = [(re.compile("^" + bot._callback_route_regex(route)), route) for route in trie.routes]
+    for route in trie.routes:
+        if route["exact"]:
+            samples = [route["key"]]
+        elif route["rest"] is not None:
+            samples = [route["key"] + "123"]
+        else:
+            samples = [route["key"], route["key"] + "123_4"]
+        for data in samples:
+            # The old dispatch: the first registered pattern that matches wins.
+            expected = next((r for regex, r in compiled if regex.match(data)), None)
+            match = trie.match(data)
+            assert expected is not None and match is not None, data
+            assert match["route"]["handler"] is expected["handler"], data
@@ -0,0 +1,144 @@
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Any
+
+import pytest
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+class _FakeBot:
+    def __init__(self) -> None:
+        self.sent: list[tuple[str, str]] = []
+
+    async def send_message(self, chat_id: str, text: str, **kwargs: Any) -> None:
+        self.sent.append((str(chat_id), text))
+
+
+class _FakeContext:
+    def __init__(self) -> None:
+        self.bot = _FakeBot()
+
+
+@pytest.mark.asyncio
+async def test_expiry_scheduler_fires_due_events_once(tmp_path, monkeypatch) -> None:
+    now = time.time()
+    hour_ms = 3600 * 1000
+    now_ms = int(now * 1000)
+    clients = [
+        {"email": "paid", "tgId": "101", "expiryTime": now_ms + 23 * hour_ms},
+        {"email": "trial", "tgId": "102", "expiryTime": now_ms - 1 * hour_ms},
+        {"email": "gone", "tgId": "103", "expiryTime": now_ms - 4 * 24 * hour_ms},
+        {"email": "later", "tgId": "104", "expiryTime": now_ms + 30 * 24 * hour_ms},
+    ]
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": clients}),))
+    conn.execute("CREATE TABLE client_traffics (id INTEGER PRIMARY KEY, inbound_id INTEGER, email TEXT, expiry_time INTEGER)")
+    conn.executemany(
+        "INSERT INTO client_traffics (inbound_id, email, expiry_time) VALUES (1, ?, ?)",
+        [(c["email"], c["expiryTime"]) for c in clients],
+    )
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "_EXPIRY_SIGNATURE", None)
+    monkeypatch.setattr(bot, "_EXPIRY_HEAP", [])
+    monkeypatch.setattr(bot, "get_lang", lambda _tg_id: "en")
+    bot.init_db()
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.execute("INSERT INTO user_prefs (tg_id, lang, trial_used) VALUES ('102', 'en', 1)")
+    conn.execute("INSERT INTO transactions (tg_id, amount, date, plan_id) VALUES ('101', 100, ?, '1_month')", (int(now),))
+    conn.execute("INSERT INTO transactions (tg_id, amount, date, plan_id) VALUES ('103', 100, ?, '1_month')", (int(now),))
+    conn.commit()
+    conn.close()
+
+    context = _FakeContext()
+    await bot.expiry_scheduler_job(context)  # type: ignore[arg-type]
+
+    sent_to = sorted(chat_id for chat_id, _text in context.bot.sent)
+    assert sent_to == ["101", "102", "103"]
+    assert any(text == bot.t("trial_expired", "en") for _chat, text in context.bot.sent)
+    # The 30-day client stays queued for later; nothing is re-sent on the next tick.
+    assert any(event[3] == "104" for event in bot._EXPIRY_HEAP)
+    await bot.expiry_scheduler_job(context)  # type: ignore[arg-type]
+    assert len(context.bot.sent) == 3
+
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    types = {row[0] for row in conn.execute("SELECT type FROM notifications")}
+    conn.close()
+    assert "expiry_warning_24h" in types and "trial_expired_followup" in types
+    assert any(notif.startswith("winback_") for notif in types)
+
+
+class _FlakyBot(_FakeBot):
+    def __init__(self) -> None:
+        super().__init__()
+        self.failures = 1
+
+    async def send_message(self, chat_id: str, text: str, **kwargs: Any) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("network down")
+        await super().send_message(chat_id, text, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_expiry_scheduler_retries_failed_send_and_sees_row_edits(tmp_path, monkeypatch) -> None:
+    now = time.time()
+    now_ms = int(now * 1000)
+    clients = [{"email": "paid", "tgId": "201", "expiryTime": now_ms + 23 * 3600 * 1000}]
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": clients}),))
+    conn.execute("CREATE TABLE client_traffics (id INTEGER PRIMARY KEY, inbound_id INTEGER, email TEXT, expiry_time INTEGER)")
+    conn.execute("INSERT INTO client_traffics (inbound_id, email, expiry_time) VALUES (1, 'paid', ?)", (clients[0]["expiryTime"],))
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "_EXPIRY_SIGNATURE", None)
+    monkeypatch.setattr(bot, "_EXPIRY_HEAP", [])
+    monkeypatch.setattr(bot, "_EXPIRY_RETRIES", {})
+    monkeypatch.setattr(bot, "get_lang", lambda _tg_id: "en")
+    bot.init_db()
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.execute("INSERT INTO transactions (tg_id, amount, date, plan_id) VALUES ('201', 100, ?, '1_month')", (int(now),))
+    conn.commit()
+    conn.close()
+
+    context = _FakeContext()
+    context.bot = _FlakyBot()
+    await bot.expiry_scheduler_job(context)  # type: ignore[arg-type]
+    assert context.bot.sent == []
+    retry = [event for event in bot._EXPIRY_HEAP if event[2] == "expiry_warning_24h"]
+    assert len(retry) == 1 and retry[0][0] > now
+
+    # Pull the retry forward; the second attempt delivers.
+    bot._EXPIRY_HEAP[:] = [(now - 1, *event[1:]) if event[2] == "expiry_warning_24h" else event for event in bot._EXPIRY_HEAP]
+    bot.heapq.heapify(bot._EXPIRY_HEAP)
+    await bot.expiry_scheduler_job(context)  # type: ignore[arg-type]
+    assert [chat_id for chat_id, _text in context.bot.sent] == ["201"]
+
+    # Editing an existing payment row (no insert, same COUNT/MAX(rowid)) still changes the signature.
+    signature = bot._EXPIRY_SIGNATURE
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.execute("UPDATE transactions SET tg_id='202' WHERE tg_id='201'")
+    conn.commit()
+    conn.close()
+    assert bot._expiry_source_signature(now) != signature
@@ -1,3 +1,4 @@
+import asyncio
 import sys
 import inspect
 import sqlite3
@@ -288,3 +289,317 @@ async def test_monitor_traffic_alert_fetches_username_when_missing(tmp_path, mon
     assert msg
     assert "@Nick980" in msg
     assert "tg\\_980794782" not in msg
+
+
+@pytest.mark.asyncio
+async def test_poll_votes_tally_in_memory_and_flush_in_batch(tmp_path, monkeypatch) -> None:
+    import json
+    import bot
+
+    bot_db_path = tmp_path / "bot.db"
+    conn = sqlite3.connect(bot_db_path)
+    conn.execute("CREATE TABLE polls (id INTEGER PRIMARY KEY, question TEXT, options TEXT, created_at INTEGER, active INTEGER DEFAULT 1)")
+    conn.execute("CREATE TABLE poll_votes (poll_id INTEGER, tg_id TEXT, option_index INTEGER, PRIMARY KEY (poll_id, tg_id))")
+    conn.execute("INSERT INTO polls (id, question, options, created_at) VALUES (1, 'Q?', ?, 0)", (json.dumps(["A", "B"]),))
+    conn.execute("INSERT INTO poll_votes VALUES (1, '10', 0)")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(bot_db_path))
+    monkeypatch.setattr(bot, "POLL_RENDER_DEBOUNCE_SEC", 0.01)
+    monkeypatch.setattr(bot, "_POLL_STATE_LOADED", False)
+    monkeypatch.setattr(bot, "_POLL_META", {})
+    monkeypatch.setattr(bot, "_POLL_VOTES", {})
+    monkeypatch.setattr(bot, "_POLL_COUNTS", {})
+    monkeypatch.setattr(bot, "_POLL_PENDING", {})
+    monkeypatch.setattr(bot, "_POLL_RENDER_TASKS", {})
+    monkeypatch.setattr(bot, "_POLL_RENDER_LATEST", {})
+    monkeypatch.setattr(bot, "get_lang", lambda _tg_id: "en")
+
+    context = MagicMock()
+    context.bot.edit_message_text = AsyncMock()
+    for voter, data in (("11", "poll_vote_1_1"), ("12", "poll_vote_1_1"), ("11", "poll_vote_1_0")):
+        query = MagicMock()
+        query.from_user.id = int(voter)
+        query.data = data
+        query.answer = AsyncMock()
+        query.message.chat_id = 5
+        query.message.message_id = 7
+        await bot.handle_poll_vote(MagicMock(callback_query=query), context)
+        query.answer.assert_awaited_once()
+
+    assert bot._POLL_COUNTS[1] == {0: 2, 1: 1}
+    text, _markup = bot.generate_poll_message(1, "en")
+    assert "(2)" in text and "(1)" in text
+
+    await asyncio.sleep(0.05)
+    assert context.bot.edit_message_text.await_count == 1
+
+    await bot.flush_poll_votes()
+    assert bot._POLL_PENDING == {}
+    conn = sqlite3.connect(bot_db_path)
+    rows = dict(conn.execute("SELECT tg_id, option_index FROM poll_votes").fetchall())
+    conn.close()
+    assert rows == {"10": 0, "11": 0, "12": 1}
+
+
+@pytest.mark.asyncio
+async def test_sync_nicknames_fetches_only_missing_and_writes_compact_json(tmp_path, monkeypatch) -> None:
+    import json
+    import bot
+
+    clients = [
+        {"email": "tg_1", "tgId": 1, "comment": ""},
+        {"email": "tg_2", "tgId": 2, "comment": "@old", "_comment": "@old"},
+        {"email": "tg_3", "tgId": 3, "comment": "VIP (admin note)"},
+        {"email": "tg_4", "tgId": "", "comment": "kept"},
+    ]
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": clients}, indent=2),))
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "_TELEGRAM_BULK_BUCKETS", {})
+    monkeypatch.setattr(bot, "get_lang", lambda _tg_id: "en")
+    monkeypatch.setattr(bot, "_return_to_admin_stats_after_delay", AsyncMock())
+    monkeypatch.setattr(bot, "_CHAT_PROFILE_CACHE", {})
+    bot.init_db()
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.execute("INSERT INTO user_prefs (tg_id, lang, username) VALUES ('2', 'en', 'renamed')")
+    conn.execute("INSERT INTO user_prefs (tg_id, lang, username) VALUES ('3', 'en', 'someone')")
+    conn.execute("INSERT INTO nickname_sync (tg_id, nick, synced_at) VALUES ('2', '@old', 0)")
+    conn.commit()
+    conn.close()
+
+    context = MagicMock()
+    context.bot.get_chat = AsyncMock(return_value=MagicMock(username="alice", first_name="Alice", last_name=None))
+    progress = MagicMock(edit_text=AsyncMock())
+    context.bot.send_message = AsyncMock(return_value=progress)
+    query = MagicMock()
+    query.from_user.id = 999
+    query.answer = AsyncMock()
+
+    await bot.admin_sync_nicknames(MagicMock(callback_query=query), context)
+
+    context.bot.get_chat.assert_awaited_once_with(1)
+    conn = sqlite3.connect(xui_db_path)
+    raw = conn.execute("SELECT settings FROM inbounds WHERE id=1").fetchone()[0]
+    conn.close()
+    assert "\n" not in raw
+    saved = {c["email"]: c for c in json.loads(raw)["clients"]}
+    assert saved["tg_1"]["comment"] == "@alice"
+    assert saved["tg_2"]["comment"] == "@renamed"
+    assert saved["tg_3"]["comment"] == "VIP (admin note)"
+    assert saved["tg_4"]["comment"] == "kept" and saved["tg_4"]["tgId"] == 4
+    final_text = progress.edit_text.await_args.args[0]
+    assert "Updated: 3" in final_text and "Already up to date: 1" in final_text
+
+
+def test_apply_nickname_sync_keeps_comments_edited_since_the_plan(tmp_path, monkeypatch) -> None:
+    import json
+    import bot
+
+    clients = [
+        {"email": "tg_1", "tgId": 1, "comment": "edited by admin"},
+        {"email": "tg_2", "tgId": 2, "comment": "@old"},
+        {"email": "tg_3", "tgId": "", "comment": "new note"},
+    ]
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": clients}),))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    bot.init_db()
+
+    # The plan saw tg_1 and tg_3 with no comment; both were edited before the write.
+    changed, written = bot._apply_nickname_sync({
+        "tg_1": ("1", "@alice", ""),
+        "tg_2": ("2", "@renamed", "@old"),
+        "tg_3": ("3", "@carol", ""),
+    })
+
+    conn = sqlite3.connect(xui_db_path)
+    saved = {c["email"]: c for c in json.loads(conn.execute("SELECT settings FROM inbounds WHERE id=1").fetchone()[0])["clients"]}
+    conn.close()
+    assert saved["tg_1"]["comment"] == "edited by admin"
+    assert saved["tg_2"]["comment"] == "@renamed"
+    assert saved["tg_3"]["comment"] == "new note" and saved["tg_3"]["tgId"] == 3
+    assert [c["email"] for c in changed] == ["tg_2", "tg_3"] and written == [("2", "@renamed")]
+
+
+@pytest.mark.asyncio
+async def test_chat_profile_cache_seeds_from_user_info_and_caches_misses(tmp_path, monkeypatch) -> None:
+    import bot
+    from telegram.error import BadRequest
+
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "_CHAT_PROFILE_CACHE", {})
+    bot.init_db()
+    now = {"t": 1000.0}
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now["t"])
+
+    fake_bot = MagicMock()
+    fake_bot.get_chat = AsyncMock(side_effect=BadRequest("Chat not found"))
+
+    bot.update_user_info("42", "alice", "Alice", None)
+    assert await bot._get_chat_profile(fake_bot, "42") == {"username": "alice", "first_name": "Alice", "last_name": None}
+    assert await bot._get_chat_profile(fake_bot, "7") is None
+    assert await bot._get_chat_profile(fake_bot, "7") is None
+    assert fake_bot.get_chat.await_count == 1
+
+    now["t"] += bot.CHAT_PROFILE_TTL_SEC + 1
+    fake_bot.get_chat = AsyncMock(return_value=MagicMock(username="alice2", first_name="Alice", last_name=None))
+    profile = await bot._get_chat_profile(fake_bot, "42")
+    assert profile is not None and profile["username"] == "alice2"
+    fake_bot.get_chat.assert_awaited_once_with(42)
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    assert conn.execute("SELECT username FROM user_prefs WHERE tg_id='42'").fetchone()[0] == "alice2"
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_qr_photo_reuses_uploaded_file_id(tmp_path, monkeypatch) -> None:
+    import bot
+    from telegram.error import BadRequest
+
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "_MEDIA_FILE_IDS", {})
+    renders: list[str] = []
+    monkeypatch.setattr(bot, "_render_qr_png", lambda data: renders.append(data) or b"\x89PNG-fake")
+    bot.init_db()
+
+    fake_bot = MagicMock()
+    fake_bot.send_photo = AsyncMock(return_value=MagicMock(photo=[MagicMock(file_id="small"), MagicMock(file_id="FILE-1")]))
+
+    await bot._send_qr_photo(fake_bot, "1", "vless://abc", caption="x")
+    first_photo = fake_bot.send_photo.await_args.kwargs["photo"]
+    assert first_photo.getvalue().startswith(b"\x89PNG")
+
+    bot._MEDIA_FILE_IDS.clear()  # persisted entry survives a restart
+    await bot._send_qr_photo(fake_bot, "2", "vless://abc", caption="y")
+    assert fake_bot.send_photo.await_args.kwargs["photo"] == "FILE-1"
+    assert renders == ["vless://abc"]
+
+    fake_bot.send_photo = AsyncMock(side_effect=[BadRequest("Wrong file identifier"), MagicMock(photo=[MagicMock(file_id="FILE-2")])])
+    await bot._send_qr_photo(fake_bot, "3", "vless://abc")
+    assert fake_bot.send_photo.await_count == 2
+    assert bot._media_cache_get("qr:" + bot.hashlib.sha256(f"{bot._QR_STYLE}\nvless://abc".encode()).hexdigest()) == "FILE-2"
+
+
+@pytest.mark.asyncio
+async def test_admin_outbox_coalesces_and_retries_with_backoff(tmp_path, monkeypatch) -> None:
+    import bot
+    from telegram.error import NetworkError
+
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "_ADMIN_OUTBOX_WORKERS", {})
+    monkeypatch.setattr(bot, "_ADMIN_OUTBOX_BACKOFF_BASE_SEC", 0.01)
+    bot.init_db()
+
+    sent: list[str] = []
+
+    async def _send_message(chat_id, text, **kwargs):
+        if not sent and not getattr(_send_message, "failed", False):
+            _send_message.failed = True
+            raise NetworkError("telegram down")
+        sent.append(text)
+
+    context = MagicMock(application=None)
+    context.bot.send_message = _send_message
+
+    await bot._send_admin_message(context, "⚠️ CPU high")
+    await bot._send_admin_message(context, "⚠️ CPU high")
+    await bot._send_admin_message(context, "other alert")
+
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    pending = -1
+    for _ in range(100):
+        await asyncio.sleep(0.02)
+        # The row is deleted right after the send, so wait for both.
+        pending = conn.execute("SELECT COUNT(*) FROM admin_outbox").fetchone()[0]
+        if len(sent) == 2 and pending == 0:
+            break
+    conn.close()
+
+    # The failed alert is retried after a backoff, so the other one overtakes it.
+    assert sent == ["other alert", "⚠️ CPU high\n\n(×2)"]
+    assert pending == 0
+    task, _wake = bot._ADMIN_OUTBOX_WORKERS[asyncio.get_running_loop()]
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_admin_outbox_keeps_alerts_merged_during_a_send(tmp_path, monkeypatch) -> None:
+    import bot
+
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "_ADMIN_OUTBOX_WORKERS", {})
+    bot.init_db()
+
+    sent: list[str] = []
+
+    async def _send_message(chat_id, text, **kwargs):
+        if not sent:
+            # The same alert fires again while the first copy is in flight.
+            bot._enqueue_admin_message("disk full")
+        sent.append(text)
+
+    context = MagicMock(application=None)
+    context.bot.send_message = _send_message
+
+    await bot._send_admin_message(context, "disk full")
+
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    pending = -1
+    for _ in range(100):
+        await asyncio.sleep(0.02)
+        pending = conn.execute("SELECT COUNT(*) FROM admin_outbox").fetchone()[0]
+        if len(sent) == 2 and pending == 0:
+            break
+    conn.close()
+
+    assert sent == ["disk full", "disk full"]
+    assert pending == 0
+    task, _wake = bot._ADMIN_OUTBOX_WORKERS[asyncio.get_running_loop()]
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_error_digest_is_cleared_only_once_queued(tmp_path, monkeypatch) -> None:
+    import bot
+
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "_ADMIN_OUTBOX_WORKERS", {})
+    monkeypatch.setattr(bot, "_ERROR_DIGEST", {})
+    bot._ERROR_DIGEST["KeyError:'plan_id'"] = {
+        "count": 3, "first_ts": 1.0, "last_ts": 2.0, "last_summary": "user_id=5", "err_head": "Traceback",
+    }
+    context = MagicMock(application=None)
+    context.bot.send_message = AsyncMock()
+
+    # No outbox table yet: the digest survives for the next run
+    await bot.send_error_digest_job(context)
+    assert bot._ERROR_DIGEST
+
+    bot.init_db()
+    await bot.send_error_digest_job(context)
+
+    assert bot._ERROR_DIGEST == {}
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    texts = [row[0] for row in conn.execute("SELECT text FROM admin_outbox")]
+    conn.close()
+    assert len(texts) == 1 and "3x KeyError:'plan\\_id'" in texts[0]
+    task, _wake = bot._ADMIN_OUTBOX_WORKERS[asyncio.get_running_loop()]
+    task.cancel()
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import sys
 import sqlite3
@@ -14,6 +15,28 @@ os.environ['ADMIN_ID'] = '999'
 
 import bot
 
+# Some tests below replace bot.process_subscription without restoring it.
+_PROCESS_SUBSCRIPTION = bot.process_subscription
+
+
+async def _successful_payment(update, context) -> None:
+    """Run the handler and the grant task it starts."""
+    await bot.successful_payment(update, context)
+    await asyncio.gather(*bot._PAYMENT_TASKS)
+
+
+async def _drain_admin_outbox(db_path) -> None:
+    """Wait for the outbox worker to deliver every queued admin message, then stop it."""
+    conn = sqlite3.connect(db_path)
+    try:
+        for _ in range(100):
+            if conn.execute("SELECT COUNT(*) FROM admin_outbox").fetchone()[0] == 0:
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        conn.close()
+    task, _wake = bot._ADMIN_OUTBOX_WORKERS.pop(asyncio.get_running_loop())
+    task.cancel()
 
 def _prepare_bot_db(db_path: str) -> None:
     conn = sqlite3.connect(db_path)
@@ -35,6 +58,19 @@ def _prepare_bot_db(db_path: str) -> None:
             processed_at INTEGER
         )
     """)
+    cursor.execute("""
+        CREATE TABLE admin_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT UNIQUE,
+            text TEXT,
+            created_at REAL,
+            last_seen_at REAL,
+            next_attempt_at REAL,
+            attempts INTEGER DEFAULT 0,
+            repeat_count INTEGER DEFAULT 1,
+            last_error TEXT
+        )
+    """)
     cursor.execute(
         "CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_charge_id "
         "ON transactions(telegram_payment_charge_id) "
@@ -69,11 +105,13 @@ async def test_successful_payment_records_transaction_and_notifies_admin_via_sup
     update.message.successful_payment.total_amount = 100
 
     context = MagicMock()
+    context.application = None
     context.bot = AsyncMock()
     support_bot = AsyncMock()
     context.bot_data = {"support_bot": support_bot}
 
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
+    await _drain_admin_outbox(db_path)
 
     conn = sqlite3.connect(db_path)
     row = conn.execute("SELECT tg_id, amount, plan_id FROM transactions").fetchone()
@@ -112,7 +150,7 @@ async def test_successful_payment_mobile_payload_routes_to_mobile_processor(tmp_
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
 
     conn = sqlite3.connect(db_path)
     row = conn.execute("SELECT tg_id, amount, plan_id FROM transactions").fetchone()
@@ -146,10 +184,12 @@ async def test_successful_payment_notifies_admin_via_main_bot_when_support_missi
     update.message.successful_payment.total_amount = 100
 
     context = MagicMock()
+    context.application = None
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
+    await _drain_admin_outbox(db_path)
 
     conn = sqlite3.connect(db_path)
     row = conn.execute("SELECT tg_id, amount, plan_id FROM transactions").fetchone()
@@ -187,7 +227,7 @@ async def test_successful_payment_unknown_payload_still_records_transaction_and_
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
 
     conn = sqlite3.connect(db_path)
     row = conn.execute("SELECT tg_id, amount, plan_id FROM transactions").fetchone()
@@ -236,7 +276,7 @@ async def test_successful_payment_db_insert_failure_does_not_block_subscription(
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
 
     bot.process_subscription.assert_awaited()
 
@@ -271,7 +311,7 @@ async def test_successful_payment_admin_notification_failure_does_not_block_subs
     support_bot.send_message.side_effect = Exception("notify failed")
     context.bot_data = {"support_bot": support_bot}
 
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
 
     bot.process_subscription.assert_awaited()
 
@@ -304,8 +344,8 @@ async def test_successful_payment_is_idempotent_by_charge_id(tmp_path, monkeypat
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
+    await _successful_payment(update, context)
 
     conn = sqlite3.connect(db_path)
     count = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
@@ -344,8 +384,8 @@ async def test_successful_payment_normalizes_int_charge_id(tmp_path, monkeypatch
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
+    await _successful_payment(update, context)
 
     conn = sqlite3.connect(db_path)
     row = conn.execute(
@@ -388,7 +428,7 @@ async def test_successful_payment_uses_message_date_for_transaction_date(tmp_pat
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
 
     conn = sqlite3.connect(db_path)
     row = conn.execute(
@@ -429,8 +469,8 @@ async def test_successful_payment_is_idempotent_without_charge_id(tmp_path, monk
     context.bot = AsyncMock()
     context.bot_data = {}
 
-    await bot.successful_payment(update, context)
-    await bot.successful_payment(update, context)
+    await _successful_payment(update, context)
+    await _successful_payment(update, context)
 
     conn = sqlite3.connect(db_path)
     count = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
@@ -440,6 +480,96 @@ async def test_successful_payment_is_idempotent_without_charge_id(tmp_path, monk
     assert bot.process_subscription.await_count == 1
 
 
+@pytest.mark.asyncio
+async def test_payment_job_is_retried_by_worker_in_one_xui_window(tmp_path, monkeypatch):
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute(
+        "CREATE TABLE client_traffics (id INTEGER PRIMARY KEY AUTOINCREMENT, inbound_id INTEGER, enable INTEGER, "
+        "email TEXT, up INTEGER, down INTEGER, expiry_time INTEGER, total INTEGER, reset INTEGER, "
+        "all_time INTEGER, last_online INTEGER)"
+    )
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": []}),))
+    conn.commit()
+    conn.close()
+
+    db_path = tmp_path / "bot_data.db"
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "ADMIN_ID_INT", 999)
+    bot.init_db()
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO user_prefs (tg_id, lang, balance) VALUES ('600', 'en', 0)")
+    conn.execute("INSERT INTO user_prefs (tg_id, lang, referrer_id) VALUES ('601', 'en', '600')")
+    conn.commit()
+    conn.close()
+
+    payload = "1_month"
+    monkeypatch.setattr(bot, "get_prices", lambda: {payload: {"amount": 100, "days": 30}})
+    monkeypatch.setattr(bot, "get_lang", lambda _tg_id: "en")
+    monkeypatch.setattr(bot, "process_subscription", AsyncMock(return_value=False))
+    monkeypatch.setattr(bot.asyncio, "sleep", AsyncMock())
+    systemctl_calls = []
+
+    async def _systemctl(*args):
+        systemctl_calls.append(args)
+
+    monkeypatch.setattr(bot, "_systemctl", _systemctl)
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+
+    for user_id in (601, 602):
+        update = MagicMock()
+        msg_mock = MagicMock()
+        msg_mock.edit_text = AsyncMock()
+        update.message.reply_text = AsyncMock(return_value=msg_mock)
+        update.message.from_user.id = user_id
+        update.message.from_user.username = f"user{user_id}"
+        update.message.successful_payment.invoice_payload = payload
+        update.message.successful_payment.total_amount = 100
+        update.message.successful_payment.telegram_payment_charge_id = f"charge-{user_id}"
+        await _successful_payment(update, context)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT charge_id, status, attempts FROM payment_jobs ORDER BY charge_id").fetchall() == [
+        ("charge-601", "pending", 1),
+        ("charge-602", "pending", 1),
+    ]
+    conn.execute("UPDATE payment_jobs SET next_attempt_at=0")
+    conn.commit()
+    conn.close()
+
+    await bot.payment_jobs_job(context)
+    await bot.payment_jobs_job(context)
+
+    # Both grants share one stop/start of x-ui, the referrer's bonus days take another,
+    # and the second run finds nothing left to do
+    assert systemctl_calls == [("stop", "x-ui"), ("start", "x-ui")] * 2
+    conn = sqlite3.connect(xui_db_path)
+    clients = json.loads(conn.execute("SELECT settings FROM inbounds WHERE id=1").fetchone()[0])["clients"]
+    conn.close()
+    assert sorted(c["email"] for c in clients) == ["tg_600", "tg_601", "tg_602"]
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT DISTINCT status FROM payment_jobs").fetchall() == [("done",)]
+    assert conn.execute("SELECT COUNT(*) FROM transactions WHERE processed_at IS NULL").fetchone()[0] == 0
+    assert conn.execute("SELECT balance FROM user_prefs WHERE tg_id='600'").fetchone()[0] == 10
+    assert conn.execute("SELECT COUNT(*) FROM referral_bonuses").fetchone()[0] == 1
+    conn.close()
+
+    applied_to = [
+        call.kwargs.get("chat_id")
+        for call in context.bot.send_message.call_args_list
+        if "has been applied" in call.kwargs.get("text", "")
+    ]
+    assert sorted(applied_to) == ["601", "602"]
+
+
 @pytest.mark.asyncio
 async def test_check_missed_transactions_reconciles_existing_row_without_charge_id(tmp_path, monkeypatch):
     db_path = tmp_path / "bot_data.db"
@@ -548,6 +678,72 @@ async def test_check_missed_transactions_does_not_double_process_existing_charge
     assert add_days_mock.await_count == 0
 
 
+@pytest.mark.asyncio
+async def test_check_missed_transactions_pages_from_stored_cursor(tmp_path, monkeypatch):
+    db_path = tmp_path / "bot_data.db"
+    _prepare_bot_db(str(db_path))
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE sync_state (key TEXT PRIMARY KEY, value TEXT, updated_at INTEGER)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "ADMIN_ID_INT", 999)
+
+    payload = "1_month"
+    monkeypatch.setattr(bot, "get_prices", lambda: {payload: {"amount": 100, "days": 30}})
+    add_days_mock = AsyncMock()
+    monkeypatch.setattr(bot, "add_days_to_user", add_days_mock)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def _tx(idx, age):
+        tx = MagicMock()
+        tx.amount = 100
+        tx.date = now - age
+        tx.id = f"charge-{idx}"
+        tx.source = MagicMock()
+        tx.source.user = MagicMock()
+        tx.source.user.id = 1000 + idx
+        return tx
+
+    # Oldest-first history: 148 transactions from before the bot ever ran, then 2 fresh ones
+    history = [_tx(i, datetime.timedelta(days=3)) for i in range(148)]
+    history += [_tx(i, datetime.timedelta(minutes=5)) for i in range(148, 150)]
+    offsets = []
+
+    async def _get_star_transactions(offset=0, limit=100):
+        offsets.append(offset)
+        return MagicMock(transactions=history[offset:offset + limit])
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+    context.bot.get_star_transactions = _get_star_transactions
+
+    await bot.check_missed_transactions(context)
+
+    assert offsets == [0, 100]
+    assert add_days_mock.await_count == 2
+    assert json.loads(bot._get_sync_state("star_tx_cursor"))["offset"] == 150
+
+    history.append(_tx(150, datetime.timedelta(minutes=2)))
+    offsets.clear()
+    await bot.check_missed_transactions(context)
+
+    # Only a small overlap is re-read and nothing already applied is extended twice
+    assert offsets == [150 - bot._STAR_TX_CURSOR_OVERLAP]
+    assert add_days_mock.await_count == 3
+    assert json.loads(bot._get_sync_state("star_tx_cursor"))["offset"] == 151
+
+    conn = sqlite3.connect(db_path)
+    processed = conn.execute(
+        "SELECT COUNT(*) FROM transactions WHERE processed_at IS NOT NULL"
+    ).fetchone()[0]
+    conn.close()
+    assert processed == 3
+
+
 @pytest.mark.asyncio
 async def test_add_days_to_user_updates_client_traffics_expiry(tmp_path, monkeypatch):
     xui_db_path = tmp_path / "xui.db"
@@ -642,3 +838,346 @@ def test_format_expiry_display_variants():
     assert bot.format_expiry_display(expiry_minutes_ms, "ru", now_ms) == "3 мин."
 
     assert bot.format_expiry_display(0, "ru", now_ms) == "Бессрочный"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_grants_do_not_lose_settings_updates(tmp_path, monkeypatch):
+    import asyncio
+
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute(
+        "CREATE TABLE client_traffics (id INTEGER PRIMARY KEY AUTOINCREMENT, inbound_id INTEGER, enable INTEGER, "
+        "email TEXT, up INTEGER, down INTEGER, expiry_time INTEGER, total INTEGER, reset INTEGER, "
+        "all_time INTEGER, last_online INTEGER)"
+    )
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": []}),))
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot_data.db"))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    bot.init_db()
+
+    async def _systemctl(*args):
+        # Stopping x-ui yields, which is where an unguarded read-modify-write would interleave.
+        await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(bot, "_systemctl", _systemctl)
+
+    await asyncio.gather(
+        bot.add_days_to_user("701", 3, MagicMock()),
+        bot.add_days_to_user("702", 3, MagicMock()),
+    )
+
+    conn = sqlite3.connect(xui_db_path)
+    clients = json.loads(conn.execute("SELECT settings FROM inbounds WHERE id=1").fetchone()[0])["clients"]
+    conn.close()
+    assert sorted(c["email"] for c in clients) == ["tg_701", "tg_702"]
+
+
+@pytest.mark.asyncio
+async def test_payment_is_not_requeued_when_only_the_confirmation_fails(tmp_path, monkeypatch):
+    xui_db_path = tmp_path / "xui.db"
+    conn = sqlite3.connect(xui_db_path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, settings TEXT)")
+    conn.execute(
+        "CREATE TABLE client_traffics (id INTEGER PRIMARY KEY AUTOINCREMENT, inbound_id INTEGER, enable INTEGER, "
+        "email TEXT, up INTEGER, down INTEGER, expiry_time INTEGER, total INTEGER, reset INTEGER, "
+        "all_time INTEGER, last_online INTEGER)"
+    )
+    conn.execute("INSERT INTO inbounds (id, settings) VALUES (1, ?)", (json.dumps({"clients": []}),))
+    conn.commit()
+    conn.close()
+
+    db_path = tmp_path / "bot_data.db"
+    monkeypatch.setattr(bot, "DB_PATH", str(xui_db_path))
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "INBOUND_ID", 1)
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "ADMIN_ID_INT", 999)
+    bot.init_db()
+
+    payload = "1_month"
+    monkeypatch.setattr(bot, "get_prices", lambda: {payload: {"amount": 100, "days": 30}})
+    monkeypatch.setattr(bot, "get_lang", lambda _tg_id: "en")
+    monkeypatch.setattr(bot, "process_subscription", _PROCESS_SUBSCRIPTION)
+    monkeypatch.setattr(bot.asyncio, "sleep", AsyncMock())
+
+    async def _systemctl(*args):
+        pass
+
+    monkeypatch.setattr(bot, "_systemctl", _systemctl)
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+    update = MagicMock()
+    update.callback_query = None
+    msg_mock = MagicMock()
+    msg_mock.edit_text = AsyncMock()
+    # The celebration message goes out; the confirmation after the grant hits a network error.
+    update.message.reply_text = AsyncMock(side_effect=[msg_mock, RuntimeError("telegram down")])
+    update.message.from_user.id = 801
+    update.message.from_user.username = "buyer"
+    update.message.successful_payment.invoice_payload = payload
+    update.message.successful_payment.total_amount = 100
+    update.message.successful_payment.telegram_payment_charge_id = "charge-801"
+
+    await _successful_payment(update, context)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT status FROM payment_jobs WHERE charge_id='charge-801'").fetchone()[0] == "done"
+    assert conn.execute("SELECT processed_at FROM transactions WHERE telegram_payment_charge_id='charge-801'").fetchone()[0]
+    conn.close()
+    conn = sqlite3.connect(xui_db_path)
+    clients = json.loads(conn.execute("SELECT settings FROM inbounds WHERE id=1").fetchone()[0])["clients"]
+    conn.close()
+    assert [c["email"] for c in clients] == ["tg_801"]
+
+
+@pytest.mark.asyncio
+async def test_check_missed_transactions_leaves_charges_with_a_live_payment_job(tmp_path, monkeypatch):
+    db_path = tmp_path / "bot_data.db"
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "ADMIN_ID_INT", 999)
+    bot.init_db()
+
+    payload = "1_month"
+    monkeypatch.setattr(bot, "get_prices", lambda: {payload: {"amount": 100, "days": 30}})
+    add_days_mock = AsyncMock()
+    monkeypatch.setattr(bot, "add_days_to_user", add_days_mock)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    tx_dt = now - datetime.timedelta(minutes=5)
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "INSERT INTO transactions (tg_id, amount, date, plan_id, telegram_payment_charge_id, processed_at) "
+        "VALUES ('112', 100, ?, ?, 'charge-112', NULL)",
+        (int(tx_dt.timestamp()), payload),
+    )
+    conn.execute(
+        "INSERT INTO payment_jobs (charge_id, tg_id, plan_id, amount, days, status) "
+        "VALUES ('charge-112', '112', ?, 100, 30, 'pending')",
+        (payload,),
+    )
+    conn.commit()
+    conn.close()
+
+    tx = MagicMock()
+    tx.amount = 100
+    tx.date = tx_dt
+    tx.id = "charge-112"
+    tx.source = MagicMock()
+    tx.source.user = MagicMock()
+    tx.source.user.id = 112
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+    context.bot.get_star_transactions = AsyncMock(return_value=MagicMock(transactions=[tx]))
+
+    await bot.check_missed_transactions(context)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT processed_at FROM transactions WHERE telegram_payment_charge_id='charge-112'").fetchone()[0] is None
+    assert conn.execute("SELECT status FROM payment_jobs WHERE charge_id='charge-112'").fetchone()[0] == "pending"
+    conn.close()
+    assert add_days_mock.await_count == 0
+
+
+@pytest.mark.asyncio
+async def test_successful_payment_acknowledges_before_granting(tmp_path, monkeypatch):
+    db_path = tmp_path / "bot_data.db"
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "ADMIN_ID_INT", 999)
+    bot.init_db()
+
+    payload = "1_month"
+    monkeypatch.setattr(bot, "get_prices", lambda: {payload: {"amount": 100, "days": 30}})
+    process_mock = AsyncMock(return_value=bot.GrantResult.GRANTED)
+    monkeypatch.setattr(bot, "process_subscription", process_mock)
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+    update = MagicMock()
+    update.message.reply_text = AsyncMock()
+    update.message.from_user.id = 901
+    update.message.from_user.username = "buyer"
+    update.message.successful_payment.invoice_payload = payload
+    update.message.successful_payment.total_amount = 100
+    update.message.successful_payment.telegram_payment_charge_id = "charge-901"
+
+    await bot.successful_payment(update, context)
+
+    update.message.reply_text.assert_awaited_once()
+    process_mock.assert_not_awaited()
+
+    await asyncio.gather(*bot._PAYMENT_TASKS)
+
+    process_mock.assert_awaited_once()
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT status FROM payment_jobs WHERE charge_id='charge-901'").fetchone()[0] == "done"
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_successful_payment_leaves_job_to_worker_when_claim_fails(tmp_path, monkeypatch):
+    db_path = tmp_path / "bot_data.db"
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "ADMIN_ID_INT", 999)
+    bot.init_db()
+
+    payload = "1_month"
+    monkeypatch.setattr(bot, "get_prices", lambda: {payload: {"amount": 100, "days": 30}})
+    process_mock = AsyncMock(return_value=bot.GrantResult.GRANTED)
+    monkeypatch.setattr(bot, "process_subscription", process_mock)
+
+    def _claim_fails(job_key):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(bot, "_claim_payment_job", _claim_fails)
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+    update = MagicMock()
+    update.message.reply_text = AsyncMock()
+    update.message.from_user.id = 902
+    update.message.from_user.username = "buyer"
+    update.message.successful_payment.invoice_payload = payload
+    update.message.successful_payment.total_amount = 100
+    update.message.successful_payment.telegram_payment_charge_id = "charge-902"
+
+    await _successful_payment(update, context)
+
+    process_mock.assert_not_awaited()
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT status FROM payment_jobs WHERE charge_id='charge-902'").fetchone()[0] == "pending"
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_xui_write_window_entrants_wait_until_xui_is_stopped(monkeypatch):
+    events = []
+
+    async def _systemctl(*args):
+        events.append(f"{args[0]}-begin")
+        await asyncio.sleep(0.02)
+        events.append(f"{args[0]}-end")
+
+    monkeypatch.setattr(bot, "_systemctl", _systemctl)
+
+    async def _writer(name):
+        async with bot._xui_write_window():
+            events.append(name)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(_writer("a"), _writer("b"))
+
+    assert events.index("stop-end") < events.index("a")
+    assert events.index("stop-end") < events.index("b")
+    assert events.count("stop-begin") == 1
+    assert events[-1] == "start-end"
+
+
+def _star_tx(now, idx, age):
+    tx = MagicMock()
+    tx.amount = 100
+    tx.date = now - age
+    tx.id = f"charge-{idx}"
+    tx.source = MagicMock()
+    tx.source.user = MagicMock()
+    tx.source.user.id = 1000 + idx
+    return tx
+
+
+def _prepare_star_tx_test(tmp_path, monkeypatch):
+    db_path = tmp_path / "bot_data.db"
+    _prepare_bot_db(str(db_path))
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE sync_state (key TEXT PRIMARY KEY, value TEXT, updated_at INTEGER)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "ADMIN_ID", "999")
+    monkeypatch.setattr(bot, "ADMIN_ID_INT", 999)
+    monkeypatch.setattr(bot, "get_prices", lambda: {"1_month": {"amount": 100, "days": 30}})
+    add_days_mock = AsyncMock()
+    monkeypatch.setattr(bot, "add_days_to_user", add_days_mock)
+    return add_days_mock
+
+
+@pytest.mark.asyncio
+async def test_check_missed_transactions_rescans_by_date_when_cursor_anchor_moved(tmp_path, monkeypatch):
+    add_days_mock = _prepare_star_tx_test(tmp_path, monkeypatch)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    history = [_star_tx(now, i, datetime.timedelta(days=3)) for i in range(10)]
+    history += [_star_tx(now, i, datetime.timedelta(minutes=5)) for i in range(10, 12)]
+    offsets = []
+
+    async def _get_star_transactions(offset=0, limit=100):
+        offsets.append(offset)
+        return MagicMock(transactions=history[offset:offset + limit])
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+    context.bot.get_star_transactions = _get_star_transactions
+
+    # The stored count points past transactions that are no longer where it expects them
+    anchor_date = int((now - datetime.timedelta(minutes=30)).timestamp())
+    bot._set_sync_state("star_tx_cursor", json.dumps({"offset": 11, "last_id": "charge-gone", "last_date": anchor_date}))
+
+    await bot.check_missed_transactions(context)
+
+    assert offsets == [11 - bot._STAR_TX_CURSOR_OVERLAP, 0]
+    # Only transactions inside the rescan window are replayed, not the three-day-old history
+    assert sorted(call.args[0] for call in add_days_mock.await_args_list) == ["1010", "1011"]
+    saved = json.loads(bot._get_sync_state("star_tx_cursor"))
+    assert (saved["offset"], saved["last_id"]) == (12, "charge-11")
+
+
+@pytest.mark.asyncio
+async def test_check_missed_transactions_handles_newest_first_history(tmp_path, monkeypatch):
+    add_days_mock = _prepare_star_tx_test(tmp_path, monkeypatch)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    history = [_star_tx(now, i, datetime.timedelta(minutes=5 + i)) for i in range(3)]
+    history += [_star_tx(now, i, datetime.timedelta(days=3, minutes=i)) for i in range(3, 250)]
+    offsets = []
+
+    async def _get_star_transactions(offset=0, limit=100):
+        offsets.append(offset)
+        return MagicMock(transactions=history[offset:offset + limit])
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot_data = {}
+    context.bot.get_star_transactions = _get_star_transactions
+
+    await bot.check_missed_transactions(context)
+
+    # Paging stops at the first page that reaches past the bootstrap window
+    assert offsets == [0]
+    assert add_days_mock.await_count == 3
+
+    history.insert(0, _star_tx(now, 900, datetime.timedelta(minutes=2)))
+    offsets.clear()
+    bot._STAR_TX_DONE.clear()
+    await bot.check_missed_transactions(context)
+
+    # New payments shift every offset, so the run rescans from the top and applies only the new one
+    assert offsets == [0]
+    assert add_days_mock.await_count == 4
+    assert add_days_mock.await_args_list[-1].args[0] == "1900"
+    saved = json.loads(bot._get_sync_state("star_tx_cursor"))
+    assert saved["last_id"] == "charge-900"
+    assert all(
+        date >= saved["last_date"] - bot._STAR_TX_RESCAN_MARGIN_SEC for date in bot._STAR_TX_DONE[bot.BOT_DB_PATH].values()
+    )
@@ -1,4 +1,5 @@
 import pytest
+import json
 import sqlite3
 import os
 import sys
@@ -209,3 +210,35 @@ async def test_admin_flash_delete_all_clears_table(tmp_path, monkeypatch):
     count = conn.execute("SELECT COUNT(*) FROM flash_messages").fetchone()[0]
     conn.close()
     assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_cleanup_flash_messages_groups_by_chat_and_records_stats(tmp_path, monkeypatch):
+    db_path = tmp_path / "bot_data.db"
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(db_path))
+    monkeypatch.setattr(bot, "_TELEGRAM_BULK_BUCKETS", {})
+    bot.init_db()
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO flash_messages (chat_id, message_id, delete_at) VALUES (?, ?, 0)",
+        [("1", 10), ("1", 11), ("1", 12), ("2", 20), ("3", 30)],
+    )
+    conn.commit()
+    conn.close()
+
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot.delete_messages = AsyncMock(return_value=True)
+    context.bot.delete_message = AsyncMock(side_effect=[True, bot.TimedOut("timeout")])
+
+    await bot.cleanup_flash_messages(context)
+
+    context.bot.delete_messages.assert_awaited_once_with(chat_id="1", message_ids=[10, 11, 12])
+    assert context.bot.delete_message.await_count == 2
+    conn = sqlite3.connect(db_path)
+    left = conn.execute("SELECT COUNT(*) FROM flash_messages").fetchone()[0]
+    conn.close()
+    assert left == 1
+    stats = json.loads(bot._get_sync_state("flash_cleanup_stats"))
+    assert (stats["total"], stats["deleted"], stats["kept"]) == (5, 4, 1)
+    assert stats["errors"] == {"TimedOut": 1}
@@ -112,6 +112,8 @@ class TestReferralSystem(unittest.TestCase):
         # Run successful_payment
         # We need to await it
         await bot.successful_payment(update, context)
+        # The grant and the referral booking run in a task started by the handler
+        await asyncio.gather(*bot._PAYMENT_TASKS)
 
         # Verify:
         # 1. Transaction recorded
@@ -0,0 +1,608 @@
+import asyncio
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+
+import pytest
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+@pytest.mark.asyncio
+async def test_fanout_nodes_runs_concurrently_with_bound() -> None:
+    running = 0
+    peak = 0
+
+    async def worker(item: int) -> int:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return item * 2
+
+    start = time.monotonic()
+    results = await bot._fanout_nodes(list(range(6)), worker, concurrency=3, timeout=5)
+    elapsed = time.monotonic() - start
+
+    assert peak == 3
+    assert elapsed < 0.25
+    assert [r["value"] for r in results] == [0, 2, 4, 6, 8, 10]
+    assert all(r["ok"] for r in results)
+
+
+@pytest.mark.asyncio
+async def test_fanout_nodes_dead_node_does_not_stall_others() -> None:
+    seen: list[int] = []
+
+    async def worker(item: int) -> str:
+        if item == 0:
+            await asyncio.sleep(10)
+        return f"node-{item}"
+
+    async def on_result(result: bot.FanoutResult) -> None:
+        seen.append(result["index"])
+
+    results = await bot._fanout_nodes([0, 1, 2], worker, concurrency=3, timeout=0.1, on_result=on_result)
+
+    assert seen[-1] == 0
+    assert results[0]["ok"] is False
+    assert results[0]["error"] == "timeout"
+    assert [r["value"] for r in results[1:]] == ["node-1", "node-2"]
+
+
+@pytest.mark.asyncio
+async def test_fanout_timeout_closes_ssh_client_of_hung_call() -> None:
+    released = threading.Event()
+
+    class _HungClient:
+        def close(self) -> None:
+            released.set()
+
+    def _blocking_call() -> str:
+        bot._track_ssh_client(_HungClient())
+        # Stands in for a read on a dead channel: it returns only once the client is closed.
+        released.wait(5)
+        return "late"
+
+    async def worker(item: int) -> str:
+        return await bot._run_remote_blocking(_blocking_call)
+
+    results = await bot._fanout_nodes([0], worker, timeout=0.1)
+
+    assert results[0]["error"] == "timeout"
+    assert released.is_set()
+
+
+@pytest.mark.asyncio
+async def test_fanout_timeout_evicts_pooled_client_without_closing_it() -> None:
+    released = threading.Event()
+    key = ("10.0.0.9", 22, "root")
+
+    class _SharedClient:
+        closed = False
+
+        def close(self) -> None:
+            self.closed = True
+
+    shared = _SharedClient()
+    bot._SSH_POOL[key] = shared
+
+    def _blocking_call() -> str:
+        bot._track_ssh_client(shared, key)
+        released.wait(0.5)
+        return "late"
+
+    async def worker(item: int) -> str:
+        return await bot._run_remote_blocking(_blocking_call)
+
+    try:
+        results = await bot._fanout_nodes([0], worker, timeout=0.1)
+    finally:
+        released.set()
+
+    assert results[0]["error"] == "timeout"
+    assert key not in bot._SSH_POOL
+    assert shared.closed is False
+
+
+@pytest.mark.asyncio
+async def test_fanout_nodes_captures_worker_errors() -> None:
+    async def worker(item: int) -> int:
+        if item == 1:
+            raise RuntimeError("ssh refused")
+        return item
+
+    results = await bot._fanout_nodes([0, 1], worker)
+
+    assert results[0]["ok"] is True
+    assert results[1]["ok"] is False
+    assert results[1]["error"] == "ssh refused"
+
+
+def _run_agent(tmp_path, requests: list[dict]) -> list[dict]:
+    agent_path = tmp_path / "agent.py"
+    agent_path.write_text(bot._REMOTE_AGENT_SOURCE, encoding="utf-8")
+    env = dict(os.environ, XUI_DB_PATH=str(tmp_path / "x-ui.db"))
+    payload = "".join(json.dumps(req) + "\n" for req in requests)
+    proc = subprocess.run(
+        [sys.executable, "-u", str(agent_path)],
+        input=payload,
+        capture_output=True,
+        text=True,
+        env=env,
+        timeout=30,
+    )
+    return [json.loads(line) for line in proc.stdout.splitlines() if line.strip()]
+
+
+def _prepare_remote_xui_db(path) -> None:
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, port INTEGER, protocol TEXT, settings TEXT, stream_settings TEXT)")
+    conn.execute(
+        "CREATE TABLE client_traffics (id INTEGER PRIMARY KEY AUTOINCREMENT, inbound_id INTEGER, enable INTEGER, email TEXT, "
+        "up INTEGER, down INTEGER, expiry_time INTEGER, total INTEGER, reset INTEGER, all_time INTEGER, last_online INTEGER)"
+    )
+    settings = {"clients": [{"id": "old-uuid", "email": "m_1", "tgId": 1, "expiryTime": 1, "enable": False}]}
+    conn.execute("INSERT INTO inbounds VALUES (7, 443, 'vless', ?, '{}')", (json.dumps(settings),))
+    conn.execute("INSERT INTO client_traffics (inbound_id, enable, email, up, down, expiry_time, total, reset, all_time, last_online) VALUES (7, 0, 'm_1', 10, 20, 1, 0, 0, 0, 5)")
+    conn.commit()
+    conn.close()
+
+
+def test_remote_agent_answers_batched_json_rpc(tmp_path) -> None:
+    _prepare_remote_xui_db(tmp_path / "x-ui.db")
+    clients = [
+        {"tg_id": "1", "email": "m_1", "uuid": "u1", "sub_id": "s1", "expiry_ms": 1000, "comment": "a"},
+        {"tg_id": "2", "email": "m_2", "uuid": "u2", "sub_id": "s2", "expiry_ms": 2000, "comment": "b"},
+    ]
+    replies = _run_agent(
+        tmp_path,
+        [
+            {"id": 1, "method": "ping"},
+            {"id": 2, "method": "upsert_clients", "params": {"inbound_id": 7, "clients": clients, "restart": False}},
+            {"id": 3, "method": "get_all_client_traffics", "params": {"inbound_id": 7}},
+            {"id": 4, "method": "get_client_traffic", "params": {"email": "m_1"}},
+            {"id": 5, "method": "nope"},
+        ],
+    )
+
+    by_id = {reply["id"]: reply for reply in replies}
+    assert by_id[1]["result"]["ok"] is True
+    assert by_id[2]["result"] == {"ok": True, "inbound_id": 7, "added": 1, "updated": 1}
+    traffic = {row["email"]: row for row in by_id[3]["result"]}
+    assert traffic["m_1"]["expiry_time"] == 1000
+    assert traffic["m_1"]["up"] == 10
+    assert traffic["m_2"]["expiry_time"] == 2000
+    assert by_id[4]["result"]["down"] == 20
+    assert "error" in by_id[5]
+
+
+@pytest.mark.asyncio
+async def test_remote_upsert_queue_coalesces_close_updates() -> None:
+    flushed: list[list[dict]] = []
+
+    async def flush(records: list[dict]) -> bool:
+        flushed.append(records)
+        return True
+
+    queue = bot._RemoteUpsertQueue(flush, delay_sec=0.05, max_batch=100)
+    first = bot._remote_client_record("1", "m_1", "u1", "s1", 1000, "old")
+    second = bot._remote_client_record("2", "m_2", "u2", "s2", 2000)
+    latest = bot._remote_client_record("1", "m_1", "u1", "s1", 5000, "new")
+
+    results = await asyncio.gather(queue.submit(first), queue.submit(second), queue.submit(latest))
+
+    assert results == [True, True, True]
+    assert len(flushed) == 1
+    by_email = {record["email"]: record for record in flushed[0]}
+    assert by_email["m_1"]["expiry_ms"] == 5000
+    assert by_email["m_1"]["comment"] == "new"
+    assert by_email["m_2"]["expiry_ms"] == 2000
+
+
+@pytest.mark.asyncio
+async def test_remote_upsert_queue_splits_batches_and_reports_failure() -> None:
+    sizes: list[int] = []
+
+    async def flush(records: list[dict]) -> bool:
+        sizes.append(len(records))
+        return False
+
+    queue = bot._RemoteUpsertQueue(flush, delay_sec=5, max_batch=2)
+    records = [bot._remote_client_record(str(i), f"m_{i}", f"u{i}", f"s{i}", 0) for i in range(3)]
+
+    results = await asyncio.wait_for(asyncio.gather(*(queue.submit(r) for r in records)), timeout=1)
+
+    assert results == [False, False, False]
+    assert sizes == [2, 1]
+
+
+@pytest.mark.asyncio
+async def test_remote_upsert_queue_flushes_first_full_batch_without_delay() -> None:
+    async def flush(records: list[dict]) -> bool:
+        return True
+
+    queue = bot._RemoteUpsertQueue(flush, delay_sec=5, max_batch=1)
+    record = bot._remote_client_record("1", "m_1", "u1", "s1", 0)
+
+    assert await asyncio.wait_for(queue.submit(record), timeout=1) is True
+
+
+@pytest.mark.asyncio
+async def test_refresh_mobile_cache_job_stores_bulk_traffic(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "MOBILE_SSH_HOST", "10.0.0.2")
+    monkeypatch.setattr(bot, "MOBILE_SSH_USER", "root")
+    monkeypatch.setattr(bot, "MOBILE_SSH_PASSWORD", "pw")
+    bot.init_db()
+
+    calls: list[str] = []
+
+    def fake_bulk(host, port, user, password, inbound_id):
+        calls.append(host)
+        return [
+            {"email": "mobile_1", "up": 100, "down": 200, "expiry_time": 5, "enable": 1},
+            {"email": "mobile_2", "up": 1, "down": 2},
+        ]
+
+    monkeypatch.setattr(bot, "_ssh_fetch_remote_client_traffics", fake_bulk)
+    monkeypatch.setattr(bot, "_ssh_fetch_remote_xui_data", lambda *args: {"sub_port": "2096"})
+
+    await bot.refresh_mobile_cache_job(None)
+
+    assert calls == ["10.0.0.2"]
+    cached = bot._get_mobile_traffic_cache("mobile_1")
+    assert cached is not None
+    assert (cached["up"], cached["down"]) == (100, 200)
+    assert abs(cached["fetched_at"] - int(time.time())) <= 2
+    assert bot._get_mobile_traffic_cache("mobile_3") is None
+    assert await bot._get_mobile_xui_data() == {"sub_port": "2096"}
+
+
+@pytest.mark.asyncio
+async def test_mobile_traffic_cache_miss_falls_back_to_ssh(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "MOBILE_TRAFFIC_REFRESH_SEC", 0)
+    monkeypatch.setattr(bot, "MOBILE_CACHE_FALLBACK_TTL_SEC", 60)
+    bot.init_db()
+
+    calls: list[tuple[str, dict]] = []
+
+    def fake_lib_call(host, port, user, password, method, params=None, timeout=120):
+        calls.append((method, params))
+        return True, {"ok": True, "up": 7, "down": 9, "expiry_time": 0, "last_online": 0}
+
+    monkeypatch.setattr(bot, "_remote_lib_call", fake_lib_call)
+
+    first = await bot._get_mobile_client_traffic("mobile_1")
+    second = await bot._get_mobile_client_traffic("mobile_1")
+
+    assert (first["up"], first["down"]) == (7, 9)
+    assert second == first
+    assert calls == [("get_client_traffic", {"email": "mobile_1"})]
+
+    bot._set_sync_state("mobile_xui_data", json.dumps({"sub_port": "1"}))
+    conn = sqlite3.connect(tmp_path / "bot.db")
+    conn.execute("UPDATE sync_state SET updated_at=0 WHERE key='mobile_xui_data'")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot, "_ssh_fetch_remote_xui_data", lambda *args: None)
+    assert await bot._get_mobile_xui_data() is None
+
+
+def test_remote_agent_applies_inbound_delta(tmp_path) -> None:
+    _prepare_remote_xui_db(tmp_path / "x-ui.db")
+    conn = sqlite3.connect(tmp_path / "x-ui.db")
+    settings = {"clients": [{"id": "a", "email": "m_1"}, {"id": "b", "email": "m_2"}], "decryption": "none"}
+    conn.execute("UPDATE inbounds SET settings=? WHERE id=7", (json.dumps(settings),))
+    conn.commit()
+    conn.close()
+
+    params = {
+        "full": False,
+        "port": 443,
+        "protocol": "vless",
+        "upsert": [{"id": "a2", "email": "m_1", "expiryTime": 9, "enable": True}, {"id": "c", "email": "m_3"}],
+        "remove": ["m_2"],
+        "restart": False,
+    }
+    replies = _run_agent(tmp_path, [{"id": 1, "method": "sync_inbound", "params": params}])
+
+    assert replies[0]["result"] == {"ok": True, "id": 7, "touched": 2}
+    conn = sqlite3.connect(tmp_path / "x-ui.db")
+    stored = json.loads(conn.execute("SELECT settings FROM inbounds WHERE id=7").fetchone()[0])
+    expiry = conn.execute("SELECT expiry_time FROM client_traffics WHERE email='m_1'").fetchone()[0]
+    conn.close()
+    assert [c["id"] for c in stored["clients"]] == ["a2", "c"]
+    assert stored["decryption"] == "none"
+    assert expiry == 9
+
+
+def test_replicate_inbound_sends_only_changed_clients(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    bot.init_db()
+    calls: list[dict] = []
+
+    def fake_call(host, port, user, password, method, params=None, timeout=120):
+        calls.append(params)
+        return True, {"ok": True}
+
+    monkeypatch.setattr(bot, "_remote_lib_call", fake_call)
+
+    def payload(clients: list[dict]) -> dict:
+        return {"port": 443, "protocol": "vless", "settings": json.dumps({"clients": clients}), "stream_settings": "{}"}
+
+    base = [{"id": "a", "email": "m_1"}, {"id": "b", "email": "m_2"}]
+    assert bot._replicate_inbound_to_node("10.0.0.3", 22, "root", "pw", payload(base))
+    assert calls[-1]["full"] is True
+
+    assert bot._replicate_inbound_to_node("10.0.0.3", 22, "root", "pw", payload(base))
+    assert len(calls) == 1
+
+    changed = [{"id": "a", "email": "m_1", "enable": False}, {"id": "c", "email": "m_3"}]
+    assert bot._replicate_inbound_to_node("10.0.0.3", 22, "root", "pw", payload(changed))
+    assert calls[-1]["full"] is False
+    assert [c["email"] for c in calls[-1]["upsert"]] == ["m_1", "m_3"]
+    assert calls[-1]["remove"] == ["m_2"]
+
+    monkeypatch.setattr(bot, "REMOTE_FULL_SYNC_INTERVAL_SEC", 0)
+    assert bot._replicate_inbound_to_node("10.0.0.3", 22, "root", "pw", payload(changed))
+    assert calls[-1]["full"] is True
+
+
+def test_sparkline_scales_and_marks_gaps() -> None:
+    assert bot._sparkline([0, 50, 100], 0, 100) == "▁▅█"
+    assert bot._sparkline([None, 3, 3]) == " ▁▁"
+    assert bot._sparkline([]) == ""
+
+
+@pytest.mark.asyncio
+async def test_node_health_probe_job_fills_ring_and_history(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "NODE_HEALTH_BUCKET_SEC", 3600)
+    monkeypatch.setattr(bot, "_NODE_HEALTH", {})
+    monkeypatch.setattr(bot, "_NODE_XUI_CACHE", {})
+    bot.init_db()
+    nodes = [
+        {"id": 1, "name": "a", "host": "10.0.0.1", "port": 22, "ssh_user": "root", "ssh_password": "pw"},
+        {"id": 2, "name": "b", "host": "10.0.0.2", "port": 22, "ssh_user": "root", "ssh_password": "pw"},
+    ]
+    monkeypatch.setattr(bot, "_remote_nodes_with_ssh", lambda: nodes)
+    cpu = {"10.0.0.1": [20.0, 40.0]}
+
+    def fake_status(host, port, user, password):
+        if host == "10.0.0.2":
+            return None
+        return {"cpu": cpu[host].pop(0), "ram_usage": 50.0, "disk_usage": 10.0, "rx_speed": 100, "tx_speed": 200}
+
+    async def fake_latency(host, port):
+        return 12
+
+    monkeypatch.setattr(bot, "_ssh_fetch_remote_server_status", fake_status)
+    monkeypatch.setattr(bot, "_ssh_fetch_remote_xui_data", lambda *args: {"inbound_port": 443})
+    monkeypatch.setattr(bot, "_check_tcp_latency", fake_latency)
+
+    await bot.node_health_probe_job(None)
+    await bot.node_health_probe_job(None)
+
+    latest = bot._node_health_latest(1)
+    assert latest is not None and latest["cpu"] == 40.0 and latest["latency"] == 12
+    assert bot._node_health_latest(2)["online"] is False
+    assert bot._NODE_XUI_CACHE[1][1] == {"inbound_port": 443}
+
+    history = bot._load_node_health_history(1, 10)
+    assert len(history) == 1
+    assert history[0]["cpu"] == 30.0
+    assert bot._load_node_health_history(2, 10) == []
+    assert "CPU 40%" in bot._format_node_health_summary(latest, "en")
+
+
+def _serve_fake_xray_release(root, zip_bytes: bytes, digest: str):
+    (root / "Xray-linux-64.zip").write_bytes(zip_bytes)
+    (root / "Xray-linux-64.zip.dgst").write_text(f"MD5= 00\nSHA2-256= {digest}\n", encoding="utf-8")
+    hits: list[str] = []
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            hits.append(self.path)
+            super().do_GET()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=str(root)))
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    release = {
+        "tag_name": "v25.1.1",
+        "assets": [
+            {"name": "Xray-linux-64.zip", "browser_download_url": f"{base}/Xray-linux-64.zip"},
+            {"name": "Xray-linux-64.zip.dgst", "browser_download_url": f"{base}/Xray-linux-64.zip.dgst"},
+        ],
+    }
+    (root / "release.json").write_text(json.dumps(release), encoding="utf-8")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{base}/release.json", hits
+
+
+def _fake_xray_zip() -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("xray", b"#!/bin/sh\necho 'Xray 25.1.1'\n")
+        zf.writestr("geoip.dat", b"")
+    return buf.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_xray_release_is_verified_and_cached_once(tmp_path, monkeypatch) -> None:
+    zip_bytes = _fake_xray_zip()
+    serve_dir = tmp_path / "serve"
+    serve_dir.mkdir()
+    server, url, hits = _serve_fake_xray_release(serve_dir, zip_bytes, hashlib.sha256(zip_bytes).hexdigest())
+    monkeypatch.setattr(bot, "XRAY_RELEASE_API_URL", url)
+    monkeypatch.setattr(bot, "XRAY_CACHE_DIR", str(tmp_path / "cache"))
+    try:
+        release, error = await bot._fetch_xray_release()
+        assert release is not None, error
+        assert release["version"] == "25.1.1"
+        asset = bot._pick_xray_asset(release, "x86_64")
+        assert asset == "Xray-linux-64.zip"
+
+        paths = await asyncio.gather(*(bot._ensure_cached_xray_binary(release, asset) for _ in range(4)))
+        assert len({path for path, _ in paths}) == 1
+        path = paths[0][0]
+        assert path is not None and os.access(path, os.X_OK)
+        assert hits.count("/Xray-linux-64.zip") == 1
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_xray_release_with_bad_digest_is_rejected(tmp_path, monkeypatch) -> None:
+    serve_dir = tmp_path / "serve"
+    serve_dir.mkdir()
+    server, url, _ = _serve_fake_xray_release(serve_dir, _fake_xray_zip(), "0" * 64)
+    monkeypatch.setattr(bot, "XRAY_RELEASE_API_URL", url)
+    monkeypatch.setattr(bot, "XRAY_CACHE_DIR", str(tmp_path / "cache"))
+    try:
+        release, _ = await bot._fetch_xray_release()
+        assert release is not None
+        path, error = await bot._ensure_cached_xray_binary(release, "Xray-linux-64.zip")
+        assert path is None
+        assert "Контрольная сумма" in error
+        assert not (tmp_path / "cache").exists()
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_xray_rollout_runs_canary_first_then_waves() -> None:
+    nodes = [{"id": i, "name": f"n{i}", "host": f"10.0.0.{i}"} for i in range(5)]
+    started: list[str] = []
+
+    async def update_node(node: dict) -> bot.XrayNodeUpdate:
+        started.append(node["name"])
+        await asyncio.sleep(0.01)
+        return {"ok": True, "detail": "1.0.0 → 2.0.0", "changed": True}
+
+    results, halted = await bot._rollout_xray(nodes, update_node, concurrency=2, canary="10.0.0.3")
+
+    assert halted is False
+    assert started[0] == "n3"
+    assert sorted(started) == [f"n{i}" for i in range(5)]
+    assert all(r is not None and r["changed"] for r in results)
+
+
+@pytest.mark.asyncio
+async def test_xray_rollout_stops_after_failed_canary() -> None:
+    nodes = [{"id": i, "name": f"n{i}", "host": f"10.0.0.{i}"} for i in range(3)]
+    seen: list[int] = []
+
+    async def update_node(node: dict) -> bot.XrayNodeUpdate:
+        return {"ok": False, "detail": "rolled_back", "changed": False}
+
+    async def on_result(idx: int, result: bot.XrayNodeUpdate) -> None:
+        seen.append(idx)
+
+    results, halted = await bot._rollout_xray(nodes, update_node, concurrency=2, canary="", on_result=on_result)
+
+    assert halted is True
+    assert seen == [0]
+    assert results[1] is None and results[2] is None
+
+
+@pytest.mark.asyncio
+async def test_github_release_cache_revalidates_with_etag(monkeypatch) -> None:
+    seen: list[str | None] = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            tag = self.headers.get("If-None-Match")
+            seen.append(tag)
+            if tag == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps({"tag_name": "v2.5.0"}).encode()
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/repos/o/r/releases/latest"
+    monkeypatch.setattr(bot, "_GITHUB_CACHE", {})
+    monkeypatch.setattr(bot, "GITHUB_RELEASE_CACHE_TTL_SEC", 3600)
+    try:
+        first = await asyncio.gather(*(bot._github_api_get(url) for _ in range(3)))
+        assert first == [(200, {"tag_name": "v2.5.0"})] * 3
+        assert seen == [None]
+
+        assert await bot._github_api_get(url, force=True) == (200, {"tag_name": "v2.5.0"})
+        assert seen == [None, '"v1"']
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_xray_release_request_error_is_reported(monkeypatch) -> None:
+    monkeypatch.setattr(bot, "_GITHUB_CACHE", {})
+    monkeypatch.setattr(bot, "XRAY_RELEASE_API_URL", "http://127.0.0.1:1/repos/XTLS/Xray-core/releases/latest")
+    try:
+        release, error = await bot._fetch_xray_release()
+        assert release is None
+        assert error.startswith("Ошибка запроса к GitHub API: ")
+        assert "вернул 0" not in error
+    finally:
+        await bot._close_github_http()
+    assert bot._GITHUB_HTTP is None
+
+
+@pytest.mark.asyncio
+async def test_stale_mobile_traffic_is_served_and_refreshed_in_background(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "BOT_DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(bot, "MOBILE_TRAFFIC_REFRESH_SEC", 0)
+    monkeypatch.setattr(bot, "MOBILE_CACHE_FALLBACK_TTL_SEC", 60)
+    bot.init_db()
+    bot._store_mobile_client_traffic("mobile_1", {"up": 1, "down": 2}, int(time.time()) - 600)
+
+    release = threading.Event()
+    timeouts: list[int] = []
+
+    def fake_lib_call(host, port, user, password, method, params=None, timeout=120):
+        timeouts.append(timeout)
+        release.wait(5)
+        return True, {"ok": True, "up": 7, "down": 9, "expiry_time": 0, "last_online": 0}
+
+    monkeypatch.setattr(bot, "_remote_lib_call", fake_lib_call)
+
+    stale = await bot._get_mobile_client_traffic("mobile_1")
+
+    # The stale entry comes back without waiting on SSH
+    assert (stale["up"], stale["down"]) == (1, 2)
+    task = bot._MOBILE_TRAFFIC_REFRESH_TASKS["mobile_1"]
+    release.set()
+    await task
+
+    fresh = bot._get_mobile_traffic_cache("mobile_1")
+    assert (fresh["up"], fresh["down"]) == (7, 9)
+    assert timeouts == [bot._MOBILE_TRAFFIC_FETCH_TIMEOUT_SEC]
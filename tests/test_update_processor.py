@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from telegram import Update
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+def _message_update(update_id: int, chat_id: int) -> Update:
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "T"},
+                "text": "hi",
+            },
+        },
+        None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_processor_runs_chats_concurrently_but_keeps_chat_order() -> None:
+    processor = bot._ChatOrderedUpdateProcessor(2)
+    finished: list[str] = []
+    running = {"now": 0, "peak": 0}
+
+    async def _handle(name: str, delay: float) -> None:
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        await asyncio.sleep(delay)
+        running["now"] -= 1
+        finished.append(name)
+
+    jobs = [
+        ("a1", 1, 0.05),
+        ("a2", 1, 0.0),
+        ("b1", 2, 0.0),
+        ("c1", 3, 0.02),
+        ("d1", 4, 0.02),
+    ]
+    tasks = [
+        asyncio.create_task(processor.process_update(_message_update(idx, chat_id), _handle(name, delay)))
+        for idx, (name, chat_id, delay) in enumerate(jobs, start=1)
+    ]
+    await asyncio.gather(*tasks)
+
+    assert finished.index("b1") < finished.index("a1")
+    assert finished.index("a1") < finished.index("a2")
+    assert running["peak"] <= 2
+    metrics = processor.metrics()
+    assert metrics["processed"] == 5
+    assert metrics["queued"] == 0 and metrics["running"] == 0
+    assert metrics["max_chat_depth"] == 2
+    assert metrics["wait_max_ms"] >= 10
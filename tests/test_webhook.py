@@ -0,0 +1,66 @@
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+from telegram import Bot
+
+sys.path.append('/usr/local/x-ui/bot')
+
+os.environ['BOT_TOKEN'] = 'test_token'
+os.environ['ADMIN_ID'] = '999'
+
+import bot
+
+
+class _FakeApplication:
+    def __init__(self) -> None:
+        self.bot = Bot("123456:TEST")
+        self.update_queue: asyncio.Queue = asyncio.Queue()
+
+
+_RECORDED_UPDATE = {
+    "update_id": 1001,
+    "callback_query": {
+        "id": "42",
+        "from": {"id": 555, "is_bot": False, "first_name": "Test"},
+        "chat_instance": "1",
+        "data": "shop",
+    },
+}
+
+
+@pytest.mark.asyncio
+async def test_webhook_listener_routes_updates_and_checks_secret() -> None:
+    main_app = _FakeApplication()
+    support_app = _FakeApplication()
+    routes = {"/hook/main": ("main-secret", main_app), "/hook/support": ("support-secret", support_app)}
+    server = await bot._start_webhook_listener(routes, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            ok = await client.post("/hook/main", json=_RECORDED_UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "main-secret"})
+            wrong_secret = await client.post("/hook/support", json=_RECORDED_UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "main-secret"})
+            unknown = await client.post("/hook/other", json=_RECORDED_UPDATE)
+            bad_body = await client.post("/hook/main", content=b"{", headers={"X-Telegram-Bot-Api-Secret-Token": "main-secret"})
+            second = await client.post("/hook/support", json=_RECORDED_UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "support-secret"})
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    assert [ok.status_code, wrong_secret.status_code, unknown.status_code, bad_body.status_code, second.status_code] == [200, 401, 404, 400, 200]
+    update = main_app.update_queue.get_nowait()
+    assert update.update_id == 1001
+    assert update.callback_query.data == "shop"
+    assert main_app.update_queue.empty()
+    assert support_app.update_queue.qsize() == 1
+
+
+def test_webhook_route_uses_base_path_and_token_secret(monkeypatch) -> None:
+    monkeypatch.setattr(bot, "WEBHOOK_URL", "https://example.com/tg/")
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "")
+    path, url, secret = bot._webhook_route("123:abc", "main")
+    assert path == "/tg/main"
+    assert url == "https://example.com/tg/main"
+    assert secret and secret != bot._webhook_route("456:def", "support")[2]